@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from django.db import connection, transaction
+from django.db.models import Max, Min, Sum
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from analytics.models import FillState
+from zerver.models import Message, Recipient, UserActivityInterval
+
+import datetime
+
+# The FillState properties of the rollups.
+MESSAGE_COUNTS = 'message_counts'
+ACTIVITY_DURATIONS = 'activity_durations'
+
+MESSAGE_CHUNK_SIZE = 100000
+
+# Each of these counts the messages with ids in (%(start)s, %(end)s],
+# and returns a count column along with the table's key columns.  The
+# days are UTC days, since Django sets the connection's time zone to UTC.
+REALM_MESSAGE_COUNTS_QUERY = '''
+    SELECT
+        up.realm_id,
+        m.pub_date::date AS day,
+        m.sending_client_id AS client_id,
+        up.is_bot,
+        r.type AS recipient_type,
+        count(*) AS count
+    FROM zerver_message m
+    JOIN zerver_userprofile up ON up.id = m.sender_id
+    JOIN zerver_recipient r ON r.id = m.recipient_id
+    WHERE m.id > %(start)s AND m.id <= %(end)s
+    GROUP BY up.realm_id, day, m.sending_client_id, up.is_bot, r.type
+'''
+
+USER_MESSAGE_COUNTS_QUERY = '''
+    SELECT
+        m.sender_id AS user_profile_id,
+        m.pub_date::date AS day,
+        m.sending_client_id AS client_id,
+        count(*) AS count
+    FROM zerver_message m
+    WHERE m.id > %(start)s AND m.id <= %(end)s
+    GROUP BY m.sender_id, day, m.sending_client_id
+'''
+
+STREAM_MESSAGE_COUNTS_QUERY = '''
+    SELECT
+        r.type_id AS stream_id,
+        m.pub_date::date AS day,
+        count(*) AS count
+    FROM zerver_message m
+    JOIN zerver_recipient r ON r.id = m.recipient_id
+    WHERE m.id > %(start)s AND m.id <= %(end)s AND r.type = ''' + str(Recipient.STREAM) + '''
+    GROUP BY r.type_id, day
+'''
+
+# Adds up the overlap of each user's activity intervals with the day
+# from %(day_start)s to %(day_end)s.
+ACTIVITY_DURATIONS_QUERY = '''
+    INSERT INTO analytics_useractivityduration (user_profile_id, day, seconds)
+    SELECT
+        user_profile_id,
+        %(day)s,
+        sum(extract(epoch from least("end", %(day_end)s) - greatest(start, %(day_start)s)))::integer
+    FROM zerver_useractivityinterval
+    WHERE "end" > %(day_start)s AND start < %(day_end)s
+    GROUP BY user_profile_id
+'''
+
+def add_counts(table, key_columns, counts_query, params):
+    # type: (str, Sequence[str], str, Dict[str, Any]) -> None
+    """Adds the counts returned by counts_query to the rollup table,
+    creating the rows that don't exist yet, in a single statement.
+    (We can't use INSERT ... ON CONFLICT, which needs PostgreSQL 9.5.)"""
+    match = " AND ".join("%s.%s = data.%s" % (table, column, column) for column in key_columns)
+    updated_match = " AND ".join("updated.%s = data.%s" % (column, column) for column in key_columns)
+    query = (
+        "WITH data AS (" + counts_query + "), "
+        "updated AS ("
+        "    UPDATE " + table + " SET count = " + table + ".count + data.count"
+        "    FROM data WHERE " + match +
+        "    RETURNING " + ", ".join("%s.%s" % (table, column) for column in key_columns) +
+        ") "
+        "INSERT INTO " + table + " (" + ", ".join(key_columns) + ", count) "
+        "SELECT " + ", ".join("data.%s" % (column,) for column in key_columns) + ", data.count "
+        "FROM data WHERE NOT EXISTS (SELECT 1 FROM updated WHERE " + updated_match + ")")
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+def lock_fill_state(property):
+    # type: (str) -> FillState
+    """Returns the FillState for property, locked until the end of the
+    current transaction, so two runs can't count the same rows."""
+    FillState.objects.get_or_create(property=property)
+    return FillState.objects.select_for_update().get(property=property)
+
+def fill_message_counts(max_id=None, chunk_size=MESSAGE_CHUNK_SIZE, progress=None):
+    # type: (Optional[int], int, Optional[Callable[[int, int], None]]) -> None
+    """Counts the messages sent since the last run (up to max_id, by
+    default the latest message more than a minute old, in case a
+    transaction that sent a message with a lower id is still running)
+    into the message count rollups,
+    chunk_size message ids at a time.  Each chunk is counted in the same
+    transaction that moves the high-water mark past it, so this can be
+    interrupted at any point (e.g. while backfilling) and resumed by
+    running it again, without counting any message twice.  progress is
+    called with the last id and max_id after each chunk."""
+    if max_id is None:
+        max_id = Message.objects.filter(
+            pub_date__lt=timezone.now() - datetime.timedelta(minutes=1)).aggregate(
+            Max('id'))['id__max'] or 0
+
+    while True:
+        with transaction.atomic():
+            state = lock_fill_state(MESSAGE_COUNTS)
+            if state.last_id >= max_id:
+                return
+            params = dict(start=state.last_id, end=min(state.last_id + chunk_size, max_id))
+            add_counts('analytics_realmmessagecount',
+                       ['realm_id', 'day', 'client_id', 'is_bot', 'recipient_type'],
+                       REALM_MESSAGE_COUNTS_QUERY, params)
+            add_counts('analytics_usermessagecount',
+                       ['user_profile_id', 'day', 'client_id'],
+                       USER_MESSAGE_COUNTS_QUERY, params)
+            add_counts('analytics_streammessagecount',
+                       ['stream_id', 'day'],
+                       STREAM_MESSAGE_COUNTS_QUERY, params)
+            state.last_id = params['end']
+            state.save(update_fields=['last_id'])
+        if progress is not None:
+            progress(state.last_id, max_id)
+
+def fill_activity_durations(until_day=None, progress=None):
+    # type: (Optional[datetime.date], Optional[Callable[[datetime.date], None]]) -> None
+    """Adds up how long each user was online on each day since the last
+    run, up to until_day (by default yesterday; only complete days are
+    counted, since their intervals won't change any more).  Each day is
+    counted in its own transaction, along with moving the high-water
+    mark, so this can be interrupted and resumed like
+    fill_message_counts.  progress is called with each day counted."""
+    if until_day is None:
+        until_day = timezone.now().date() - datetime.timedelta(days=1)
+
+    while True:
+        with transaction.atomic():
+            state = lock_fill_state(ACTIVITY_DURATIONS)
+            if state.last_day is None:
+                first_start = UserActivityInterval.objects.aggregate(Min('start'))['start__min']
+                if first_start is None:
+                    return
+                day = first_start.date()
+            else:
+                day = state.last_day + datetime.timedelta(days=1)
+            if day > until_day:
+                return
+
+            day_start = datetime.datetime.combine(day, datetime.time()).replace(tzinfo=timezone.utc)
+            with connection.cursor() as cursor:
+                cursor.execute(ACTIVITY_DURATIONS_QUERY,
+                               dict(day=day, day_start=day_start,
+                                    day_end=day_start + datetime.timedelta(days=1)))
+            state.last_day = day
+            state.save(update_fields=['last_day'])
+        if progress is not None:
+            progress(day)
+
+def days_ago(days):
+    # type: (int) -> datetime.date
+    """The (UTC) date the given number of days ago.  Filter rollups with
+    day__gt=days_ago(n) for roughly the last n days, including today."""
+    return timezone.now().date() - datetime.timedelta(days=days)
+
+def sum_counts(counts):
+    # type: (QuerySet) -> int
+    return counts.aggregate(total=Sum('count'))['total'] or 0
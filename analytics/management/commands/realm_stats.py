@@ -9,7 +9,9 @@ import datetime
 import pytz
 
 from django.core.management.base import BaseCommand
-from django.db.models import Count
+from django.db.models import Count, QuerySet
+from analytics.lib.counts import days_ago, sum_counts
+from analytics.models import RealmMessageCount, UserMessageCount
 from zerver.models import UserProfile, Realm, Stream, Message, Recipient, UserActivity, \
     Subscription, UserMessage, get_realm
 
@@ -19,7 +21,9 @@ HUMAN_CLIENT_LIST = MOBILE_CLIENT_LIST + ["website"]
 human_messages = Message.objects.filter(sending_client__name__in=HUMAN_CLIENT_LIST)
 
 class Command(BaseCommand):
-    help = "Generate statistics on realm activity."
+    help = """Generate statistics on realm activity.
+
+Message counts come from the rollups that update_analytics_counts fills."""
 
     def add_arguments(self, parser):
         # type: (ArgumentParser) -> None
@@ -37,42 +41,42 @@ class Command(BaseCommand):
                                                 query="/json/users/me/pointer",
                                                 client__name="website")]
 
-    def messages_sent_by(self, user, days_ago):
+    def messages_sent_by(self, user, days):
         # type: (UserProfile, int) -> int
-        sent_time_cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=days_ago)
-        return human_messages.filter(sender=user, pub_date__gt=sent_time_cutoff).count()
+        return sum_counts(UserMessageCount.objects.filter(
+            user_profile=user, client__name__in=HUMAN_CLIENT_LIST, day__gt=days_ago(days)))
+
+    def message_counts(self, realm, days):
+        # type: (Realm, int) -> QuerySet
+        return RealmMessageCount.objects.filter(realm=realm, day__gt=days_ago(days))
 
-    def total_messages(self, realm, days_ago):
+    def total_messages(self, realm, days):
         # type: (Realm, int) -> int
-        sent_time_cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=days_ago)
-        return Message.objects.filter(sender__realm=realm, pub_date__gt=sent_time_cutoff).count()
+        return sum_counts(self.message_counts(realm, days))
 
-    def human_messages(self, realm, days_ago):
+    def human_messages(self, realm, days):
         # type: (Realm, int) -> int
-        sent_time_cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=days_ago)
-        return human_messages.filter(sender__realm=realm, pub_date__gt=sent_time_cutoff).count()
+        return sum_counts(self.message_counts(realm, days).filter(
+            client__name__in=HUMAN_CLIENT_LIST))
 
-    def api_messages(self, realm, days_ago):
+    def api_messages(self, realm, days):
         # type: (Realm, int) -> int
-        return (self.total_messages(realm, days_ago) - self.human_messages(realm, days_ago))
+        return (self.total_messages(realm, days) - self.human_messages(realm, days))
 
-    def stream_messages(self, realm, days_ago):
+    def stream_messages(self, realm, days):
         # type: (Realm, int) -> int
-        sent_time_cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=days_ago)
-        return human_messages.filter(sender__realm=realm, pub_date__gt=sent_time_cutoff,
-                                     recipient__type=Recipient.STREAM).count()
+        return sum_counts(self.message_counts(realm, days).filter(
+            client__name__in=HUMAN_CLIENT_LIST, recipient_type=Recipient.STREAM))
 
-    def private_messages(self, realm, days_ago):
+    def private_messages(self, realm, days):
         # type: (Realm, int) -> int
-        sent_time_cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=days_ago)
-        return human_messages.filter(sender__realm=realm, pub_date__gt=sent_time_cutoff).exclude(
-            recipient__type=Recipient.STREAM).exclude(recipient__type=Recipient.HUDDLE).count()
+        return sum_counts(self.message_counts(realm, days).filter(
+            client__name__in=HUMAN_CLIENT_LIST, recipient_type=Recipient.PERSONAL))
 
-    def group_private_messages(self, realm, days_ago):
+    def group_private_messages(self, realm, days):
         # type: (Realm, int) -> int
-        sent_time_cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=days_ago)
-        return human_messages.filter(sender__realm=realm, pub_date__gt=sent_time_cutoff).exclude(
-            recipient__type=Recipient.STREAM).exclude(recipient__type=Recipient.PERSONAL).count()
+        return sum_counts(self.message_counts(realm, days).filter(
+            client__name__in=HUMAN_CLIENT_LIST, recipient_type=Recipient.HUDDLE))
 
     def report_percentage(self, numerator, denominator, text):
         # type: (float, float, str) -> None
@@ -109,17 +113,17 @@ class Command(BaseCommand):
                        'zerver_subscription.active = true']).annotate(count=Count("name"))
             print("%d streams" % (streams.count(),))
 
-            for days_ago in (1, 7, 30):
-                print("In last %d days, users sent:" % (days_ago,))
-                sender_quantities = [self.messages_sent_by(user, days_ago) for user in user_profiles]
+            for days in (1, 7, 30):
+                print("In last %d days, users sent:" % (days,))
+                sender_quantities = [self.messages_sent_by(user, days) for user in user_profiles]
                 for quantity in sorted(sender_quantities, reverse=True):
                     print(quantity, end=' ')
                 print("")
 
-                print("%d stream messages" % (self.stream_messages(realm, days_ago),))
-                print("%d one-on-one private messages" % (self.private_messages(realm, days_ago),))
-                print("%d messages sent via the API" % (self.api_messages(realm, days_ago),))
-                print("%d group private messages" % (self.group_private_messages(realm, days_ago),))
+                print("%d stream messages" % (self.stream_messages(realm, days),))
+                print("%d one-on-one private messages" % (self.private_messages(realm, days),))
+                print("%d messages sent via the API" % (self.api_messages(realm, days),))
+                print("%d group private messages" % (self.group_private_messages(realm, days),))
 
             num_notifications_enabled = len([x for x in active_users if x.enable_desktop_notifications == True])
             self.report_percentage(num_notifications_enabled, num_active,
@@ -129,7 +133,8 @@ class Command(BaseCommand):
             self.report_percentage(num_enter_sends, num_active,
                                    "active users have enter-sends")
 
-            all_message_count = human_messages.filter(sender__realm=realm).count()
+            all_message_count = sum_counts(RealmMessageCount.objects.filter(
+                realm=realm, client__name__in=HUMAN_CLIENT_LIST))
             multi_paragraph_message_count = human_messages.filter(
                 sender__realm=realm, content__contains="\n\n").count()
             self.report_percentage(multi_paragraph_message_count, all_message_count,
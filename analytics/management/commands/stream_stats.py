@@ -6,7 +6,9 @@ from typing import Any
 from argparse import ArgumentParser
 from django.core.management.base import BaseCommand
 from django.db.models import Q
-from zerver.models import Realm, Stream, Message, Subscription, Recipient, get_realm
+from analytics.lib.counts import sum_counts
+from analytics.models import StreamMessageCount
+from zerver.models import Realm, Stream, Subscription, Recipient, get_realm
 
 class Command(BaseCommand):
     help = "Generate statistics on the streams for a realm."
@@ -40,7 +42,7 @@ class Command(BaseCommand):
                 print("%25s" % (stream.name,), end=' ')
                 recipient = Recipient.objects.filter(type=Recipient.STREAM, type_id=stream.id)
                 print("%10d" % (len(Subscription.objects.filter(recipient=recipient, active=True)),), end=' ')
-                num_messages = len(Message.objects.filter(recipient=recipient))
+                num_messages = sum_counts(StreamMessageCount.objects.filter(stream=stream))
                 print("%12d" % (num_messages,))
             print("%d invite-only streams" % (invite_only_count,))
             print("")
@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from analytics.lib.counts import MESSAGE_CHUNK_SIZE, fill_message_counts, \
+    fill_activity_durations
+
+import datetime
+
+class Command(BaseCommand):
+    help = """Update the rollup tables the analytics pages and *_stats commands read.
+
+Counts the messages sent and the time users were online since the last
+run.  The first run backfills the rollups from all the existing
+messages and activity intervals, which can take a long time; it can be
+interrupted at any point and will pick up where it left off the next
+time it is run.
+
+Usage: python manage.py update_analytics_counts [--verbose]"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                            default=MESSAGE_CHUNK_SIZE,
+                            help='Number of message ids to count at a time.')
+        parser.add_argument('--verbose', dest='verbose', action='store_true', default=False,
+                            help='Print progress after each chunk and day.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        def message_progress(last_id, max_id):
+            # type: (int, int) -> None
+            if options['verbose']:
+                print("%s counted messages through id %d of %d" % (
+                    datetime.datetime.now(), last_id, max_id))
+
+        def duration_progress(day):
+            # type: (datetime.date) -> None
+            if options['verbose']:
+                print("%s counted activity durations for %s" % (datetime.datetime.now(), day))
+
+        fill_message_counts(chunk_size=options['chunk_size'], progress=message_progress)
+        fill_activity_durations(progress=duration_progress)
@@ -2,12 +2,12 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from argparse import ArgumentParser
-import datetime
-import pytz
 from typing import Any
 
 from django.core.management.base import BaseCommand
-from zerver.models import UserProfile, Realm, Stream, Message, get_realm
+from analytics.lib.counts import days_ago, sum_counts
+from analytics.models import UserMessageCount
+from zerver.models import UserProfile, Realm, Stream, get_realm
 from six.moves import range
 
 class Command(BaseCommand):
@@ -20,9 +20,8 @@ class Command(BaseCommand):
 
     def messages_sent_by(self, user, week):
         # type: (UserProfile, int) -> int
-        start = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=(week + 1)*7)
-        end = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=week*7)
-        return Message.objects.filter(sender=user, pub_date__gt=start, pub_date__lte=end).count()
+        return sum_counts(UserMessageCount.objects.filter(
+            user_profile=user, day__gt=days_ago((week + 1)*7), day__lte=days_ago(week*7)))
 
     def handle(self, *args, **options):
         # type: (*Any, **Any) -> None
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0025_realm_message_content_edit_limit'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FillState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('property', models.CharField(unique=True, max_length=40)),
+                ('last_id', models.IntegerField(default=0)),
+                ('last_day', models.DateField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RealmMessageCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('is_bot', models.BooleanField()),
+                ('recipient_type', models.PositiveSmallIntegerField()),
+                ('count', models.IntegerField()),
+                ('client', models.ForeignKey(to='zerver.Client')),
+                ('realm', models.ForeignKey(to='zerver.Realm')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StreamMessageCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('count', models.IntegerField()),
+                ('stream', models.ForeignKey(to='zerver.Stream')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserActivityDuration',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField(db_index=True)),
+                ('seconds', models.IntegerField()),
+                ('user_profile', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserMessageCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('count', models.IntegerField()),
+                ('client', models.ForeignKey(to='zerver.Client')),
+                ('user_profile', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='usermessagecount',
+            unique_together=set([('user_profile', 'day', 'client')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='useractivityduration',
+            unique_together=set([('user_profile', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='streammessagecount',
+            unique_together=set([('stream', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='realmmessagecount',
+            unique_together=set([('realm', 'day', 'client', 'is_bot', 'recipient_type')]),
+        ),
+    ]
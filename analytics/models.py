@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+
+from django.db import models
+
+from zerver.models import Realm, UserProfile, Stream, Client
+
+import datetime
+
+# These tables roll up zerver_message and zerver_useractivityinterval
+# so the activity pages and the *_stats management commands don't
+# need to scan them.  They are filled by the update_analytics_counts
+# management command; see analytics/lib/counts.py.
+
+class FillState(models.Model):
+    # Which rollup this is the state of; see analytics/lib/counts.py.
+    property = models.CharField(max_length=40, unique=True) # type: str
+    # For message counts, the id of the last message counted.
+    last_id = models.IntegerField(default=0) # type: int
+    # For activity durations, the last (complete) day counted.
+    last_day = models.DateField(null=True) # type: datetime.date
+
+class RealmMessageCount(models.Model):
+    realm = models.ForeignKey(Realm) # type: Realm
+    day = models.DateField() # type: datetime.date
+    client = models.ForeignKey(Client) # type: Client
+    # Whether the messages' senders are bots, and the type (see
+    # Recipient) of their recipients.
+    is_bot = models.BooleanField() # type: bool
+    recipient_type = models.PositiveSmallIntegerField() # type: int
+    count = models.IntegerField() # type: int
+
+    class Meta(object):
+        unique_together = ("realm", "day", "client", "is_bot", "recipient_type")
+
+class UserMessageCount(models.Model):
+    user_profile = models.ForeignKey(UserProfile) # type: UserProfile
+    day = models.DateField() # type: datetime.date
+    client = models.ForeignKey(Client) # type: Client
+    count = models.IntegerField() # type: int
+
+    class Meta(object):
+        unique_together = ("user_profile", "day", "client")
+
+class StreamMessageCount(models.Model):
+    stream = models.ForeignKey(Stream) # type: Stream
+    day = models.DateField() # type: datetime.date
+    count = models.IntegerField() # type: int
+
+    class Meta(object):
+        unique_together = ("stream", "day")
+
+class UserActivityDuration(models.Model):
+    user_profile = models.ForeignKey(UserProfile) # type: UserProfile
+    day = models.DateField(db_index=True) # type: datetime.date
+    # How long the user was online that day, from UserActivityInterval.
+    seconds = models.IntegerField() # type: int
+
+    class Meta(object):
+        unique_together = ("user_profile", "day")
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from django.utils import timezone
+
+from analytics.lib.counts import MESSAGE_COUNTS, ACTIVITY_DURATIONS, \
+    fill_message_counts, fill_activity_durations
+from analytics.models import FillState, RealmMessageCount, UserMessageCount, \
+    StreamMessageCount, UserActivityDuration
+from zerver.lib.test_helpers import AuthedTestCase
+from zerver.models import Message, Recipient, UserActivityInterval, get_client, \
+    get_stream, get_user_profile_by_email
+
+import datetime
+
+class AnalyticsCountsTest(AuthedTestCase):
+    def test_fill_message_counts(self):
+        # type: () -> None
+        FillState.objects.create(property=MESSAGE_COUNTS, last_id=Message.objects.latest('id').id)
+        self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM)
+        self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM)
+        self.send_message("hamlet@zulip.com", "othello@zulip.com", Recipient.PERSONAL)
+
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        today = timezone.now().date()
+        denmark = get_stream('Denmark', hamlet.realm)
+
+        def check_counts(stream_count):
+            # type: (int) -> None
+            self.assertEqual(RealmMessageCount.objects.get(
+                realm=hamlet.realm, day=today, client=get_client('test suite'),
+                is_bot=False, recipient_type=Recipient.STREAM).count, stream_count)
+            self.assertEqual(RealmMessageCount.objects.get(
+                realm=hamlet.realm, day=today, client=get_client('test suite'),
+                is_bot=False, recipient_type=Recipient.PERSONAL).count, 1)
+            self.assertEqual(UserMessageCount.objects.get(
+                user_profile=hamlet, day=today, client=get_client('test suite')).count,
+                stream_count + 1)
+            self.assertEqual(StreamMessageCount.objects.get(stream=denmark, day=today).count,
+                             stream_count)
+
+        # Count the messages a couple of ids at a time, like a backfill.
+        max_id = Message.objects.latest('id').id
+        fill_message_counts(max_id=max_id, chunk_size=2)
+        check_counts(2)
+        self.assertEqual(FillState.objects.get(property=MESSAGE_COUNTS).last_id, max_id)
+
+        # Running it again doesn't count anything twice.
+        fill_message_counts(max_id=max_id)
+        check_counts(2)
+
+        # A new message is added to the existing rows.
+        self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM)
+        fill_message_counts(max_id=Message.objects.latest('id').id)
+        check_counts(3)
+
+    def test_fill_activity_durations(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        day = datetime.date(2000, 1, 1)
+        midnight = datetime.datetime(2000, 1, 2, tzinfo=timezone.utc)
+        UserActivityInterval.objects.create(user_profile=hamlet,
+                                            start=midnight - datetime.timedelta(hours=14),
+                                            end=midnight - datetime.timedelta(hours=13, minutes=30))
+        UserActivityInterval.objects.create(user_profile=hamlet,
+                                            start=midnight - datetime.timedelta(hours=1),
+                                            end=midnight + datetime.timedelta(hours=1))
+        FillState.objects.create(property=ACTIVITY_DURATIONS, last_day=day - datetime.timedelta(days=1))
+
+        fill_activity_durations(until_day=day + datetime.timedelta(days=1))
+
+        self.assertEqual(UserActivityDuration.objects.get(user_profile=hamlet, day=day).seconds,
+                         90 * 60)
+        self.assertEqual(UserActivityDuration.objects.get(
+            user_profile=hamlet, day=day + datetime.timedelta(days=1)).seconds, 60 * 60)
+        self.assertEqual(FillState.objects.get(property=ACTIVITY_DURATIONS).last_day,
+                         day + datetime.timedelta(days=1))
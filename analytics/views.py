@@ -11,13 +11,12 @@ from django.http import HttpResponseNotFound, HttpRequest, HttpResponse
 from jinja2 import Markup as mark_safe
 
 from zerver.decorator import has_request_variables, REQ, zulip_internal
-from zerver.models import get_realm, UserActivity, UserActivityInterval, Realm
-from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import get_realm, UserActivity, Realm
+from analytics.lib.counts import ACTIVITY_DURATIONS
 
 from collections import defaultdict
 from datetime import datetime, timedelta
 import itertools
-import time
 import re
 import pytz
 from six.moves import filter
@@ -61,16 +60,15 @@ def get_realm_day_counts():
     query = '''
         select
             r.domain,
-            (now()::date - pub_date::date) age,
-            count(*) cnt
-        from zerver_message m
-        join zerver_userprofile up on up.id = m.sender_id
-        join zerver_realm r on r.id = up.realm_id
-        join zerver_client c on c.id = m.sending_client_id
+            (now()::date - mc.day) age,
+            sum(mc.count) cnt
+        from analytics_realmmessagecount mc
+        join zerver_realm r on r.id = mc.realm_id
+        join zerver_client c on c.id = mc.client_id
         where
-            (not up.is_bot)
+            (not mc.is_bot)
         and
-            pub_date > now()::date - interval '8 day'
+            mc.day > now()::date - 8
         and
             c.name not in ('zephyr_mirror', 'ZulipMonitoring')
         group by
@@ -279,46 +277,47 @@ def realm_summary_table(realm_minutes):
 
 def user_activity_intervals():
     # type: () -> Tuple[mark_safe, Dict[str, float]]
-    day_end = timestamp_to_datetime(time.time())
-    day_start = day_end - timedelta(hours=24)
+    # Online durations are rolled up a (UTC) day at a time by the
+    # update_analytics_counts command; show the last day it counted.
+    query = '''
+        select
+            fs.last_day as day,
+            r.domain,
+            up.email,
+            d.seconds
+        from analytics_fillstate fs
+        join analytics_useractivityduration d on d.day = fs.last_day
+        join zerver_userprofile up on up.id = d.user_profile_id
+        join zerver_realm r on r.id = up.realm_id
+        where
+            fs.property = %s
+        order by
+            r.domain,
+            up.email
+    '''
+    cursor = connection.cursor()
+    cursor.execute(query, [ACTIVITY_DURATIONS])
+    rows = dictfetchall(cursor)
+    cursor.close()
 
-    output = "Per-user online duration for the last 24 hours:\n"
+    if rows:
+        output = "Per-user online duration for %s (UTC):\n" % (rows[0]['day'],)
+    else:
+        output = "No online durations have been counted yet.\n"
     total_duration = timedelta(0)
 
-    all_intervals = UserActivityInterval.objects.filter(
-        end__gte=day_start,
-        start__lte=day_end
-    ).select_related(
-        'user_profile',
-        'user_profile__realm'
-    ).only(
-        'start',
-        'end',
-        'user_profile__email',
-        'user_profile__realm__domain'
-    ).order_by(
-        'user_profile__realm__domain',
-        'user_profile__email'
-    )
-
-    by_domain = lambda row: row.user_profile.realm.domain
-    by_email = lambda row: row.user_profile.email
+    by_domain = lambda row: row['domain']
 
     realm_minutes = {}
 
-    for domain, realm_intervals in itertools.groupby(all_intervals, by_domain):
+    for domain, realm_rows in itertools.groupby(rows, by_domain):
         realm_duration = timedelta(0)
         output += '<hr>%s\n' % (domain,)
-        for email, intervals in itertools.groupby(realm_intervals, by_email):
-            duration = timedelta(0)
-            for interval in intervals:
-                start = max(day_start, interval.start)
-                end = min(day_end, interval.end)
-                duration += end - start
-
+        for row in realm_rows:
+            duration = timedelta(seconds=row['seconds'])
             total_duration += duration
             realm_duration += duration
-            output += "  %-*s%s\n" % (37, email, duration)
+            output += "  %-*s%s\n" % (37, row['email'], duration)
 
         realm_minutes[domain] = realm_duration.total_seconds() / 60
 
@@ -352,42 +351,36 @@ def sent_messages_report(realm):
         ) as series
         left join (
             select
-                pub_date::date pub_date,
-                count(*) cnt
-            from zerver_message m
-            join zerver_userprofile up on up.id = m.sender_id
-            join zerver_realm r on r.id = up.realm_id
+                mc.day,
+                sum(mc.count) cnt
+            from analytics_realmmessagecount mc
+            join zerver_realm r on r.id = mc.realm_id
             where
                 r.domain = %s
             and
-                (not up.is_bot)
+                (not mc.is_bot)
             and
-                pub_date > now() - interval '2 week'
+                mc.day >= now()::date - 14
             group by
-                pub_date::date
-            order by
-                pub_date::date
+                mc.day
         ) humans on
-            series.day = humans.pub_date
+            series.day = humans.day
         left join (
             select
-                pub_date::date pub_date,
-                count(*) cnt
-            from zerver_message m
-            join zerver_userprofile up on up.id = m.sender_id
-            join zerver_realm r on r.id = up.realm_id
+                mc.day,
+                sum(mc.count) cnt
+            from analytics_realmmessagecount mc
+            join zerver_realm r on r.id = mc.realm_id
             where
                 r.domain = %s
             and
-                up.is_bot
+                mc.is_bot
             and
-                pub_date > now() - interval '2 week'
+                mc.day >= now()::date - 14
             group by
-                pub_date::date
-            order by
-                pub_date::date
+                mc.day
         ) bots on
-            series.day = bots.pub_date
+            series.day = bots.day
     '''
     cursor = connection.cursor()
     cursor.execute(query, [realm, realm])
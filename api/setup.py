@@ -49,11 +49,15 @@ package_info = dict(
 )
 
 setuptools_info = dict(
-    install_requires=['requests>=0.12.1',
+    install_requires=['requests>=1.0.0',
                       'simplejson',
                       'six',
                       'typing',
     ],
+    extras_require={
+        # For zulip.asyncio_client (Python 3.5+ only).
+        'async': ['aiohttp'],
+    },
 )
 
 try:
@@ -70,9 +74,9 @@ except ImportError:
         sys.exit(1)
     try:
         import requests
-        assert(LooseVersion(requests.__version__) >= LooseVersion('0.12.1')) # type: ignore # https://github.com/JukkaL/mypy/issues/1165
+        assert(LooseVersion(requests.__version__) >= LooseVersion('1.0.0')) # type: ignore # https://github.com/JukkaL/mypy/issues/1165
     except (ImportError, AssertionError):
-        print("requests >=0.12.1 is not installed", file=sys.stderr)
+        print("requests >=1.0.0 is not installed", file=sys.stderr)
         sys.exit(1)
 
 
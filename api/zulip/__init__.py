@@ -41,18 +41,23 @@ import six
 from typing import Any, Dict
 
 
-__version__ = "0.2.5"
+__version__ = "0.3.0"
 
 logger = logging.getLogger(__name__)
 
 # Check that we have a recent enough version
-# Older versions don't provide the 'json' attribute on responses.
-assert(LooseVersion(requests.__version__) >= LooseVersion('0.12.1')) # type: ignore # https://github.com/python/mypy/issues/1165 and https://github.com/python/typeshed/pull/206
+# Older versions don't provide the 'json' attribute on responses or
+# let us size a Session's connection pool with an HTTPAdapter.
+assert(LooseVersion(requests.__version__) >= LooseVersion('1.0.0')) # type: ignore # https://github.com/python/mypy/issues/1165 and https://github.com/python/typeshed/pull/206
 # In newer versions, the 'json' attribute is a function, not a property
 requests_json_is_function = callable(requests.Response.json)
 
 API_VERSTRING = "v1/"
 
+# The default number of connections a Client keeps open to the server;
+# see Client.ensure_session.
+DEFAULT_POOL_SIZE = 10
+
 class CountingBackoff(object):
     def __init__(self, maximum_retries=10, timeout_success_equivalent=None):
         self.number_of_retries = 0
@@ -172,7 +177,8 @@ class Client(object):
                  verbose=False, retry_on_errors=True,
                  site=None, client=None,
                  cert_bundle=None, insecure=None,
-                 client_cert=None, client_cert_key=None):
+                 client_cert=None, client_cert_key=None,
+                 pool_size=DEFAULT_POOL_SIZE):
         if client is None:
             client = _default_client()
 
@@ -252,6 +258,33 @@ class Client(object):
                                        %(client_cert_key,))
         self.client_cert = client_cert
         self.client_cert_key = client_cert_key
+        self.pool_size = pool_size
+        self.session = None # type: requests.Session
+
+    def ensure_session(self):
+        # type: () -> None
+        """Creates the requests Session that all of this client's API
+        queries go through, so they reuse (up to pool_size, e.g. for
+        threads sharing the client) keep-alive connections to the server
+        rather than opening a new connection for each query."""
+        if self.session is not None:
+            return
+
+        # Build a client cert object for requests
+        if self.client_cert_key is not None:
+            client_cert = (self.client_cert, self.client_cert_key)
+        else:
+            client_cert = self.client_cert
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.auth = requests.auth.HTTPBasicAuth(self.email, self.api_key)
+        session.verify = self.tls_verification
+        session.cert = client_cert
+        session.headers.update({"User-agent": self.get_user_agent()})
+        self.session = session
 
     def get_user_agent(self):
         vendor = ''
@@ -277,14 +310,20 @@ class Client(object):
                 vendor_version=vendor_version,
                 )
 
-    def do_api_query(self, orig_request, url, method="POST", longpolling = False):
+    def encode_request(self, orig_request):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """JSON-encodes the non-string parameters of an API query."""
         request = {}
-
         for (key, val) in six.iteritems(orig_request):
             if isinstance(val, str) or isinstance(val, six.text_type):
                 request[key] = val
             else:
                 request[key] = simplejson.dumps(val)
+        return request
+
+    def do_api_query(self, orig_request, url, method="POST", longpolling = False):
+        request = self.encode_request(orig_request)
+        self.ensure_session()
 
         query_state = {
             'had_error_retry': False,
@@ -323,21 +362,10 @@ class Client(object):
                     kwarg = "data"
                 kwargs = {kwarg: query_state["request"]}
 
-                # Build a client cert object for requests
-                if self.client_cert_key is not None:
-                    client_cert = (self.client_cert, self.client_cert_key)
-                else:
-                    client_cert = self.client_cert
-
-                res = requests.request(
+                res = self.session.request(
                         method,
                         urllib.parse.urljoin(self.base_url, url),
-                        auth=requests.auth.HTTPBasicAuth(self.email,
-                                                         self.api_key),
-                        verify=self.tls_verification,
-                        cert=client_cert,
                         timeout=90,
-                        headers={"User-agent": self.get_user_agent()},
                         **kwargs)
 
                 # On 50x errors, try again after a short sleep
@@ -463,7 +491,7 @@ class Client(object):
             if event['type'] == 'message':
                 callback(event['message'])
 
-        self.call_on_each_event(event_callback, ['message'])
+        return self.call_on_each_event(event_callback, ['message'])
 
 def _mk_subs(streams, **kwargs):
     result = kwargs
@@ -508,6 +536,7 @@ class ZulipStream(object):
         pass
 
 Client._register('send_message', url='messages', make_request=(lambda request: request))
+Client._register('send_messages', url='messages/bulk', make_request=(lambda messages: dict(messages=messages)))
 Client._register('update_message', method='PATCH', url='messages', make_request=(lambda request: request))
 Client._register('get_messages', method='GET', url='messages/latest', longpolling=True)
 Client._register('get_events', url='events', method='GET', longpolling=True, make_request=(lambda **kwargs: kwargs))
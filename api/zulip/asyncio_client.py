@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Zulip, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# An asyncio version of zulip.Client, for running many API queries
+# (e.g. the long-polls of several event queues) concurrently in one
+# process.  It needs Python 3.5 and aiohttp, which the rest of the API
+# bindings don't, so it is not imported by the zulip package; use
+#
+#   from zulip.asyncio_client import AsyncClient
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import asyncio
+import inspect
+import ssl
+import sys
+import traceback
+
+import aiohttp
+from six.moves import urllib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from zulip import API_VERSTRING, Client
+
+class AsyncClient(Client):
+    """A zulip.Client whose API methods (send_message, get_events,
+    register, etc.) are coroutines, e.g.
+
+        client = AsyncClient()
+        result = await client.send_message(message)
+
+    It takes the same arguments as Client.  Its pool_size is the number
+    of requests it makes to the server at a time, including the long-polls
+    of call_on_each_event; the others wait for a free connection.  Call
+    close() (or use it with async with) when done with it."""
+
+    def ensure_session(self):
+        # type: () -> None
+        if self.session is not None:
+            return
+
+        if self.tls_verification is False:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, verify_ssl=False)
+        else:
+            if self.tls_verification is True:
+                ssl_context = ssl.create_default_context()
+            else:
+                ssl_context = ssl.create_default_context(cafile=self.tls_verification)
+            if self.client_cert is not None:
+                ssl_context.load_cert_chain(self.client_cert, self.client_cert_key)
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl_context=ssl_context)
+
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            auth=aiohttp.BasicAuth(self.email, self.api_key),
+            headers={"User-agent": self.get_user_agent()})
+
+    async def close(self):
+        # type: () -> None
+        if self.session is None:
+            return
+        result = self.session.close()
+        # ClientSession.close is a coroutine in newer aiohttp versions.
+        if inspect.isawaitable(result):
+            await result
+        self.session = None
+
+    async def __aenter__(self):
+        # type: () -> AsyncClient
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # type: (*Any) -> None
+        await self.close()
+
+    async def _fetch(self, method, url, kwargs):
+        # type: (str, str, Dict[str, Any]) -> Tuple[int, Optional[Dict[str, Any]]]
+        async with self.session.request(method, url, **kwargs) as res:
+            try:
+                json_result = await res.json()
+            except Exception:
+                json_result = None
+            return (res.status, json_result)
+
+    async def do_api_query(self, orig_request, url, method="POST", longpolling=False):
+        # type: (Dict[str, Any], str, str, bool) -> Dict[str, Any]
+        request = self.encode_request(orig_request)
+        self.ensure_session()
+
+        query_state = {
+            'had_error_retry': False,
+            'failures': 0,
+        } # type: Dict[str, Any]
+
+        async def error_retry(error_string):
+            # type: (str) -> bool
+            if not self.retry_on_errors or query_state["failures"] >= 10:
+                return False
+            if self.verbose:
+                if not query_state["had_error_retry"]:
+                    sys.stdout.write("zulip API(%s): connection error%s -- retrying." %
+                                     (url.split(API_VERSTRING, 2)[0], error_string,))
+                    query_state["had_error_retry"] = True
+                else:
+                    sys.stdout.write(".")
+                sys.stdout.flush()
+            request["dont_block"] = "true"
+            await asyncio.sleep(1)
+            query_state["failures"] += 1
+            return True
+
+        def end_error_retry(succeeded):
+            # type: (bool) -> None
+            if query_state["had_error_retry"] and self.verbose:
+                if succeeded:
+                    print("Success!")
+                else:
+                    print("Failed!")
+
+        while True:
+            if method == "GET":
+                kwargs = {"params": request}
+            else:
+                kwargs = {"data": request}
+
+            try:
+                (status, json_result) = await asyncio.wait_for(
+                    self._fetch(method, urllib.parse.urljoin(self.base_url, url), kwargs),
+                    timeout=90)
+            except asyncio.TimeoutError:
+                if longpolling:
+                    # When longpolling, we expect the timeout to fire,
+                    # and the correct response is to just retry
+                    continue
+                end_error_retry(False)
+                return {'msg': "Connection error:\n%s" % traceback.format_exc(),
+                        "result": "connection-error"}
+            except (aiohttp.ClientError, OSError):
+                if await error_retry(""):
+                    continue
+                end_error_retry(False)
+                return {'msg': "Connection error:\n%s" % traceback.format_exc(),
+                        "result": "connection-error"}
+            except Exception:
+                return {'msg': "Unexpected error:\n%s" % traceback.format_exc(),
+                        "result": "unexpected-error"}
+
+            # On 50x errors, try again after a short sleep
+            if str(status).startswith('5'):
+                if await error_retry(" (server %s)" % (status,)):
+                    continue
+
+            if json_result is not None:
+                end_error_retry(True)
+                return json_result
+            end_error_retry(False)
+            return {'msg': "Unexpected error from the server", "result": "http-error",
+                    "status_code": status}
+
+    async def call_on_each_event(self, callback, event_types=None, narrow=None):
+        # type: (Callable[[Dict[str, Any]], Any], Optional[List[str]], Optional[List[List[str]]]) -> None
+        """Like Client.call_on_each_event; callback may be a coroutine
+        function, in which case each event is handled before the next
+        one.  Run several of these as tasks to long-poll several event
+        queues at once."""
+        if narrow is None:
+            narrow = []
+
+        async def do_register():
+            # type: () -> Tuple[str, int]
+            while True:
+                if event_types is None:
+                    res = await self.register()
+                else:
+                    res = await self.register(event_types=event_types, narrow=narrow)
+
+                if 'error' in res.get('result'):
+                    if self.verbose:
+                        print("Server returned error:\n%s" % res['msg'])
+                    await asyncio.sleep(1)
+                else:
+                    return (res['queue_id'], res['last_event_id'])
+
+        queue_id = None
+        while True:
+            if queue_id is None:
+                (queue_id, last_event_id) = await do_register()
+
+            res = await self.get_events(queue_id=queue_id, last_event_id=last_event_id)
+            if 'error' in res.get('result'):
+                if res["result"] == "http-error":
+                    if self.verbose:
+                        print("HTTP error fetching events -- probably a server restart")
+                elif res["result"] == "connection-error":
+                    if self.verbose:
+                        print("Connection error fetching events -- probably server is temporarily down?")
+                else:
+                    if self.verbose:
+                        print("Server returned error:\n%s" % res["msg"])
+                    if res["msg"].startswith("Bad event queue id:"):
+                        # Our event queue went away; see
+                        # Client.call_on_each_event.
+                        queue_id = None
+                await asyncio.sleep(1)
+                continue
+
+            for event in res['events']:
+                last_event_id = max(last_event_id, int(event['id']))
+                result = callback(event)
+                if inspect.isawaitable(result):
+                    await result
+
+    def call_on_each_message(self, callback):
+        # type: (Callable[[Dict[str, Any]], Any]) -> Awaitable[None]
+        async def event_callback(event):
+            # type: (Dict[str, Any]) -> None
+            if event['type'] == 'message':
+                result = callback(event['message'])
+                if inspect.isawaitable(result):
+                    await result
+
+        return self.call_on_each_event(event_callback, ['message'])
@@ -0,0 +1,116 @@
+var noop = function () {};
+
+set_global('$', function () {
+    return {remove: noop};
+});
+set_global('page_params', {email: 'hamlet@zulip.com'});
+set_global('util', {
+    execute_early: noop,
+    is_current_user: function (email) {
+        return email === 'hamlet@zulip.com';
+    },
+    normalize_recipients: function (recipients) {
+        return recipients;
+    }
+});
+set_global('people', {
+    get_by_email: function (email) {
+        return {
+            'cordelia@zulip.com': {full_name: 'Cordelia Lear'},
+            'hamlet@zulip.com': {full_name: 'King Hamlet'}
+        }[email];
+    }
+});
+set_global('alert_words', {process_message: noop});
+set_global('compose', {report_as_received: noop});
+set_global('condense', {un_cache_message_content_height: noop});
+set_global('loading', {destroy_indicator: noop});
+set_global('process_loaded_for_unread', noop);
+set_global('stream_list', {
+    update_streams_sidebar: noop,
+    update_private_messages: noop
+});
+set_global('unread', {
+    process_visible: noop,
+    update_unread_counts: noop
+});
+set_global('narrow', {
+    active: function () {return false;},
+    narrowed_by_reply: function () {return false;}
+});
+set_global('home_msg_list', {
+    add_messages: noop,
+    view: {rerender_messages: noop}
+});
+set_global('message_list', {all: {add_messages: noop}});
+set_global('current_msg_list', {
+    get_row: function () {
+        return {length: 1};
+    }
+});
+
+var edits_ended = 0;
+set_global('message_edit', {
+    end: function () {
+        edits_ended += 1;
+    }
+});
+
+var notified = [];
+set_global('notifications', {
+    possibly_notify_new_messages_outside_viewport: noop,
+    received_messages: function (messages) {
+        notified = notified.concat(messages);
+    }
+});
+
+var message_store = require('js/message_store.js');
+
+message_store.insert_new_messages([{
+    id: 1,
+    type: 'private',
+    sender_email: 'cordelia@zulip.com',
+    sender_full_name: 'Cordelia Lear',
+    display_recipient: [{email: 'cordelia@zulip.com', full_name: 'Cordelia Lear'},
+                        {email: 'hamlet@zulip.com', full_name: 'King Hamlet'}],
+    content: '<p>see https://zulip.org</p>',
+    flags: [],
+    timestamp: 1000
+}]);
+
+(function test_link_preview_update() {
+    edits_ended = 0;
+    notified = [];
+
+    // Link previews arrive as an update_message event without an
+    // edit_timestamp; they aren't edits.
+    message_store.update_messages([{
+        message_id: 1,
+        flags: [],
+        rendered_content: '<p>see https://zulip.org</p><div class="preview"></div>'
+    }]);
+
+    var msg = message_store.get(1);
+    assert.equal(msg.content, '<p>see https://zulip.org</p><div class="preview"></div>');
+    assert.equal(msg.last_edit_timestamp, undefined);
+    assert.equal(edits_ended, 0);
+    assert.deepEqual(notified, []);
+}());
+
+(function test_edit_update() {
+    edits_ended = 0;
+    notified = [];
+
+    message_store.update_messages([{
+        message_id: 1,
+        flags: [],
+        rendered_content: '<p>edited</p>',
+        edit_timestamp: 2000
+    }]);
+
+    var msg = message_store.get(1);
+    assert.equal(msg.content, '<p>edited</p>');
+    assert.equal(msg.last_edit_timestamp, 2000);
+    assert.equal(edits_ended, 1);
+    assert.deepEqual(notified, [msg]);
+}());
@@ -17,6 +17,13 @@ class zulip_internal::prod_app_frontend {
     target => '/etc/nginx/sites-available/zulip',
     notify => Service["nginx"],
   }
+  file { "/etc/cron.d/update-analytics-counts":
+    ensure => file,
+    owner  => "root",
+    group  => "root",
+    mode => 644,
+    source => "puppet:///modules/zulip_internal/cron.d/update-analytics-counts",
+  }
 
   file { [ "/srv/www/", "/srv/www/dist/", "/srv/www/dist/api",
            "/srv/www/dist/apps/", "/srv/www/dist/apps/mac/",
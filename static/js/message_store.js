@@ -16,6 +16,24 @@ exports.get = function get(message_id) {
     return stored_messages[message_id];
 };
 
+exports.ids_in_flag_range = function (message_range) {
+    // The ids of the messages we have that are in the range of an
+    // update_message_flags event (see update_message_flags_in_ranges
+    // in zerver/lib/actions.py).
+    var topic = message_range.topic && message_range.topic.toLowerCase();
+    var messages = _.filter(stored_messages, function (message) {
+        if (message.id <= message_range.after || message.id > message_range.until) {
+            return false;
+        }
+        if (message_range.recipient_id !== undefined &&
+            message.recipient_id !== message_range.recipient_id) {
+            return false;
+        }
+        return topic === undefined || message.subject.toLowerCase() === topic;
+    });
+    return _.pluck(messages, 'id');
+};
+
 exports.get_private_message_recipient = function (message, attr, fallback_attr) {
     var recipient, i;
     var other_recipients = _.filter(message.display_recipient,
@@ -280,6 +298,11 @@ exports.update_messages = function update_messages(events) {
         msg.mentioned = event.flags.indexOf("mentioned") !== -1 ||
                         event.flags.indexOf("wildcard_mentioned") !== -1;
 
+        // Link previews arriving (see zerver.lib.unfurl) update the
+        // rendered content without the message having been edited;
+        // those events have no edit_timestamp.
+        var edited = event.edit_timestamp !== undefined;
+
         condense.un_cache_message_content_height(msg.id);
 
         if (event.rendered_content !== undefined) {
@@ -287,7 +310,9 @@ exports.update_messages = function update_messages(events) {
         }
 
         var row = current_msg_list.get_row(event.message_id);
-        if (row.length > 0) {
+        if (edited && row.length > 0) {
+            // A preview arriving mustn't close (and so throw away) the
+            // sender's own edit of the message.
             message_edit.end(row);
         }
 
@@ -353,10 +378,14 @@ exports.update_messages = function update_messages(events) {
             });
         }
 
-        msg.last_edit_timestamp = event.edit_timestamp;
-        delete msg.last_edit_timestr;
+        if (edited) {
+            msg.last_edit_timestamp = event.edit_timestamp;
+            delete msg.last_edit_timestr;
+            // We already notified about a preview's message when it
+            // arrived.
+            notifications.received_messages([msg]);
+        }
 
-        notifications.received_messages([msg]);
         alert_words.process_message(msg);
     });
 
@@ -146,20 +146,24 @@ function get_events_success(events) {
                     subs.pin_or_unpin_stream(event.name);
                 }
             } else if (event.op === 'peer_add' || event.op === 'peer_remove') {
+                // Bulk (un)subscribes list all the users in user_emails.
+                var user_emails = event.user_emails || [event.user_email];
                 _.each(event.subscriptions, function (sub) {
-                    var js_event_type;
-                    if (event.op === 'peer_add') {
-                        js_event_type = 'peer_subscribe.zulip';
+                    _.each(user_emails, function (user_email) {
+                        var js_event_type;
+                        if (event.op === 'peer_add') {
+                            js_event_type = 'peer_subscribe.zulip';
 
-                        stream_data.add_subscriber(sub, event.user_email);
-                    } else if (event.op === 'peer_remove') {
-                        js_event_type = 'peer_unsubscribe.zulip';
+                            stream_data.add_subscriber(sub, user_email);
+                        } else if (event.op === 'peer_remove') {
+                            js_event_type = 'peer_unsubscribe.zulip';
 
-                        stream_data.remove_subscriber(sub, event.user_email);
-                    }
+                            stream_data.remove_subscriber(sub, user_email);
+                        }
 
-                    $(document).trigger(js_event_type, {stream_name: sub,
-                                                        user_email: event.user_email});
+                        $(document).trigger(js_event_type, {stream_name: sub,
+                                                            user_email: user_email});
+                    });
                 });
 
             }
@@ -171,14 +175,18 @@ function get_events_success(events) {
             break;
         case 'update_message_flags':
             var new_value = event.operation === "add";
+            var message_ids = event.messages;
+            if (event.message_range !== undefined) {
+                message_ids = message_store.ids_in_flag_range(event.message_range);
+            }
             switch(event.flag) {
             case 'starred':
-                _.each(event.messages, function (message_id) {
+                _.each(message_ids, function (message_id) {
                     ui.update_starred(message_id, new_value);
                 });
                 break;
             case 'read':
-                var msgs_to_update = _.map(event.messages, function (message_id) {
+                var msgs_to_update = _.map(message_ids, function (message_id) {
                     return message_store.get(message_id);
                 });
                 unread.mark_messages_as_read(msgs_to_update, {from: "server"});
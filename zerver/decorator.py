@@ -16,8 +16,7 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.utils import statsd
 from zerver.exceptions import RateLimited
-from zerver.lib.rate_limiter import incr_ratelimit, is_ratelimited, \
-     api_calls_left
+from zerver.lib.rate_limiter import rate_limit_request
 from zerver.lib.request import REQ, has_request_variables, JsonableError, RequestVariableMissingError
 from django.core.handlers import base
 
@@ -519,13 +518,13 @@ def statsd_increment(counter, val=1):
         return wrapped_func
     return wrapper
 
-def rate_limit_user(request, user, domain):
-    # type: (HttpRequest, UserProfile, text_type) -> None
+def rate_limit_user(request, user, domain, count=1):
+    # type: (HttpRequest, UserProfile, text_type, int) -> None
     """Returns whether or not a user was rate limited. Will raise a RateLimited exception
     if the user has been rate limited, otherwise returns and modifies request to contain
-    the rate limit information"""
+    the rate limit information.  count is the number of API calls the request counts as."""
 
-    ratelimited, time = is_ratelimited(user, domain)
+    ratelimited, time, calls_remaining = rate_limit_request(user, domain, count)
     request._ratelimit_applied_limits = True
     request._ratelimit_secs_to_freedom = time
     request._ratelimit_over_limit = ratelimited
@@ -534,11 +533,7 @@ def rate_limit_user(request, user, domain):
         statsd.incr("ratelimiter.limited.%s.%s" % (type(user), user.id))
         raise RateLimited()
 
-    incr_ratelimit(user, domain)
-    calls_remaining, time_reset = api_calls_left(user, domain)
-
     request._ratelimit_remaining = calls_remaining
-    request._ratelimit_secs_to_freedom = time_reset
 
 def rate_limit(domain='all'):
     # type: (text_type) -> Callable[[Callable[..., HttpResponse]], Callable[..., HttpResponse]]
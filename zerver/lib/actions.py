@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from typing import (
-    AbstractSet, Any, AnyStr, Callable, Dict, Iterable, Mapping, MutableMapping,
+    AbstractSet, Any, AnyStr, Callable, Dict, FrozenSet, Iterable, List, Mapping, MutableMapping,
     Optional, Sequence, Tuple, TypeVar, Union
 )
 
@@ -22,12 +22,12 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     UserActivityInterval, get_active_user_dicts_in_realm, get_active_streams, \
     realm_filters_for_domain, RealmFilter, receives_offline_notifications, \
     ScheduledJob, realm_filters_for_domain, get_owned_bot_dicts, \
-    get_old_unclaimed_attachments, get_cross_realm_users
+    get_old_unclaimed_attachments, get_cross_realm_users, stringify_message_dict
 
 from zerver.lib.avatar import get_avatar_url, avatar_url
 
-from django.db import transaction, IntegrityError
-from django.db.models import F, Q
+from django.db import transaction, IntegrityError, connection
+from django.db.models import F, Max, Q
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
 from django.utils.importlib import import_module
@@ -50,9 +50,10 @@ from zerver.lib.queue import queue_json_publish
 from django.utils import timezone
 from zerver.lib.create_user import create_user
 from zerver.lib import bugdown
+from zerver.lib import unfurl
 from zerver.lib.cache import cache_with_key, cache_set, \
     user_profile_by_email_cache_key, cache_set_many, \
-    cache_delete, cache_delete_many
+    cache_delete, cache_delete_many, user_presence_dicts_cache_key
 from zerver.decorator import statsd_increment
 from zerver.lib.event_queue import request_event_queue, get_user_events, send_event
 from zerver.lib.utils import log_statsd_event, statsd
@@ -68,6 +69,8 @@ from zerver.lib.session_user import get_session_user
 from zerver.lib.upload import attachment_url_re, attachment_url_to_path_id, \
     claim_attachment, delete_message_image
 from zerver.lib.str_utils import NonBinaryStr
+from zerver.lib.validator import check_dict, check_list, check_none_or, check_string, \
+    check_variable_type
 
 import DNS
 import ujson
@@ -79,7 +82,7 @@ import os
 import platform
 import logging
 import itertools
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import copy
 
 # This will be used to type annotate parameters in a function if the function
@@ -458,7 +461,9 @@ def do_deactivate_user(user_profile, log=True, _cascade=True):
         return
 
     user_profile.is_active = False;
-    user_profile.save(update_fields=["is_active"])
+    with transaction.atomic():
+        user_profile.save(update_fields=["is_active"])
+        change_user_subscriber_counts(user_profile, -1)
 
     delete_user_sessions(user_profile)
 
@@ -512,7 +517,9 @@ def do_deactivate_stream(stream, log=True):
     # code path.
 
     stream.name = new_name[:Stream.MAX_NAME_LENGTH]
-    stream.save()
+    # Don't overwrite the subscriber_count that do_remove_subscription
+    # just updated in the database.
+    stream.save(update_fields=["name", "deactivated", "invite_only"])
 
     # Remove the old stream information from remote cache.
     old_cache_key = get_stream_cache_key(old_name, stream.realm)
@@ -590,6 +597,47 @@ def always_push_notify(user):
     # messages, regardless of idle status
     return user.realm.domain in ['robinhood.io']
 
+def bulk_get_recipient_user_profiles(recipients):
+    # type: (Iterable[Recipient]) -> Dict[int, List[UserProfile]]
+    """
+    Returns a dict mapping the id of each stream or huddle recipient to
+    the UserProfiles actively subscribed to it, using a single query
+    for the whole batch.  Personal recipients are ignored; callers
+    look those up via the user_profile_by_id cache instead.
+    """
+    recipient_ids = set(recipient.id for recipient in recipients
+                        if recipient.type in (Recipient.STREAM, Recipient.HUDDLE))
+    user_profiles = dict((recipient_id, []) for recipient_id in recipient_ids) # type: Dict[int, List[UserProfile]]
+    if not recipient_ids:
+        return user_profiles
+
+    # We use select_related()/only() here, while the PERSONAL case in
+    # do_send_messages uses get_user_profile_by_id() to get UserProfile
+    # objects from cache.  Streams will typically have more recipients
+    # than PMs, so get_user_profile_by_id() would be a bit more
+    # expensive here, given that we need to hit the DB anyway and only
+    # care about the email from the user profile.
+    fields = [
+        'recipient',
+        'user_profile__id',
+        'user_profile__email',
+        'user_profile__is_active',
+        'user_profile__realm__domain'
+    ]
+    query = Subscription.objects.select_related("user_profile", "user_profile__realm").only(*fields).filter(
+        recipient_id__in=recipient_ids, active=True)
+    for sub in query:
+        user_profiles[sub.recipient_id].append(sub.user_profile)
+    return user_profiles
+
+def bulk_get_streams_by_id(stream_ids):
+    # type: (Iterable[int]) -> Dict[int, Stream]
+    stream_ids = set(stream_ids)
+    if not stream_ids:
+        return {}
+    return dict((stream.id, stream) for stream in
+                Stream.objects.select_related("realm").filter(id__in=stream_ids))
+
 # Helper function. Defaults here are overriden by those set in do_send_messages
 def do_send_message(message, rendered_content = None, no_log = False, stream = None, local_id = None):
     # type: (Union[int, Message], Optional[text_type], bool, Optional[Stream], Optional[int]) -> int
@@ -628,6 +676,11 @@ def do_send_messages(messages):
         if not message['no_log']:
             log_message(message['message'])
 
+    # Resolve the recipients of all the stream and huddle messages in
+    # the batch with a single query, rather than one query per message.
+    recipient_user_profiles = bulk_get_recipient_user_profiles(
+        [message['message'].recipient for message in messages])
+
     for message in messages:
         if message['message'].recipient.type == Recipient.PERSONAL:
             message['recipients'] = list(set([get_user_profile_by_id(message['message'].recipient.type_id),
@@ -637,20 +690,7 @@ def do_send_messages(messages):
             assert((len(message['recipients']) == 1) or (len(message['recipients']) == 2))
         elif (message['message'].recipient.type == Recipient.STREAM or
               message['message'].recipient.type == Recipient.HUDDLE):
-            # We use select_related()/only() here, while the PERSONAL case above uses
-            # get_user_profile_by_id() to get UserProfile objects from cache.  Streams will
-            # typically have more recipients than PMs, so get_user_profile_by_id() would be
-            # a bit more expensive here, given that we need to hit the DB anyway and only
-            # care about the email from the user profile.
-            fields = [
-                'user_profile__id',
-                'user_profile__email',
-                'user_profile__is_active',
-                'user_profile__realm__domain'
-            ]
-            query = Subscription.objects.select_related("user_profile", "user_profile__realm").only(*fields).filter(
-                recipient=message['message'].recipient, active=True)
-            message['recipients'] = [s.user_profile for s in query]
+            message['recipients'] = recipient_user_profiles[message['message'].recipient.id]
         else:
             raise ValueError('Bad recipient type')
 
@@ -697,17 +737,21 @@ def do_send_messages(messages):
             if Message.content_has_attachment(message['message'].content):
                 do_claim_attachments(message)
 
+    # Fetch any streams our callers didn't provide in one query.
+    streams_by_id = bulk_get_streams_by_id(
+        [message['message'].recipient.type_id for message in messages
+         if message['message'].recipient.type == Recipient.STREAM and message['stream'] is None])
+    for message in messages:
+        if message['message'].recipient.type == Recipient.STREAM and message['stream'] is None:
+            message['stream'] = streams_by_id[message['message'].recipient.type_id]
+
     for message in messages:
         # Render Markdown etc. here and store (automatically) in
         # remote cache, so that the single-threaded Tornado server
         # doesn't have to.
         user_flags = user_message_flags.get(message['message'].id, {})
         sender = message['message'].sender
-        user_presences = get_status_dict(sender)
-        presences = {}
-        for user_profile in message['active_recipients']:
-            if user_profile.email in user_presences:
-                presences[user_profile.id] = user_presences[user_profile.email]
+        presences = get_status_dicts_for_recipients(sender, message['active_recipients'])
 
         event = dict(
             type         = 'message',
@@ -725,8 +769,6 @@ def do_send_messages(messages):
             # notify new_message request if it's a public stream,
             # ensuring that in the tornado server, non-public stream
             # messages are only associated to their subscribed users.
-            if message['stream'] is None:
-                message['stream'] = Stream.objects.select_related("realm").get(id=message['message'].recipient.type_id)
             if message['stream'].is_public():
                 event['realm_id'] = message['stream'].realm.id
                 event['stream_name'] = message['stream'].name
@@ -737,6 +779,7 @@ def do_send_messages(messages):
         if message['sender_queue_id'] is not None:
             event['sender_queue_id'] = message['sender_queue_id']
         send_event(event, users)
+        queue_link_previews(message['message'])
         if (settings.ENABLE_FEEDBACK and
             message['message'].recipient.type == Recipient.PERSONAL and
             settings.FEEDBACK_BOT in [up.email for up in message['recipients']]):
@@ -856,7 +899,8 @@ def extract_recipients(s):
     # See test_extract_recipients() for examples of what we allow.
     try:
         data = ujson.loads(s)
-    except ValueError:
+    except (ValueError, TypeError):
+        # Not a JSON string; e.g. already a list.
         data = s
 
     if isinstance(data, six.string_types):
@@ -884,6 +928,48 @@ def check_send_message(sender, client, message_type_name, message_to,
                             forwarder_user_profile, local_id, sender_queue_id)
     return do_send_messages([message])[0]
 
+# The parameters of each message in a bulk send; see check_send_messages.
+check_message_request = check_dict([
+    ('type', check_string),
+    ('to', check_variable_type([check_string, check_list(check_string)])),
+    ('subject', check_none_or(check_string)),
+    ('content', check_string),
+])
+
+def check_send_messages(sender, client, message_requests):
+    # type: (UserProfile, Client, Sequence[Mapping[str, Any]]) -> List[Dict[str, Any]]
+    """Sends the messages described by message_requests, each a dict of
+    the type, to, subject and content parameters of a single message
+    send, from sender with a single do_send_messages call (so in one
+    transaction).  Returns a result for each, in order: {'result':
+    'success', 'id': ...}, or {'result': 'error', 'msg': ...} if it
+    couldn't be sent; an invalid message doesn't keep the others from
+    being sent."""
+    results = [] # type: List[Dict[str, Any]]
+    messages = [] # type: List[Dict[str, Any]]
+    for i, message_request in enumerate(message_requests):
+        message_request = dict(message_request)
+        message_request.setdefault('to', [])
+        message_request.setdefault('subject', None)
+        try:
+            error = check_message_request('messages[%d]' % (i,), message_request)
+            if error:
+                raise JsonableError(error)
+            messages.append(check_message(sender, client, message_request['type'],
+                                          extract_recipients(message_request['to']),
+                                          message_request['subject'],
+                                          message_request['content'],
+                                          forwarder_user_profile=sender))
+            results.append({'result': 'success'})
+        except JsonableError as e:
+            results.append({'result': 'error', 'msg': e.error})
+
+    message_ids = iter(do_send_messages(messages))
+    for result in results:
+        if result['result'] == 'success':
+            result['id'] = next(message_ids)
+    return results
+
 def check_stream_name(stream_name):
     # type: (text_type) -> None
     if stream_name == "":
@@ -1250,6 +1336,29 @@ def get_subscribers_to_streams(streams):
 
     return subscribes_to
 
+def send_peer_subscription_events(op, peer_changes):
+    # type: (str, Iterable[Tuple[Stream, Sequence[UserProfile], AbstractSet[int]]]) -> None
+    """Sends the peer_add or peer_remove events for a bulk (un)subscribe.
+    peer_changes lists, for each stream, the users who were
+    (un)subscribed to it and the ids of the users to notify.  Streams
+    with the same users and recipients share one event, listing all the
+    users in user_emails, so that e.g. adding many users to many streams
+    sends one event per stream at most, rather than one per user and
+    stream.  Tornado splits these events up for clients that expect a
+    single user_email (see process_event)."""
+    stream_names_by_change = OrderedDict() # type: Dict[Tuple[Tuple[text_type, ...], FrozenSet[int]], List[text_type]]
+    for (stream, users, recipient_ids) in peer_changes:
+        if not users or not recipient_ids:
+            continue
+        key = (tuple(sorted(user.email for user in users)), frozenset(recipient_ids))
+        stream_names_by_change.setdefault(key, []).append(stream.name)
+
+    for ((emails, recipient_ids), stream_names) in six.iteritems(stream_names_by_change):
+        event = dict(type="subscription", op=op,
+                     subscriptions=stream_names,
+                     user_emails=list(emails))
+        send_event(event, list(recipient_ids))
+
 def notify_subscriptions_added(user_profile, sub_pairs, stream_emails, no_log=False):
     # type: (UserProfile, Iterable[Tuple[Subscription, Stream]], Callable[[Stream], List[text_type]], bool) -> None
     if not no_log:
@@ -1319,17 +1428,31 @@ def bulk_add_subscriptions(streams, users):
         subs_by_user[user_profile.id].append(sub_to_add)
         subs_to_add.append((sub_to_add, stream))
 
-    # TODO: XXX: This transaction really needs to be done at the serializeable
-    # transaction isolation level.
+    active_user_ids_set = set(user.id for user in users if user.is_active)
     with transaction.atomic():
-        occupied_streams_before = list(get_occupied_streams(user_profile.realm))
         Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add])
-        Subscription.objects.filter(id__in=[sub.id for (sub, stream) in subs_to_activate]).update(active=True)
-        occupied_streams_after = list(get_occupied_streams(user_profile.realm))
-
-    new_occupied_streams = [stream for stream in
-                            set(occupied_streams_after) - set(occupied_streams_before)
-                            if not stream.invite_only]
+        if subs_to_activate:
+            # Lock the subscriptions we're reactivating and check that
+            # they're still inactive, so that a concurrent subscribe
+            # isn't counted twice.
+            inactive_sub_ids = set(Subscription.objects.select_for_update().filter(
+                id__in=[sub.id for (sub, stream) in subs_to_activate],
+                active=False).values_list('id', flat=True))
+            already_subscribed.extend((sub.user_profile, stream) for (sub, stream) in subs_to_activate
+                                      if sub.id not in inactive_sub_ids)
+            subs_to_activate = [(sub, stream) for (sub, stream) in subs_to_activate
+                                if sub.id in inactive_sub_ids]
+            Subscription.objects.filter(id__in=inactive_sub_ids).update(active=True)
+
+        subscriber_deltas = defaultdict(int) # type: Dict[int, int]
+        for (sub, stream) in subs_to_add + subs_to_activate:
+            if sub.user_profile_id in active_user_ids_set:
+                subscriber_deltas[stream.id] += 1
+        (newly_occupied, _) = change_subscriber_counts(subscriber_deltas)
+
+    new_occupied_streams = [stream for stream in streams
+                            if stream.id in newly_occupied and
+                            not stream.invite_only and not stream.deactivated]
     if new_occupied_streams:
         event = dict(type="stream", op="occupy",
                      streams=[stream.to_dict()
@@ -1370,30 +1493,25 @@ def bulk_add_subscriptions(streams, users):
         sub_pairs = sub_tuples_by_user[user_profile.id]
         notify_subscriptions_added(user_profile, sub_pairs, fetch_stream_subscriber_emails)
 
+    realm_user_ids = None # type: Optional[Set[int]]
+    peer_changes = [] # type: List[Tuple[Stream, List[UserProfile], AbstractSet[int]]]
     for stream in streams:
         if stream.realm.domain == "mit.edu" and not stream.invite_only:
             continue
 
         new_users = [user for user in users if (user.id, stream.id) in new_streams]
-        new_user_ids = [user.id for user in new_users]
-        non_new_user_ids = set(active_user_ids(user_profile.realm)) - set(new_user_ids)
-        all_subscribed_ids = [user.id for user in all_subs_by_stream[stream.id]]
-        other_user_ids = set(all_subscribed_ids) - set(new_user_ids)
+        new_user_ids = set(user.id for user in new_users)
         if not stream.invite_only:
             # We now do "peer_add" events even for streams users were
             # never subscribed to, in order for the neversubscribed
             # structure to stay up-to-date.
-            for user_profile in new_users:
-                event = dict(type="subscription", op="peer_add",
-                             subscriptions=[stream.name],
-                             user_email=user_profile.email)
-                send_event(event, non_new_user_ids)
-        elif other_user_ids:
-            for user_profile in new_users:
-                event = dict(type="subscription", op="peer_add",
-                             subscriptions=[stream.name],
-                             user_email=user_profile.email)
-                send_event(event, other_user_ids)
+            if realm_user_ids is None:
+                realm_user_ids = set(active_user_ids(user_profile.realm))
+            peer_changes.append((stream, new_users, realm_user_ids - new_user_ids))
+        else:
+            all_subscribed_ids = set(user.id for user in all_subs_by_stream[stream.id])
+            peer_changes.append((stream, new_users, all_subscribed_ids - new_user_ids))
+    send_peer_subscription_events("peer_add", peer_changes)
 
     return ([(user_profile, stream) for (user_profile, recipient_id, stream) in new_subs] +
             [(sub.user_profile, stream) for (sub, stream) in subs_to_activate],
@@ -1404,19 +1522,22 @@ def do_add_subscription(user_profile, stream, no_log=False):
     # type: (UserProfile, Stream, bool) -> bool
     recipient = get_recipient(Recipient.STREAM, stream.id)
     color = pick_color(user_profile)
-    # TODO: XXX: This transaction really needs to be done at the serializeable
-    # transaction isolation level.
+    vacant_before = False
     with transaction.atomic():
-        vacant_before = stream.num_subscribers() == 0
         (subscription, created) = Subscription.objects.get_or_create(
             user_profile=user_profile, recipient=recipient,
             defaults={'active': True, 'color': color,
                       'notifications': user_profile.default_desktop_notifications})
         did_subscribe = created
         if not subscription.active:
-            did_subscribe = True
+            # Only count the subscription if a concurrent subscribe
+            # didn't reactivate it first.
+            did_subscribe = Subscription.objects.filter(
+                id=subscription.id, active=False).update(active=True) > 0
             subscription.active = True
-            subscription.save(update_fields=["active"])
+        if did_subscribe and user_profile.is_active:
+            (newly_occupied, _) = change_subscriber_counts({stream.id: 1})
+            vacant_before = stream.id in newly_occupied
 
     if vacant_before and did_subscribe and not stream.invite_only:
         event = dict(type="stream", op="occupy",
@@ -1435,8 +1556,8 @@ def do_add_subscription(user_profile, stream, no_log=False):
 
     return did_subscribe
 
-def notify_subscriptions_removed(user_profile, streams, no_log=False):
-    # type: (UserProfile, Iterable[Stream], bool) -> None
+def notify_subscriptions_removed(user_profile, streams, no_log=False, notify_peers=True):
+    # type: (UserProfile, Iterable[Stream], bool, bool) -> None
     if not no_log:
         log_event({'type': 'subscription_removed',
                    'user': user_profile.email,
@@ -1448,6 +1569,11 @@ def notify_subscriptions_removed(user_profile, streams, no_log=False):
                  subscriptions=payload)
     send_event(event, [user_profile.id])
 
+    if not notify_peers:
+        # The caller sends the peer_remove events for a bulk unsubscribe;
+        # see bulk_remove_subscriptions.
+        return
+
     # As with a subscription add, send a 'peer subscription' notice to other
     # subscribers so they know the user unsubscribed.
     # FIXME: This code was mostly a copy-paste from notify_subscriptions_added.
@@ -1490,17 +1616,29 @@ def bulk_remove_subscriptions(users, streams):
         for recipient_id in recipients_to_unsub:
             not_subscribed.append((user_profile, stream_map[recipient_id]))
 
-    # TODO: XXX: This transaction really needs to be done at the serializeable
-    # transaction isolation level.
     with transaction.atomic():
-        occupied_streams_before = list(get_occupied_streams(user_profile.realm))
-        Subscription.objects.filter(id__in=[sub.id for (sub, stream_name) in
-                                            subs_to_deactivate]).update(active=False)
-        occupied_streams_after = list(get_occupied_streams(user_profile.realm))
-
-    new_vacant_streams = [stream for stream in
-                          set(occupied_streams_before) - set(occupied_streams_after)
-                          if not stream.invite_only]
+        if subs_to_deactivate:
+            # Lock the subscriptions and check that they're still
+            # active, so that a concurrent unsubscribe isn't counted
+            # twice.
+            active_sub_ids = set(Subscription.objects.select_for_update().filter(
+                id__in=[sub.id for (sub, stream) in subs_to_deactivate],
+                active=True).values_list('id', flat=True))
+            not_subscribed.extend((sub.user_profile, stream) for (sub, stream) in subs_to_deactivate
+                                  if sub.id not in active_sub_ids)
+            subs_to_deactivate = [(sub, stream) for (sub, stream) in subs_to_deactivate
+                                  if sub.id in active_sub_ids]
+            Subscription.objects.filter(id__in=active_sub_ids).update(active=False)
+
+        subscriber_deltas = defaultdict(int) # type: Dict[int, int]
+        for (sub, stream) in subs_to_deactivate:
+            if sub.user_profile.is_active:
+                subscriber_deltas[stream.id] -= 1
+        (_, newly_vacant) = change_subscriber_counts(subscriber_deltas)
+
+    new_vacant_streams = [stream for stream in streams
+                          if stream.id in newly_vacant and
+                          not stream.invite_only and not stream.deactivated]
     if new_vacant_streams:
         event = dict(type="stream", op="vacate",
                      streams=[stream.to_dict()
@@ -1511,10 +1649,33 @@ def bulk_remove_subscriptions(users, streams):
     for (sub, stream) in subs_to_deactivate:
         streams_by_user[sub.user_profile_id].append(stream)
 
+    removed_users_by_stream = defaultdict(list) # type: Dict[int, List[UserProfile]]
     for user_profile in users:
         if len(streams_by_user[user_profile.id]) == 0:
             continue
-        notify_subscriptions_removed(user_profile, streams_by_user[user_profile.id])
+        notify_subscriptions_removed(user_profile, streams_by_user[user_profile.id],
+                                     notify_peers=False)
+        for stream in streams_by_user[user_profile.id]:
+            removed_users_by_stream[stream.id].append(user_profile)
+
+    # Send a 'peer subscription' notice to the remaining subscribers
+    # of each stream, so they know the users unsubscribed.
+    subscriber_ids_by_stream = defaultdict(set) # type: Dict[int, Set[int]]
+    for (stream_id, subscriber_id) in Subscription.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id__in=list(removed_users_by_stream.keys()),
+            user_profile__is_active=True,
+            active=True).values_list('recipient__type_id', 'user_profile_id'):
+        subscriber_ids_by_stream[stream_id].add(subscriber_id)
+
+    peer_changes = [] # type: List[Tuple[Stream, List[UserProfile], AbstractSet[int]]]
+    for stream in streams:
+        if stream.realm.domain == "mit.edu" and not stream.invite_only:
+            # We don't track subscribers to public MIT streams.
+            continue
+        peer_changes.append((stream, removed_users_by_stream[stream.id],
+                             subscriber_ids_by_stream[stream.id]))
+    send_peer_subscription_events("peer_remove", peer_changes)
 
     return ([(sub.user_profile, stream) for (sub, stream) in subs_to_deactivate],
             not_subscribed)
@@ -1527,11 +1688,16 @@ def do_remove_subscription(user_profile, stream, no_log=False):
     if len(maybe_sub) == 0:
         return False
     subscription = maybe_sub[0]
-    did_remove = subscription.active
-    subscription.active = False
+    vacant_after = False
     with transaction.atomic():
-        subscription.save(update_fields=["active"])
-        vacant_after = stream.num_subscribers() == 0
+        # Only count the removal if the subscription was still active;
+        # a concurrent unsubscribe may have deactivated it already.
+        did_remove = Subscription.objects.filter(
+            id=subscription.id, active=True).update(active=False) > 0
+        subscription.active = False
+        if did_remove and user_profile.is_active:
+            (_, newly_vacant) = change_subscriber_counts({stream.id: -1})
+            vacant_after = stream.id in newly_vacant
 
     if vacant_after and did_remove and not stream.invite_only:
         event = dict(type="stream", op="vacate",
@@ -1570,12 +1736,16 @@ def do_change_subscription_property(user_profile, sub, stream_name,
 
 def do_activate_user(user_profile, log=True, join_date=timezone.now()):
     # type: (UserProfile, bool, datetime.datetime) -> None
+    was_active = user_profile.is_active
     user_profile.is_active = True
     user_profile.is_mirror_dummy = False
     user_profile.set_unusable_password()
     user_profile.date_joined = join_date
-    user_profile.save(update_fields=["is_active", "date_joined", "password",
-                                     "is_mirror_dummy"])
+    with transaction.atomic():
+        user_profile.save(update_fields=["is_active", "date_joined", "password",
+                                         "is_mirror_dummy"])
+        if not was_active:
+            change_user_subscriber_counts(user_profile, 1)
 
     if log:
         domain = user_profile.realm.domain
@@ -1589,8 +1759,12 @@ def do_reactivate_user(user_profile):
     # type: (UserProfile) -> None
     # Unlike do_activate_user, this is meant for re-activating existing users,
     # so it doesn't reset their password, etc.
+    was_active = user_profile.is_active
     user_profile.is_active = True
-    user_profile.save(update_fields=["is_active"])
+    with transaction.atomic():
+        user_profile.save(update_fields=["is_active"])
+        if not was_active:
+            change_user_subscriber_counts(user_profile, 1)
 
     domain = user_profile.realm.domain
     log_event({'type': 'user_reactivated',
@@ -2109,43 +2283,111 @@ def streams_to_dicts_sorted(streams):
     # type: (List[Stream]) -> List[Dict[str, Any]]
     return sorted([stream.to_dict() for stream in streams], key=lambda elt: elt["name"])
 
-def do_update_user_activity_interval(user_profile, log_time):
-    # type: (UserProfile, datetime.datetime) -> None
-    effective_end = log_time + datetime.timedelta(minutes=15)
+def do_update_user_activity_intervals(activity_times):
+    # type: (Mapping[int, Iterable[datetime.datetime]]) -> None
+    """Bulk version of do_update_user_activity_interval: activity_times
+    maps user ids to the times they were active.  Each time counts as
+    activity for the following 15 minutes; overlapping intervals are
+    merged with each other and with each user's latest interval in the
+    database, which are all fetched with one query and extended with
+    another."""
+    intervals = defaultdict(list) # type: Dict[int, List[List[Any]]]
+    for user_profile_id, log_times in activity_times.items():
+        for log_time in log_times:
+            intervals[user_profile_id].append([log_time, log_time + datetime.timedelta(minutes=15), None])
+    if not intervals:
+        return
+
     # This code isn't perfect, because with various races we might end
     # up creating two overlapping intervals, but that shouldn't happen
     # often, and can be corrected for in post-processing
+    latest_intervals = UserActivityInterval.objects.filter(
+        user_profile_id__in=list(intervals.keys())).order_by(
+        'user_profile_id', '-end').distinct('user_profile_id')
+    for last in latest_intervals:
+        intervals[last.user_profile_id].append([last.start, last.end, last.id])
+
+    new_intervals = [] # type: List[UserActivityInterval]
+    extended_intervals = [] # type: List[List[Any]]
+    for user_profile_id, user_intervals in intervals.items():
+        merged = [] # type: List[List[Any]]
+        for start, end, interval_id in sorted(user_intervals, key=lambda interval: interval[0]):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+                if interval_id is not None:
+                    merged[-1][2] = interval_id
+            else:
+                merged.append([start, end, interval_id])
+        for start, end, interval_id in merged:
+            if interval_id is None:
+                new_intervals.append(UserActivityInterval(user_profile_id=user_profile_id,
+                                                          start=start, end=end))
+            else:
+                extended_intervals.append([interval_id, start, end])
+
+    UserActivityInterval.objects.bulk_create(new_intervals)
+    if extended_intervals:
+        query = ('UPDATE zerver_useractivityinterval SET start = data.start_time, "end" = data.end_time '
+                 'FROM (VALUES %s) AS data (id, start_time, end_time) '
+                 'WHERE zerver_useractivityinterval.id = data.id' % (
+                     ", ".join(["(%s, %s, %s)"] * len(extended_intervals)),))
+        with connection.cursor() as cursor:
+            cursor.execute(query, list(itertools.chain.from_iterable(extended_intervals)))
+
+def do_update_user_activity_interval(user_profile, log_time):
+    # type: (UserProfile, datetime.datetime) -> None
+    do_update_user_activity_intervals({user_profile.id: [log_time]})
+
+def do_update_user_activities(activity_counts, retry_on_conflict=True):
+    # type: (Mapping[Tuple[int, int, text_type], Tuple[int, datetime.datetime]], bool) -> None
+    """Bulk version of do_update_user_activity: activity_counts maps
+    (user id, client id, query) to the number of new visits and the
+    time of the latest one.  Missing UserActivity rows are created with
+    a single INSERT, and the rest are updated with a single UPDATE."""
+    if not activity_counts:
+        return
+
+    existing = set(UserActivity.objects.filter(
+        user_profile_id__in=set(key[0] for key in activity_counts),
+        client_id__in=set(key[1] for key in activity_counts),
+        query__in=set(key[2] for key in activity_counts)).values_list(
+        'user_profile_id', 'client_id', 'query'))
+
+    new_activities = [UserActivity(user_profile_id=user_profile_id, client_id=client_id, query=query,
+                                   count=count, last_visit=last_visit)
+                      for (user_profile_id, client_id, query), (count, last_visit)
+                      in activity_counts.items()
+                      if (user_profile_id, client_id, query) not in existing]
     try:
-        last = UserActivityInterval.objects.filter(user_profile=user_profile).order_by("-end")[0]
-        # There are two ways our intervals could overlap:
-        # (1) The start of the new interval could be inside the old interval
-        # (2) The end of the new interval could be inside the old interval
-        # In either case, we just extend the old interval to include the new interval.
-        if ((log_time <= last.end and log_time >= last.start) or
-            (effective_end <= last.end and effective_end >= last.start)):
-            last.end = max(last.end, effective_end)
-            last.start = min(last.start, log_time)
-            last.save(update_fields=["start", "end"])
-            return
-    except IndexError:
-        pass
+        with transaction.atomic():
+            UserActivity.objects.bulk_create(new_activities)
+    except IntegrityError:
+        # Someone else created some of these rows since we looked for
+        # them.  Nothing has been written yet, so just start over.
+        if not retry_on_conflict:
+            raise
+        do_update_user_activities(activity_counts, retry_on_conflict=False)
+        return
 
-    # Otherwise, the intervals don't overlap, so we should make a new one
-    UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
-                                        end=effective_end)
+    params = [] # type: List[Any]
+    for key, (count, last_visit) in activity_counts.items():
+        if key in existing:
+            params.extend([key[0], key[1], key[2], count, last_visit])
+    if params:
+        query = ("UPDATE zerver_useractivity SET count = zerver_useractivity.count + data.count, "
+                 "last_visit = GREATEST(zerver_useractivity.last_visit, data.last_visit) "
+                 "FROM (VALUES %s) AS data (user_profile_id, client_id, query, count, last_visit) "
+                 "WHERE zerver_useractivity.user_profile_id = data.user_profile_id "
+                 "AND zerver_useractivity.client_id = data.client_id "
+                 "AND zerver_useractivity.query = data.query" % (
+                     ", ".join(["(%s, %s, %s, %s, %s)"] * (len(params) // 5)),))
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+    statsd.incr('user_activity', sum(count for count, _ in activity_counts.values()))
 
-@statsd_increment('user_activity')
 def do_update_user_activity(user_profile, client, query, log_time):
     # type: (UserProfile, Client, text_type, datetime.datetime) -> None
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        query = query,
-        defaults={'last_visit': log_time, 'count': 0})
-
-    activity.count += 1
-    activity.last_visit = log_time
-    activity.save(update_fields=["last_visit", "count"])
+    do_update_user_activities({(user_profile.id, client.id, query): (1, log_time)})
 
 def send_presence_changed(user_profile, presence):
     # type: (UserProfile, UserPresence) -> None
@@ -2168,51 +2410,100 @@ def consolidate_client(client):
     else:
         return client
 
-@statsd_increment('user_presence')
+def do_update_user_presences(presence_updates, retry_on_conflict=True):
+    # type: (Sequence[Tuple[UserProfile, Client, datetime.datetime, int]], bool) -> None
+    """Bulk version of do_update_user_presence for a list of (user,
+    client, time, status) updates.  Only the latest update for each user
+    and client matters; the existing UserPresence rows are all fetched
+    with one query, missing ones are created with one INSERT and the
+    rest are updated with one UPDATE."""
+    latest = {} # type: Dict[Tuple[int, int], Tuple[UserProfile, Client, datetime.datetime, int]]
+    for user_profile, client, log_time, status in presence_updates:
+        client = consolidate_client(client)
+        key = (user_profile.id, client.id)
+        if key not in latest or latest[key][2] <= log_time:
+            latest[key] = (user_profile, client, log_time, status)
+    if not latest:
+        return
+
+    existing = dict(((presence.user_profile_id, presence.client_id), presence)
+                    for presence in UserPresence.objects.filter(
+                        user_profile_id__in=set(key[0] for key in latest),
+                        client_id__in=set(key[1] for key in latest)))
+
+    new_presences = [] # type: List[UserPresence]
+    updated_presences = [] # type: List[UserPresence]
+    changed = [] # type: List[Tuple[UserProfile, UserPresence]]
+    for key, (user_profile, client, log_time, status) in latest.items():
+        presence = existing.get(key)
+        if presence is None:
+            presence = UserPresence(user_profile=user_profile, client=client,
+                                    timestamp=log_time, status=status)
+            new_presences.append(presence)
+            changed.append((user_profile, presence))
+            continue
+
+        stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
+        was_idle = presence.status == UserPresence.IDLE
+        became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
+
+        # We suppress changes from ACTIVE to IDLE before stale_status is reached;
+        # this protects us from the user having two clients open: one active, the
+        # other idle. Without this check, we would constantly toggle their status
+        # between the two states.
+        if stale_status or was_idle or status == presence.status:
+            presence.timestamp = log_time
+            presence.status = status
+            updated_presences.append(presence)
+        if became_online:
+            changed.append((user_profile, presence))
+
+    try:
+        with transaction.atomic():
+            UserPresence.objects.bulk_create(new_presences)
+    except IntegrityError:
+        # Someone else created some of these rows since we looked for
+        # them.  Nothing has been written yet, so just start over.
+        if not retry_on_conflict:
+            raise
+        do_update_user_presences(presence_updates, retry_on_conflict=False)
+        return
+
+    if updated_presences:
+        params = [] # type: List[Any]
+        for presence in updated_presences:
+            params.extend([presence.id, presence.timestamp, presence.status])
+        query = ('UPDATE zerver_userpresence SET "timestamp" = data.new_timestamp, '
+                 'status = data.new_status '
+                 'FROM (VALUES %s) AS data (id, new_timestamp, new_status) '
+                 'WHERE zerver_userpresence.id = data.id' % (
+                     ", ".join(["(%s, %s, %s)"] * len(updated_presences)),))
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+
+    # Neither query sends UserPresence's post_save signal, so we flush
+    # the presence dicts of the users we changed ourselves.
+    cache_delete_many(set(user_presence_dicts_cache_key(presence.user_profile_id)
+                          for presence in new_presences + updated_presences))
+    statsd.incr('user_presence', len(latest))
+
+    for user_profile, presence in changed:
+        if not user_profile.realm.domain == "mit.edu":
+            # Push event to all users in the realm so they see the new user
+            # appear in the presence list immediately, or the newly online
+            # user without delay.  Note that we won't send an update here for a
+            # timestamp update, because we rely on the browser to ping us every 50
+            # seconds for realm-wide status updates, and those updates should have
+            # recent timestamps, which means the browser won't think active users
+            # have gone idle.  If we were more aggressive in this function about
+            # sending timestamp updates, we could eliminate the ping responses, but
+            # that's not a high priority for now, considering that most of our non-MIT
+            # realms are pretty small.
+            send_presence_changed(user_profile, presence)
+
 def do_update_user_presence(user_profile, client, log_time, status):
     # type: (UserProfile, Client, datetime.datetime, int) -> None
-    client = consolidate_client(client)
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        defaults = {'timestamp': log_time,
-                    'status': status})
-
-    stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
-    was_idle = presence.status == UserPresence.IDLE
-    became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
-
-    # If an object was created, it has already been saved.
-    #
-    # We suppress changes from ACTIVE to IDLE before stale_status is reached;
-    # this protects us from the user having two clients open: one active, the
-    # other idle. Without this check, we would constantly toggle their status
-    # between the two states.
-    if not created and stale_status or was_idle or status == presence.status:
-        # The following block attempts to only update the "status"
-        # field in the event that it actually changed.  This is
-        # important to avoid flushing the UserPresence cache when the
-        # data it would return to a client hasn't actually changed
-        # (see the UserPresence post_save hook for details).
-        presence.timestamp = log_time
-        update_fields = ["timestamp"]
-        if presence.status != status:
-            presence.status = status
-            update_fields.append("status")
-        presence.save(update_fields=update_fields)
-
-    if not user_profile.realm.domain == "mit.edu" and (created or became_online):
-        # Push event to all users in the realm so they see the new user
-        # appear in the presence list immediately, or the newly online
-        # user without delay.  Note that we won't send an update here for a
-        # timestamp update, because we rely on the browser to ping us every 50
-        # seconds for realm-wide status updates, and those updates should have
-        # recent timestamps, which means the browser won't think active users
-        # have gone idle.  If we were more aggressive in this function about
-        # sending timestamp updates, we could eliminate the ping responses, but
-        # that's not a high priority for now, considering that most of our non-MIT
-        # realms are pretty small.
-        send_presence_changed(user_profile, presence)
+    do_update_user_presences([(user_profile, client, log_time, status)])
 
 def update_user_activity_interval(user_profile, log_time):
     # type: (UserProfile, datetime.datetime) -> None
@@ -2255,14 +2546,84 @@ def do_update_pointer(user_profile, pointer, update_flags=False):
     event = dict(type='pointer', pointer=pointer)
     send_event(event, [user_profile.id])
 
-def do_update_message_flags(user_profile, operation, flag, messages, all, stream_obj, topic_name):
-    # type: (UserProfile, str, str, Sequence[Message], bool, Optional[Stream], Optional[text_type]) -> int
+# Flag updates that can touch a very large number of messages (all of
+# a user's messages, or a whole stream) are done in chunks of this many
+# messages, so that no single UPDATE holds locks on too many rows.
+MESSAGE_FLAGS_CHUNK_SIZE = 5000
+
+def update_message_flags_in_ranges(user_profile, operation, flag, msgs, all=False,
+                                   recipient=None, topic_name=None,
+                                   chunk_size=MESSAGE_FLAGS_CHUNK_SIZE, progress=None):
+    # type: (UserProfile, str, str, QuerySet, bool, Optional[Recipient], Optional[text_type], int, Optional[Callable[[int, int], None]]) -> int
+    """Updates flag on user_profile's UserMessage rows in msgs, in chunks
+    of consecutive message ids, each its own UPDATE.
+
+    Rather than the ids of the messages, the event for each chunk
+    describes its range of message ids, along with the recipient and
+    topic the messages were restricted to (if any): every message the
+    user has in that range now has (or doesn't have) the flag.  If
+    given, progress is called after each chunk with the number of
+    messages updated so far and the last message id updated."""
+    flagattr = getattr(UserMessage.flags, flag)
+
+    # The filter() statements below prevent postgres from doing a lot of
+    # unnecessary work, which is a big deal for users updating lots of
+    # flags (e.g. bankruptcy).  This patch arose from seeing slow calls
+    # to POST /json/messages/flags in the logs.  The filter() statements
+    # are kind of magical; they are actually just testing the one bit.
+    if operation == 'add':
+        msgs = msgs.filter(flags=~flagattr)
+        new_flags = F('flags').bitor(flagattr)
+    elif operation == 'remove':
+        msgs = msgs.filter(flags=flagattr)
+        new_flags = F('flags').bitand(~flagattr)
+
+    # Don't chase messages that arrive while we're working.
+    until_id = msgs.aggregate(Max('message_id'))['message_id__max']
+    count = 0
+    last_message_id = 0
+    while until_id is not None and last_message_id < until_id:
+        chunk_ids = list(msgs.filter(message_id__gt=last_message_id, message_id__lte=until_id)
+                         .order_by('message_id').values_list('message_id', flat=True)[:chunk_size])
+        if not chunk_ids:
+            break
+        count += msgs.filter(message_id__gt=last_message_id,
+                             message_id__lte=chunk_ids[-1]).update(flags=new_flags)
+
+        message_range = {'after': last_message_id,
+                         'until': chunk_ids[-1]} # type: Dict[str, Any]
+        if recipient is not None:
+            message_range['recipient_id'] = recipient.id
+        if topic_name:
+            message_range['topic'] = topic_name
+        event = {'type': 'update_message_flags',
+                 'operation': operation,
+                 'flag': flag,
+                 'messages': [],
+                 'message_range': message_range,
+                 'all': all}
+        log_event(event)
+        send_event(event, [user_profile.id])
+
+        last_message_id = chunk_ids[-1]
+        if progress is not None:
+            progress(count, last_message_id)
+    return count
+
+def do_update_message_flags(user_profile, operation, flag, messages, all, stream_obj, topic_name,
+                            progress=None):
+    # type: (UserProfile, str, str, Sequence[int], bool, Optional[Stream], Optional[text_type], Optional[Callable[[int, int], None]]) -> int
     flagattr = getattr(UserMessage.flags, flag)
 
     if all:
         log_statsd_event('bankruptcy')
         msgs = UserMessage.objects.filter(user_profile=user_profile)
-    elif stream_obj is not None:
+        count = update_message_flags_in_ranges(user_profile, operation, flag, msgs,
+                                               all=True, progress=progress)
+        statsd.incr("flags.%s.%s" % (flag, operation), count)
+        return count
+
+    if stream_obj is not None:
         recipient = get_recipient(Recipient.STREAM, stream_obj.id)
         if topic_name:
             msgs = UserMessage.objects.filter(message__recipient=recipient,
@@ -2270,49 +2631,46 @@ def do_update_message_flags(user_profile, operation, flag, messages, all, stream
                                               message__subject__iexact=topic_name)
         else:
             msgs = UserMessage.objects.filter(message__recipient=recipient, user_profile=user_profile)
-    else:
-        msgs = UserMessage.objects.filter(user_profile=user_profile,
-                                          message__id__in=messages)
-        # Hack to let you star any message
-        if msgs.count() == 0:
-            if not len(messages) == 1:
-                raise JsonableError(_("Invalid message(s)"))
-            if flag != "starred":
-                raise JsonableError(_("Invalid message(s)"))
-            # Check that the user could have read the relevant message
-            try:
-                message = Message.objects.get(id=messages[0])
-            except Message.DoesNotExist:
-                raise JsonableError(_("Invalid message(s)"))
-            recipient = Recipient.objects.get(id=message.recipient_id)
-            if recipient.type != Recipient.STREAM:
-                raise JsonableError(_("Invalid message(s)"))
-            stream = Stream.objects.select_related("realm").get(id=recipient.type_id)
-            if not stream.is_public():
-                raise JsonableError(_("Invalid message(s)"))
-
-            # OK, this is a message that you legitimately have access
-            # to via narrowing to the stream it is on, even though you
-            # didn't actually receive it.  So we create a historical,
-            # read UserMessage message row for you to star.
-            UserMessage.objects.create(user_profile=user_profile,
-                                       message=message,
-                                       flags=UserMessage.flags.historical | UserMessage.flags.read)
-
-    # The filter() statements below prevent postgres from doing a lot of
-    # unnecessary work, which is a big deal for users updating lots of
-    # flags (e.g. bankruptcy).  This patch arose from seeing slow calls
-    # to POST /json/messages/flags in the logs.  The filter() statements
-    # are kind of magical; they are actually just testing the one bit.
+        count = update_message_flags_in_ranges(user_profile, operation, flag, msgs,
+                                               recipient=recipient, topic_name=topic_name,
+                                               progress=progress)
+        statsd.incr("flags.%s.%s" % (flag, operation), count)
+        return count
+
+    msgs = UserMessage.objects.filter(user_profile=user_profile,
+                                      message__id__in=messages)
+    # Hack to let you star any message
+    if msgs.count() == 0:
+        if not len(messages) == 1:
+            raise JsonableError(_("Invalid message(s)"))
+        if flag != "starred":
+            raise JsonableError(_("Invalid message(s)"))
+        # Check that the user could have read the relevant message
+        try:
+            message = Message.objects.get(id=messages[0])
+        except Message.DoesNotExist:
+            raise JsonableError(_("Invalid message(s)"))
+        recipient = Recipient.objects.get(id=message.recipient_id)
+        if recipient.type != Recipient.STREAM:
+            raise JsonableError(_("Invalid message(s)"))
+        stream = Stream.objects.select_related("realm").get(id=recipient.type_id)
+        if not stream.is_public():
+            raise JsonableError(_("Invalid message(s)"))
+
+        # OK, this is a message that you legitimately have access
+        # to via narrowing to the stream it is on, even though you
+        # didn't actually receive it.  So we create a historical,
+        # read UserMessage message row for you to star.
+        UserMessage.objects.create(user_profile=user_profile,
+                                   message=message,
+                                   flags=UserMessage.flags.historical | UserMessage.flags.read)
+
+    # See the comment in update_message_flags_in_ranges about these filters.
     if operation == 'add':
         msgs = msgs.filter(flags=~flagattr)
-        if stream_obj:
-            messages = list(msgs.values_list('message__id', flat=True))
         count = msgs.update(flags=F('flags').bitor(flagattr))
     elif operation == 'remove':
         msgs = msgs.filter(flags=flagattr)
-        if stream_obj:
-            messages = list(msgs.values_list('message__id', flat=True))
         count = msgs.update(flags=F('flags').bitand(~flagattr))
 
     event = {'type': 'update_message_flags',
@@ -2443,32 +2801,6 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
         event['subject_links'] = bugdown.subject_links(message.sender.realm.domain.lower(), subject)
         edit_history_event["prev_subject"] = orig_subject
 
-
-        if propagate_mode in ["change_later", "change_all"]:
-            propagate_query = Q(recipient = message.recipient, subject = orig_subject)
-            # We only change messages up to 2 days in the past, to avoid hammering our
-            # DB by changing an unbounded amount of messages
-            if propagate_mode == 'change_all':
-                before_bound = now() - datetime.timedelta(days=2)
-
-                propagate_query = propagate_query & ~Q(id = message.id) & \
-                                                     Q(pub_date__range=(before_bound, now()))
-            if propagate_mode == 'change_later':
-                propagate_query = propagate_query & Q(id__gt = message.id)
-
-            messages = Message.objects.filter(propagate_query).select_related();
-
-            # Evaluate the query before running the update
-            messages_list = list(messages)
-            messages.update(subject=subject)
-
-            for m in messages_list:
-                # The cached ORM object is not changed by messages.update()
-                # and the remote cache update requires the new value
-                m.subject = subject
-
-            changed_messages += messages_list
-
     message.last_edit_time = timezone.now()
     event['edit_timestamp'] = datetime_to_timestamp(message.last_edit_time)
     edit_history_event['timestamp'] = event['edit_timestamp']
@@ -2504,6 +2836,154 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
         }
     send_event(event, list(map(user_info, ums)))
 
+    if content is not None:
+        queue_link_previews(message)
+
+    if subject is not None and propagate_mode in ["change_later", "change_all"]:
+        # The rest of the topic can be arbitrarily large, so we move it
+        # in the background; see do_propagate_topic_rename.
+        topic_event = dict((key, event[key]) for key in
+                           ['type', 'sender', 'message_id', 'orig_subject', 'propagate_mode',
+                            'stream_id', 'subject', 'subject_links', 'edit_timestamp'])
+        queue_json_publish("topic_renames",
+                           {"event": topic_event, "recipient_id": message.recipient_id},
+                           lambda job: do_propagate_topic_rename(job["event"], job["recipient_id"]))
+
+def queue_link_previews(message):
+    # type: (Message) -> None
+    """Queues the link previews that rendering message didn't find in the
+    cache to be fetched, and the message updated with them, in the
+    background; see zerver.lib.unfurl."""
+    links = getattr(message, 'links_for_preview', None)
+    if links:
+        queue_json_publish("link_previews", {"message_id": message.id, "links": links},
+                           lambda event: do_render_link_previews([event]))
+
+def do_render_link_previews(events):
+    # type: (Sequence[Mapping[str, Any]]) -> List[int]
+    """Fetches the link previews queued by queue_link_previews for a batch
+    of messages, and re-renders the messages that any of them were found
+    for.  Each message whose rendering changed is saved, and its
+    recipients are sent an update_message event with the new
+    rendered_content (which, unlike an edit, isn't recorded in the
+    message's edit history).  Returns the ids of those messages."""
+    previews = unfurl.fetch_previews([link for event in events for link in event['links']],
+                                     bugdown.fetch_preview)
+    message_ids = [event['message_id'] for event in events
+                   if any(previews.get((kind, key)) is not None
+                          for (kind, key, domain) in event['links'])]
+
+    updated_message_ids = [] # type: List[int]
+    for message in Message.objects.select_related().filter(id__in=message_ids):
+        rendered_content = message.render_markdown(message.content)
+        if rendered_content is None or rendered_content == message.rendered_content:
+            continue
+        # Only save the new rendering if the message hasn't been edited
+        # since we loaded it; otherwise we'd overwrite the edit's
+        # rendering with that of the old content.
+        if not Message.objects.filter(id=message.id, content=message.content).update(
+                rendered_content=rendered_content,
+                rendered_content_version=bugdown.version):
+            continue
+        # The rest of the message may have been edited too, so have the
+        # to_dict cache rebuilt from the database.
+        cache_delete(to_dict_cache_key(message, True))
+
+        event = {'type': 'update_message',
+                 'sender': message.sender.email,
+                 'message_id': message.id,
+                 'message_ids': [message.id],
+                 'rendered_content': rendered_content}
+        users = [{'id': um.user_profile_id, 'flags': um.flags_list()}
+                 for um in UserMessage.objects.filter(message=message.id)]
+        send_event(event, users)
+        updated_message_ids.append(message.id)
+    return updated_message_ids
+
+# How many messages do_propagate_topic_rename moves to the new topic at
+# a time, with a single UPDATE and an update_message event.
+TOPIC_RENAME_CHUNK_SIZE = 1000
+
+def do_propagate_topic_rename(event, recipient_id, chunk_size=TOPIC_RENAME_CHUNK_SIZE):
+    # type: (Dict[str, Any], int, int) -> int
+    """Moves the rest of a topic to the topic that do_update_message
+    moved event['message_id'] to: all of it for propagate_mode
+    change_all, or the messages after it for change_later.
+
+    The messages are moved in chunks of consecutive ids, and for each
+    chunk we refresh their to_dict caches and send the recipients of
+    the edited message an update_message event listing the chunk's
+    message ids.  Returns the number of messages moved."""
+    message_id = event['message_id']
+    messages = Message.objects.filter(recipient_id=recipient_id,
+                                      subject=event['orig_subject']).exclude(id=message_id)
+    if event['propagate_mode'] == 'change_later':
+        messages = messages.filter(id__gt=message_id)
+
+    users = [{'id': um.user_profile_id, 'flags': um.flags_list()}
+             for um in UserMessage.objects.filter(message=message_id)]
+
+    count = 0
+    last_message_id = 0
+    while True:
+        message_ids = list(messages.filter(id__gt=last_message_id).order_by('id')
+                           .values_list('id', flat=True)[:chunk_size])
+        if not message_ids:
+            break
+        Message.objects.filter(id__in=message_ids).update(subject=event['subject'])
+
+        # Update the to_dict caches from a single query, the way
+        # get_old_messages_backend fills them.
+        items_for_remote_cache = {}
+        for row in Message.get_raw_db_rows(message_ids):
+            for apply_markdown in [True, False]:
+                items_for_remote_cache[to_dict_cache_key_id(row['id'], apply_markdown)] = \
+                    (stringify_message_dict(Message.build_dict_from_raw_db_row(row, apply_markdown)),)
+        cache_set_many(items_for_remote_cache, timeout=3600*24)
+
+        chunk_event = dict(event, message_ids=message_ids)
+        log_event(chunk_event)
+        send_event(chunk_event, users)
+
+        count += len(message_ids)
+        last_message_id = message_ids[-1]
+    return count
+
+def do_rerender_messages(messages, pool=None):
+    # type: (Sequence[Message], Optional[Any]) -> List[Message]
+    """Re-renders the content of messages (e.g. after bugdown.version
+    changes) in parallel in a bugdown rendering pool, saves it with a
+    single UPDATE query, and clears the messages' to_dict caches.
+    Returns the messages that were rendered and saved; a message edited
+    since it was fetched is skipped, since the edit rendered it."""
+    rendered = Message.render_markdown_many(messages, pool)
+    rendered_messages = [] # type: List[Message]
+    for message, rendered_content in zip(messages, rendered):
+        if rendered_content is not None:
+            message.set_rendered_content(rendered_content)
+            rendered_messages.append(message)
+    if not rendered_messages:
+        return rendered_messages
+
+    params = [bugdown.version] # type: List[Any]
+    for message in rendered_messages:
+        params.extend([message.id, message.content, message.rendered_content])
+    query = ("UPDATE zerver_message SET rendered_content = data.rendered_content, "
+             "rendered_content_version = %%s "
+             "FROM (VALUES %s) AS data (id, content, rendered_content) "
+             "WHERE zerver_message.id = data.id AND zerver_message.content = data.content "
+             "RETURNING zerver_message.id" % (", ".join(["(%s, %s, %s)"] * len(rendered_messages)),))
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        updated_ids = set(row[0] for row in cursor.fetchall())
+    updated_messages = [message for message in rendered_messages if message.id in updated_ids]
+
+    # Only the apply_markdown=True dictionaries contain rendered_content.
+    # We delete them rather than setting them from our copies, which an
+    # edit racing with us could have made stale.
+    cache_delete_many(to_dict_cache_key_id(message.id, True) for message in updated_messages)
+    return updated_messages
+
 def encode_email_address(stream):
     # type: (Stream) -> text_type
     return encode_email_address_helper(stream.name, stream.email_token)
@@ -2672,6 +3152,17 @@ def get_status_dict(requesting_user_profile):
 
     return UserPresence.get_status_dict_by_realm(requesting_user_profile.realm_id)
 
+def get_status_dicts_for_recipients(sender, recipients):
+    # type: (UserProfile, Iterable[UserProfile]) -> Dict[int, Dict[text_type, Dict[str, Any]]]
+    """Presence info, keyed by user id, for just those recipients of a
+    message from `sender` who are in the sender's realm."""
+    # Return no status info for MIT
+    if sender.realm.domain == 'mit.edu':
+        return {}
+
+    return UserPresence.get_status_dicts_for_users(
+        [user_profile.id for user_profile in recipients
+         if user_profile.realm.id == sender.realm_id])
 
 def get_realm_user_dicts(user_profile):
     # type: (UserProfile) -> List[Dict[str, text_type]]
@@ -2776,6 +3267,14 @@ def fetch_initial_state_data(user_profile, event_types, queue_id):
 
     return state
 
+def peer_event_user_ids(event):
+    # type: (Mapping[str, Any]) -> List[int]
+    if 'user_emails' in event:
+        emails = event['user_emails']
+    else:
+        emails = [event['user_email']]
+    return [get_user_profile_by_email(email).id for email in emails]
+
 def apply_events(state, events, user_profile):
     # type: (Dict[str, Any], Iterable[Dict[str, Any]], UserProfile) -> None
     for event in events:
@@ -2912,21 +3411,21 @@ def apply_events(state, events, user_profile):
                     if sub['name'].lower() == event['name'].lower():
                         sub[event['property']] = event['value']
             elif event['op'] == 'peer_add':
-                user_id = get_user_profile_by_email(event['user_email']).id
-                for sub in state['subscriptions']:
-                    if (sub['name'] in event['subscriptions'] and
-                        user_id not in sub['subscribers']):
-                        sub['subscribers'].append(user_id)
-                for sub in state['never_subscribed']:
-                    if (sub['name'] in event['subscriptions'] and
-                        user_id not in sub['subscribers']):
-                        sub['subscribers'].append(user_id)
+                for user_id in peer_event_user_ids(event):
+                    for sub in state['subscriptions']:
+                        if (sub['name'] in event['subscriptions'] and
+                            user_id not in sub['subscribers']):
+                            sub['subscribers'].append(user_id)
+                    for sub in state['never_subscribed']:
+                        if (sub['name'] in event['subscriptions'] and
+                            user_id not in sub['subscribers']):
+                            sub['subscribers'].append(user_id)
             elif event['op'] == 'peer_remove':
-                user_id = get_user_profile_by_email(event['user_email']).id
-                for sub in state['subscriptions']:
-                    if (sub['name'] in event['subscriptions'] and
-                        user_id in sub['subscribers']):
-                        sub['subscribers'].remove(user_id)
+                for user_id in peer_event_user_ids(event):
+                    for sub in state['subscriptions']:
+                        if (sub['name'] in event['subscriptions'] and
+                            user_id in sub['subscribers']):
+                            sub['subscribers'].remove(user_id)
         elif event['type'] == "presence":
             state['presences'][event['email']] = event['presence']
         elif event['type'] == "update_message":
@@ -2955,15 +3454,15 @@ def apply_events(state, events, user_profile):
 
 def do_events_register(user_profile, user_client, apply_markdown=True,
                        event_types=None, queue_lifespan_secs=0, all_public_streams=False,
-                       narrow=[]):
-    # type: (UserProfile, Client, bool, Optional[Iterable[str]], int, bool, Iterable[Sequence[text_type]]) -> Dict[str, Any]
+                       narrow=[], compact_peer_events=False):
+    # type: (UserProfile, Client, bool, Optional[Iterable[str]], int, bool, Iterable[Sequence[text_type]], bool) -> Dict[str, Any]
     # Technically we don't need to check this here because
     # build_narrow_filter will check it, but it's nicer from an error
     # handling perspective to do it before contacting Tornado
     check_supported_events_narrow_filter(narrow)
     queue_id = request_event_queue(user_profile, user_client, apply_markdown,
                                    queue_lifespan_secs, event_types, all_public_streams,
-                                   narrow=narrow)
+                                   narrow=narrow, compact_peer_events=compact_peer_events)
 
     if queue_id is None:
         raise JsonableError(_("Could not allocate event queue"))
@@ -3269,12 +3768,86 @@ def get_occupied_streams(realm):
     # type: (Realm) -> QuerySet
     # TODO: Make a generic stub for QuerySet
     """ Get streams with subscribers """
-    subs_filter = Subscription.objects.filter(active=True, user_profile__realm=realm,
-                                              user_profile__is_active=True).values('recipient_id')
-    stream_ids = Recipient.objects.filter(
-        type=Recipient.STREAM, id__in=subs_filter).values('type_id')
-
-    return Stream.objects.filter(id__in=stream_ids, realm=realm, deactivated=False)
+    return Stream.objects.filter(realm=realm, deactivated=False, subscriber_count__gt=0)
+
+def change_subscriber_counts(stream_deltas):
+    # type: (Mapping[int, int]) -> Tuple[Set[int], Set[int]]
+    """Adds stream_deltas (a map from stream ids to the change in their
+    number of active subscribers) to the streams' subscriber_count, and
+    returns the ids of the streams that became occupied and the ids of
+    those that became vacant.  This must be called in the transaction
+    that changes the subscriptions; it locks the streams' rows until
+    the end of it, so that concurrent changes to the same streams are
+    counted one after the other."""
+    stream_ids_by_delta = defaultdict(list) # type: Dict[int, List[int]]
+    for (stream_id, delta) in six.iteritems(stream_deltas):
+        if delta != 0:
+            stream_ids_by_delta[delta].append(stream_id)
+    if not stream_ids_by_delta:
+        return (set(), set())
+
+    changed_stream_ids = [stream_id for stream_ids in stream_ids_by_delta.values()
+                          for stream_id in stream_ids]
+    counts_before = dict(Stream.objects.select_for_update().filter(
+        id__in=changed_stream_ids).values_list('id', 'subscriber_count'))
+    for (delta, stream_ids) in six.iteritems(stream_ids_by_delta):
+        Stream.objects.filter(id__in=stream_ids).update(
+            subscriber_count=F('subscriber_count') + delta)
+
+    newly_occupied = set() # type: Set[int]
+    newly_vacant = set() # type: Set[int]
+    for (stream_id, count) in six.iteritems(counts_before):
+        if count == 0 and count + stream_deltas[stream_id] > 0:
+            newly_occupied.add(stream_id)
+        elif count > 0 and count + stream_deltas[stream_id] <= 0:
+            newly_vacant.add(stream_id)
+    return (newly_occupied, newly_vacant)
+
+def change_user_subscriber_counts(user_profile, delta):
+    # type: (UserProfile, int) -> None
+    """Updates the subscriber_count of the user's streams when the user
+    is deactivated (delta=-1) or reactivated (delta=1)."""
+    stream_ids = Subscription.objects.filter(
+        user_profile=user_profile, active=True,
+        recipient__type=Recipient.STREAM).values_list('recipient__type_id', flat=True)
+    change_subscriber_counts(dict((stream_id, delta) for stream_id in stream_ids))
+
+# Counts the active subscribers of each stream; keep in sync with the
+# migration that added Stream.subscriber_count.
+STREAM_SUBSCRIBER_COUNTS_QUERY = '''
+    SELECT s.id AS stream_id, count(up.id) AS count
+    FROM zerver_stream s
+    LEFT JOIN zerver_recipient r ON r.type = %(stream_type)s AND r.type_id = s.id
+    LEFT JOIN zerver_subscription sub ON sub.recipient_id = r.id AND sub.active
+    LEFT JOIN zerver_userprofile up ON up.id = sub.user_profile_id AND up.is_active
+    %(where)s
+    GROUP BY s.id
+'''
+
+def update_stream_subscriber_counts(stream_ids=None):
+    # type: (Optional[Sequence[int]]) -> int
+    """Recomputes the subscriber_count of the given streams (by default,
+    all of them) from their subscriptions, and returns the number that
+    were wrong.  Subscription changes that don't go through the
+    functions in this file (e.g. populate_db) need this afterwards."""
+    if stream_ids is None:
+        where = ''
+        params = {} # type: Dict[str, Any]
+    else:
+        where = 'WHERE s.id = ANY(%(stream_ids)s)'
+        params = dict(stream_ids=list(stream_ids))
+    query = STREAM_SUBSCRIBER_COUNTS_QUERY % dict(stream_type=Recipient.STREAM, where=where)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Lock the streams first, so that subscription changes that
+            # commit while we count are added on top of our counts.
+            cursor.execute('SELECT id FROM zerver_stream s ' + where + ' FOR UPDATE', params)
+            cursor.execute(
+                'UPDATE zerver_stream SET subscriber_count = counts.count '
+                'FROM (' + query + ') counts '
+                'WHERE zerver_stream.id = counts.stream_id '
+                'AND zerver_stream.subscriber_count != counts.count', params)
+            return cursor.rowcount
 
 def do_get_streams(user_profile, include_public=True, include_subscribed=True,
                    include_all_active=False, include_default=False):
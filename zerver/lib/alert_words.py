@@ -6,7 +6,7 @@ from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
 import ujson
 import six
 from six import text_type
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Set, Tuple
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm):
@@ -17,6 +17,105 @@ def alert_words_in_realm(realm):
     user_ids_with_words = dict((user_id, w) for (user_id, w) in six.iteritems(all_user_words) if len(w))
     return user_ids_with_words
 
+# Characters that may appear immediately before or after an alert word
+# for it to count as a match (in addition to whitespace and the
+# start/end of the message).
+ALERT_WORD_ALLOWED_BEFORE = frozenset(u'(".,\';[*`>')
+ALERT_WORD_ALLOWED_AFTER = frozenset(u')"?:.,\';]!*`')
+
+class AlertWordAutomaton(object):
+    """An Aho-Corasick automaton over all the alert words in a realm.
+
+    Scanning a message once with the automaton finds every alert word
+    in it, which is much cheaper than searching the message separately
+    for each word of each user in the realm.
+    """
+    def __init__(self, realm_alert_words):
+        # type: (Dict[int, List[text_type]]) -> None
+        user_ids_by_word = {} # type: Dict[text_type, Set[int]]
+        for user_id, words in six.iteritems(realm_alert_words):
+            for word in words:
+                word = word.lower()
+                if word:
+                    user_ids_by_word.setdefault(word, set()).add(user_id)
+
+        # State 0 is the root of the trie; for each state we store its
+        # transitions, its failure link, and the (word length, user ids)
+        # pairs for every word ending at that state.
+        self.transitions = [{}] # type: List[Dict[text_type, int]]
+        self.failure = [0] # type: List[int]
+        self.outputs = [[]] # type: List[List[Tuple[int, frozenset]]]
+        for word, user_ids in six.iteritems(user_ids_by_word):
+            state = 0
+            for char in word:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions.append({})
+                    self.failure.append(0)
+                    self.outputs.append([])
+                    self.transitions[state][char] = next_state
+                state = next_state
+            self.outputs[state].append((len(word), frozenset(user_ids)))
+
+        # Compute the failure links breadth-first, so that each state's
+        # failure link is final before we look at its children.
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for char, next_state in six.iteritems(self.transitions[state]):
+                fallback = self.failure[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[next_state] = self.transitions[fallback].get(char, 0)
+                self.outputs[next_state] = (self.outputs[next_state] +
+                                            self.outputs[self.failure[next_state]])
+                queue.append(next_state)
+
+    def user_ids_alerted(self, content):
+        # type: (text_type) -> Set[int]
+        """Returns the ids of users with an alert word in content."""
+        content = content.lower()
+        transitions = self.transitions
+        failure = self.failure
+        outputs = self.outputs
+        user_ids = set() # type: Set[int]
+        state = 0
+        for end, char in enumerate(content):
+            while state and char not in transitions[state]:
+                state = failure[state]
+            state = transitions[state].get(char, 0)
+            if not outputs[state]:
+                continue
+
+            if end + 1 < len(content):
+                after = content[end + 1]
+                if not (after.isspace() or after in ALERT_WORD_ALLOWED_AFTER):
+                    continue
+            for length, word_user_ids in outputs[state]:
+                start = end - length + 1
+                if start > 0:
+                    before = content[start - 1]
+                    if not (before.isspace() or before in ALERT_WORD_ALLOWED_BEFORE):
+                        continue
+                user_ids |= word_user_ids
+        return user_ids
+
+# Compiled automata, by realm id, along with the alert words they were
+# built from.  We check the words against the (memcached)
+# alert_words_in_realm result on every use, so that an automaton is
+# only rebuilt when someone in the realm changes their alert words.
+realm_alert_word_automata = {} # type: Dict[int, Tuple[Dict[int, List[text_type]], AlertWordAutomaton]]
+
+def alert_word_automaton_for_realm(realm):
+    # type: (Realm) -> AlertWordAutomaton
+    realm_words = alert_words_in_realm(realm)
+    cached = realm_alert_word_automata.get(realm.id)
+    if cached is not None and cached[0] == realm_words:
+        return cached[1]
+    automaton = AlertWordAutomaton(realm_words)
+    realm_alert_word_automata[realm.id] = (realm_words, automaton)
+    return automaton
+
 def user_alert_words(user_profile):
     # type: (UserProfile) -> List[text_type]
     return ujson.loads(user_profile.alert_words)
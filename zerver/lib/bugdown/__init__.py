@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 # Zulip's main markdown implementation.  See docs/markdown.md for
 # detailed documentation on our markdown syntax.
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar, Union
 from typing.re import Match
 
 import markdown
@@ -31,13 +31,17 @@ from zerver.lib.avatar  import gravatar_hash
 from zerver.lib.bugdown import codehilite
 from zerver.lib.bugdown import fenced_code
 from zerver.lib.bugdown.fenced_code import FENCE_RE
+from zerver.lib.bugdown import render_pool
 from zerver.lib.camo import get_camo_url
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, cache_get_many, cache_set_many
-from zerver.models import Message
+from zerver.lib.cache import cache_get, cache_get_many, cache_set, cache_set_many, \
+    realm_rendering_generation_cache_key
+from zerver.lib import unfurl
+from zerver.models import Message, Realm
 import zerver.lib.alert_words as alert_words
 import zerver.lib.mention as mention
 from zerver.lib.str_utils import force_text, force_str
+from zerver.lib.utils import generate_random_token
 import six
 from six.moves import range, html_parser
 from six import text_type
@@ -119,7 +123,6 @@ def add_a(root, url, link, height="", title=None, desc=None,
         desc_div = markdown.util.etree.SubElement(summary_div, "desc")
         desc_div.set("class", "message_inline_image_desc")
 
-@cache_with_key(lambda tweet_id: tweet_id, cache_name="database", with_statsd_key="tweet_data")
 def fetch_tweet_data(tweet_id):
     # type: (text_type) -> Optional[Dict[text_type, Any]]
     if settings.TEST_SUITE:
@@ -246,6 +249,14 @@ def fetch_open_graph_image(url):
         desc = og_desc.get('content')
     return {'image': image, 'title': title, 'desc': desc}
 
+def fetch_preview(kind, key):
+    # type: (text_type, text_type) -> Optional[Dict[text_type, Any]]
+    """Fetches a link preview of one of the kinds that
+    InlineInterestingLinkProcessor asks zerver.lib.unfurl for."""
+    if kind == 'tweet':
+        return fetch_tweet_data(key)
+    return fetch_open_graph_image(key)
+
 def get_tweet_id(url):
     # type: (text_type) -> Optional[text_type]
     parsed_url = urllib.parse.urlparse(url)
@@ -283,6 +294,20 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
         self.bugdown = bugdown
         markdown.treeprocessors.Treeprocessor.__init__(self, md)
 
+    def get_preview(self, kind, key, domain):
+        # type: (text_type, text_type, text_type) -> Optional[Dict[text_type, Any]]
+        """Returns the cached preview of a link, if any.  Otherwise, it is
+        fetched after the message is sent (see zerver.lib.unfurl), unless
+        there is no message to update with it then (e.g. when previewing
+        a message being composed)."""
+        cached = unfurl.get_cached_preview(kind, key)
+        if cached is not None:
+            return cached[0]
+        if current_message is None:
+            return unfurl.fetch_preview(fetch_preview, kind, key)
+        current_message.links_for_preview.append([kind, key, domain])
+        return None
+
     def is_image(self, url):
         # type: (text_type) -> bool
         if not settings.INLINE_IMAGE_PREVIEW:
@@ -311,7 +336,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             # However, we might want to make use of title and description
             # in the future. If the actual image is too big, we might also
             # want to use the open graph image.
-            image_info = fetch_open_graph_image(url)
+            image_info = self.get_preview('open_graph', url, parsed_url.netloc)
 
             is_image = is_album or self.is_image(url)
 
@@ -447,7 +472,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             return None
 
         try:
-            res = fetch_tweet_data(tweet_id)
+            res = self.get_preview('tweet', tweet_id, 'twitter.com')
             if res is None:
                 return None
             user = res['user'] # type: Dict[text_type, Any]
@@ -885,21 +910,10 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
         if current_message and db_data is not None:
             # We check for a user's custom notifications here, as we want
             # to check for plaintext words that depend on the recipient.
-            realm_words = db_data['realm_alert_words']
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
-
-            for user_id, words in six.iteritems(realm_words):
-                for word in words:
-                    escaped = re.escape(word.lower())
-                    match_re = re.compile(u'(?:%s)%s(?:%s)' %
-                                            (allowed_before_punctuation,
-                                             escaped,
-                                             allowed_after_punctuation))
-                    if re.search(match_re, content):
-                        current_message.user_ids_with_alert_words.add(user_id)
+            content = '\n'.join(lines)
+            automaton = db_data['realm_alert_word_automaton']
+            current_message.user_ids_with_alert_words.update(
+                automaton.user_ids_alerted(content))
 
         return lines
 
@@ -1116,13 +1130,41 @@ current_message = None # type: Optional[Message]
 # threads themselves, as well.
 db_data = None # type: Dict[text_type, Any]
 
-def do_convert(md, realm_domain=None, message=None):
-    # type: (markdown.Markdown, Optional[text_type], Optional[Message]) -> Optional[text_type]
-    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
-    from zerver.models import get_active_user_dicts_in_realm, UserProfile
-
-    if message:
-        maybe_update_realm_filters(message.get_realm().domain)
+# The properties that rendering sets on the message.
+MESSAGE_RENDERING_ATTRIBUTES = ('mentions_wildcard', 'mentions_user_ids',
+                                'user_ids_with_alert_words', 'links_for_preview')
+
+def fetch_db_data(message):
+    # type: (Message) -> Dict[text_type, Any]
+    """Pre-fetch data from the DB that is used in the bugdown thread."""
+    from zerver.models import get_active_user_dicts_in_realm
+
+    realm = message.get_realm()
+    realm_users = get_active_user_dicts_in_realm(realm)
+    return {'realm_alert_word_automaton': alert_words.alert_word_automaton_for_realm(realm),
+            'full_names':        dict((user['full_name'].lower(), user) for user in realm_users),
+            'short_names':       dict((user['short_name'].lower(), user) for user in realm_users),
+            'emoji':             realm.get_emoji()}
+
+def get_rendering_generation(realm):
+    # type: (Realm) -> text_type
+    """Returns a token that changes whenever fetch_db_data's result for the
+    realm may have changed, so that rendering workers can keep that data
+    until then."""
+    key = realm_rendering_generation_cache_key(realm.id)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    # The key is deleted to invalidate the data; start a new generation.
+    generation = generate_random_token(16)
+    cache_set(key, generation, timeout=3600*24*7)
+    return generation
+
+def render_with_data(md, realm_domain, message, message_db_data):
+    # type: (text_type, Optional[text_type], Optional[Message], Optional[Dict[text_type, Any]]) -> text_type
+    """Convert Markdown to HTML using data from fetch_db_data.  This is
+    what runs in the bugdown thread (or rendering worker process)."""
+    global current_message, db_data
 
     if realm_domain in md_engines:
         _md_engine = md_engines[realm_domain]
@@ -1131,43 +1173,98 @@ def do_convert(md, realm_domain=None, message=None):
     # Reset the parser; otherwise it will get slower over time.
     _md_engine.reset()
 
-    global current_message
     current_message = message
+    db_data = message_db_data
+    try:
+        return _md_engine.convert(md)
+    finally:
+        current_message = None
+        db_data = None
 
-    # Pre-fetch data from the DB that is used in the bugdown thread
-    global db_data
-    if message:
-        realm_users = get_active_user_dicts_in_realm(message.get_realm())
+def report_rendering_failure(md, num_failures=1, exc_text=None):
+    # type: (text_type, int, Optional[str]) -> None
+    """Called from an exception handler when rendering md failed.  For a
+    batch of messages, called once with the number of messages that
+    failed, the first of them and its traceback (exc_text)."""
+    from zerver.lib.actions import internal_send_message
+
+    cleaned = _sanitize_for_log(md)
+    if exc_text is None:
+        exc_text = traceback.format_exc()
+
+    # Output error to log as well as sending a zulip and email
+    logging.getLogger('').error('Exception in Markdown parser (%d failures): %sInput (sanitized) was: %s'
+        % (num_failures, exc_text, cleaned))
+    subject = "Markdown parser failure on %s" % (platform.node(),)
+    if num_failures == 1:
+        details = "Failed message: %s\n\n%s\n\n" % (cleaned, exc_text)
+    else:
+        details = "%d messages failed to render.  First failed message: %s\n\n%s\n\n" % (
+            num_failures, cleaned, exc_text)
+    if settings.ERROR_BOT is not None:
+        internal_send_message(settings.ERROR_BOT, "stream",
+                "errors", subject, "Markdown parser failed, email sent with details.")
+    mail.mail_admins(subject, details, fail_silently=False)
 
-        db_data = {'realm_alert_words': alert_words.alert_words_in_realm(message.get_realm()),
-                   'full_names':        dict((user['full_name'].lower(), user) for user in realm_users),
-                   'short_names':       dict((user['short_name'].lower(), user) for user in realm_users),
-                   'emoji':             message.get_realm().get_emoji()}
+def do_convert(md, realm_domain=None, message=None):
+    # type: (markdown.Markdown, Optional[text_type], Optional[Message]) -> Optional[text_type]
+    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    if message:
+        maybe_update_realm_filters(message.get_realm().domain)
 
     try:
+        if settings.BUGDOWN_RENDERING_PROCESSES:
+            # The workers fetch the data they need themselves.
+            return render_pool.get_rendering_pool().render(md, realm_domain, message)
+
+        message_db_data = None # type: Optional[Dict[text_type, Any]]
+        if message:
+            message_db_data = fetch_db_data(message)
         # Spend at most 5 seconds rendering.
         # Sometimes Python-Markdown is really slow; see
         # https://trac.zulip.net/ticket/345
-        return timeout(5, _md_engine.convert, md)
+        return timeout(5, render_with_data, md, realm_domain, message, message_db_data)
     except:
-        from zerver.lib.actions import internal_send_message
-
-        cleaned = _sanitize_for_log(md)
-
-        # Output error to log as well as sending a zulip and email
-        logging.getLogger('').error('Exception in Markdown parser: %sInput (sanitized) was: %s'
-            % (traceback.format_exc(), cleaned))
-        subject = "Markdown parser failure on %s" % (platform.node(),)
-        if settings.ERROR_BOT is not None:
-            internal_send_message(settings.ERROR_BOT, "stream",
-                    "errors", subject, "Markdown parser failed, email sent with details.")
-        mail.mail_admins(subject, "Failed message: %s\n\n%s\n\n" % (
-                                    cleaned, traceback.format_exc()),
-                         fail_silently=False)
+        report_rendering_failure(md)
         return None
-    finally:
-        current_message = None
-        db_data = None
+
+def convert_many(renders, pool=None):
+    # type: (Sequence[Tuple[text_type, Optional[text_type], Optional[Message]]], Optional[render_pool.RenderingPool]) -> List[Optional[text_type]]
+    """Like convert, for many (md, realm_domain, message) tuples at once,
+    which are rendered in parallel in a rendering pool (by default,
+    this process's BUGDOWN_RENDERING_PROCESSES pool).  Used to re-render
+    messages in bulk, e.g. after a change to bugdown.version."""
+    if pool is None:
+        pool = render_pool.get_rendering_pool()
+
+    generations = {} # type: Dict[int, text_type]
+    results = []
+    for md, realm_domain, message in renders:
+        generation = None # type: Optional[text_type]
+        if message:
+            realm = message.get_realm()
+            if realm.id not in generations:
+                maybe_update_realm_filters(realm.domain)
+                generations[realm.id] = get_rendering_generation(realm)
+            generation = generations[realm.id]
+        results.append(pool.submit(md, realm_domain, message, generation))
+
+    rendered = [] # type: List[Optional[text_type]]
+    num_failures = 0
+    first_failure = None # type: Optional[Tuple[text_type, str]]
+    for (md, realm_domain, message), result in zip(renders, results):
+        try:
+            rendered.append(pool.wait_for(result, message))
+        except:
+            num_failures += 1
+            if first_failure is None:
+                first_failure = (md, traceback.format_exc())
+            rendered.append(None)
+    if first_failure is not None:
+        # Whatever broke may well have broken every message, so report
+        # the batch's failures together.
+        report_rendering_failure(first_failure[0], num_failures, first_failure[1])
+    return rendered
 
 bugdown_time_start = 0.0
 bugdown_total_time = 0.0
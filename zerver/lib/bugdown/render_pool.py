@@ -0,0 +1,165 @@
+"""A pool of worker processes for rendering markdown.
+
+Python-Markdown is pure Python, and some inputs take it a very long
+time to render.  With BUGDOWN_RENDERING_PROCESSES set, bugdown renders
+messages in a pool of forked worker processes instead of on the thread
+handling the request, so rendering throughput scales with the number
+of cores.  The workers are forked with bugdown's md_engines already
+built, and each one stops rendering a message once it has used
+BUGDOWN_RENDERING_CPU_LIMIT seconds of CPU time, rather than relying
+on zerver.lib.timeout's thread-based timeouts.
+
+Each worker fetches what the markdown processors need from the
+database (see bugdown.fetch_db_data) itself, and keeps it for each
+realm until the realm's rendering generation changes; the parent only
+sends the generation along with the message.
+"""
+from __future__ import absolute_import
+
+from typing import Any, Dict, List, Optional, Tuple
+from six import text_type
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from zerver.lib.timeout import TimeoutExpired
+
+import multiprocessing
+import os
+import signal
+import traceback
+
+# How long the parent waits for a worker to render a message, including
+# any time the message spends queued behind others.  The CPU limit in
+# the worker is what normally stops slow renders; this only protects
+# the parent against a worker that is stuck.
+RENDERING_WAIT_SECS = 30
+
+class RenderingFailed(Exception):
+    '''Raised in the parent when rendering a message failed in a worker.
+       The message of the exception is the worker's traceback.'''
+
+# Database connections inherited from the parent; see init_worker.
+inherited_connections = [] # type: List[Any]
+
+# The bugdown.fetch_db_data results for the realms this worker has
+# rendered messages for, with the bugdown.get_rendering_generation
+# they were fetched for.
+realm_db_data = {} # type: Dict[int, Tuple[text_type, Dict[text_type, Any]]]
+
+def raise_timeout(signum, frame):
+    # type: (int, Any) -> None
+    raise TimeoutExpired
+
+def init_worker():
+    # type: () -> None
+    # The worker is forked from a Django process that may already have
+    # database and memcached connections open, and must open its own.
+    # Closing a psycopg2 connection tells the server to end the session,
+    # which the parent is still using, so we hang on to the inherited
+    # connection objects instead of closing them or letting them be
+    # garbage collected.
+    for conn in connections.all():
+        inherited_connections.append(conn.connection)
+        conn.connection = None
+    for cache in caches.all():
+        cache.close()
+
+    signal.signal(signal.SIGPROF, raise_timeout)
+    # Leave handling Ctrl-C to the parent.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def get_realm_db_data(message, generation):
+    # type: (Any, text_type) -> Dict[text_type, Any]
+    import zerver.lib.bugdown as bugdown
+
+    realm_id = message.get_realm().id
+    cached = realm_db_data.get(realm_id)
+    if cached is None or cached[0] != generation:
+        cached = (generation, bugdown.fetch_db_data(message))
+        realm_db_data[realm_id] = cached
+    return cached[1]
+
+def render_in_worker(md, realm_domain, realm_filters, message, generation):
+    # type: (text_type, Optional[text_type], Optional[List[Tuple[text_type, text_type]]], Any, Optional[text_type]) -> Tuple[Optional[text_type], Dict[str, Any]]
+    import zerver.lib.bugdown as bugdown
+
+    try:
+        # Pick up any changes to the realm's filters since we were forked.
+        if realm_filters is not None and bugdown.realm_filter_data.get(realm_domain) != realm_filters:
+            bugdown.make_realm_filters(realm_domain, realm_filters)
+
+        message_db_data = None # type: Optional[Dict[text_type, Any]]
+        if message is not None and generation is not None:
+            message_db_data = get_realm_db_data(message, generation)
+
+        signal.setitimer(signal.ITIMER_PROF, settings.BUGDOWN_RENDERING_CPU_LIMIT)
+        try:
+            rendered_content = bugdown.render_with_data(md, realm_domain, message, message_db_data)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+    except Exception:
+        # Exceptions are pickled to be sent to the parent, which loses
+        # the traceback; send it as text instead.
+        raise RenderingFailed(traceback.format_exc())
+
+    # Rendering records things like mentions on the message; send those
+    # back so they can be copied onto the parent's copy of the message.
+    message_attributes = {} # type: Dict[str, Any]
+    if message is not None:
+        for attribute in bugdown.MESSAGE_RENDERING_ATTRIBUTES:
+            message_attributes[attribute] = getattr(message, attribute)
+    return rendered_content, message_attributes
+
+class RenderingPool(object):
+    def __init__(self, processes):
+        # type: (int) -> None
+        self.pid = os.getpid()
+        self.pool = multiprocessing.Pool(processes, initializer=init_worker)
+
+    def submit(self, md, realm_domain, message, generation=None):
+        # type: (text_type, Optional[text_type], Any, Optional[text_type]) -> Any
+        """Queues md to be rendered; pass the result to wait_for.  The
+        arguments are the same as for bugdown.convert, plus the message's
+        realm's bugdown.get_rendering_generation if the caller already
+        has it."""
+        import zerver.lib.bugdown as bugdown
+
+        realm_filters = bugdown.realm_filter_data.get(realm_domain)
+        if message is not None and generation is None:
+            generation = bugdown.get_rendering_generation(message.get_realm())
+        return self.pool.apply_async(render_in_worker,
+                                     (md, realm_domain, realm_filters, message, generation))
+
+    def wait_for(self, result, message):
+        # type: (Any, Any) -> Optional[text_type]
+        try:
+            rendered_content, message_attributes = result.get(RENDERING_WAIT_SECS)
+        except multiprocessing.TimeoutError:
+            raise TimeoutExpired
+        for attribute, value in message_attributes.items():
+            setattr(message, attribute, value)
+        return rendered_content
+
+    def render(self, md, realm_domain, message):
+        # type: (text_type, Optional[text_type], Any) -> Optional[text_type]
+        return self.wait_for(self.submit(md, realm_domain, message), message)
+
+    def close(self):
+        # type: () -> None
+        self.pool.close()
+        self.pool.join()
+
+rendering_pool = None # type: Optional[RenderingPool]
+
+def get_rendering_pool():
+    # type: () -> RenderingPool
+    """Returns this process's pool of BUGDOWN_RENDERING_PROCESSES workers,
+    starting it on first use."""
+    global rendering_pool
+    # A pool's workers belong to the process that started it, so a
+    # process forked from one that had a pool needs a new one.
+    if rendering_pool is None or rendering_pool.pid != os.getpid():
+        rendering_pool = RenderingPool(settings.BUGDOWN_RENDERING_PROCESSES)
+    return rendering_pool
@@ -9,11 +9,18 @@ from django.conf import settings
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
-from typing import Any, Callable, Iterable, Optional, Union, TypeVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union, TypeVar
 
+from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from collections import OrderedDict
+from six.moves import cPickle as pickle
+import logging
+import redis
 import subprocess
+import threading
 import time
+import ujson
 import base64
 import random
 import sys
@@ -96,6 +103,165 @@ def bounce_key_prefix_for_testing(test_name):
     # type: (text_type) -> None
     global KEY_PREFIX
     KEY_PREFIX = test_name + u':' + text_type(os.getpid()) + u':'
+    clear_local_caches()
+
+# Optionally, values for some families of cache keys (the part of the
+# key before the first ':', e.g. "user_profile_by_id") are also kept in
+# an in-process LRU cache in front of the remote cache; see
+# LOCAL_CACHE_KEY_FAMILIES in settings.py.  We keep the values pickled,
+# so that callers still get their own copy of e.g. a UserProfile that
+# they can modify, just as from the remote cache.
+#
+# Each process listens on a Redis channel for the keys that other
+# processes have invalidated (see publish_cache_invalidations, called
+# by cache_set, cache_delete and their _many variants), and only uses its
+# local caches while it is listening.  Entries also expire after the
+# family's TTL, to bound staleness from changes that no hook covers.
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache_invalidations'
+
+class LocalCache(object):
+    def __init__(self, family, max_size, ttl):
+        # type: (str, int, float) -> None
+        self.family = family
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict() # type: Dict[text_type, Tuple[float, bytes]]
+        self.lock = threading.Lock()
+        # Incremented on every invalidation, so that we don't store a
+        # value fetched from the remote cache before an invalidation
+        # that arrived while we were fetching it.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # type: (text_type) -> Any
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None and item[0] > time.time():
+                # Re-insert the item to mark it as most recently used.
+                self.items[key] = item
+                self.hits += 1
+                return pickle.loads(item[1])
+            self.misses += 1
+            return None
+
+    def set(self, key, val, generation):
+        # type: (text_type, Any, int) -> None
+        pickled = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl, pickled)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        # type: (text_type) -> None
+        with self.lock:
+            self.generation += 1
+            self.items.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self.generation += 1
+            self.items.clear()
+
+local_caches = {} # type: Dict[str, LocalCache]
+
+class LocalCacheInvalidationListener(threading.Thread):
+    def __init__(self):
+        # type: () -> None
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = os.getpid()
+        self.listening = False
+
+    def run(self):
+        # type: () -> None
+        while True:
+            try:
+                pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(LOCAL_CACHE_INVALIDATION_CHANNEL)
+                self.listening = True
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        for key in ujson.loads(message['data']):
+                            local_cache = local_caches.get(local_cache_family(key[len(KEY_PREFIX):]))
+                            if local_cache is not None:
+                                local_cache.delete(key)
+            except Exception:
+                logging.exception("Error listening for local cache invalidations")
+            # We may have missed invalidations, so throw away everything
+            # we have cached until we're listening again.
+            self.listening = False
+            clear_local_caches()
+            time.sleep(1)
+
+local_cache_listener = None # type: Optional[LocalCacheInvalidationListener]
+
+def local_cache_family(key):
+    # type: (text_type) -> str
+    return str(key.split(u':', 1)[0])
+
+def get_local_cache(key, cache_name=None):
+    # type: (text_type, Optional[str]) -> Optional[LocalCache]
+    """Returns the local cache for key, or None if we shouldn't keep key
+    in a local cache right now."""
+    global local_cache_listener
+    if cache_name is not None or not settings.LOCAL_CACHE_KEY_FAMILIES:
+        return None
+    family = local_cache_family(key)
+    if family not in settings.LOCAL_CACHE_KEY_FAMILIES:
+        return None
+
+    # Each process needs its own listener, including processes forked
+    # from one that already had one.
+    if local_cache_listener is None or local_cache_listener.pid != os.getpid():
+        clear_local_caches()
+        local_cache_listener = LocalCacheInvalidationListener()
+        local_cache_listener.start()
+    if not local_cache_listener.listening:
+        return None
+
+    if family not in local_caches:
+        config = settings.LOCAL_CACHE_KEY_FAMILIES[family]
+        local_caches[family] = LocalCache(family, config['max_size'], config['ttl'])
+    return local_caches[family]
+
+def clear_local_caches():
+    # type: () -> None
+    for local_cache in list(local_caches.values()):
+        local_cache.clear()
+
+def get_local_cache_stats():
+    # type: () -> Dict[str, Tuple[int, int]]
+    """Returns the (hits, misses) for each family of keys in this
+    process's local caches.  The same numbers are sent to statsd."""
+    return dict((family, (local_cache.hits, local_cache.misses))
+                for family, local_cache in local_caches.items())
+
+def publish_cache_invalidations(keys):
+    # type: (Iterable[text_type]) -> None
+    """Tells every process to drop keys from its local cache.  Must be
+    called whenever a value that may be cached locally changes."""
+    if not settings.LOCAL_CACHE_KEY_FAMILIES:
+        return
+    prefixed_keys = [] # type: List[text_type]
+    for key in keys:
+        if local_cache_family(key) in settings.LOCAL_CACHE_KEY_FAMILIES:
+            local_cache = local_caches.get(local_cache_family(key))
+            if local_cache is not None:
+                local_cache.delete(KEY_PREFIX + key)
+            prefixed_keys.append(KEY_PREFIX + key)
+    if not prefixed_keys:
+        return
+    try:
+        get_redis_client().publish(LOCAL_CACHE_INVALIDATION_CHANNEL, ujson.dumps(prefixed_keys))
+    except redis.RedisError:
+        logging.exception("Error publishing local cache invalidations")
 
 def get_cache_backend(cache_name):
     # type: (Optional[str]) -> BaseCache
@@ -156,45 +322,84 @@ def cache_set(key, val, cache_name=None, timeout=None):
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        publish_cache_invalidations([key])
 
 def cache_get(key, cache_name=None):
     # type: (text_type, Optional[str]) -> Any
+    local_cache = get_local_cache(key, cache_name)
+    if local_cache is not None:
+        ret = local_cache.get(KEY_PREFIX + key)
+        statsd.incr("local_cache.%s.%s" % (local_cache.family, "hit" if ret is not None else "miss"))
+        if ret is not None:
+            return ret
+        generation = local_cache.generation
+
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
     remote_cache_stats_finish()
+
+    if local_cache is not None and ret is not None:
+        local_cache.set(KEY_PREFIX + key, ret, generation)
     return ret
 
 def cache_get_many(keys, cache_name=None):
     # type: (List[text_type], Optional[str]) -> Dict[text_type, Any]
-    keys = [KEY_PREFIX + key for key in keys]
+    ret = {} # type: Dict[text_type, Any]
+    remote_keys = [] # type: List[text_type]
+    local_cache_misses = {} # type: Dict[text_type, Tuple[LocalCache, int]]
+    for key in keys:
+        local_cache = get_local_cache(key, cache_name)
+        if local_cache is not None:
+            val = local_cache.get(KEY_PREFIX + key)
+            statsd.incr("local_cache.%s.%s" % (local_cache.family, "hit" if val is not None else "miss"))
+            if val is not None:
+                ret[key] = val
+                continue
+            local_cache_misses[KEY_PREFIX + key] = (local_cache, local_cache.generation)
+        remote_keys.append(KEY_PREFIX + key)
+    if not remote_keys:
+        return ret
+
     remote_cache_stats_start()
-    ret = get_cache_backend(cache_name).get_many(keys)
+    remote_ret = get_cache_backend(cache_name).get_many(remote_keys)
     remote_cache_stats_finish()
-    return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
+    for key, value in remote_ret.items():
+        if key in local_cache_misses:
+            local_cache, generation = local_cache_misses[key]
+            local_cache.set(key, value, generation)
+        ret[key[len(KEY_PREFIX):]] = value
+    return ret
 
 def cache_set_many(items, cache_name=None, timeout=None):
     # type: (Dict[text_type, Any], Optional[str], Optional[int]) -> None
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        publish_cache_invalidations(items.keys())
 
 def cache_delete(key, cache_name=None):
     # type: (text_type, Optional[str]) -> None
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    if cache_name is None:
+        publish_cache_invalidations([key])
 
 def cache_delete_many(items, cache_name=None):
     # type: (Iterable[text_type], Optional[str]) -> None
+    items = list(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
+    if cache_name is None:
+        publish_cache_invalidations(items)
 
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
@@ -325,6 +530,7 @@ def flush_user_profile(sender, **kwargs):
     if kwargs.get('update_fields') is None or \
         len(set(active_user_dict_fields + ['is_active']) & set(kwargs['update_fields'])) > 0:
         cache_delete(active_user_dicts_in_realm_cache_key(user_profile.realm))
+        cache_delete(realm_rendering_generation_cache_key(user_profile.realm_id))
 
     # Invalidate our active_bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
@@ -333,10 +539,16 @@ def flush_user_profile(sender, **kwargs):
                                  set(kwargs['update_fields']))):
         cache_delete(active_bot_dicts_in_realm_cache_key(user_profile.realm))
 
+    # Invalidate the user's presence dicts if anything they depend on changed
+    if kwargs.get('update_fields') is None or \
+        len(set(user_presence_dict_fields) & set(kwargs['update_fields'])) > 0:
+        cache_delete(user_presence_dicts_cache_key(user_profile.id))
+
     # Invalidate realm-wide alert words cache if any user in the realm has changed
     # alert words
     if kwargs.get('update_fields') is None or "alert_words" in kwargs['update_fields']:
         cache_delete(realm_alert_words_cache_key(user_profile.realm))
+        cache_delete(realm_rendering_generation_cache_key(user_profile.realm_id))
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -351,11 +563,27 @@ def flush_realm(sender, **kwargs):
         cache_delete(active_user_dicts_in_realm_cache_key(realm))
         cache_delete(active_bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
+        cache_delete(realm_rendering_generation_cache_key(realm.id))
+
+def user_presence_dicts_cache_key(user_profile_id):
+    # type: (int) -> text_type
+    return u"user_presence_dicts:%s" % (user_profile_id,)
+
+# Fields of UserProfile that affect the presence dicts we compute for
+# that user (see UserPresence.get_status_dicts_for_users).
+user_presence_dict_fields = ['is_active', 'is_bot', 'is_mirror_dummy',
+                             'enable_offline_push_notifications'] # type: List[str]
 
 def realm_alert_words_cache_key(realm):
     # type: (Realm) -> text_type
     return u"realm_alert_words:%s" % (realm.domain,)
 
+def realm_rendering_generation_cache_key(realm_id):
+    # type: (int) -> text_type
+    # Deleted whenever the data bugdown.fetch_db_data returns for the
+    # realm may have changed; see bugdown.get_rendering_generation.
+    return u"realm_rendering_generation:%s" % (realm_id,)
+
 # Called by models.py to flush the stream cache whenever we save a stream
 # object.
 def flush_stream(sender, **kwargs):
@@ -1,19 +1,19 @@
 from __future__ import absolute_import
-from typing import Any, Callable, Iterable, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 from collections import defaultdict
 import datetime
 import six
 from six import text_type
 
-from django.db.models import Q, QuerySet
+from django.db.models import F
 from django.template import loader
 from django.conf import settings
 
 from zerver.lib.notifications import build_message_list, hashchange_encode, \
     send_future_email, one_click_unsubscribe_link
-from zerver.models import UserProfile, UserMessage, Recipient, Stream, \
-    Subscription, get_active_streams
+from zerver.models import Message, Realm, UserProfile, UserMessage, Recipient, \
+    Stream, Subscription, get_active_streams
 
 import logging
 
@@ -35,27 +35,102 @@ logger.addHandler(file_handler)
 # 4. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
 
-def gather_hot_conversations(user_profile, stream_messages):
-    # type: (UserProfile, QuerySet) -> List[Dict[str, Any]]
+# How many users' subscriptions and missed PMs to fetch at a time.
+DIGEST_USER_BATCH_SIZE = 500
+
+def gather_stream_messages(realm, cutoff_date, user_profile_ids=None):
+    # type: (Realm, datetime.datetime, Optional[List[int]]) -> Dict[int, Tuple[int, text_type, Optional[text_type]]]
+    # Gather the stream messages sent in the realm since the cutoff.
+    # This is the same for everyone in the realm, so we do it once, and
+    # build each user's conversations from the messages they received.
+    # If user_profile_ids is given, we only need the messages those
+    # users received.
+    #
+    # Returns a dictionary mapping the messages' ids to their stream
+    # ids, topics and, if they were sent by a human, sender's name.
+    rows = Message.objects.filter(
+        recipient__type=Recipient.STREAM,
+        recipient__type_id__in=Stream.objects.filter(realm=realm).values('id'),
+        pub_date__gt=cutoff_date)
+    if user_profile_ids is not None:
+        rows = rows.filter(id__in=UserMessage.objects.filter(
+            user_profile_id__in=user_profile_ids,
+            message__pub_date__gt=cutoff_date).values('message_id'))
+
+    messages = {} # type: Dict[int, Tuple[int, text_type, Optional[text_type]]]
+    for row in rows.values('id', 'recipient__type_id', 'subject', 'sender__full_name',
+                           'sending_client__name').iterator():
+        if Message.client_is_human(row['sending_client__name']):
+            sender_name = row['sender__full_name']
+        else:
+            # Don't include automated messages in the count.
+            sender_name = None
+        messages[row['id']] = (row['recipient__type_id'], row['subject'], sender_name)
+    return messages
+
+def gather_received_messages(user_profile_ids, first_message_id):
+    # type: (List[int], int) -> Dict[int, List[int]]
+    # Returns the ids of the messages from first_message_id on that each
+    # user received, in order.  Users can only read the messages they
+    # received, which for private streams excludes those sent before
+    # they subscribed.
+    received = defaultdict(list) # type: Dict[int, List[int]]
+    for user_profile_id, message_id in UserMessage.objects.filter(
+            user_profile_id__in=user_profile_ids,
+            message_id__gte=first_message_id).order_by("message_id").values_list(
+            'user_profile_id', 'message_id'):
+        received[user_profile_id].append(message_id)
+    return received
+
+def gather_stream_conversations(realm_data, message_ids, stream_ids):
+    # type: (RealmDigestData, Iterable[int], Iterable[int]) -> Dict[Tuple[int, text_type], Dict[str, Any]]
+    # Gather statistics on the conversations in the given streams among
+    # the messages a user received.
+    #
+    # Returns a dictionary mapping stream ids and topics to the number
+    # of messages sent by humans ("length"), the names of the humans
+    # who sent them ("participants"), and the ids of the conversation's
+    # first 2 messages ("message_ids").
+    stream_ids = set(stream_ids)
+    conversations = {} # type: Dict[Tuple[int, text_type], Dict[str, Any]]
+    for message_id in message_ids:
+        if message_id not in realm_data.messages:
+            continue
+        stream_id, subject, sender_name = realm_data.messages[message_id]
+        if stream_id not in stream_ids:
+            continue
+        key = (stream_id, subject)
+        if key not in conversations:
+            conversations[key] = {"length": 0, "participants": set(), "message_ids": []}
+        conversation = conversations[key]
+
+        # We'll display up to 2 messages from the conversation.
+        if len(conversation["message_ids"]) < 2:
+            conversation["message_ids"].append(message_id)
+
+        if sender_name is not None:
+            conversation["length"] += 1
+            conversation["participants"].add(sender_name)
+    return conversations
+
+def gather_hot_conversations(user_profile, realm_data, message_ids, stream_ids):
+    # type: (UserProfile, RealmDigestData, Iterable[int], Iterable[int]) -> List[Dict[str, Any]]
     # Gather stream conversations of 2 types:
     # 1. long conversations
     # 2. conversations where many different people participated
     #
     # Returns a list of dictionaries containing the templating
     # information for each hot conversation.
+    conversations = gather_stream_conversations(realm_data, message_ids, stream_ids)
 
-    conversation_length = defaultdict(int) # type: Dict[Tuple[int, text_type], int]
-    conversation_diversity = defaultdict(set) # type: Dict[Tuple[int, text_type], Set[text_type]]
-    for user_message in stream_messages:
-        if not user_message.message.sent_by_human():
-            # Don't include automated messages in the count.
+    conversation_length = {} # type: Dict[Tuple[int, text_type], int]
+    conversation_diversity = {} # type: Dict[Tuple[int, text_type], Set[text_type]]
+    for key, conversation in six.iteritems(conversations):
+        if conversation["length"] == 0:
+            # Only automated messages were sent to this conversation.
             continue
-
-        key = (user_message.message.recipient.type_id,
-               user_message.message.subject)
-        conversation_diversity[key].add(
-            user_message.message.sender.full_name)
-        conversation_length[key] += 1
+        conversation_length[key] = conversation["length"]
+        conversation_diversity[key] = conversation["participants"]
 
     diversity_list = list(conversation_diversity.items())
     diversity_list.sort(key=lambda entry: len(entry[1]), reverse=True)
@@ -81,44 +156,37 @@ def gather_hot_conversations(user_profile, stream_messages):
 
     hot_conversation_render_payloads = []
     for h in hot_conversations:
-        stream_id, subject = h
         users = list(conversation_diversity[h])
         count = conversation_length[h]
-
-        # We'll display up to 2 messages from the conversation.
-        first_few_messages = [user_message.message for user_message in \
-                                  stream_messages.filter(
-                message__recipient__type_id=stream_id,
-                message__subject=subject)[:2]]
+        num_messages, first_few_messages = realm_data.first_few_messages(
+            user_profile, conversations[h]["message_ids"])
 
         teaser_data = {"participants": users,
-                       "count": count - len(first_few_messages),
-                       "first_few_messages": build_message_list(
-                user_profile, first_few_messages)}
+                       "count": count - num_messages,
+                       "first_few_messages": first_few_messages}
 
         hot_conversation_render_payloads.append(teaser_data)
     return hot_conversation_render_payloads
 
-def gather_new_users(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, List[text_type]]
+def gather_new_users(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, List[text_type]]
     # Gather information on users in the realm who have recently
     # joined.
-    if user_profile.realm.domain == "mit.edu":
-        new_users = [] # type: List[UserProfile]
+    if realm.domain == "mit.edu":
+        user_names = [] # type: List[text_type]
     else:
-        new_users = list(UserProfile.objects.filter(
-                realm=user_profile.realm, date_joined__gt=threshold,
-                is_bot=False))
-    user_names = [user.full_name for user in new_users]
+        user_names = list(UserProfile.objects.filter(
+                realm=realm, date_joined__gt=threshold,
+                is_bot=False).values_list('full_name', flat=True))
 
     return len(user_names), user_names
 
-def gather_new_streams(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, Dict[str, List[text_type]]]
-    if user_profile.realm.domain == "mit.edu":
+def gather_new_streams(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, Dict[str, List[text_type]]]
+    if realm.domain == "mit.edu":
         new_streams = [] # type: List[Stream]
     else:
-        new_streams = list(get_active_streams(user_profile.realm).filter(
+        new_streams = list(get_active_streams(realm).filter(
                 invite_only=False, date_created__gt=threshold))
 
     base_url = u"https://%s/#narrow/stream/" % (settings.EXTERNAL_HOST,)
@@ -134,6 +202,62 @@ def gather_new_streams(user_profile, threshold):
 
     return len(new_streams), {"html": streams_html, "plain": streams_plain}
 
+class RealmDigestData(object):
+    """The parts of a digest that are the same for everyone in a realm.
+    If user_profile_ids is given, only they will be sent a digest."""
+    def __init__(self, realm, cutoff_date, user_profile_ids=None):
+        # type: (Realm, datetime.datetime, Optional[List[int]]) -> None
+        self.messages = gather_stream_messages(realm, cutoff_date, user_profile_ids)
+        self.first_message_id = min(self.messages) if self.messages else None # type: Optional[int]
+        self.new_streams_count, self.new_streams = gather_new_streams(realm, cutoff_date)
+        self.new_users_count, self.new_users = gather_new_users(realm, cutoff_date)
+        self.teasers = {} # type: Dict[Tuple[int, ...], Tuple[int, List[Dict[str, Any]]]]
+
+    def first_few_messages(self, user_profile, message_ids):
+        # type: (UserProfile, List[int]) -> Tuple[int, List[Dict[str, Any]]]
+        # Returns the number of messages shown from a conversation and
+        # their templating information.  For stream messages, that
+        # doesn't depend on who is reading, so we only build it once
+        # for everyone who received the same messages.
+        key = tuple(message_ids)
+        if key not in self.teasers:
+            messages = list(Message.objects.select_related("sender", "recipient").filter(
+                    id__in=message_ids).order_by("id"))
+            self.teasers[key] = (len(messages), build_message_list(user_profile, messages))
+        return self.teasers[key]
+
+def gather_home_view_streams(user_profile_ids):
+    # type: (List[int]) -> Dict[int, List[int]]
+    # Returns the ids of the streams that each user has in their home view.
+    home_view_streams = defaultdict(list) # type: Dict[int, List[int]]
+    for user_profile_id, stream_id in Subscription.objects.filter(
+            user_profile_id__in=user_profile_ids, active=True, in_home_view=True,
+            recipient__type=Recipient.STREAM).values_list('user_profile_id', 'recipient__type_id'):
+        home_view_streams[user_profile_id].append(stream_id)
+    return home_view_streams
+
+def gather_missed_pms(user_profile_ids, cutoff_date, pms_limit):
+    # type: (List[int], datetime.datetime, int) -> Tuple[Dict[int, List[Message]], Dict[int, int]]
+    # Returns each user's first pms_limit private messages since the
+    # cutoff, and how many they got in total.
+    #
+    # You can't have an unread message that you sent, but when testing
+    # this causes confusion so filter your messages out.
+    pms = UserMessage.objects.filter(
+        user_profile_id__in=user_profile_ids,
+        message__pub_date__gt=cutoff_date).exclude(
+        message__recipient__type=Recipient.STREAM).exclude(
+        message__sender=F('user_profile')).select_related(
+        "message", "message__sender", "message__recipient").order_by("message__pub_date")
+
+    first_pms = defaultdict(list) # type: Dict[int, List[Message]]
+    pm_counts = defaultdict(int) # type: Dict[int, int]
+    for pm in pms.iterator():
+        pm_counts[pm.user_profile_id] += 1
+        if len(first_pms[pm.user_profile_id]) < pms_limit:
+            first_pms[pm.user_profile_id].append(pm.message)
+    return first_pms, pm_counts
+
 def enough_traffic(unread_pms, hot_conversations, new_streams, new_users):
     # type: (text_type, text_type, int, int) -> bool
     if unread_pms or hot_conversations:
@@ -158,66 +282,64 @@ def send_digest_email(user_profile, html_content, text_content):
 
 def handle_digest_email(user_profile_id, cutoff):
     # type: (int, int) -> None
-    user_profile=UserProfile.objects.get(id=user_profile_id)
+    user_profile = UserProfile.objects.get(id=user_profile_id)
+    handle_realm_digest_emails(user_profile.realm_id, [user_profile_id], cutoff,
+                               realm_wide=False)
+
+def handle_realm_digest_emails(realm_id, user_profile_ids, cutoff, realm_wide=True):
+    # type: (int, List[int], int, bool) -> None
+    # With realm_wide, we gather all the realm's traffic since the
+    # cutoff once and share it; that's wasteful for just a few users.
+    realm = Realm.objects.get(id=realm_id)
     # Convert from epoch seconds to a datetime object.
     cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
 
-    all_messages = UserMessage.objects.filter(
-        user_profile=user_profile,
-        message__pub_date__gt=cutoff_date).order_by("message__pub_date")
-
-    # Start building email template data.
-    template_payload = {
-        'name': user_profile.full_name,
-        'external_host': settings.EXTERNAL_HOST,
-        'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest")
-        } # type: Dict[str, Any]
-
-    # Gather recent missed PMs, re-using the missed PM email logic.
-    # You can't have an unread message that you sent, but when testing
-    # this causes confusion so filter your messages out.
-    pms = all_messages.filter(
-        ~Q(message__recipient__type=Recipient.STREAM) & \
-             ~Q(message__sender=user_profile))
+    realm_data = RealmDigestData(realm, cutoff_date,
+                                 None if realm_wide else user_profile_ids)
 
     # Show up to 4 missed PMs.
     pms_limit = 4
 
-    template_payload['unread_pms'] = build_message_list(
-        user_profile, [pm.message for pm in pms[:pms_limit]])
-    template_payload['remaining_unread_pms_count'] = min(0, len(pms) - pms_limit)
-
-    home_view_recipients = [sub.recipient for sub in \
-                                Subscription.objects.filter(
-            user_profile=user_profile, active=True, in_home_view=True)]
-
-    stream_messages = all_messages.filter(
-        message__recipient__type=Recipient.STREAM,
-        message__recipient__in=home_view_recipients)
-
-    # Gather hot conversations.
-    template_payload["hot_conversations"] = gather_hot_conversations(
-        user_profile, stream_messages)
-
-    # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
-    template_payload["new_streams"] = new_streams
-    template_payload["new_streams_count"] = new_streams_count
-
-    # Gather users who signed up recently.
-    new_users_count, new_users = gather_new_users(
-        user_profile, cutoff_date)
-    template_payload["new_users"] = new_users
-
-    text_content = loader.render_to_string(
-        'zerver/emails/digest/digest_email.txt', template_payload)
-    html_content = loader.render_to_string(
-        'zerver/emails/digest/digest_email_html.txt', template_payload)
-
-    # We don't want to send emails containing almost no information.
-    if enough_traffic(template_payload["unread_pms"],
-                      template_payload["hot_conversations"],
-                      new_streams_count, new_users_count):
-        logger.info("Sending digest email for %s" % (user_profile.email,))
-        send_digest_email(user_profile, html_content, text_content)
+    for i in range(0, len(user_profile_ids), DIGEST_USER_BATCH_SIZE):
+        batch_ids = user_profile_ids[i:i + DIGEST_USER_BATCH_SIZE]
+        home_view_streams = gather_home_view_streams(batch_ids)
+        unread_pms, unread_pm_counts = gather_missed_pms(batch_ids, cutoff_date, pms_limit)
+        received_messages = {} # type: Dict[int, List[int]]
+        if realm_data.first_message_id is not None:
+            received_messages = gather_received_messages(batch_ids, realm_data.first_message_id)
+
+        for user_profile in UserProfile.objects.filter(id__in=batch_ids).order_by("id"):
+            # Start building email template data.
+            template_payload = {
+                'name': user_profile.full_name,
+                'external_host': settings.EXTERNAL_HOST,
+                'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest")
+                } # type: Dict[str, Any]
+
+            # Gather recent missed PMs, re-using the missed PM email logic.
+            template_payload['unread_pms'] = build_message_list(
+                user_profile, unread_pms[user_profile.id])
+            template_payload['remaining_unread_pms_count'] = min(
+                0, unread_pm_counts[user_profile.id] - pms_limit)
+
+            # Gather hot conversations.
+            template_payload["hot_conversations"] = gather_hot_conversations(
+                user_profile, realm_data, received_messages.get(user_profile.id, []),
+                home_view_streams[user_profile.id])
+
+            # Gather new streams and users who signed up recently.
+            template_payload["new_streams"] = realm_data.new_streams
+            template_payload["new_streams_count"] = realm_data.new_streams_count
+            template_payload["new_users"] = realm_data.new_users
+
+            text_content = loader.render_to_string(
+                'zerver/emails/digest/digest_email.txt', template_payload)
+            html_content = loader.render_to_string(
+                'zerver/emails/digest/digest_email_html.txt', template_payload)
+
+            # We don't want to send emails containing almost no information.
+            if enough_traffic(template_payload["unread_pms"],
+                              template_payload["hot_conversations"],
+                              realm_data.new_streams_count, realm_data.new_users_count):
+                logger.info("Sending digest email for %s" % (user_profile.email,))
+                send_digest_email(user_profile, html_content, text_content)
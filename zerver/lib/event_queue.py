@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from typing import cast, AbstractSet, Any, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Union
+from typing import cast, AbstractSet, Any, IO, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Dict, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
@@ -31,6 +31,8 @@ from zerver.lib.narrow import build_narrow_filter
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.lib.timestamp import timestamp_to_datetime
+from django.utils.module_loading import import_string
+from collections import defaultdict
 import copy
 import six
 from six import text_type
@@ -41,6 +43,18 @@ from six import text_type
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
 
+# Changes to the event queues are appended to a journal, which is
+# flushed to disk this often; this bounds how much we can lose if
+# Tornado crashes rather than exiting cleanly.
+EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS = 1000
+# Once the journal grows past this size, we start a new, empty journal
+# and write a fresh snapshot of all the event queues to go with it, so
+# that replaying the journal on restart stays fast.  The snapshot is
+# written by a forked child process, so that the IOLoop isn't blocked
+# while it's written.
+EVENT_QUEUE_JOURNAL_MAX_BYTES = 64 * 1024 * 1024
+EVENT_QUEUE_SNAPSHOT_VERSION = 2
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -55,8 +69,9 @@ HEARTBEAT_MIN_FREQ_SECS = 45
 class ClientDescriptor(object):
     def __init__(self, user_profile_id, user_profile_email, realm_id, event_queue,
                  event_types, client_type_name, apply_markdown=True,
-                 all_public_streams=False, lifespan_secs=0, narrow=[]):
-        # type: (int, text_type, int, EventQueue, Optional[Sequence[str]], text_type, bool, bool, int, Iterable[Sequence[text_type]]) -> None
+                 all_public_streams=False, lifespan_secs=0, narrow=[],
+                 compact_peer_events=False):
+        # type: (int, text_type, int, EventQueue, Optional[Sequence[str]], text_type, bool, bool, int, Iterable[Sequence[text_type]], bool) -> None
         # These objects are serialized on shutdown and restored on restart.
         # If fields are added or semantics are changed, temporary code must be
         # added to load_event_queues() to update the restored objects.
@@ -74,36 +89,46 @@ class ClientDescriptor(object):
         self.all_public_streams = all_public_streams
         self.client_type_name = client_type_name
         self._timeout_handle = None # type: Any # TODO: should be return type of ioloop.add_timeout
+        # A connection (see zerver/lib/socket.py) that is pushing this
+        # queue's events to the client as they arrive, instead of the
+        # client long-polling for them; it is told about new events
+        # with events_added() and about the queue going away with
+        # event_queue_deleted().
+        self.event_stream = None # type: Any
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        # Whether the client understands peer_add/peer_remove events
+        # with a list of user_emails; see process_event.
+        self.compact_peer_events = compact_peer_events
 
         # Clamp queue_timeout to between minimum and maximum timeouts
         self.queue_timeout = max(IDLE_EVENT_QUEUE_TIMEOUT_SECS, min(self.queue_timeout, MAX_QUEUE_TIMEOUT_SECS))
 
-    def to_dict(self):
-        # type: () -> Dict[str, Any]
+    def to_dict(self, bodies=None):
+        # type: (Optional[Dict[str, InternedEvent]]) -> Dict[str, Any]
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
         # loading event queues that lack that key.
         return dict(user_profile_id=self.user_profile_id,
                     user_profile_email=self.user_profile_email,
                     realm_id=self.realm_id,
-                    event_queue=self.event_queue.to_dict(),
+                    event_queue=self.event_queue.to_dict(bodies),
                     queue_timeout=self.queue_timeout,
                     event_types=self.event_types,
                     last_connection_time=self.last_connection_time,
                     apply_markdown=self.apply_markdown,
                     all_public_streams=self.all_public_streams,
                     narrow=self.narrow,
-                    client_type_name=self.client_type_name)
+                    client_type_name=self.client_type_name,
+                    compact_peer_events=self.compact_peer_events)
 
     def __repr__(self):
         # type: () -> str
         return "ClientDescriptor<%s>" % (self.event_queue.id,)
 
     @classmethod
-    def from_dict(cls, d):
-        # type: (MutableMapping[str, Any]) -> ClientDescriptor
+    def from_dict(cls, d, bodies=None):
+        # type: (MutableMapping[str, Any], Optional[Mapping[str, InternedEvent]]) -> ClientDescriptor
         if 'user_profile_email' not in d:
             # Temporary migration for the addition of the new user_profile_email field
             from zerver.models import get_user_profile_by_id
@@ -112,9 +137,10 @@ class ClientDescriptor(object):
             # Temporary migration for the rename of client_type to client_type_name
             d['client_type_name'] = d['client_type']
         ret = cls(d['user_profile_id'], d['user_profile_email'], d['realm_id'],
-                  EventQueue.from_dict(d['event_queue']), d['event_types'],
+                  EventQueue.from_dict(d['event_queue'], bodies), d['event_types'],
                   d['client_type_name'], d['apply_markdown'], d['all_public_streams'],
-                  d['queue_timeout'], d.get('narrow', []))
+                  d['queue_timeout'], d.get('narrow', []),
+                  d.get('compact_peer_events', False))
         ret.last_connection_time = d['last_connection_time']
         return ret
 
@@ -122,14 +148,24 @@ class ClientDescriptor(object):
         # type: () -> None
         self.current_handler_id = None
         self._timeout_handle = None
+        self.event_stream = None
+
+    def add_event(self, event, overrides=None):
+        # type: (Union[Dict[str, Any], InternedEvent], Optional[Dict[str, Any]]) -> None
+        """event is either a dict owned by this queue, or an InternedEvent
+        shared with the other queues it is sent to, with this queue's own
+        keys (e.g. the message flags) in overrides."""
+        if not isinstance(event, InternedEvent):
+            event = InternedEvent(event)
 
-    def add_event(self, event):
-        # type: (Dict[str, Any]) -> None
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_restart(handler._request)
 
-        self.event_queue.push(event)
+        journal_event_push(self.event_queue.id, event, overrides)
+        self.event_queue.push(event, overrides)
+        if self.event_stream is not None:
+            self.event_stream.events_added()
         self.finish_current_handler()
 
     def finish_current_handler(self, need_timeout=False):
@@ -165,6 +201,7 @@ class ClientDescriptor(object):
             self.queue_timeout = IDLE_EVENT_QUEUE_TIMEOUT_SECS
 
         return (self.current_handler_id is None
+                and self.event_stream is None
                 and now - self.last_connection_time >= self.queue_timeout)
 
     def connect_handler(self, handler_id, client_name):
@@ -183,6 +220,25 @@ class ClientDescriptor(object):
         if self.client_type_name != 'API: heartbeat test':
             self._timeout_handle = ioloop.add_timeout(heartbeat_time, timeout_callback)
 
+    def connect_event_stream(self, event_stream, client_name):
+        # type: (Any, text_type) -> None
+        # A client streaming events doesn't long-poll too, so finish any
+        # get_events request it left behind.
+        self.finish_current_handler()
+        self.event_stream = event_stream
+        self.current_client_name = client_name
+        self.last_connection_time = time.time()
+
+    def disconnect_event_stream(self, event_stream):
+        # type: (Any) -> None
+        if self.event_stream is not event_stream:
+            # Already replaced by a newer connection.
+            return
+        self.event_stream = None
+        self.current_client_name = None
+        # The queue's idle timeout starts when the stream disconnects.
+        self.last_connection_time = time.time()
+
     def disconnect_handler(self, client_closed=False, need_timeout=True):
         # type: (bool, bool) -> None
         if self.current_handler_id:
@@ -208,6 +264,9 @@ class ClientDescriptor(object):
         # invariant that event queues are idle when passed to
         # `do_gc_event_queues` is preserved.
         self.finish_current_handler(need_timeout=False)
+        if self.event_stream is not None:
+            self.event_stream.event_queue_deleted()
+            self.event_stream = None
         do_gc_event_queues({self.event_queue.id}, {self.user_profile_id},
                            {self.realm_id})
 
@@ -231,66 +290,132 @@ def compute_full_event_type(event):
         if event["all"]:
             # Put the "all" case in its own category
             return "all_flags/%s/%s" % (event["flag"], event["operation"])
+        if "message_range" in event:
+            # Ranges of messages can't be collapsed like lists of ids
+            return "range_flags/%s/%s" % (event["flag"], event["operation"])
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
+# Each event is stored once, no matter how many queues it is sent to:
+# the queues hold (event id, InternedEvent, overrides) entries that
+# refer to a shared, read-only event body, and only build the event
+# dicts they return to clients (with the queue's own event id and
+# overrides, e.g. the message flags) when the events are fetched.
+# The snapshot and journal refer to the bodies by body_id too, so that
+# a body is written to each of them once rather than once per queue.
+next_body_id = 0
+
+class InternedEvent(object):
+    __slots__ = ('body_id', 'event', 'journal_id')
+
+    def __init__(self, event, body_id=None):
+        # type: (Dict[str, Any], Optional[str]) -> None
+        global next_body_id
+        if body_id is None:
+            body_id = str(settings.SERVER_GENERATION) + ':' + str(next_body_id)
+            next_body_id += 1
+        self.body_id = body_id # type: str
+        # Must not be modified once the event has been pushed.
+        self.event = event
+        # The journal this body has already been written to, if any.
+        self.journal_id = None # type: Optional[str]
+
+EventQueueEntry = Tuple[int, InternedEvent, Optional[Dict[str, Any]]]
+
+def event_from_entry(entry):
+    # type: (EventQueueEntry) -> Dict[str, Any]
+    (event_id, interned, overrides) = entry
+    event = dict(interned.event)
+    if overrides is not None:
+        event.update(overrides)
+    event['id'] = event_id
+    return event
+
 class EventQueue(object):
     def __init__(self, id):
         # type: (str) -> None
-        self.queue = deque() # type: deque[Dict[str, Any]]
+        self.queue = deque() # type: deque[EventQueueEntry]
         self.next_event_id = 0 # type: int
         self.id = id # type: str
         self.virtual_events = {} # type: Dict[str, Dict[str, Any]]
 
-    def to_dict(self):
-        # type: () -> Dict[str, Any]
+    def to_dict(self, bodies=None):
+        # type: (Optional[Dict[str, InternedEvent]]) -> Dict[str, Any]
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
         # loading event queues that lack that key.
+        #
+        # If bodies is given, the queued events refer to their bodies
+        # by body_id, and the bodies are added to it; otherwise the
+        # events are written out in full.
+        if bodies is None:
+            queue = [event_from_entry(entry) for entry in self.queue] # type: List[Any]
+        else:
+            queue = []
+            for (event_id, interned, overrides) in self.queue:
+                bodies[interned.body_id] = interned
+                queue.append([event_id, interned.body_id, overrides])
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
-                    queue=list(self.queue),
+                    queue=queue,
                     virtual_events=self.virtual_events)
 
     @classmethod
-    def from_dict(cls, d):
-        # type: (Dict[str, Any]) -> EventQueue
+    def from_dict(cls, d, bodies=None):
+        # type: (Dict[str, Any], Optional[Mapping[str, InternedEvent]]) -> EventQueue
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
-        ret.queue = deque(d['queue'])
+        for entry in d['queue']:
+            if isinstance(entry, dict):
+                # An event written out in full.
+                event = dict(entry)
+                event_id = event.pop('id')
+                ret.queue.append((event_id, InternedEvent(event), None))
+            else:
+                (event_id, body_id, overrides) = entry
+                ret.queue.append((event_id, bodies[body_id], overrides))
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
-    def push(self, event):
-        # type: (Dict[str, Any]) -> None
-        event['id'] = self.next_event_id
+    def push(self, event, overrides=None):
+        # type: (Union[Dict[str, Any], InternedEvent], Optional[Dict[str, Any]]) -> None
+        if not isinstance(event, InternedEvent):
+            event = InternedEvent(event)
+        event_id = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
+        body = event.event
+        full_event_type = compute_full_event_type(body)
         if (full_event_type in ["pointer", "restart"] or
             full_event_type.startswith("flags/")):
+            # Virtual events are collapsed in place, so each queue
+            # needs its own copy.
             if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
+                virtual_event = copy.deepcopy(body)
+                if overrides is not None:
+                    virtual_event.update(copy.deepcopy(overrides))
+                virtual_event["id"] = event_id
+                self.virtual_events[full_event_type] = virtual_event
                 return
             # Update the virtual event with the values from the event
             virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
-            if "timestamp" in event:
-                virtual_event["timestamp"] = event["timestamp"]
+            virtual_event["id"] = event_id
+            if "timestamp" in body:
+                virtual_event["timestamp"] = body["timestamp"]
             if full_event_type == "pointer":
-                virtual_event["pointer"] = event["pointer"]
+                virtual_event["pointer"] = body["pointer"]
             elif full_event_type == "restart":
-                virtual_event["server_generation"] = event["server_generation"]
+                virtual_event["server_generation"] = body["server_generation"]
             elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
+                virtual_event["messages"] += body["messages"]
         else:
-            self.queue.append(event)
+            self.queue.append((event_id, event, overrides or None))
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self):
         # type: () -> Dict[str, Any]
-        return self.queue.popleft()
+        return event_from_entry(self.queue.popleft())
 
     def empty(self):
         # type: () -> bool
@@ -299,32 +424,33 @@ class EventQueue(object):
     # See the comment on pop; that applies here as well
     def prune(self, through_id):
         # type: (int) -> None
-        while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
-            self.pop()
+        while len(self.queue) != 0 and self.queue[0][0] <= through_id:
+            self.queue.popleft()
 
     def contents(self):
         # type: () -> List[Dict[str, Any]]
-        contents = [] # type: List[Dict[str, Any]]
-        virtual_id_map = {} # type: Dict[str, Dict[str, Any]]
-        for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
-        virtual_ids = sorted(list(virtual_id_map.keys()))
-
-        # Merge the virtual events into their final place in the queue
-        index = 0
-        length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
-                index += 1
-            contents.append(event)
-        while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
-            index += 1
-
-        self.virtual_events = {}
-        self.queue = deque(contents)
-        return contents
+        if self.virtual_events:
+            virtual_entries = [] # type: List[EventQueueEntry]
+            for virtual_event in six.itervalues(self.virtual_events):
+                body = dict(virtual_event)
+                event_id = body.pop("id")
+                virtual_entries.append((event_id, InternedEvent(body), None))
+            virtual_entries.sort(key=lambda entry: entry[0])
+
+            # Merge the virtual events into their final place in the queue
+            queue = deque() # type: deque[EventQueueEntry]
+            index = 0
+            length = len(virtual_entries)
+            for entry in self.queue:
+                while index < length and virtual_entries[index][0] < entry[0]:
+                    queue.append(virtual_entries[index])
+                    index += 1
+                queue.append(entry)
+            queue.extend(virtual_entries[index:])
+
+            self.virtual_events = {}
+            self.queue = queue
+        return [event_from_entry(entry) for entry in self.queue]
 
 # maps queue ids to client descriptors
 clients = {} # type: Dict[str, ClientDescriptor]
@@ -368,11 +494,15 @@ def allocate_client_descriptor(new_queue_data):
     # type: (MutableMapping[str, Any]) -> ClientDescriptor
     global next_queue_id
     queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    if len(get_tornado_servers()) > 1:
+        # Let the proxy route requests for this queue to our shard.
+        queue_id = str(tornado_shard) + '-' + queue_id
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    journal_event_queue_change(dict(op='add', client=client.to_dict()))
     return client
 
 def do_gc_event_queues(to_remove, affected_users, affected_realms):
@@ -399,6 +529,9 @@ def do_gc_event_queues(to_remove, affected_users, affected_realms):
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
 
+    if to_remove:
+        journal_event_queue_change(dict(op='remove', queue_ids=list(to_remove)))
+
 def gc_event_queues():
     # type: () -> None
     start = time.time()
@@ -423,13 +556,294 @@ def gc_event_queues():
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
+# The event queues are persisted across Tornado restarts as a snapshot
+# plus a journal.  The snapshot has a header line followed by one line
+# of JSON per queue (so that it can be loaded without parsing the whole
+# file at once); the journal has a header line followed by one line of
+# JSON per change to the queues since the snapshot was written.  Both
+# headers carry the same journal_id, so that a journal left over from
+# before the latest snapshot is never replayed on top of it.  In both,
+# the body of an event sent to several queues is written out once, the
+# first time it's needed, and referred to by body_id after that.
+#
+# When compacting the journal, we move it aside to filename.old and
+# start a new journal, whose header also carries the journal_id of the
+# old one, until the child process writing the new snapshot is done.
+# If we crash before then, we replay both journals on top of the old
+# snapshot.
+event_queue_journal = None # type: Optional[IO[str]]
+event_queue_journal_id = None # type: Optional[str]
+# The pid of the child process writing a snapshot, if any.
+event_queue_snapshot_writer_pid = None # type: Optional[int]
+
+def journal_event_queue_change(record):
+    # type: (Mapping[str, Any]) -> None
+    if event_queue_journal is not None:
+        event_queue_journal.write(ujson.dumps(record) + "\n")
+
+def journal_event_push(queue_id, interned, overrides):
+    # type: (str, InternedEvent, Optional[Dict[str, Any]]) -> None
+    if event_queue_journal is None:
+        return
+    record = dict(op='push', queue_id=queue_id, body_id=interned.body_id) # type: Dict[str, Any]
+    if interned.journal_id != event_queue_journal_id:
+        record['event'] = interned.event
+        interned.journal_id = event_queue_journal_id
+    if overrides is not None:
+        record['overrides'] = overrides
+    journal_event_queue_change(record)
+
+def open_event_queue_journal(filename, journal_id, truncate, previous_journal_id=None):
+    # type: (str, str, bool, Optional[str]) -> None
+    global event_queue_journal
+    global event_queue_journal_id
+    if event_queue_journal is not None:
+        event_queue_journal.close()
+    if truncate:
+        header = dict(journal_id=journal_id) # type: Dict[str, str]
+        if previous_journal_id is not None:
+            header['previous_journal_id'] = previous_journal_id
+        event_queue_journal = open(filename, "w")
+        event_queue_journal.write(ujson.dumps(header) + "\n")
+        event_queue_journal.flush()
+        os.fsync(event_queue_journal.fileno())
+    else:
+        event_queue_journal = open(filename, "a")
+    event_queue_journal_id = journal_id
+
+def flush_event_queue_journal():
+    # type: () -> None
+    if event_queue_journal is None:
+        return
+    event_queue_journal.flush()
+    if wait_for_event_queue_snapshot_writer(block=False) is False:
+        # The new journal is only useful on top of the old one until
+        # we have a snapshot to go with it, so write one ourselves.
+        logging.error("Writing the event queue snapshot failed; retrying in Tornado")
+        dump_event_queues()
+    elif (event_queue_snapshot_writer_pid is None and
+          event_queue_journal.tell() > EVENT_QUEUE_JOURNAL_MAX_BYTES):
+        compact_event_queue_journal()
+
+def wait_for_event_queue_snapshot_writer(block):
+    # type: (bool) -> Optional[bool]
+    """Reaps the child process writing a snapshot, if it's done (or
+    once it is, if block).  Returns whether it succeeded, or None if
+    there's no such process that has finished."""
+    global event_queue_snapshot_writer_pid
+    if event_queue_snapshot_writer_pid is None:
+        return None
+    (pid, status) = os.waitpid(event_queue_snapshot_writer_pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    event_queue_snapshot_writer_pid = None
+    return status == 0
+
+def compact_event_queue_journal():
+    # type: () -> None
+    """Starts a new journal, and forks a child process to write a
+    snapshot of the event queues as they are now to go with it, so that
+    we can carry on serving requests while it's written."""
+    global event_queue_snapshot_writer_pid
+    journal_filename = event_queue_journal_filename()
+    old_journal_filename = journal_filename + ".old"
+    previous_journal_id = event_queue_journal_id
+    journal_id = "%s:%s" % (settings.SERVER_GENERATION, time.time())
+
+    event_queue_journal.flush()
+    os.fsync(event_queue_journal.fileno())
+    os.rename(journal_filename, old_journal_filename)
+    open_event_queue_journal(journal_filename, journal_id, truncate=True,
+                             previous_journal_id=previous_journal_id)
+
+    pid = os.fork()
+    if pid == 0:
+        # We use os._exit so that the child never runs our atexit
+        # handlers, which would dump the event queues over the
+        # parent's.
+        try:
+            start = time.time()
+            write_event_queue_snapshot(event_queue_snapshot_filename(), journal_id, clients)
+            os.remove(old_journal_filename)
+            logging.info('Tornado compacted %d event queues in %.3fs'
+                         % (len(clients), time.time() - start))
+        except Exception:
+            logging.exception("Could not write event queue snapshot")
+            os._exit(1)
+        os._exit(0)
+    event_queue_snapshot_writer_pid = pid
+
+def write_event_queue_snapshot(filename, journal_id, client_dict):
+    # type: (str, str, Mapping[str, ClientDescriptor]) -> None
+    # We write to a temporary file and rename it into place, so that a
+    # crash while writing can't leave us with a truncated snapshot.
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as stored_queues:
+        stored_queues.write(ujson.dumps(dict(version=EVENT_QUEUE_SNAPSHOT_VERSION,
+                                             journal_id=journal_id)) + "\n")
+        written_body_ids = set() # type: Set[str]
+        for client in six.itervalues(client_dict):
+            bodies = {} # type: Dict[str, InternedEvent]
+            client_data = client.to_dict(bodies)
+            # Each event body goes on its own line, before the first
+            # queue that refers to it.
+            for (body_id, interned) in six.iteritems(bodies):
+                if body_id not in written_body_ids:
+                    stored_queues.write(ujson.dumps(dict(body_id=body_id,
+                                                         event=interned.event)) + "\n")
+                    written_body_ids.add(body_id)
+            stored_queues.write(ujson.dumps(client_data) + "\n")
+        stored_queues.flush()
+        os.fsync(stored_queues.fileno())
+    os.rename(tmp_filename, filename)
+
+def read_event_queue_snapshot(filename):
+    # type: (str) -> Tuple[Dict[str, ClientDescriptor], Optional[str]]
+    loaded_clients = {} # type: Dict[str, ClientDescriptor]
+    with open(filename, "r") as stored_queues:
+        header = stored_queues.readline()
+        if header.startswith("["):
+            # The old format, written by Tornado before we had a
+            # journal: a single JSON list of (queue id, client) pairs.
+            json_data = header + stored_queues.read()
+            loaded_clients = dict((qid, ClientDescriptor.from_dict(client))
+                                  for (qid, client) in ujson.loads(json_data))
+            return loaded_clients, None
+
+        journal_id = ujson.loads(header)['journal_id'] # type: Optional[str]
+        bodies = {} # type: Dict[str, InternedEvent]
+        for line in stored_queues:
+            data = ujson.loads(line)
+            if 'body_id' in data:
+                bodies[data['body_id']] = InternedEvent(data['event'], data['body_id'])
+                continue
+            client = ClientDescriptor.from_dict(data, bodies)
+            loaded_clients[client.event_queue.id] = client
+    return loaded_clients, journal_id
+
+def replay_event_queue_journal(filename, journal_id, client_dict):
+    # type: (str, str, MutableMapping[str, ClientDescriptor]) -> Optional[int]
+    """Applies the changes recorded in the journal to client_dict, and
+    returns the number of changes applied, or None if the journal
+    doesn't belong to the snapshot with the given journal_id."""
+    num_records = 0
+    bodies = {} # type: Dict[str, InternedEvent]
+    with open(filename, "r") as journal:
+        header = journal.readline()
+        try:
+            if ujson.loads(header)['journal_id'] != journal_id:
+                # This journal predates the snapshot we loaded.
+                return None
+        except (ValueError, KeyError):
+            return None
+
+        for line in journal:
+            if not line.endswith("\n"):
+                # A partial write from when we crashed; see
+                # truncate_event_queue_journal.
+                break
+            try:
+                record = ujson.loads(line)
+            except ValueError:
+                # A partial write from when we crashed; everything
+                # after this point was lost.
+                break
+
+            num_records += 1
+            if record['op'] == 'push' and 'body_id' in record and 'event' in record:
+                # The first push of a body, which later pushes (maybe
+                # to queues we don't have) refer to.
+                bodies[record['body_id']] = InternedEvent(record['event'], record['body_id'])
+
+            if record['op'] == 'add':
+                client = ClientDescriptor.from_dict(record['client'])
+                client_dict[client.event_queue.id] = client
+            elif record['op'] == 'remove':
+                for queue_id in record['queue_ids']:
+                    client_dict.pop(queue_id, None)
+            elif record['queue_id'] in client_dict:
+                client = client_dict[record['queue_id']]
+                if record['op'] == 'push' and 'body_id' in record:
+                    client.event_queue.push(bodies[record['body_id']],
+                                            record.get('overrides'))
+                elif record['op'] == 'push':
+                    client.event_queue.push(record['event'])
+                elif record['op'] == 'prune':
+                    # Clients only prune events that we've returned to
+                    # them, which always goes through contents().
+                    client.event_queue.contents()
+                    client.event_queue.prune(record['through_id'])
+                    client.last_connection_time = record['time']
+    return num_records
+
+def replay_rotated_event_queue_journal(filename, journal_id, client_dict):
+    # type: (str, str, MutableMapping[str, ClientDescriptor]) -> Optional[int]
+    """Like replay_event_queue_journal, for when we crashed while
+    compacting the journal: replays the old journal and then the new
+    one that follows it."""
+    old_filename = filename + ".old"
+    if not os.path.exists(old_filename):
+        return None
+    with open(filename, "r") as journal:
+        try:
+            header = ujson.loads(journal.readline())
+        except ValueError:
+            return None
+    if header.get('previous_journal_id') != journal_id:
+        return None
+    num_old_records = replay_event_queue_journal(old_filename, journal_id, client_dict)
+    if num_old_records is None:
+        return None
+    num_records = replay_event_queue_journal(filename, header['journal_id'], client_dict)
+    return num_old_records + (num_records or 0)
+
+def truncate_event_queue_journal(filename):
+    # type: (str) -> None
+    """Drops the partial record a crash can leave at the end of the
+    journal, so that the records we append after it aren't glued onto
+    it and lost with it when the journal is next replayed."""
+    with open(filename, "rb+") as journal:
+        journal.seek(0, os.SEEK_END)
+        end = journal.tell()
+        pos = end
+        while pos > 0:
+            chunk_start = max(pos - 4096, 0)
+            journal.seek(chunk_start)
+            newline = journal.read(pos - chunk_start).rfind(b"\n")
+            if newline != -1:
+                pos = chunk_start + newline + 1
+                break
+            pos = chunk_start
+        if pos != end:
+            journal.truncate(pos)
+
+# Each Tornado shard persists its own event queues.
+def event_queue_snapshot_filename():
+    # type: () -> str
+    if tornado_shard == 0:
+        return settings.JSON_PERSISTENT_QUEUE_FILENAME
+    return "%s.%d" % (settings.JSON_PERSISTENT_QUEUE_FILENAME, tornado_shard)
+
+def event_queue_journal_filename():
+    # type: () -> str
+    if tornado_shard == 0:
+        return settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME
+    return "%s.%d" % (settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME, tornado_shard)
+
 def dump_event_queues():
     # type: () -> None
+    # A child process still writing an older snapshot mustn't rename
+    # it over the one we're about to write.
+    wait_for_event_queue_snapshot_writer(block=True)
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)],
-                   stored_queues)
+    journal_id = "%s:%s" % (settings.SERVER_GENERATION, start)
+    write_event_queue_snapshot(event_queue_snapshot_filename(), journal_id, clients)
+    open_event_queue_journal(event_queue_journal_filename(),
+                             journal_id, truncate=True)
+    old_journal_filename = event_queue_journal_filename() + ".old"
+    if os.path.exists(old_journal_filename):
+        os.remove(old_journal_filename)
 
     logging.info('Tornado dumped %d event queues in %.3fs'
                  % (len(clients), time.time() - start))
@@ -437,38 +851,58 @@ def dump_event_queues():
 def load_event_queues():
     # type: () -> None
     global clients
+    global event_queue_journal_id
     start = time.time()
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
+    # ujson chokes on bad input pretty easily.  We handle a missing file
+    # separately from other errors so that we don't silently fail if we
+    # get bad input.
+    journal_id = None # type: Optional[str]
     try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
-            json_data = stored_queues.read()
-        try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
-        except Exception:
-            logging.exception("Could not deserialize event queues")
+        clients, journal_id = read_event_queue_snapshot(event_queue_snapshot_filename())
     except (IOError, EOFError):
         pass
+    except Exception:
+        logging.exception("Could not deserialize event queues")
+
+    num_records = None # type: Optional[int]
+    can_append = False
+    try:
+        if journal_id is not None:
+            num_records = replay_event_queue_journal(event_queue_journal_filename(),
+                                                     journal_id, clients)
+            can_append = num_records is not None
+            if num_records is None:
+                num_records = replay_rotated_event_queue_journal(event_queue_journal_filename(),
+                                                                 journal_id, clients)
+    except IOError:
+        pass
+    except Exception:
+        logging.exception("Could not replay event queue journal")
+
+    # We can only keep appending to the existing journal if it belonged
+    # to the snapshot we just loaded; otherwise setup_event_queue
+    # writes a fresh snapshot.
+    if can_append:
+        event_queue_journal_id = journal_id
 
     for client in six.itervalues(clients):
         # Put code for migrations due to event queue data format changes here
 
         add_to_client_dicts(client)
 
-    logging.info('Tornado loaded %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+    logging.info('Tornado loaded %d event queues (replaying %d journal entries) in %.3fs'
+                 % (len(clients), num_records or 0, time.time() - start))
 
 def send_restart_events(immediate=False):
     # type: (bool) -> None
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION) # type: Dict[str, Any]
     if immediate:
         event['immediate'] = True
+    restart_event = InternedEvent(event)
     for client in six.itervalues(clients):
         if client.accepts_event(event):
-            client.add_event(event.copy())
+            client.add_event(restart_event)
 
 def setup_event_queue():
     # type: () -> None
@@ -479,10 +913,15 @@ def setup_event_queue():
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
         tornado.autoreload.add_reload_hook(dump_event_queues) # type: ignore # TODO: Fix missing tornado.autoreload stub
 
-    try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
-    except OSError:
-        pass
+        if event_queue_journal_id is not None:
+            truncate_event_queue_journal(event_queue_journal_filename())
+            open_event_queue_journal(event_queue_journal_filename(),
+                                     event_queue_journal_id, truncate=False)
+        else:
+            # We have no journal matching the snapshot (e.g. on first
+            # startup, or when upgrading from the old single-file
+            # format), so start over with a fresh snapshot and journal.
+            dump_event_queues()
 
     # Set up event queue garbage collection
     ioloop = tornado.ioloop.IOLoop.instance()
@@ -490,8 +929,21 @@ def setup_event_queue():
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    if not settings.TEST_SUITE:
+        journal_pc = tornado.ioloop.PeriodicCallback(flush_event_queue_journal,
+                                                     EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS,
+                                                     ioloop)
+        journal_pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
+def prune_event_queue(client, through_id):
+    # type: (ClientDescriptor, int) -> None
+    """Drops the events the client has seen, through through_id."""
+    client.event_queue.prune(through_id)
+    journal_event_queue_change(dict(op='prune', queue_id=client.event_queue.id,
+                                    through_id=through_id, time=time.time()))
+
 def fetch_events(query):
     # type: (Mapping[str, Any]) -> Dict[str, Any]
     queue_id = query["queue_id"] # type: str
@@ -509,6 +961,8 @@ def fetch_events(query):
         extra_log_data = ""
         if queue_id is None:
             if dont_block:
+                if get_tornado_shard(user_profile_id) != tornado_shard:
+                    raise JsonableError(_("Event queues for this user are on another server"))
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
             else:
@@ -521,7 +975,7 @@ def fetch_events(query):
                 raise JsonableError(_("Bad event queue id: %s") % (queue_id,))
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
-            client.event_queue.prune(last_event_id)
+            prune_event_queue(client, last_event_id)
             was_connected = client.finish_current_handler()
 
         if not client.event_queue.empty() or dont_block:
@@ -548,6 +1002,58 @@ def fetch_events(query):
     client.connect_handler(handler_id, client_type_name)
     return dict(type="async")
 
+# Tornado sharding.  If settings.TORNADO_SERVERS lists more than one
+# Tornado process, each user's event queues live on a single process
+# (a "shard"), picked by settings.TORNADO_SHARD_ROUTER.  Django sends
+# requests about a user's queues to that user's shard, and sends each
+# event only to the shards with recipients on them.  Each shard
+# consumes its own notify_tornado queue, and prefixes its queue ids
+# with its shard number so that the proxy can route get_events
+# requests for a queue to the shard that owns it.
+
+# The shard this process serves, set by runtornado.
+tornado_shard = 0
+
+def get_tornado_servers():
+    # type: () -> List[Optional[str]]
+    if settings.TORNADO_SERVERS:
+        return settings.TORNADO_SERVERS
+    return [settings.TORNADO_SERVER]
+
+def shard_by_user_id(user_profile_id, num_shards):
+    # type: (int, int) -> int
+    return user_profile_id % num_shards
+
+def get_tornado_shard(user_profile_id):
+    # type: (int) -> int
+    num_shards = len(get_tornado_servers())
+    if num_shards == 1:
+        return 0
+    return import_string(settings.TORNADO_SHARD_ROUTER)(user_profile_id, num_shards)
+
+def get_tornado_shard_for_port(port):
+    # type: (int) -> int
+    for (shard, server) in enumerate(get_tornado_servers()):
+        if server is not None and server.rstrip('/').endswith(':%s' % (port,)):
+            return shard
+    return 0
+
+def get_tornado_server(user_profile_id):
+    # type: (int) -> Optional[str]
+    return get_tornado_servers()[get_tornado_shard(user_profile_id)]
+
+def notify_tornado_queue_name(shard):
+    # type: (int) -> str
+    if shard == 0:
+        return "notify_tornado"
+    return "notify_tornado_%d" % (shard,)
+
+def tornado_return_queue_name(shard):
+    # type: (int) -> str
+    if shard == 0:
+        return "tornado_return"
+    return "tornado_return_%d" % (shard,)
+
 # The following functions are called from Django
 
 # Workaround to support the Python-requests 1.0 transition of .json
@@ -562,19 +1068,21 @@ def extract_json_response(resp):
 
 def request_event_queue(user_profile, user_client, apply_markdown,
                         queue_lifespan_secs, event_types=None, all_public_streams=False,
-                        narrow=[]):
-    # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[text_type]]) -> Optional[str]
-    if settings.TORNADO_SERVER:
+                        narrow=[], compact_peer_events=False):
+    # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[text_type]], bool) -> Optional[str]
+    tornado_server = get_tornado_server(user_profile.id)
+    if tornado_server:
         req = {'dont_block'    : 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'all_public_streams': ujson.dumps(all_public_streams),
                'client'        : 'internal',
                'user_client'   : user_client.name,
                'narrow'        : ujson.dumps(narrow),
+               'compact_peer_events': ujson.dumps(compact_peer_events),
                'lifespan_secs' : queue_lifespan_secs}
         if event_types is not None:
             req['event_types'] = ujson.dumps(event_types)
-        resp = requests.get(settings.TORNADO_SERVER + '/api/v1/events',
+        resp = requests.get(tornado_server + '/api/v1/events',
                             auth=requests.auth.HTTPBasicAuth(user_profile.email,
                                                              user_profile.api_key),
                             params=req)
@@ -587,8 +1095,9 @@ def request_event_queue(user_profile, user_client, apply_markdown,
 
 def get_user_events(user_profile, queue_id, last_event_id):
     # type: (UserProfile, str, int) -> List[Dict]
-    if settings.TORNADO_SERVER:
-        resp = requests.get(settings.TORNADO_SERVER + '/api/v1/events',
+    tornado_server = get_tornado_server(user_profile.id)
+    if tornado_server:
+        resp = requests.get(tornado_server + '/api/v1/events',
                             auth=requests.auth.HTTPBasicAuth(user_profile.email,
                                                              user_profile.api_key),
                             params={'queue_id'     : queue_id,
@@ -684,6 +1193,7 @@ def process_message_event(event_template, users):
     message_id = message_dict_markdown['id'] # type: int
     message_type = message_dict_markdown['type'] # type: str
     sending_client = message_dict_markdown['client'] # type: text_type
+    invite_only = event_template.get("invite_only", False) # type: bool
 
     # To remove duplicate clients: Maps queue ID to {'client': Client, 'flags': flags}
     send_to_clients = {} # type: Dict[str, Dict[str, Any]]
@@ -691,8 +1201,13 @@ def process_message_event(event_template, users):
     # Extra user-specific data to include
     extra_user_data = {} # type: Dict[int, Any]
 
-    if 'stream_name' in event_template and not event_template.get("invite_only"):
+    # We skip clients that don't want messages at all here, rather
+    # than in the delivery loop below, so that a big stream doesn't
+    # build up bookkeeping for e.g. presence-only queues.
+    if 'stream_name' in event_template and not invite_only:
         for client in get_client_descriptors_for_realm_all_streams(event_template['realm_id']):
+            if not client.accepts_messages():
+                continue
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': None}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
                 send_to_clients[client.event_queue.id]['is_sender'] = True
@@ -702,17 +1217,24 @@ def process_message_event(event_template, users):
         flags = user_data.get('flags', []) # type: Iterable[str]
 
         for client in get_client_descriptors_for_user(user_profile_id):
+            if not client.accepts_messages():
+                continue
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': flags}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
                 send_to_clients[client.event_queue.id]['is_sender'] = True
 
         # If the recipient was offline and the message was a single or group PM to him
-        # or she was @-notified potentially notify more immediately
+        # or she was @-notified potentially notify more immediately.  Only
+        # those users can be notified, so we don't bother checking
+        # whether anyone else is idle.
         received_pm = message_type == "private" and user_profile_id != sender_id
         mentioned = 'mentioned' in flags
+        if not (received_pm or mentioned):
+            continue
+
         idle = receiver_is_idle(user_profile_id, realm_presences)
         always_push_notify = user_data.get('always_push_notify', False)
-        if (received_pm or mentioned) and (idle or always_push_notify):
+        if idle or always_push_notify:
             notice = build_offline_notification(user_profile_id, message_id)
             queue_json_publish("missedmessage_mobile_notifications", notice, lambda notice: None)
             notified = dict(push_notified=True) # type: Dict[str, bool]
@@ -725,52 +1247,81 @@ def process_message_event(event_template, users):
 
             extra_user_data[user_profile_id] = notified
 
+    # Every queue the message is delivered to shares one event body
+    # per (apply_markdown, invite_only_stream) variant; the queues only
+    # store the flags and other per-recipient data, as overrides.
+    # Zephyr mirroring bots need to know whether the stream is
+    # invite-only, so we build that variant at most once per message
+    # rather than once per bot.
+    message_events = {} # type: Dict[Tuple[bool, bool], InternedEvent]
+
     for client_data in six.itervalues(send_to_clients):
         client = client_data['client']
         flags = client_data['flags']
         is_sender = client_data.get('is_sender', False) # type: bool
         extra_data = extra_user_data.get(client.user_profile_id, None) # type: Optional[Mapping[str, bool]]
 
-        if not client.accepts_messages():
-            # The actual check is the accepts_event() check below;
-            # this line is just an optimization to avoid copying
-            # message data unnecessarily
+        # The below prevents (Zephyr) mirroring loops.
+        if ('mirror' in sending_client and
+            sending_client.lower() == client.client_type_name.lower()):
             continue
 
-        if client.apply_markdown:
-            message_dict = message_dict_markdown
-        else:
-            message_dict = message_dict_no_markdown
-
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
-        user_event = dict(type='message', message=message_dict, flags=flags) # type: Dict[str, Any]
+        variant = (client.apply_markdown, invite_only and "mirror" in client.client_type_name)
+        if variant not in message_events:
+            if client.apply_markdown:
+                message_dict = message_dict_markdown
+            else:
+                message_dict = message_dict_no_markdown
+            if variant[1]:
+                message_dict = message_dict.copy()
+                message_dict["invite_only_stream"] = True
+            message_events[variant] = InternedEvent(dict(type='message', message=message_dict))
+        message_event = message_events[variant]
+
+        overrides = dict(flags=flags) # type: Dict[str, Any]
         if extra_data is not None:
-            user_event.update(extra_data)
+            overrides.update(extra_data)
 
         if is_sender:
             local_message_id = event_template.get('local_id', None)
             if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
+                overrides["local_message_id"] = local_message_id
 
+        user_event = dict(message_event.event)
+        user_event.update(overrides)
         if not client.accepts_event(user_event):
             continue
 
-        # The below prevents (Zephyr) mirroring loops.
-        if ('mirror' in sending_client and
-            sending_client.lower() == client.client_type_name.lower()):
-            continue
-        client.add_event(user_event)
+        client.add_event(message_event, overrides)
+
+def legacy_peer_events(event):
+    # type: (Mapping[str, Any]) -> List[InternedEvent]
+    """Splits a peer_add or peer_remove event for several user_emails
+    into the one event per user that older clients expect."""
+    events = [] # type: List[InternedEvent]
+    for email in event['user_emails']:
+        legacy_event = dict(event)
+        del legacy_event['user_emails']
+        legacy_event['user_email'] = email
+        events.append(InternedEvent(legacy_event))
+    return events
 
 def process_event(event, users):
     # type: (Mapping[str, Any], Iterable[int]) -> None
+    interned = InternedEvent(dict(event))
+    legacy_events = None # type: Optional[List[InternedEvent]]
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(event):
-                client.add_event(dict(event))
+            if not client.accepts_event(event):
+                continue
+            if 'user_emails' in event and not client.compact_peer_events:
+                if legacy_events is None:
+                    legacy_events = legacy_peer_events(event)
+                for legacy_event in legacy_events:
+                    client.add_event(legacy_event)
+            else:
+                client.add_event(interned)
 
 def process_userdata_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
@@ -781,9 +1332,10 @@ def process_userdata_event(event_template, users):
             if key != "id":
                 user_event[key] = user_data[key]
 
+        interned = InternedEvent(user_event)
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(user_event):
-                client.add_event(user_event)
+                client.add_event(interned)
 
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
@@ -801,10 +1353,11 @@ def process_notification(notice):
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data):
-    # type: (Mapping[str, Any]) -> None
-    if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+def send_notification_http(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
+    tornado_server = get_tornado_servers()[shard]
+    if tornado_server and not settings.RUNNING_INSIDE_TORNADO:
+        requests.post(tornado_server + '/notify_tornado', data=dict(
                 data   = ujson.dumps(data),
                 secret = settings.SHARED_SECRET))
     else:
@@ -814,11 +1367,36 @@ def send_notification(data):
     # type: (Mapping[str, Any]) -> None
     queue_json_publish("notify_tornado", data, send_notification_http)
 
+def send_event_to_shard(event, users, shard):
+    # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]], int) -> None
+    queue_json_publish(notify_tornado_queue_name(shard),
+                       dict(event=event, users=users),
+                       lambda data: send_notification_http(data, shard))
+
 def send_event(event, users):
     # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    num_shards = len(get_tornado_servers())
+    if num_shards == 1:
+        send_event_to_shard(event, users, 0)
+        return
+
+    users_by_shard = defaultdict(list) # type: Dict[int, List[Any]]
+    for user in users:
+        if isinstance(user, dict):
+            user_profile_id = user['id']
+        else:
+            user_profile_id = user
+        users_by_shard[get_tornado_shard(user_profile_id)].append(user)
+
+    if event['type'] == 'message' and 'stream_name' in event:
+        # Queues following all public streams in the realm (or
+        # narrowed to a stream) may be on any shard.
+        shards = range(num_shards) # type: Iterable[int]
+    else:
+        shards = sorted(users_by_shard.keys())
+
+    for shard in shards:
+        send_event_to_shard(event, users_by_shard[shard], shard)
@@ -4,7 +4,9 @@ from django.conf import settings
 import pika
 from pika.adapters.blocking_connection import BlockingChannel
 from pika.spec import Basic
+from contextlib import contextmanager
 import logging
+import os
 import ujson
 import random
 import time
@@ -13,7 +15,8 @@ import atexit
 from collections import defaultdict
 
 from zerver.lib.utils import statsd
-from typing import Any, Callable, Dict, Mapping, Optional, Set, Union
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Set, \
+    Tuple, Union
 
 Consumer = Callable[[BlockingChannel, Basic.Deliver, pika.BasicProperties, str], None]
 
@@ -28,6 +31,8 @@ class SimpleQueueClient(object):
         self.queues = set() # type: Set[str]
         self.channel = None # type: Optional[BlockingChannel]
         self.consumers = defaultdict(set) # type: Dict[str, Set[Consumer]]
+        # The channel we've put in transaction mode; see publish_batch.
+        self.transactional_channel = None # type: Optional[BlockingChannel]
         # Disable RabbitMQ heartbeats since BlockingConnection can't process them
         self.rabbitmq_heartbeat = 0
         self._connect()
@@ -108,6 +113,50 @@ class SimpleQueueClient(object):
 
         self.ensure_queue(queue_name, do_publish)
 
+    def _publish_batch(self, items):
+        # type: (Sequence[Tuple[str, str]]) -> None
+        if not self.connection.is_open:
+            self._connect()
+        for queue_name in set(queue_name for queue_name, _ in items):
+            if queue_name not in self.queues:
+                self.channel.queue_declare(queue=queue_name, durable=True)
+                self.queues.add(queue_name)
+
+        if self.transactional_channel is not self.channel:
+            self.channel.tx_select()
+            self.transactional_channel = self.channel
+        for queue_name, body in items:
+            self.channel.basic_publish(
+                            exchange='',
+                            routing_key=queue_name,
+                            properties=pika.BasicProperties(delivery_mode=2),
+                            body=body)
+        self.channel.tx_commit()
+
+        for queue_name, _ in items:
+            statsd.incr("rabbitmq.publish.%s" % (queue_name,))
+
+    def publish_batch(self, items):
+        # type: (Sequence[Tuple[str, str]]) -> None
+        """Publishes a list of (queue name, body) pairs in one AMQP
+        transaction.  When this returns, RabbitMQ has accepted all of
+        them, at the cost of a single round trip for the whole batch.
+        If the connection fails, the whole batch is sent again, so
+        events may be published twice.
+
+        Once a client has published a batch, its channel is in
+        transaction mode, so it should only be used for batches."""
+        try:
+            self._publish_batch(items)
+        except (AttributeError, pika.exceptions.AMQPConnectionError):
+            # We can't tell whether RabbitMQ committed the transaction
+            # before the connection failed, so this may duplicate the
+            # batch's events; consumers already have to cope with
+            # events being redelivered.
+            self.log.warning("Failed to send to rabbitmq, trying to reconnect and send again")
+            self._reconnect()
+            self._publish_batch(items)
+
     def json_publish(self, queue_name, body):
         # type: (str, Union[Mapping[str, Any], str]) -> None
         # Union because of zerver.middleware.write_log_line uses a str
@@ -142,6 +191,64 @@ class SimpleQueueClient(object):
             callback(ujson.loads(body))
         self.register_consumer(queue_name, wrapped_callback)
 
+    def set_prefetch_count(self, prefetch_count):
+        # type: (int) -> None
+        """Limits how many unacknowledged messages RabbitMQ will deliver
+        to this client's consumers at a time.  Without a limit, RabbitMQ
+        sends a consumer everything in its queue as fast as it can."""
+        if not self.connection.is_open:
+            self._connect()
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def consume_json_batches(self, queue_name, callback, batch_size, batch_wait):
+        # type: (str, Callable[[List[Dict[str, Any]]], None], int, float) -> None
+        """Calls callback with lists of up to batch_size (decoded) messages
+        from the queue until stop_consuming_batches is called.  A batch is
+        handed to callback as soon as it is full, or batch_wait seconds
+        after its first message arrived.  All the messages in a batch are
+        acknowledged together once callback returns, or rejected if it
+        raises.  Use set_prefetch_count to allow at least batch_size
+        unacknowledged messages, or batches will never fill up."""
+        batch = [] # type: List[Dict[str, Any]]
+        delivery_tags = [] # type: List[int]
+
+        def flush():
+            # type: () -> None
+            try:
+                callback(batch)
+            except Exception as e:
+                self.channel.basic_nack(delivery_tag=delivery_tags[-1], multiple=True)
+                raise e
+            self.channel.basic_ack(delivery_tag=delivery_tags[-1], multiple=True)
+            del batch[:]
+            del delivery_tags[:]
+
+        def consume():
+            # type: () -> None
+            deadline = 0.0
+            # With an inactivity_timeout, the generator yields None
+            # when nothing has arrived for that long, which lets us
+            # flush a partial batch on time.
+            for delivery in self.channel.consume(queue_name, inactivity_timeout=batch_wait):
+                if delivery is not None:
+                    method, properties, body = delivery
+                    if not batch:
+                        deadline = time.time() + batch_wait
+                    batch.append(ujson.loads(body))
+                    delivery_tags.append(method.delivery_tag)
+                if batch and (len(batch) >= batch_size or time.time() >= deadline):
+                    flush()
+            # We were cancelled, but the channel is still open, so
+            # finish the messages we already have.
+            if batch:
+                flush()
+
+        self.ensure_queue(queue_name, consume)
+
+    def stop_consuming_batches(self):
+        # type: () -> None
+        self.channel.cancel()
+
     def drain_queue(self, queue_name, json=False):
         # type: (str, bool) -> List[Dict[str, Any]]
         "Returns all messages in the desired queue"
@@ -295,18 +402,108 @@ def setup_tornado_rabbitmq():
     if settings.USING_RABBITMQ:
         atexit.register(lambda: queue_client.close())
 
-# We using a simple lock to prevent multiple RabbitMQ messages being
-# sent to the SimpleQueueClient at the same time; this is a workaround
-# for an issue with the pika BlockingConnection where using
-# BlockingConnection for multiple queues causes the channel to
-# randomly close.
-queue_lock = threading.RLock()
+# Most events are published to RabbitMQ by a thread's QueuePublisher,
+# over a connection of its own: pika's BlockingConnection can't be
+# used from more than one thread.  (Tornado instead uses its
+# TornadoQueueClient from get_queue_client.)
+
+# The largest number of events an outbox holds before flushing them.
+QUEUE_OUTBOX_MAX_SIZE = 1000
+
+class QueuePublisher(object):
+    def __init__(self):
+        # type: () -> None
+        self.pid = os.getpid()
+        self.client = None # type: Optional[SimpleQueueClient]
+        self.outbox = [] # type: List[Tuple[str, str]]
+        self.outbox_depth = 0
+
+    def publish(self, queue_name, body):
+        # type: (str, str) -> None
+        """Publishes body to queue_name.  While an outbox is open (see
+        open_queue_outbox), this just adds it to the outbox."""
+        self.outbox.append((queue_name, body))
+        if self.outbox_depth == 0 or len(self.outbox) >= QUEUE_OUTBOX_MAX_SIZE:
+            self.flush()
+
+    def flush(self):
+        # type: () -> None
+        if not self.outbox:
+            return
+        batch = self.outbox
+        self.outbox = []
+        if self.client is None:
+            self.client = SimpleQueueClient()
+        self.client.publish_batch(batch)
+
+    def open_outbox(self):
+        # type: () -> None
+        self.outbox_depth += 1
+
+    def close_outbox(self):
+        # type: () -> None
+        self.outbox_depth -= 1
+        if self.outbox_depth == 0:
+            self.flush()
+
+    def reset_outbox(self):
+        # type: () -> None
+        self.outbox_depth = 0
+        self.flush()
+
+queue_publishers = threading.local()
+
+def get_queue_publisher():
+    # type: () -> QueuePublisher
+    publisher = getattr(queue_publishers, 'publisher', None) # type: Optional[QueuePublisher]
+    # A forked process can't share its parent's connection.
+    if publisher is None or publisher.pid != os.getpid():
+        publisher = QueuePublisher()
+        queue_publishers.publisher = publisher
+    return publisher
+
+def uses_queue_publisher():
+    # type: () -> bool
+    return settings.USING_RABBITMQ and not settings.RUNNING_INSIDE_TORNADO
+
+def open_queue_outbox():
+    # type: () -> None
+    """Starts collecting the events this thread publishes, to publish
+    them together when the matching close_queue_outbox call is made (or
+    once there are QUEUE_OUTBOX_MAX_SIZE of them).  We do this for each
+    request and for each event a queue worker consumes."""
+    if uses_queue_publisher():
+        get_queue_publisher().open_outbox()
+
+def close_queue_outbox():
+    # type: () -> None
+    if uses_queue_publisher():
+        get_queue_publisher().close_outbox()
+
+def reset_queue_outbox():
+    # type: () -> None
+    """Publishes any events left in this thread's outbox and closes it,
+    however many times it was opened.  Called at the start of each
+    request, in case the previous request's outbox was never closed
+    (e.g. because another middleware raised an exception)."""
+    if uses_queue_publisher():
+        get_queue_publisher().reset_outbox()
+
+@contextmanager
+def queue_outbox():
+    # type: () -> Iterator[None]
+    open_queue_outbox()
+    try:
+        yield
+    finally:
+        close_queue_outbox()
 
 def queue_json_publish(queue_name, event, processor):
     # type: (str, Union[Mapping[str, Any], str], Callable[[Any], None]) -> None
     # most events are dicts, but zerver.middleware.write_log_line uses a str
-    with queue_lock:
-        if settings.USING_RABBITMQ:
-            get_queue_client().json_publish(queue_name, event)
-        else:
-            processor(event)
+    if not settings.USING_RABBITMQ:
+        processor(event)
+    elif uses_queue_publisher():
+        get_queue_publisher().publish(queue_name, ujson.dumps(event))
+    else:
+        get_queue_client().json_publish(queue_name, event)
@@ -1,11 +1,11 @@
 from __future__ import absolute_import
 
 from six import text_type
-from typing import Any, Iterator, Tuple
+from typing import Any, Iterator, List, Tuple
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
-from six.moves import zip
+from six.moves import range, zip
 
 from zerver.models import UserProfile
 
@@ -78,6 +78,12 @@ def clear_user_history(user, domain='all'):
     '''
     for key in redis_key(user, domain):
         client.delete(key)
+    client.delete(gcra_redis_key(user, domain))
+
+def gcra_redis_key(user, domain):
+    # type: (UserProfile, text_type) -> text_type
+    """Return the redis key for this user's state in the 'gcra' rate limiter"""
+    return "ratelimit:%s:%s:%s:gcra" % (type(user), user.id, domain)
 
 def _get_api_calls_left(user, domain, range_seconds, max_calls):
     # type: (UserProfile, text_type, int, int) -> Tuple[int, float]
@@ -115,9 +121,9 @@ def api_calls_left(user, domain='all'):
     max_calls = _rules_for_user(user)[-1][1]
     return _get_api_calls_left(user, domain, max_window, max_calls)
 
-def is_ratelimited(user, domain='all'):
-    # type: (UserProfile, text_type) -> Tuple[bool, float]
-    "Returns a tuple of (rate_limited, time_till_free)"
+def is_ratelimited(user, domain='all', count=1):
+    # type: (UserProfile, text_type, int) -> Tuple[bool, float]
+    "Returns a tuple of (rate_limited, time_till_free) for making count more API calls"
     list_key, set_key, blocking_key = redis_key(user, domain)
 
     rules = _rules_for_user(user)
@@ -130,7 +136,9 @@ def is_ratelimited(user, domain='all'):
     # get the timestamps for each nth items
     with client.pipeline() as pipe:
         for _, request_count in rules:
-            pipe.lindex(list_key, request_count - 1) # 0-indexed list
+            # 0-indexed list; if more than request_count calls can't fit
+            # in the rule at all, this gets the oldest call, if any.
+            pipe.lindex(list_key, max(request_count - count, 0))
 
         # Get blocking info
         pipe.get(blocking_key)
@@ -152,6 +160,9 @@ def is_ratelimited(user, domain='all'):
 
     now = time.time()
     for timestamp, (range_seconds, num_requests) in zip(rule_timestamps, rules):
+        if count > num_requests:
+            # These calls would exceed this rule even if we had made no others.
+            return True, float(range_seconds)
         # Check if the nth timestamp is newer than the associated rule. If so,
         # it means we've hit our limit for this rule
         if timestamp is None:
@@ -166,11 +177,14 @@ def is_ratelimited(user, domain='all'):
     # No api calls recorded yet
     return False, 0.0
 
-def incr_ratelimit(user, domain='all'):
-    # type: (UserProfile, text_type) -> None
-    """Increases the rate-limit for the specified user"""
+def incr_ratelimit(user, domain='all', count=1):
+    # type: (UserProfile, text_type, int) -> None
+    """Increases the rate-limit for the specified user by count API calls"""
     list_key, set_key, _ = redis_key(user, domain)
     now = time.time()
+    # The sorted set can't hold the same timestamp twice, so we record
+    # the calls a microsecond apart.
+    timestamps = [now + i * 1e-6 for i in range(count)]
 
     # If we have no rules, we don't store anything
     if len(rules) == 0:
@@ -178,7 +192,7 @@ def incr_ratelimit(user, domain='all'):
 
     # Start redis transaction
     with client.pipeline() as pipe:
-        count = 0
+        attempts = 0
         while True:
             try:
                 # To avoid a race condition between getting the element we might trim from our list
@@ -187,26 +201,28 @@ def incr_ratelimit(user, domain='all'):
                 # When watching a value, the pipeline is set to Immediate mode
                 pipe.watch(list_key)
 
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(user) - 1)
+                # Get the last elems that we'll trim (so we can remove them from our sorted set)
+                last_vals = pipe.lrange(list_key, max(max_api_calls(user) - len(timestamps), 0),
+                                        max_api_calls(user) - 1)
 
                 # Restart buffered execution
                 pipe.multi()
 
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
+                # Add these timestamps to our list
+                pipe.lpush(list_key, *timestamps)
 
                 # Trim our list to the oldest rule we have
                 pipe.ltrim(list_key, 0, max_api_calls(user) - 1)
 
-                # Add our new value to the sorted set that we keep
+                # Add our new values to the sorted set that we keep
                 # We need to put the score and val both as timestamp,
                 # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
+                for timestamp in timestamps:
+                    pipe.zadd(set_key, timestamp, timestamp)
 
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
+                # Remove the trimmed values from our sorted set, if there were any
+                if last_vals:
+                    pipe.zrem(set_key, *last_vals)
 
                 # Set the TTL for our keys as well
                 api_window = max_api_window(user)
@@ -218,10 +234,101 @@ def incr_ratelimit(user, domain='all'):
                 # If no exception was raised in the execution, there were no transaction conflicts
                 break
             except redis.WatchError:
-                if count > 10:
+                if attempts > 10:
                     logging.error("Failed to complete incr_ratelimit transaction without interference 10 times "
                                   "in a row! Aborting rate-limit increment")
                     break
-                count += 1
+                attempts += 1
 
                 continue
+
+# The 'gcra' rate limiter (see RATE_LIMITING_ALGORITHM) implements each
+# (range_seconds, num_requests) rule with the Generic Cell Rate
+# Algorithm: requests are allowed at one per range_seconds/num_requests
+# on average, with bursts of up to num_requests.  For each rule, we only
+# store the "theoretical arrival time" of the next request, in a hash
+# field named after the rule; a request is allowed if that time is less
+# than range_seconds in the future.  The script checks a request against
+# the manual block and every rule and records it, atomically, in a
+# single round-trip.
+#
+# KEYS: the user's gcra key and blocking key
+# ARGV: the current time, the number of API calls the request counts as,
+#       then range_seconds and num_requests for each rule, with the
+#       longest rule last
+# Returns {1, secs_to_freedom, 0} if the request is rate-limited, and
+# otherwise {0, secs_to_reset, calls_remaining} for the longest rule.
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local count = tonumber(ARGV[2])
+
+local block_ttl = redis.call('ttl', KEYS[2])
+if block_ttl == -1 then
+    return {1, '0.5', 0}
+elseif block_ttl >= 0 then
+    return {1, tostring(block_ttl), 0}
+end
+
+local new_tats = {}
+local wait = 0
+local max_range = 0
+local secs_to_reset = 0
+local calls_remaining = 0
+for i = 3, #ARGV, 2 do
+    local range_seconds = tonumber(ARGV[i])
+    local num_requests = tonumber(ARGV[i + 1])
+    local interval = range_seconds / num_requests
+    local tat = tonumber(redis.call('hget', KEYS[1], ARGV[i] .. ':' .. ARGV[i + 1]))
+    if tat == nil or tat < now then
+        tat = now
+    end
+    local new_tat = tat + interval * count
+    if new_tat - range_seconds > now then
+        wait = math.max(wait, new_tat - range_seconds - now)
+    end
+    new_tats[#new_tats + 1] = new_tat
+    max_range = math.max(max_range, range_seconds)
+    secs_to_reset = new_tat - now
+    calls_remaining = num_requests - math.ceil((new_tat - now) / interval - 1e-6)
+end
+
+if wait > 0 then
+    return {1, tostring(wait), 0}
+end
+for i = 3, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i] .. ':' .. ARGV[i + 1], tostring(new_tats[(i - 1) / 2]))
+end
+redis.call('expire', KEYS[1], math.ceil(max_range))
+return {0, tostring(secs_to_reset), calls_remaining}
+"""
+gcra_script = client.register_script(GCRA_SCRIPT)
+
+def _gcra_rate_limit_request(user, domain, count):
+    # type: (UserProfile, text_type, int) -> Tuple[bool, float, int]
+    rules = _rules_for_user(user)
+    if len(rules) == 0:
+        return False, 0.0, 0
+
+    _, _, blocking_key = redis_key(user, domain)
+    args = [time.time(), count] # type: List[Any]
+    for range_seconds, num_requests in rules:
+        args.extend([range_seconds, num_requests])
+    ratelimited, secs, calls_remaining = gcra_script(keys=[gcra_redis_key(user, domain), blocking_key],
+                                                     args=args)
+    return bool(ratelimited), float(secs), int(calls_remaining)
+
+def rate_limit_request(user, domain='all', count=1):
+    # type: (UserProfile, text_type, int) -> Tuple[bool, float, int]
+    """Checks whether the user is over their rate limits, and if not,
+    records this request against them, as count API calls (e.g. one per
+    message sent by a bulk request).  Returns a tuple of
+    (rate_limited, time_till_free, calls_remaining)."""
+    if settings.RATE_LIMITING_ALGORITHM == 'gcra':
+        return _gcra_rate_limit_request(user, domain, count)
+
+    ratelimited, time_till_free = is_ratelimited(user, domain, count)
+    if ratelimited:
+        return True, time_till_free, 0
+    incr_ratelimit(user, domain, count)
+    calls_remaining, time_reset = api_calls_left(user, domain)
+    return False, time_reset, calls_remaining
@@ -20,7 +20,9 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.actions import check_send_message, extract_recipients
 from zerver.decorator import JsonableError
 from zerver.lib.utils import statsd
-from zerver.lib.event_queue import get_client_descriptor
+from zerver.lib import event_queue
+from zerver.lib.event_queue import get_client_descriptor, tornado_return_queue_name, \
+    prune_event_queue
 from zerver.middleware import record_request_start_data, record_request_stop_data, \
     record_request_restart_data, write_log_line, format_timedelta
 from zerver.lib.redis_utils import get_redis_client
@@ -84,6 +86,20 @@ class CloseErrorInfo(object):
 class SocketConnection(sockjs.tornado.SockJSConnection):
     client_id = None # type: Optional[Union[int, str]]
 
+    # Besides sending messages, a connection can stream the events of
+    # the event queue it authenticated with, instead of the client
+    # long-polling /json/get_events.  The client sends an 'events'
+    # request with the last_event_id it has seen; after that, the
+    # queue's events are pushed to it as {'type': 'events', 'queue_id':
+    # ..., 'events': [...]} messages as they arrive, all the events
+    # added during one pass of the IOLoop in a single message.  The
+    # client acknowledges the events it has handled with further
+    # 'events' requests, which prune them from the queue; if the
+    # connection drops, it reconnects and resumes from its last
+    # acknowledged event id, just as with get_events.
+    last_sent_event_id = None # type: Optional[int]
+    events_flush_scheduled = False
+
     def on_open(self, info):
         # type: (ConnectionInfo) -> None
         log_data = dict(extra='[transport=%s]' % (self.session.transport_name,))
@@ -95,6 +111,7 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
         self.session.user_profile = None
         self.close_info = None # type: CloseErrorInfo
         self.did_close = False
+        self.streaming_events = False
 
         try:
             self.browser_session_id = info.get_cookie(settings.SESSION_COOKIE_NAME).value
@@ -207,6 +224,22 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
                                status_code=403, error_content=ujson.dumps(response))
                 return
 
+        if msg['type'] == 'events':
+            log_data['extra'] += ']'
+            response = self.handle_events_request(msg['request'])
+            self.session.send_message({'req_id': msg['req_id'], 'type': 'response',
+                                       'response': response})
+            if response['result'] == 'success':
+                write_log_line(log_data, path='/socket/events', method='SOCKET',
+                               remote_ip=self.session.conn_info.ip,
+                               email=self.session.user_profile.email, client_name='?')
+            else:
+                write_log_line(log_data, path='/socket/events', method='SOCKET',
+                               remote_ip=self.session.conn_info.ip,
+                               email=self.session.user_profile.email, client_name='?',
+                               status_code=400, error_content=ujson.dumps(response))
+            return
+
         redis_key = req_redis_key(msg['req_id'])
         with redis_client.pipeline() as pipeline:
             pipeline.hmset(redis_key, {'status': 'received'})
@@ -219,11 +252,57 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
                                 req_id=msg['req_id'],
                                 server_meta=dict(user_id=self.session.user_profile.id,
                                                  client_id=self.client_id,
-                                                 return_queue="tornado_return",
+                                                 return_queue=tornado_return_queue_name(event_queue.tornado_shard),
                                                  log_data=log_data,
                                                  request_environ=dict(REMOTE_ADDR=self.session.conn_info.ip))),
                            fake_message_sender)
 
+    def handle_events_request(self, request):
+        # type: (Mapping[str, Any]) -> Dict[str, Any]
+        client = get_client_descriptor(self.client_id)
+        if client is None:
+            return {'result': 'error', 'msg': 'Bad event queue id: %s' % (self.client_id,)}
+        last_event_id = request.get('last_event_id')
+        if not isinstance(last_event_id, int):
+            return {'result': 'error', 'msg': "Missing 'last_event_id' argument"}
+
+        prune_event_queue(client, last_event_id)
+        if client.event_stream is not self:
+            client.connect_event_stream(self, request.get('client', 'websocket'))
+            self.streaming_events = True
+            # Send whatever the client hasn't seen yet.
+            self.last_sent_event_id = last_event_id
+            self.events_added()
+        return {'result': 'success', 'msg': ''}
+
+    def events_added(self):
+        # type: () -> None
+        if not self.events_flush_scheduled:
+            self.events_flush_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.send_events)
+
+    def send_events(self):
+        # type: () -> None
+        self.events_flush_scheduled = False
+        client = get_client_descriptor(self.client_id)
+        if self.did_close or client is None or client.event_stream is not self:
+            return
+        events = [event for event in client.event_queue.contents()
+                  if event['id'] > self.last_sent_event_id]
+        if len(events) == 0:
+            return
+        self.last_sent_event_id = events[-1]['id']
+        self.session.send_message({'type': 'events', 'queue_id': client.event_queue.id,
+                                   'events': events})
+        statsd.incr('socket.events_pushed', len(events))
+
+    def event_queue_deleted(self):
+        # type: () -> None
+        self.streaming_events = False
+        self.session.send_message({'type': 'events', 'queue_id': self.client_id,
+                                   'result': 'error',
+                                   'msg': 'Bad event queue id: %s' % (self.client_id,)})
+
     def on_close(self):
         # type: () -> None
         log_data = dict(extra='[transport=%s]' % (self.session.transport_name,))
@@ -235,6 +314,10 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
                            error_content=self.close_info.err_msg)
         else:
             deregister_connection(self)
+            if self.streaming_events:
+                client = get_client_descriptor(self.client_id)
+                if client is not None:
+                    client.disconnect_event_stream(self)
             email = self.session.user_profile.email \
                 if self.session.user_profile is not None else 'unknown'
             write_log_line(log_data, path='/socket/close', method='SOCKET',
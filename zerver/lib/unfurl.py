@@ -0,0 +1,134 @@
+"""Link previews ("unfurling"), fetched in the background.
+
+Sending a message never waits for an external site.  When bugdown's
+InlineInterestingLinkProcessor renders a message, it only uses the
+previews (tweets, Dropbox open graph data) that are already in the
+persistent preview cache, and records the ones that aren't on the
+message, as links_for_preview.  The message is sent without them, and
+do_send_messages queues them to the link_previews worker.  That worker
+fetches the previews for a batch of messages with fetch_previews,
+caches them, and re-renders the messages; see
+zerver.lib.actions.do_render_link_previews.
+
+Previews are cached in the 'database' cache, so they survive restarts
+and are shared by all the servers.  We also cache the fact that a link
+has no preview, for a shorter time.  Errors that are likely to go away
+(e.g. timeouts, or Twitter rate-limiting us) aren't cached at all.
+"""
+from __future__ import absolute_import
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from six import text_type
+
+from zerver.lib.cache import cache_get, cache_set
+from zerver.lib.utils import make_safe_digest
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from six.moves import zip_longest
+import logging
+import threading
+import traceback
+
+# How long to keep a link's preview, and how long to remember that a
+# link has no preview, before fetching it again.
+PREVIEW_CACHE_TIMEOUT = 7 * 24 * 3600
+NO_PREVIEW_CACHE_TIMEOUT = 3600
+
+# How many links fetch_previews fetches at a time, and at most how many
+# of those may be from the same domain, so that a slow site can't tie
+# up the whole pool (or get a burst of requests from us).
+FETCH_THREADS = 8
+MAX_FETCHES_PER_DOMAIN = 2
+
+# A link to preview is a [kind, key, domain] list: the kind of preview
+# ('tweet' or 'open_graph'), the key it is fetched and cached by (a
+# tweet id or URL), and the domain it is fetched from.  These are sent
+# through the link_previews queue, so they're lists rather than tuples.
+PreviewLink = Sequence[text_type]
+Preview = Optional[Dict[text_type, Any]]
+# Called with a preview's kind and key; see bugdown.fetch_preview.
+PreviewFetcher = Callable[[text_type, text_type], Preview]
+
+def preview_cache_key(kind, key):
+    # type: (text_type, text_type) -> text_type
+    return u'link_preview:%s:%s' % (kind, make_safe_digest(key))
+
+def get_cached_preview(kind, key):
+    # type: (text_type, text_type) -> Optional[Tuple[Preview]]
+    """Returns a 1-tuple of the cached preview (which is None if the link
+    has no preview), or None if it isn't cached."""
+    return cache_get(preview_cache_key(kind, key), cache_name='database')
+
+def cache_preview(kind, key, preview):
+    # type: (text_type, text_type, Preview) -> None
+    if preview is not None:
+        timeout = PREVIEW_CACHE_TIMEOUT
+    else:
+        timeout = NO_PREVIEW_CACHE_TIMEOUT
+    cache_set(preview_cache_key(kind, key), preview, cache_name='database', timeout=timeout)
+
+def try_fetch(fetch, kind, key):
+    # type: (PreviewFetcher, text_type, text_type) -> Tuple[bool, Preview]
+    """Returns whether fetching the preview succeeded, and the preview."""
+    try:
+        return (True, fetch(kind, key))
+    except Exception:
+        logging.warning("Failed to fetch the %s preview for %s:\n%s" % (
+            kind, key, traceback.format_exc()))
+        return (False, None)
+
+def fetch_preview(fetch, kind, key):
+    # type: (PreviewFetcher, text_type, text_type) -> Preview
+    """Fetches a single preview now, and caches it."""
+    (succeeded, preview) = try_fetch(fetch, kind, key)
+    if succeeded:
+        cache_preview(kind, key, preview)
+    return preview
+
+def fetch_previews(links, fetch, threads=FETCH_THREADS, max_per_domain=MAX_FETCHES_PER_DOMAIN):
+    # type: (Sequence[PreviewLink], PreviewFetcher, int, int) -> Dict[Tuple[text_type, text_type], Preview]
+    """Fetches the previews for links in parallel, with at most
+    max_per_domain requests to a domain at a time, and caches them.
+    Links that are repeated, or whose previews have been cached since
+    they were queued, are only fetched once (or not at all).  Returns a
+    dict mapping each link's (kind, key) to its preview."""
+    previews = {} # type: Dict[Tuple[text_type, text_type], Preview]
+    links_by_domain = OrderedDict() # type: Dict[text_type, List[PreviewLink]]
+    for (kind, key, domain) in links:
+        if (kind, key) in previews:
+            continue
+        cached = get_cached_preview(kind, key)
+        previews[(kind, key)] = cached[0] if cached is not None else None
+        if cached is None:
+            links_by_domain.setdefault(domain, []).append((kind, key, domain))
+    if not links_by_domain:
+        return previews
+
+    # Take the links from each domain in turn, so that the pool's threads
+    # aren't all stuck waiting for the same domain's semaphore.
+    to_fetch = [link for links_for_domains in zip_longest(*links_by_domain.values())
+                for link in links_for_domains if link is not None]
+    semaphores = dict((domain, threading.BoundedSemaphore(max_per_domain))
+                      for domain in links_by_domain)
+
+    def fetch_link(link):
+        # type: (PreviewLink) -> Tuple[bool, Preview]
+        (kind, key, domain) = link
+        with semaphores[domain]:
+            return try_fetch(fetch, kind, key)
+
+    # The threads only make the requests; the cache is updated from this
+    # thread, so that they don't open database connections of their own.
+    pool = ThreadPool(min(threads, len(to_fetch)))
+    try:
+        results = pool.map(fetch_link, to_fetch)
+    finally:
+        pool.close()
+        pool.join()
+
+    for ((kind, key, domain), (succeeded, preview)) in zip(to_fetch, results):
+        if succeeded:
+            cache_preview(kind, key, preview)
+        previews[(kind, key)] = preview
+    return previews
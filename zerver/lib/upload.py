@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from typing import Optional, Tuple, Mapping, Any
+from typing import Any, IO, Iterable, Iterator, Mapping, Optional, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
@@ -24,8 +24,11 @@ from zerver.models import Realm, UserProfile
 
 from six.moves import urllib
 import base64
+import imghdr
+import itertools
 import os
 import re
+import tempfile
 from PIL import Image, ImageOps
 from six import binary_type, text_type
 import io
@@ -40,8 +43,11 @@ import logging
 # Because we set FILE_UPLOAD_MAX_MEMORY_SIZE to 0, only the latter case
 # should occur in practice.
 #
-# This is great, because passing the pseudofile object that Django gives
-# you to boto would be a pain.
+# The backends never read a whole upload into memory either: they copy
+# it UPLOAD_CHUNK_SIZE bytes at a time, to a temporary file that is
+# renamed into place (local storage) or as the parts of a multipart
+# upload (S3), so a worker's memory use doesn't grow with the sizes or
+# number of the files being uploaded.
 
 # To come up with a s3 key we randomly generate a "directory". The
 # "file name" is the original filename provided by the user run
@@ -80,11 +86,51 @@ def random_name(bytes=60):
 class BadImageError(JsonableError):
     pass
 
-def resize_avatar(image_data):
-    # type: (binary_type) -> binary_type
+class FileTooLargeError(JsonableError):
+    pass
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# S3 requires all but the last part of a multipart upload to be at
+# least 5MiB.
+S3_PART_SIZE = 5 * 1024 * 1024
+
+FileData = Union[binary_type, IO[bytes]]
+
+def read_chunks(file_data, max_size=None):
+    # type: (FileData, Optional[int]) -> Iterator[binary_type]
+    """Yields the contents of file_data (a file-like object, or bytes)
+    in chunks, raising FileTooLargeError as soon as more than max_size
+    bytes have been read."""
+    if isinstance(file_data, binary_type):
+        file_data = io.BytesIO(file_data)
+    size = 0
+    while True:
+        chunk = file_data.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise FileTooLargeError(_("File Upload is larger than allowed limit"))
+        yield chunk
+
+def sniff_content_type(chunks):
+    # type: (Iterator[binary_type]) -> Tuple[Optional[text_type], Iterator[binary_type]]
+    """Guesses the content type of an upload from its first chunk;
+    returns it and an iterator over all the chunks."""
+    first_chunk = next(chunks, b'')
+    content_type = None
+    image_type = imghdr.what(None, h=first_chunk)
+    if image_type is not None:
+        guessed_type = guess_type('image.' + image_type)[0]
+        if guessed_type is not None:
+            content_type = force_text(guessed_type)
+    return content_type, itertools.chain([first_chunk], chunks)
+
+def resize_avatar(image_file):
+    # type: (IO[bytes]) -> binary_type
     AVATAR_SIZE = 100
     try:
-        im = Image.open(io.BytesIO(image_data))
+        im = Image.open(image_file)
         im = ImageOps.fit(im, (AVATAR_SIZE, AVATAR_SIZE), Image.ANTIALIAS)
     except IOError:
         raise BadImageError("Could not decode avatar image; did you upload an image file?")
@@ -95,8 +141,9 @@ def resize_avatar(image_data):
 ### Common
 
 class ZulipUploadBackend(object):
-    def upload_message_image(self, uploaded_file_name, content_type, file_data, user_profile, target_realm=None):
-        # type: (text_type, Optional[text_type], binary_type, UserProfile, Optional[Realm]) -> text_type
+    def upload_message_image(self, uploaded_file_name, content_type, file_data, user_profile,
+                             target_realm=None, max_size=None):
+        # type: (text_type, Optional[text_type], FileData, UserProfile, Optional[Realm], Optional[int]) -> text_type
         raise NotImplementedError()
 
     def upload_avatar_image(self, user_file, user_profile, email):
@@ -129,21 +176,61 @@ def upload_image_to_s3(
         user_profile,
         contents,
     ):
-    # type: (NonBinaryStr, text_type, Optional[text_type], UserProfile, binary_type) -> None
+    # type: (NonBinaryStr, text_type, Optional[text_type], UserProfile, Union[binary_type, Iterable[binary_type]]) -> None
 
     conn = S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
     bucket = get_bucket(conn, force_str(bucket_name))
-    key = Key(bucket)
-    key.key = force_str(file_name)
-    key.set_metadata("user_profile_id", str(user_profile.id))
-    key.set_metadata("realm_id", str(user_profile.realm.id))
+    metadata = {
+        "user_profile_id": str(user_profile.id),
+        "realm_id": str(user_profile.realm.id),
+    }
 
     if content_type is not None:
         headers = {'Content-Type': force_str(content_type)}
     else:
         headers = None
 
-    key.set_contents_from_string(contents, headers=headers)
+    if isinstance(contents, binary_type):
+        contents = [contents]
+
+    # Collect the contents into S3_PART_SIZE parts in a temporary file,
+    # and send each one as a part of a multipart upload; files smaller
+    # than a part are uploaded with a single request.
+    multipart = None
+    num_parts = 0
+    part = tempfile.TemporaryFile()
+    try:
+        for chunk in contents:
+            part.write(chunk)
+            if part.tell() >= S3_PART_SIZE:
+                if multipart is None:
+                    multipart = bucket.initiate_multipart_upload(
+                        force_str(file_name), headers=headers, metadata=metadata)
+                num_parts += 1
+                part.seek(0)
+                multipart.upload_part_from_file(part, num_parts)
+                part.seek(0)
+                part.truncate()
+
+        if multipart is None:
+            key = Key(bucket)
+            key.key = force_str(file_name)
+            for name, value in metadata.items():
+                key.set_metadata(name, value)
+            part.seek(0)
+            key.set_contents_from_file(part, headers=headers)
+        else:
+            if part.tell() > 0:
+                num_parts += 1
+                part.seek(0)
+                multipart.upload_part_from_file(part, num_parts)
+            multipart.complete_upload()
+    except Exception:
+        if multipart is not None:
+            multipart.cancel_upload()
+        raise
+    finally:
+        part.close()
 
 def get_file_info(request, user_file):
     # type: (HttpRequest, File) -> Tuple[text_type, Optional[text_type]]
@@ -176,8 +263,13 @@ def get_realm_for_filename(path):
     return get_user_profile_by_id(key.metadata["user_profile_id"]).realm.id
 
 class S3UploadBackend(ZulipUploadBackend):
-    def upload_message_image(self, uploaded_file_name, content_type, file_data, user_profile, target_realm=None):
-        # type: (text_type, Optional[text_type], binary_type, UserProfile, Optional[Realm]) -> text_type
+    def upload_message_image(self, uploaded_file_name, content_type, file_data, user_profile,
+                             target_realm=None, max_size=None):
+        # type: (text_type, Optional[text_type], FileData, UserProfile, Optional[Realm], Optional[int]) -> text_type
+        chunks = read_chunks(file_data, max_size)
+        if content_type is None:
+            content_type, chunks = sniff_content_type(chunks)
+
         bucket_name = settings.S3_AUTH_UPLOADS_BUCKET
         s3_file_name = "/".join([
             str(target_realm.id if target_realm is not None else user_profile.realm.id),
@@ -191,7 +283,7 @@ class S3UploadBackend(ZulipUploadBackend):
                 s3_file_name,
                 content_type,
                 user_profile,
-                file_data
+                chunks
         )
 
         create_attachment(uploaded_file_name, s3_file_name, user_profile)
@@ -218,16 +310,16 @@ class S3UploadBackend(ZulipUploadBackend):
         bucket_name = settings.S3_AVATAR_BUCKET
         s3_file_name = user_avatar_hash(email)
 
-        image_data = user_file.read()
         upload_image_to_s3(
             bucket_name,
             s3_file_name + ".original",
             content_type,
             user_profile,
-            image_data,
+            read_chunks(user_file),
         )
 
-        resized_data = resize_avatar(image_data)
+        user_file.seek(0)
+        resized_data = resize_avatar(user_file)
         upload_image_to_s3(
             bucket_name,
             s3_file_name,
@@ -247,11 +339,25 @@ def mkdirs(path):
         os.makedirs(dirname)
 
 def write_local_file(type, path, file_data):
-    # type: (text_type, text_type, binary_type) -> None
+    # type: (text_type, text_type, Union[binary_type, Iterable[binary_type]]) -> None
     file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, type, path)
     mkdirs(file_path)
-    with open(file_path, 'wb') as f:
-        f.write(file_data)
+    if isinstance(file_data, binary_type):
+        file_data = [file_data]
+
+    # Write to a temporary file in the same directory and rename it into
+    # place, so that a partially written file is never served (or left
+    # behind if the upload fails).
+    (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in file_data:
+                f.write(chunk)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, file_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
 
 def get_local_file_path(path_id):
     # type: (text_type) -> Optional[text_type]
@@ -262,8 +368,9 @@ def get_local_file_path(path_id):
         return None
 
 class LocalUploadBackend(ZulipUploadBackend):
-    def upload_message_image(self, uploaded_file_name, content_type, file_data, user_profile, target_realm=None):
-        # type: (text_type, Optional[text_type], binary_type, UserProfile, Optional[Realm]) -> text_type
+    def upload_message_image(self, uploaded_file_name, content_type, file_data, user_profile,
+                             target_realm=None, max_size=None):
+        # type: (text_type, Optional[text_type], FileData, UserProfile, Optional[Realm], Optional[int]) -> text_type
         # Split into 256 subdirectories to prevent directories from getting too big
         path = "/".join([
             str(user_profile.realm.id),
@@ -272,7 +379,7 @@ class LocalUploadBackend(ZulipUploadBackend):
             sanitize_name(uploaded_file_name)
         ])
 
-        write_local_file('files', path, file_data)
+        write_local_file('files', path, read_chunks(file_data, max_size))
         create_attachment(uploaded_file_name, path, user_profile)
         return '/user_uploads/' + path
 
@@ -292,10 +399,10 @@ class LocalUploadBackend(ZulipUploadBackend):
         # type: (File, UserProfile, text_type) -> None
         email_hash = user_avatar_hash(email)
 
-        image_data = user_file.read()
-        write_local_file('avatars', email_hash+'.original', image_data)
+        write_local_file('avatars', email_hash+'.original', read_chunks(user_file))
 
-        resized_data = resize_avatar(image_data)
+        user_file.seek(0)
+        resized_data = resize_avatar(user_file)
         write_local_file('avatars', email_hash+'.png', resized_data)
 
 # Common and wrappers
@@ -312,10 +419,12 @@ def upload_avatar_image(user_file, user_profile, email):
     # type: (File, UserProfile, text_type) -> None
     upload_backend.upload_avatar_image(user_file, user_profile, email)
 
-def upload_message_image(uploaded_file_name, content_type, file_data, user_profile, target_realm=None):
-    # type: (text_type, Optional[text_type], binary_type, UserProfile, Optional[Realm]) -> text_type
+def upload_message_image(uploaded_file_name, content_type, file_data, user_profile,
+                         target_realm=None, max_size=None):
+    # type: (text_type, Optional[text_type], FileData, UserProfile, Optional[Realm], Optional[int]) -> text_type
     return upload_backend.upload_message_image(uploaded_file_name, content_type, file_data,
-                                               user_profile, target_realm=target_realm)
+                                               user_profile, target_realm=target_realm,
+                                               max_size=max_size)
 
 def claim_attachment(user_profile, path_id, message, is_message_realm_public):
     # type: (UserProfile, text_type, Mapping[str, Any], bool) -> bool
@@ -341,4 +450,5 @@ def create_attachment(file_name, path_id, user_profile):
 def upload_message_image_from_request(request, user_file, user_profile):
     # type: (HttpRequest, File, UserProfile) -> text_type
     uploaded_file_name, content_type = get_file_info(request, user_file)
-    return upload_message_image(uploaded_file_name, content_type, user_file.read(), user_profile)
+    return upload_message_image(uploaded_file_name, content_type, user_file, user_profile,
+                                max_size=settings.MAX_FILE_UPLOAD_SIZE * 1024 * 1024)
@@ -26,7 +26,13 @@ class Command(BaseCommand):
                 print("e-mail %s doesn't exist in the system, skipping" % (email,))
                 continue
 
-            do_update_message_flags(user_profile, "add", "read", None, True, None, None)
+            def progress(count, last_message_id):
+                # type: (int, int) -> None
+                print("%s: marked %d messages as read, through message %d" % (
+                    email, count, last_message_id))
+
+            do_update_message_flags(user_profile, "add", "read", [], True, None, None,
+                                    progress=progress)
 
             messages = Message.objects.filter(
                 usermessage__user_profile=user_profile).order_by('-id')[:1]
@@ -3,13 +3,14 @@ import datetime
 import pytz
 import logging
 
-from typing import Any
+from typing import Any, List
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Max, Q, QuerySet
 
 from zerver.lib.queue import queue_json_publish
-from zerver.models import UserActivity, UserProfile, get_realm, Realm
+from zerver.models import UserProfile, get_realm, Realm
 
 ## Logging setup ##
 
@@ -26,19 +27,13 @@ logger.addHandler(file_handler)
 
 
 VALID_DIGEST_DAYS = (1, 2, 3, 4)
-def inactive_since(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> bool
-    # Hasn't used the app in the last 24 business-day hours.
-    most_recent_visit = [row.last_visit for row in \
-                             UserActivity.objects.filter(
-            user_profile=user_profile)]
-
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+def inactive_users(user_profiles, cutoff):
+    # type: (QuerySet, datetime.datetime) -> QuerySet
+    # The users who haven't used the app in the last 24 business-day
+    # hours, including those who have never used it, in a single query.
+    return user_profiles.annotate(
+        last_visit=Max('useractivity__last_visit')).filter(
+        Q(last_visit=None) | Q(last_visit__lt=cutoff))
 
 def last_business_day():
     # type: () -> datetime.datetime
@@ -50,10 +45,13 @@ def last_business_day():
 
 # Changes to this should also be reflected in
 # zerver/worker/queue_processors.py:DigestWorker.consume()
-def queue_digest_recipient(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> None
+def queue_digest_recipients(realm, user_profile_ids, cutoff):
+    # type: (Realm, List[int], datetime.datetime) -> None
+    # The digests for a realm share most of their contents, so they are
+    # generated together; see zerver.lib.digest.handle_realm_digest_emails.
     # Convert cutoff to epoch seconds for transit.
-    event = {"user_profile_id": user_profile.id,
+    event = {"realm_id": realm.id,
+             "user_profile_ids": user_profile_ids,
              "cutoff": cutoff.strftime('%s')}
     queue_json_publish("digest_emails", event, lambda event: None)
 
@@ -109,9 +107,11 @@ in a while.
                 realm=get_realm(domain), is_active=True, is_bot=False,
                 enable_digest_emails=True)
 
-            for user_profile in user_profiles:
-                cutoff = last_business_day()
-                if inactive_since(user_profile, cutoff):
-                    queue_digest_recipient(user_profile, cutoff)
-                    logger.info("%s is inactive, queuing for potential digest" % (
-                            user_profile.email,))
+            cutoff = last_business_day()
+            user_profile_ids = [] # type: List[int]
+            for user_profile_id, email in inactive_users(user_profiles, cutoff).values_list(
+                    'id', 'email'):
+                user_profile_ids.append(user_profile_id)
+                logger.info("%s is inactive, queuing for potential digest" % (email,))
+            if user_profile_ids:
+                queue_digest_recipients(realm, user_profile_ids, cutoff)
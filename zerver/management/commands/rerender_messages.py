@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from zerver.lib import bugdown
+from zerver.lib.actions import do_rerender_messages
+from zerver.lib.bugdown.render_pool import RenderingPool
+from zerver.models import Message
+
+import datetime
+import multiprocessing
+import time
+
+class Command(BaseCommand):
+    help = """Re-render messages rendered by an older version of bugdown.
+
+Messages whose rendered_content is missing or older than the current
+bugdown.version are otherwise only re-rendered when someone fetches
+them.  This walks through them in order of id, rendering each chunk
+in parallel worker processes and saving it with a single UPDATE.
+
+The command can be interrupted at any time; run it again to continue
+(pass --start-id with the last id it printed to skip ahead).
+
+Usage: python manage.py rerender_messages [--rows-per-second 500]"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--start-id', dest='start_id', type=int, default=0,
+                            help='Only re-render messages with ids greater than this.')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000,
+                            help='Number of messages to render and save at a time.')
+        parser.add_argument('--processes', dest='processes', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='Number of worker processes to render with.')
+        parser.add_argument('--rows-per-second', dest='rows_per_second', type=float,
+                            default=0,
+                            help='Maximum number of messages to re-render per second '
+                                 '(default: no limit).')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        stale = Q(rendered_content_version=None) | Q(rendered_content_version__lt=bugdown.version)
+        pool = RenderingPool(options['processes'])
+        last_id = options['start_id']
+        total_rendered = 0
+        total_failed = 0
+        start = time.time()
+        try:
+            while True:
+                chunk_start = time.time()
+                messages = list(Message.objects.select_related().filter(stale, id__gt=last_id)
+                                .order_by('id')[:options['chunk_size']])
+                if len(messages) == 0:
+                    break
+
+                rendered = do_rerender_messages(messages, pool)
+                last_id = messages[-1].id
+                total_rendered += len(rendered)
+                total_failed += len(messages) - len(rendered)
+                print("%s rendered %d messages (%d failed or edited meanwhile), through id %d, %.1f messages/s" % (
+                    datetime.datetime.now(), total_rendered, total_failed, last_id,
+                    (total_rendered + total_failed) / (time.time() - start)))
+
+                if options['rows_per_second']:
+                    time.sleep(max(0, len(messages) / options['rows_per_second'] -
+                                   (time.time() - chunk_start)))
+        finally:
+            pool.close()
+        print("Done; rendered %d messages (%d failed)." % (total_rendered, total_failed))
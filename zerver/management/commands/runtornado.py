@@ -25,7 +25,9 @@ from zerver.lib.debug import interactive_debug_listen
 from zerver.lib.response import json_response
 from zerver.lib.event_queue import process_notification, missedmessage_hook
 from zerver.lib.event_queue import setup_event_queue, add_client_gc_hook, \
-    get_descriptor_by_handler_id, clear_handler_by_id
+    get_descriptor_by_handler_id, clear_handler_by_id, get_tornado_shard_for_port, \
+    notify_tornado_queue_name, tornado_return_queue_name
+from zerver.lib import event_queue
 from zerver.lib.handlers import allocate_handler_id
 from zerver.lib.queue import setup_tornado_rabbitmq
 from zerver.lib.socket import get_sockjs_router, respond_send_message
@@ -95,11 +97,17 @@ class Command(BaseCommand):
             print("Tornado server is running at http://%s:%s/" % (addr, port))
             print("Quit the server with %s." % (quit_command,))
 
+            # When running several Tornado processes, each one serves
+            # the event queues of one shard of the users.
+            event_queue.tornado_shard = get_tornado_shard_for_port(int(port))
+
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(notify_tornado_queue_name(event_queue.tornado_shard),
+                                                    process_notification)
+                queue_client.register_json_consumer(tornado_return_queue_name(event_queue.tornado_shard),
+                                                    respond_send_message)
 
             try:
                 urls = (r"/notify_tornado",
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from typing import Any, Iterable
+from typing import Any, Sequence
 
 from optparse import make_option
 import logging
@@ -10,13 +10,14 @@ import sys
 from django.core.management.base import BaseCommand
 
 from zerver.lib import utils
+from zerver.lib.actions import do_update_message_flags, update_message_flags_in_ranges
 from zerver.models import UserMessage, get_user_profile_by_email
-from django.db import models
 
 
 class Command(BaseCommand):
-    help = """Sets user message flags. Used internally by actions.py. Marks all
-    Expects a comma-delimited list of user message ids via stdin, and an EOF to terminate."""
+    help = """Sets user message flags.  Marks all messages with ids up to
+    --until, or expects a comma-delimited list of message ids via stdin,
+    and an EOF to terminate."""
 
     option_list = BaseCommand.option_list + (
         make_option('-r', '--for-real',
@@ -34,8 +35,8 @@ class Command(BaseCommand):
                     help="The operation to do: 'add' or 'remove'"),
         make_option('-u', '--until',
                     dest='all_until',
-                    type='string',
-                    help="Mark all messages <= specific usermessage id"),
+                    type='int',
+                    help="Mark all messages <= specific message id"),
         make_option('-m', '--email',
                     dest='email',
                     type='string',
@@ -49,36 +50,36 @@ class Command(BaseCommand):
             exit(1)
 
         op = options['op']
-        flag = getattr(UserMessage.flags, options['flag'])
+        flag = options['flag']
         all_until = options['all_until']
         email = options['email']
 
         user_profile = get_user_profile_by_email(email)
 
+        msgs = UserMessage.objects.filter(user_profile=user_profile)
         if all_until:
-            filt = models.Q(id__lte=all_until)
+            msgs = msgs.filter(message_id__lte=all_until)
         else:
-            filt = models.Q(message__id__in=[mid.strip() for mid in sys.stdin.read().split(',')])
-        mids = [m.id for m in
-                    UserMessage.objects.filter(filt, user_profile=user_profile).order_by('-id')]
-
-        if options["for_real"]:
-            sys.stdin.close()
-            sys.stdout.close()
-            sys.stderr.close()
-
-        def do_update(batch):
-            # type: (Iterable[int]) -> None
-            msgs = UserMessage.objects.filter(id__in=batch)
-            if op == 'add':
-                msgs.update(flags=models.F('flags').bitor(flag))
-            elif op == 'remove':
-                msgs.update(flags=models.F('flags').bitand(~flag))
+            msgs = msgs.filter(message_id__in=[mid.strip() for mid in sys.stdin.read().split(',')])
 
         if not options["for_real"]:
+            mids = list(msgs.order_by('-message_id').values_list('message_id', flat=True))
             logging.info("Updating %s by %s %s" % (mids, op, flag))
             logging.info("Dry run completed. Run with --for-real to change message flags.")
             exit(1)
 
-        utils.run_in_batches(mids, 400, do_update, sleep_time=3)
+        def progress(count, last_message_id):
+            # type: (int, int) -> None
+            logging.info("Updated %d messages, through message %d" % (count, last_message_id))
+
+        if all_until:
+            update_message_flags_in_ranges(user_profile, op, flag, msgs, progress=progress)
+        else:
+            def do_update(batch):
+                # type: (Sequence[int]) -> None
+                do_update_message_flags(user_profile, op, flag, batch, False, None, None)
+
+            mids = list(msgs.order_by('message_id').values_list('message_id', flat=True))
+            utils.run_in_batches(mids, 400, do_update, sleep_time=3,
+                                 logger=logging.info)
         exit(0)
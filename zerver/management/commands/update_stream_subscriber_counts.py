@@ -0,0 +1,38 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib.actions import update_stream_subscriber_counts
+from zerver.models import Stream, get_realm
+
+class Command(BaseCommand):
+    help = """Recompute the number of subscribers of each stream.
+
+Each stream's subscriber count is updated along with its subscriptions,
+so this is only needed after changing subscriptions directly in the
+database (or to check that the counts are right).  It prints how many
+streams had the wrong count.
+
+Usage: python manage.py update_stream_subscriber_counts [--domain zulip.com]"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--domain', dest='domain', type=str, default=None,
+                            help='Only update the streams of the realm with this domain.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if options['domain'] is None:
+            num_fixed = update_stream_subscriber_counts()
+        else:
+            realm = get_realm(options['domain'])
+            if realm is None:
+                print("Unknown domain %s" % (options['domain'],))
+                exit(1)
+            num_fixed = update_stream_subscriber_counts(
+                list(Stream.objects.filter(realm=realm).values_list('id', flat=True)))
+        print("Fixed the subscriber counts of %d streams." % (num_fixed,))
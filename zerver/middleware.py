@@ -11,7 +11,8 @@ from zerver.lib.request import JsonableError
 from django.db import connection
 from django.http import HttpRequest, HttpResponse
 from zerver.lib.utils import statsd
-from zerver.lib.queue import queue_json_publish
+from zerver.lib.queue import queue_json_publish, open_queue_outbox, close_queue_outbox, \
+    reset_queue_outbox
 from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests
 from zerver.lib.bugdown import get_bugdown_time, get_bugdown_requests
 from zerver.models import flush_per_request_caches
@@ -335,6 +336,25 @@ class RateLimitMiddleware(object):
             resp['Retry-After'] = request._ratelimit_secs_to_freedom
             return resp
 
+class QueueOutboxMiddleware(object):
+    # Publishes the RabbitMQ events from each request together when it
+    # is done; see zerver.lib.queue.open_queue_outbox.
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        # process_response isn't called if a later middleware's
+        # process_response raises, so don't rely on it having closed
+        # the previous request's outbox.
+        reset_queue_outbox()
+        open_queue_outbox()
+        request._queue_outbox_open = True
+
+    def process_response(self, request, response):
+        # type: (HttpRequest, HttpResponse) -> HttpResponse
+        if getattr(request, '_queue_outbox_open', False):
+            request._queue_outbox_open = False
+            close_queue_outbox()
+        return response
+
 class FlushDisplayRecipientCache(object):
     def process_response(self, request, response):
         # type: (HttpRequest, HttpResponse) -> HttpResponse
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Keep in sync with STREAM_SUBSCRIBER_COUNTS_QUERY in zerver/lib/actions.py.
+FILL_SUBSCRIBER_COUNTS = """
+UPDATE zerver_stream SET subscriber_count = counts.count
+FROM (
+    SELECT s.id AS stream_id, count(up.id) AS count
+    FROM zerver_stream s
+    LEFT JOIN zerver_recipient r ON r.type = 2 AND r.type_id = s.id
+    LEFT JOIN zerver_subscription sub ON sub.recipient_id = r.id AND sub.active
+    LEFT JOIN zerver_userprofile up ON up.id = sub.user_profile_id AND up.is_active
+    GROUP BY s.id
+) counts
+WHERE zerver_stream.id = counts.stream_id
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0025_realm_message_content_edit_limit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stream',
+            name='subscriber_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(FILL_SUBSCRIBER_COUNTS, reverse_sql=migrations.RunSQL.noop),
+    ]
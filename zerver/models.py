@@ -17,7 +17,8 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     display_recipient_cache_key, cache_delete, \
     get_stream_cache_key, active_user_dicts_in_realm_cache_key, \
     active_bot_dicts_in_realm_cache_key, active_user_dict_fields, \
-    active_bot_dict_fields
+    active_bot_dict_fields, user_presence_dicts_cache_key, \
+    realm_rendering_generation_cache_key
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from zerver.lib.str_utils import force_bytes, ModelReprMixin, dict_with_str_keys
 from django.db import transaction
@@ -282,6 +283,7 @@ def flush_realm_emoji(sender, **kwargs):
     cache_set(get_realm_emoji_cache_key(realm),
               get_realm_emoji_uncached(realm),
               timeout=3600*24*7)
+    cache_delete(realm_rendering_generation_cache_key(realm.id))
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
 post_delete.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -539,6 +541,13 @@ class PushDeviceToken(models.Model):
     # [optional] Contains the app id of the device if it is an iOS device
     ios_app_id = models.TextField(null=True) # type: Optional[text_type]
 
+def flush_push_device_token(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    cache_delete(user_presence_dicts_cache_key(kwargs['instance'].user_id))
+
+post_save.connect(flush_push_device_token, sender=PushDeviceToken)
+post_delete.connect(flush_push_device_token, sender=PushDeviceToken)
+
 class MitUser(models.Model):
     email = models.EmailField(unique=True) # type: text_type
     # status: whether an object has been confirmed.
@@ -563,6 +572,13 @@ class Stream(ModelReprMixin, models.Model):
 
     date_created = models.DateTimeField(default=timezone.now) # type: datetime.datetime
     deactivated = models.BooleanField(default=False) # type: bool
+    # The number of active users with active subscriptions to the
+    # stream.  It's maintained by the functions in zerver/lib/actions.py
+    # that change subscriptions (see change_subscriber_counts) with
+    # UPDATEs, so it's stale on Stream objects from the cache; use
+    # num_subscribers() to read it.  `manage.py
+    # update_stream_subscriber_counts` recomputes it.
+    subscriber_count = models.IntegerField(default=0) # type: int
 
     def __unicode__(self):
         # type: () -> text_type
@@ -588,12 +604,8 @@ class Stream(ModelReprMixin, models.Model):
 
     def num_subscribers(self):
         # type: () -> int
-        return Subscription.objects.filter(
-                recipient__type=Recipient.STREAM,
-                recipient__type_id=self.id,
-                user_profile__is_active=True,
-                active=True
-        ).count()
+        return Stream.objects.filter(id=self.id).values_list(
+            'subscriber_count', flat=True)[0]
 
     # This is stream information that is sent to clients
     def to_dict(self):
@@ -812,10 +824,23 @@ class Message(ModelReprMixin, models.Model):
             import zerver.lib.bugdown as bugdown
             # 'from zerver.lib import bugdown' gives mypy error in python 3 mode.
 
+        domain = self.prepare_to_render(domain)
+        rendered_content = bugdown.convert(content, domain, self)
+
+        self.is_me_message = Message.is_status_message(content, rendered_content)
+
+        return rendered_content
+
+    def prepare_to_render(self, domain=None):
+        # type: (Optional[text_type]) -> text_type
+        """Reset the properties bugdown sets on the message, and return
+        the domain whose markdown processor should render it."""
         self.mentions_wildcard = False
         self.is_me_message = False
         self.mentions_user_ids = set() # type: Set[int]
         self.user_ids_with_alert_words = set() # type: Set[int]
+        # Links whose previews weren't cached; see zerver.lib.unfurl.
+        self.links_for_preview = [] # type: List[List[text_type]]
 
         if not domain:
             domain = self.sender.realm.domain
@@ -823,11 +848,25 @@ class Message(ModelReprMixin, models.Model):
             # Use slightly customized Markdown processor for content
             # delivered via zephyr_mirror
             domain = u"mit.edu/zephyr_mirror"
-        rendered_content = bugdown.convert(content, domain, self)
+        return domain
 
-        self.is_me_message = Message.is_status_message(content, rendered_content)
+    @staticmethod
+    def render_markdown_many(messages, pool=None):
+        # type: (Sequence[Message], Optional[Any]) -> List[Optional[text_type]]
+        """Like render_markdown, for the content of many messages at once,
+        rendered in parallel by a bugdown rendering pool."""
+        global bugdown
+        if bugdown is None:
+            import zerver.lib.bugdown as bugdown
 
-        return rendered_content
+        renders = [(message.content, message.prepare_to_render(), message)
+                   for message in messages]
+        rendered = bugdown.convert_many(renders, pool)
+        for message, rendered_content in zip(messages, rendered):
+            if rendered_content is not None:
+                message.is_me_message = Message.is_status_message(message.content,
+                                                                  rendered_content)
+        return rendered
 
     def set_rendered_content(self, rendered_content, save = False):
         # type: (text_type, bool) -> bool
@@ -1102,7 +1141,12 @@ class Message(ModelReprMixin, models.Model):
 
     def sent_by_human(self):
         # type: () -> bool
-        sending_client = self.sending_client.name.lower()
+        return Message.client_is_human(self.sending_client.name)
+
+    @staticmethod
+    def client_is_human(sending_client_name):
+        # type: (text_type) -> bool
+        sending_client = sending_client_name.lower()
 
         return (sending_client in ('zulipandroid', 'zulipios', 'zulipdesktop',
                                    'website', 'ios', 'android')) or \
@@ -1447,7 +1491,7 @@ class UserPresence(models.Model):
         )
 
         mobile_user_ids = [row['user'] for row in PushDeviceToken.objects.filter(
-                user__realm_id=1,
+                user__realm_id=realm_id,
                 user__is_active=True,
                 user__is_bot=False,
         ).distinct("user").values("user")]
@@ -1466,6 +1510,63 @@ class UserPresence(models.Model):
 
         return user_statuses
 
+    @staticmethod
+    def get_status_dicts_for_users(user_profile_ids):
+        # type: (Iterable[int]) -> Dict[int, Dict[text_type, Dict[str, Any]]]
+        """Like get_status_dict_by_realm, but only for the given users, and
+        keyed by user id rather than email.  Each user's presence dicts
+        are cached in the remote cache until their presence changes, so
+        sending a message doesn't need to read every presence row in
+        the realm."""
+        def query_function(user_profile_ids):
+            # type: (List[int]) -> List[Tuple[int, Dict[text_type, Dict[str, Any]]]]
+            user_statuses = dict((user_profile_id, {}) for user_profile_id in user_profile_ids) # type: Dict[int, Dict[text_type, Dict[str, Any]]]
+
+            query = UserPresence.objects.filter(
+                    user_profile_id__in=user_profile_ids,
+                    user_profile__is_active=True,
+                    user_profile__is_bot=False
+            ).values(
+                    'client__name',
+                    'status',
+                    'timestamp',
+                    'user_profile__id',
+                    'user_profile__enable_offline_push_notifications',
+                    'user_profile__is_mirror_dummy',
+            )
+
+            mobile_user_ids = set(row['user'] for row in PushDeviceToken.objects.filter(
+                    user_id__in=user_profile_ids,
+            ).distinct("user").values("user"))
+
+            for row in query:
+                info = UserPresence.to_presence_dict(
+                        client_name=row['client__name'],
+                        status=row['status'],
+                        dt=row['timestamp'],
+                        push_enabled=row['user_profile__enable_offline_push_notifications'],
+                        has_push_devices=row['user_profile__id'] in mobile_user_ids,
+                        is_mirror_dummy=row['user_profile__is_mirror_dummy'],
+                        )
+                user_statuses[row['user_profile__id']][row['client__name']] = info
+
+            # We return (and thus cache) an entry for every user, even
+            # those without any presence rows, so that users who never
+            # set their presence don't miss the cache on every lookup.
+            return list(user_statuses.items())
+
+        user_profile_ids = list(set(user_profile_ids))
+        if not user_profile_ids:
+            return {}
+
+        user_statuses = generic_bulk_cached_fetch(user_presence_dicts_cache_key,
+                                                  query_function,
+                                                  user_profile_ids,
+                                                  id_fetcher=lambda row: row[0],
+                                                  cache_transformer=lambda row: row[1])
+        return dict((user_profile_id, statuses) for (user_profile_id, statuses)
+                    in user_statuses.items() if statuses)
+
     @staticmethod
     def to_presence_dict(client_name=None, status=None, dt=None, push_enabled=None,
                          has_push_devices=None, is_mirror_dummy=None):
@@ -1503,6 +1604,13 @@ class UserPresence(models.Model):
     class Meta(object):
         unique_together = ("user_profile", "client")
 
+def flush_user_presence(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    cache_delete(user_presence_dicts_cache_key(kwargs['instance'].user_profile_id))
+
+post_save.connect(flush_user_presence, sender=UserPresence)
+post_delete.connect(flush_user_presence, sender=UserPresence)
+
 class DefaultStream(models.Model):
     realm = models.ForeignKey(Realm) # type: Realm
     stream = models.ForeignKey(Stream) # type: Stream
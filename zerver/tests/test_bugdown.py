@@ -3,24 +3,34 @@ from __future__ import print_function
 from __future__ import absolute_import
 from django.conf import settings
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from zerver.lib import bugdown
+from zerver.lib import bugdown, unfurl
+from zerver.lib.bugdown import render_pool
+from zerver.lib.alert_words import alert_word_automaton_for_realm
 from zerver.lib.actions import (
     check_add_realm_emoji,
     do_remove_realm_emoji,
+    do_render_link_previews,
     do_set_alert_words,
     get_realm,
 )
+from zerver.lib.cache import get_cache_backend
 from zerver.lib.camo import get_camo_url
+from zerver.lib.test_helpers import AuthedTestCase, tornado_redirected_to_list
 from zerver.models import (
     get_client,
     get_user_profile_by_email,
     Message,
+    Recipient,
     RealmFilter,
 )
 
+from six.moves import BaseHTTPServer, socketserver
 import mock
 import os
+import threading
+import time
 import ujson
 import six
 
@@ -411,6 +421,32 @@ class BugdownTest(TestCase):
         self.assertEqual(msg.render_markdown(content), "<p>We have a NOTHINGWORD day today!</p>")
         self.assertEqual(msg.user_ids_with_alert_words, set())
 
+    def test_overlapping_alert_words(self):
+        othello = get_user_profile_by_email("othello@zulip.com")
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        cordelia = get_user_profile_by_email("cordelia@zulip.com")
+        do_set_alert_words(othello, ["scary WORD"])
+        do_set_alert_words(hamlet, ["word"])
+        do_set_alert_words(cordelia, ["ary"])
+
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        msg.render_markdown("That's a (scary word).")
+        self.assertEqual(msg.user_ids_with_alert_words, set([othello.id, hamlet.id]))
+
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        msg.render_markdown("wordy scarywords")
+        self.assertEqual(msg.user_ids_with_alert_words, set())
+
+    def test_alert_word_automaton_cache(self):
+        user_profile = get_user_profile_by_email("othello@zulip.com")
+        do_set_alert_words(user_profile, ["ALERTWORD"])
+        automaton = alert_word_automaton_for_realm(user_profile.realm)
+        self.assertIs(alert_word_automaton_for_realm(user_profile.realm), automaton)
+
+        do_set_alert_words(user_profile, ["ALERTWORD", "scaryword"])
+        automaton = alert_word_automaton_for_realm(user_profile.realm)
+        self.assertEqual(automaton.user_ids_alerted(u"A SCARYWORD!"), set([user_profile.id]))
+
     def test_mention_wildcard(self):
         user_profile = get_user_profile_by_email("othello@zulip.com")
         msg = Message(sender=user_profile, sending_client=get_client("test"))
@@ -556,3 +592,236 @@ class BugdownTest(TestCase):
             '<p><a href="https://lists.debian.org/debian-ctte/2014/02/msg00173.html" target="_blank" title="https://lists.debian.org/debian-ctte/2014/02/msg00173.html">https://lists.debian.org/debian-ctte/2014/02/msg00173.html</a></p>',
             )
 
+
+class BugdownRenderingPoolTest(TestCase):
+    def tearDown(self):
+        if render_pool.rendering_pool is not None:
+            render_pool.rendering_pool.close()
+            render_pool.rendering_pool = None
+        render_pool.realm_db_data.clear()
+
+    @override_settings(BUGDOWN_RENDERING_PROCESSES=1)
+    def test_render_in_pool(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+
+        content = "@**King Hamlet**"
+        self.assertEqual(msg.render_markdown(content),
+                         '<p><span class="user-mention" data-user-email="hamlet@zulip.com">@King Hamlet</span></p>')
+        self.assertEqual(msg.mentions_user_ids, set([user_profile.id]))
+        self.assertIsNotNone(render_pool.rendering_pool)
+
+    @override_settings(BUGDOWN_RENDERING_PROCESSES=1, BUGDOWN_RENDERING_CPU_LIMIT=0.01)
+    def test_cpu_limit(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+
+        with mock.patch('zerver.lib.bugdown.report_rendering_failure') as report:
+            self.assertEqual(msg.render_markdown("*slow* " * 50000), None)
+        report.assert_called_once_with("*slow* " * 50000)
+
+    def test_render_markdown_many(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        cordelia = get_user_profile_by_email("cordelia@zulip.com")
+        messages = [Message(sender=sender_user_profile, sending_client=get_client("test"),
+                            content=content)
+                    for content in ["@**King Hamlet**", "/me waves", "@**Cordelia Lear**"]]
+
+        pool = render_pool.RenderingPool(2)
+        try:
+            rendered = Message.render_markdown_many(messages, pool)
+        finally:
+            pool.close()
+
+        self.assertEqual(rendered[1], "<p>/me waves</p>")
+        self.assertEqual([msg.mentions_user_ids for msg in messages],
+                         [set([hamlet.id]), set(), set([cordelia.id])])
+        self.assertEqual([msg.is_me_message for msg in messages], [False, True, False])
+
+    def test_render_markdown_many_failures(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        messages = [Message(sender=sender_user_profile, sending_client=get_client("test"),
+                            content=content)
+                    for content in ["first", "second", "third"]]
+
+        # The workers are forked with the broken renderer.
+        with mock.patch('zerver.lib.bugdown.render_with_data', side_effect=ValueError):
+            pool = render_pool.RenderingPool(2)
+        try:
+            with mock.patch('zerver.lib.bugdown.report_rendering_failure') as report:
+                rendered = Message.render_markdown_many(messages, pool)
+        finally:
+            pool.close()
+
+        self.assertEqual(rendered, [None, None, None])
+        report.assert_called_once_with("first", 3, mock.ANY)
+        self.assertIn("ValueError", report.call_args[0][2])
+
+    def test_worker_keeps_realm_data(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+        realm = sender_user_profile.realm
+        generation = bugdown.get_rendering_generation(realm)
+        self.assertEqual(bugdown.get_rendering_generation(realm), generation)
+
+        with mock.patch('zerver.lib.bugdown.fetch_db_data', return_value={}) as fetch:
+            render_pool.get_realm_db_data(msg, generation)
+            render_pool.get_realm_db_data(msg, generation)
+            self.assertEqual(fetch.call_count, 1)
+
+            # Changing the realm's users starts a new generation, and
+            # the data is fetched again.
+            sender_user_profile.full_name = "Othello, the Moor"
+            sender_user_profile.save(update_fields=["full_name"])
+            new_generation = bugdown.get_rendering_generation(realm)
+            self.assertNotEqual(new_generation, generation)
+            render_pool.get_realm_db_data(msg, new_generation)
+            self.assertEqual(fetch.call_count, 2)
+
+LINK_PREVIEW_TEST_CACHES = dict(settings.CACHES)
+# The test suite's 'database' cache doesn't store anything.
+LINK_PREVIEW_TEST_CACHES['database'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'link-preview-test-cache',
+}
+
+class OpenGraphStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a page with open graph tags for every path but /missing,
+    slowly, keeping track of how many requests it is handling at once."""
+    lock = threading.Lock()
+    num_requests = 0
+    active_requests = 0
+    max_active_requests = 0
+
+    def do_GET(self):
+        cls = OpenGraphStubHandler
+        with cls.lock:
+            cls.num_requests += 1
+            cls.active_requests += 1
+            cls.max_active_requests = max(cls.max_active_requests, cls.active_requests)
+        try:
+            time.sleep(0.05)
+            if self.path == '/missing':
+                body = '<html><head><title>Not found</title></head></html>'
+            else:
+                body = ('<html><head><meta property="og:image" content="http://example.com%s.png"/>'
+                        '<meta property="og:title" content="Page %s"/></head></html>' % (
+                            self.path, self.path))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+        finally:
+            with cls.lock:
+                cls.active_requests -= 1
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+@override_settings(CACHES=LINK_PREVIEW_TEST_CACHES)
+class LinkPreviewTest(AuthedTestCase):
+    def setUp(self):
+        get_cache_backend('database').clear()
+        OpenGraphStubHandler.num_requests = 0
+        OpenGraphStubHandler.max_active_requests = 0
+        self.server = StubServer(('127.0.0.1', 0), OpenGraphStubHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def stub_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+
+    def test_fetch_previews(self):
+        links = [['open_graph', self.stub_url('/page%d' % (i,)), '127.0.0.1'] for i in range(6)]
+        links.append(['open_graph', self.stub_url('/missing'), '127.0.0.1'])
+        links.append(links[0])
+        previews = unfurl.fetch_previews(links, bugdown.fetch_preview,
+                                         threads=8, max_per_domain=2)
+
+        page_preview = {'image': 'http://example.com/page1.png', 'title': 'Page /page1',
+                        'desc': None}
+        self.assertEqual(previews[('open_graph', self.stub_url('/page1'))], page_preview)
+        self.assertIsNone(previews[('open_graph', self.stub_url('/missing'))])
+        self.assertEqual(len(previews), 7)
+        self.assertEqual(OpenGraphStubHandler.num_requests, 7)
+        self.assertLessEqual(OpenGraphStubHandler.max_active_requests, 2)
+
+        # Both the previews and the lack of one are cached.
+        self.assertEqual(unfurl.get_cached_preview('open_graph', self.stub_url('/page1')),
+                         (page_preview,))
+        self.assertEqual(unfurl.get_cached_preview('open_graph', self.stub_url('/missing')),
+                         (None,))
+        self.assertEqual(unfurl.fetch_previews(links, bugdown.fetch_preview), previews)
+        self.assertEqual(OpenGraphStubHandler.num_requests, 7)
+
+    def test_failed_fetch_not_cached(self):
+        def fetch(kind, key):
+            raise bugdown.TimeoutExpired
+
+        links = [['tweet', '287977969287315456', 'twitter.com']]
+        with mock.patch('logging.warning') as warn:
+            previews = unfurl.fetch_previews(links, fetch)
+        self.assertEqual(previews, {('tweet', '287977969287315456'): None})
+        self.assertEqual(warn.call_count, 1)
+        self.assertIsNone(unfurl.get_cached_preview('tweet', '287977969287315456'))
+
+    def test_preview_after_edit(self):
+        url = 'http://twitter.com/wdaher/status/287977969287315456'
+        message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, url)
+
+        def render_then_edit(message, content):
+            # The message is edited while its preview is being rendered.
+            Message.objects.filter(id=message_id).update(content='edited',
+                                                         rendered_content='<p>edited</p>')
+            return '<p>stale</p>'
+
+        events = []
+        with mock.patch.object(Message, 'render_markdown', autospec=True,
+                               side_effect=render_then_edit), \
+                tornado_redirected_to_list(events):
+            updated = do_render_link_previews([{'message_id': message_id,
+                                                'links': [['tweet', '287977969287315456',
+                                                           'twitter.com']]}])
+        self.assertEqual(updated, [])
+        self.assertEqual(events, [])
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content, '<p>edited</p>')
+
+    def test_message_updated_with_preview(self):
+        url = 'http://twitter.com/wdaher/status/287977969287315456'
+        self.subscribe_to_stream("hamlet@zulip.com", "Denmark")
+
+        events = []
+        with tornado_redirected_to_list(events):
+            message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, url)
+
+        # The message is sent without the preview, and updated with it
+        # once it has been fetched (here, right away).
+        (message_event,) = [event['event'] for event in events
+                            if event['event']['type'] == 'message']
+        self.assertNotIn('twitter-tweet', message_event['message_dict_markdown']['content'])
+        (update_event,) = [event['event'] for event in events
+                           if event['event']['type'] == 'update_message']
+        self.assertEqual(update_event['message_id'], message_id)
+        self.assertNotIn('edit_timestamp', update_event)
+        self.assertIn('twitter-tweet', update_event['rendered_content'])
+        message = Message.objects.get(id=message_id)
+        self.assertEqual(message.rendered_content, update_event['rendered_content'])
+        self.assertIsNone(message.edit_history)
+
+        # Now that the preview is cached, it is included right away.
+        events = []
+        with tornado_redirected_to_list(events):
+            message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, url)
+        self.assertEqual([event for event in events
+                          if event['event']['type'] == 'update_message'], [])
+        self.assertIn('twitter-tweet', Message.objects.get(id=message_id).rendered_content)
@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 
 from django.test import TestCase
+from django.utils.timezone import now
 
 from zerver.lib.test_helpers import (
     AuthedTestCase,
@@ -10,8 +11,8 @@ from zerver.lib.test_helpers import (
 )
 
 from zerver.models import (
-    get_display_recipient, get_stream, get_user_profile_by_email,
-    Recipient,
+    get_client, get_display_recipient, get_stream, get_user_profile_by_email,
+    Recipient, UserActivity, UserProfile,
 )
 
 from zerver.lib.actions import (
@@ -22,7 +23,8 @@ from zerver.lib.email_mirror import (
     create_missed_message_address,
 )
 
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import handle_digest_email, handle_realm_digest_emails
+from zerver.management.commands.enqueue_digest_emails import inactive_users
 
 from zerver.lib.notifications import (
     handle_missedmessage_emails,
@@ -209,6 +211,82 @@ class TestDigestEmailMessages(AuthedTestCase):
         self.assertEqual(mock_send_future_email.call_args[0][0][0]['email'],
                          u'othello@zulip.com')
 
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_realm_digest_emails(self, mock_send_future_email):
+        othello = get_user_profile_by_email("othello@zulip.com")
+        iago = get_user_profile_by_email("iago@zulip.com")
+        for user_profile in [othello, iago]:
+            self.subscribe_to_stream(user_profile.email, "Denmark")
+
+        cutoff = time.time()
+        self.login("hamlet@zulip.com")
+        for content in ["first digest message", "second digest message"]:
+            result = self.client.post("/json/messages", {"type": "stream",
+                                                         "to": "Denmark",
+                                                         "subject": "digest topic",
+                                                         "content": content})
+            self.assert_json_success(result)
+
+        handle_realm_digest_emails(othello.realm_id, [othello.id, iago.id], cutoff)
+        self.assertEqual(mock_send_future_email.call_count, 2)
+        self.assertEqual(sorted(call_args[0][0][0]['email'] for call_args in
+                                mock_send_future_email.call_args_list),
+                         [u'iago@zulip.com', u'othello@zulip.com'])
+        for call_args in mock_send_future_email.call_args_list:
+            text_content = call_args[0][2]
+            self.assertIn("Denmark > digest topic", text_content)
+            self.assertIn("second digest message", text_content)
+
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_digest_only_has_received_messages(self, mock_send_future_email):
+        othello = get_user_profile_by_email("othello@zulip.com")
+        cutoff = time.time()
+        self.login("hamlet@zulip.com")
+        self.common_subscribe_to_streams("hamlet@zulip.com", ["digest secrets"], invite_only=True)
+
+        def send(content):
+            result = self.client.post("/json/messages", {"type": "stream",
+                                                         "to": "digest secrets",
+                                                         "subject": "digest topic",
+                                                         "content": content})
+            self.assert_json_success(result)
+
+        # Othello can't read the messages sent to the private stream
+        # before they were subscribed, so they aren't in their digest.
+        send("sent before subscribing")
+        self.subscribe_to_stream(othello.email, "digest secrets")
+        send("sent after subscribing")
+
+        handle_realm_digest_emails(othello.realm_id, [othello.id], cutoff)
+        handle_digest_email(othello.id, cutoff)
+        self.assertEqual(mock_send_future_email.call_count, 2)
+        for call_args in mock_send_future_email.call_args_list:
+            text_content = call_args[0][2]
+            self.assertIn("digest secrets > digest topic", text_content)
+            self.assertIn("sent after subscribing", text_content)
+            self.assertNotIn("sent before subscribing", text_content)
+
+    def test_inactive_users(self):
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        othello = get_user_profile_by_email("othello@zulip.com")
+        cordelia = get_user_profile_by_email("cordelia@zulip.com")
+        UserActivity.objects.filter(user_profile__in=[hamlet, othello, cordelia]).delete()
+
+        cutoff = now() - datetime.timedelta(days=1)
+        client = get_client("website")
+        UserActivity.objects.create(user_profile=hamlet, client=client, query="/json/messages",
+                                    count=1, last_visit=cutoff - datetime.timedelta(days=1))
+        UserActivity.objects.create(user_profile=hamlet, client=client, query="/json/users/me/pointer",
+                                    count=1, last_visit=now())
+        UserActivity.objects.create(user_profile=othello, client=client, query="/json/messages",
+                                    count=1, last_visit=cutoff - datetime.timedelta(days=1))
+
+        # Othello last visited before the cutoff, and Cordelia never has.
+        user_profiles = UserProfile.objects.filter(id__in=[hamlet.id, othello.id, cordelia.id])
+        self.assertEqual(sorted(user_profile.email for user_profile in
+                                inactive_users(user_profiles, cutoff)),
+                         [u'cordelia@zulip.com', u'othello@zulip.com'])
+
 class TestReplyExtraction(AuthedTestCase):
     def test_reply_is_extracted_from_plain(self):
 
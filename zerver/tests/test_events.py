@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 from django.http import HttpRequest, HttpResponse
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from zerver.models import (
     get_client, get_realm, get_stream, get_user_profile_by_email,
@@ -12,6 +13,8 @@ from zerver.models import (
 
 from zerver.lib.actions import (
     apply_events,
+    bulk_add_subscriptions,
+    bulk_remove_subscriptions,
     create_stream_if_needed,
     do_add_alert_words,
     check_add_realm_emoji,
@@ -49,7 +52,11 @@ from zerver.lib.actions import (
     get_subscription
 )
 
-from zerver.lib.event_queue import allocate_client_descriptor
+from zerver.lib import event_queue
+from zerver.lib.event_queue import allocate_client_descriptor, ClientDescriptor, \
+    do_gc_event_queues, get_tornado_shard, get_tornado_shard_for_port, process_notification, \
+    send_event
+from zerver.lib.socket import SocketConnection
 from zerver.lib.test_helpers import AuthedTestCase, POSTRequestMock
 from zerver.lib.validator import (
     check_bool, check_dict, check_int, check_list, check_string,
@@ -61,6 +68,10 @@ from zerver.views import _default_all_public_streams, _default_narrow
 from zerver.tornadoviews import get_events_backend
 
 from collections import OrderedDict
+import mock
+import os
+import shutil
+import tempfile
 import time
 import ujson
 from six.moves import range
@@ -225,8 +236,8 @@ class EventsRegisterTest(AuthedTestCase):
             ])),
         ])
 
-    def do_test(self, action, event_types=None):
-        # type: (Callable[[], Any], Optional[List[str]]) -> List[Dict[str, Any]]
+    def do_test(self, action, event_types=None, compact_peer_events=False):
+        # type: (Callable[[], Any], Optional[List[str]], bool) -> List[Dict[str, Any]]
         client = allocate_client_descriptor(
             dict(user_profile_id = self.user_profile.id,
                  user_profile_email = self.user_profile.email,
@@ -237,7 +248,8 @@ class EventsRegisterTest(AuthedTestCase):
                  all_public_streams = False,
                  queue_timeout = 600,
                  last_connection_time = time.time(),
-                 narrow = [])
+                 narrow = [],
+                 compact_peer_events = compact_peer_events)
             )
         # hybrid_state = initial fetch state + re-applying events triggered by our action
         # normal_state = do action then fetch at the end (the "normal" code path)
@@ -741,6 +753,28 @@ class EventsRegisterTest(AuthedTestCase):
         error = schema_checker('events[2]', events[2])
         self.assert_on_error(error)
 
+    def test_bulk_subscribe_peer_events(self):
+        # type: () -> None
+        stream, _ = create_stream_if_needed(self.user_profile.realm, u"test_stream")
+        self.subscribe_to_stream("hamlet@zulip.com", "test_stream")
+        users = [get_user_profile_by_email(email)
+                 for email in ["othello@zulip.com", "cordelia@zulip.com"]]
+
+        # Clients that asked for compact peer events get one event for
+        # all the users; the others get one per user.
+        action = lambda: bulk_add_subscriptions([stream], users)
+        events = self.do_test(action, compact_peer_events=True)
+        peer_events = [event for event in events if event.get('op') == 'peer_add']
+        self.assertEqual([(event['subscriptions'], event['user_emails']) for event in peer_events],
+                         [(["test_stream"], ["cordelia@zulip.com", "othello@zulip.com"])])
+
+        action = lambda: bulk_remove_subscriptions(users, [stream])
+        events = self.do_test(action)
+        peer_events = [event for event in events if event.get('op') == 'peer_remove']
+        self.assertEqual(sorted((event['user_email'], event['subscriptions']) for event in peer_events),
+                         [("cordelia@zulip.com", ["test_stream"]),
+                          ("othello@zulip.com", ["test_stream"])])
+
     def test_subscribe_events(self):
         # type: ignore # action changes type several times
         subscription_schema_checker = check_list(
@@ -848,7 +882,7 @@ class FetchInitialStateDataTest(AuthedTestCase):
         result = fetch_initial_state_data(user_profile, None, "")
         self.assertTrue(len(result['realm_bots']) > 5)
 
-from zerver.lib.event_queue import EventQueue
+from zerver.lib.event_queue import EventQueue, InternedEvent
 class EventQueueTest(TestCase):
     def test_one_event(self):
         # type: () -> None
@@ -966,6 +1000,34 @@ class EventQueueTest(TestCase):
                            "messages": [1, 2, 3, 4, 5, 6],
                            "timestamp": "1"}])
 
+    def test_flag_range_not_collapsed(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        queue.push({"type": "update_message_flags",
+                    "flag": "read",
+                    "operation": "add",
+                    "all": False,
+                    "messages": [1, 2],
+                    "timestamp": "1"})
+        queue.push({"type": "update_message_flags",
+                    "flag": "read",
+                    "operation": "add",
+                    "all": False,
+                    "messages": [],
+                    "message_range": {"after": 0, "until": 10, "recipient_id": 5},
+                    "timestamp": "1"})
+        queue.push({"type": "update_message_flags",
+                    "flag": "read",
+                    "operation": "add",
+                    "all": False,
+                    "messages": [],
+                    "message_range": {"after": 10, "until": 20, "recipient_id": 5},
+                    "timestamp": "1"})
+        self.assertEqual([event.get("message_range") for event in queue.contents()],
+                         [None,
+                          {"after": 0, "until": 10, "recipient_id": 5},
+                          {"after": 10, "until": 20, "recipient_id": 5}])
+
     def test_collapse_event(self):
         # type: () -> None
         queue = EventQueue("1")
@@ -983,6 +1045,392 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_shared_event(self):
+        # type: () -> None
+        message_event = InternedEvent({"type": "message", "message": {"id": 1}})
+        queue = EventQueue("1")
+        other_queue = EventQueue("2")
+        other_queue.push({"type": "unknown"})
+        queue.push(message_event, {"flags": ["read"]})
+        other_queue.push(message_event, {"flags": []})
+        self.assertIs(queue.queue[0][1], other_queue.queue[1][1])
+        self.assertEqual(queue.contents(),
+                         [{'id': 0, 'type': 'message', 'message': {'id': 1}, 'flags': ['read']}])
+        self.assertEqual(other_queue.contents()[1],
+                         {'id': 1, 'type': 'message', 'message': {'id': 1}, 'flags': []})
+        # The shared body isn't modified by the per-queue data.
+        self.assertEqual(message_event.event, {"type": "message", "message": {"id": 1}})
+
+class EventQueuePersistenceTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_filename = os.path.join(self.tmp_dir, 'event_queues.json')
+        self.journal_filename = os.path.join(self.tmp_dir, 'event_queues.journal')
+
+    def tearDown(self):
+        # type: () -> None
+        if event_queue.event_queue_journal is not None:
+            event_queue.event_queue_journal.close()
+        event_queue.event_queue_journal = None
+        event_queue.event_queue_journal_id = None
+        event_queue.event_queue_snapshot_writer_pid = None
+        shutil.rmtree(self.tmp_dir)
+
+    def make_client(self, queue_id):
+        # type: (str) -> ClientDescriptor
+        return ClientDescriptor(1, 'hamlet@zulip.com', 1, EventQueue(queue_id),
+                                None, 'website')
+
+    def test_snapshot_and_journal(self):
+        # type: () -> None
+        client = self.make_client('1')
+        client.add_event({"type": "unknown", "value": 1})
+        event_queue.write_event_queue_snapshot(self.snapshot_filename, 'a', {'1': client})
+
+        event_queue.open_event_queue_journal(self.journal_filename, 'a', truncate=True)
+        new_client = self.make_client('2')
+        event_queue.journal_event_queue_change(dict(op='add', client=new_client.to_dict()))
+        client.add_event({"type": "unknown", "value": 2})
+        event_queue.journal_event_queue_change(dict(op='prune', queue_id='1',
+                                                    through_id=0, time=12345))
+        event_queue.journal_event_queue_change(dict(op='push', queue_id='2',
+                                                    event={"type": "unknown", "value": 3}))
+        event_queue.event_queue_journal.flush()
+
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertEqual(journal_id, 'a')
+        self.assertEqual(list(clients.keys()), ['1'])
+        num_records = event_queue.replay_event_queue_journal(self.journal_filename,
+                                                             journal_id, clients)
+        self.assertEqual(num_records, 4)
+        self.assertEqual(sorted(clients.keys()), ['1', '2'])
+        self.assertEqual(clients['1'].event_queue.contents(),
+                         [{"type": "unknown", "value": 2, "id": 1}])
+        self.assertEqual(clients['1'].last_connection_time, 12345)
+        self.assertEqual(clients['2'].event_queue.contents(),
+                         [{"type": "unknown", "value": 3, "id": 0}])
+
+    def test_shared_bodies_written_once(self):
+        # type: () -> None
+        client = self.make_client('1')
+        other_client = self.make_client('2')
+        first_event = InternedEvent({"type": "unknown", "value": 1})
+        client.add_event(first_event, {"flags": ["read"]})
+        other_client.add_event(first_event, {"flags": []})
+        event_queue.write_event_queue_snapshot(self.snapshot_filename, 'a',
+                                               {'1': client, '2': other_client})
+        with open(self.snapshot_filename) as f:
+            self.assertEqual(f.read().count('"value":1'), 1)
+
+        event_queue.open_event_queue_journal(self.journal_filename, 'a', truncate=True)
+        second_event = InternedEvent({"type": "unknown", "value": 2})
+        client.add_event(second_event)
+        other_client.add_event(second_event, {"flags": ["starred"]})
+        event_queue.event_queue_journal.flush()
+        with open(self.journal_filename) as f:
+            self.assertEqual(f.read().count('"value":2'), 1)
+
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertEqual(event_queue.replay_event_queue_journal(self.journal_filename,
+                                                                journal_id, clients), 2)
+        self.assertEqual(clients['1'].event_queue.contents(),
+                         [{"type": "unknown", "value": 1, "flags": ["read"], "id": 0},
+                          {"type": "unknown", "value": 2, "id": 1}])
+        self.assertEqual(clients['2'].event_queue.contents(),
+                         [{"type": "unknown", "value": 1, "flags": [], "id": 0},
+                          {"type": "unknown", "value": 2, "flags": ["starred"], "id": 1}])
+        # The loaded queues share the bodies too.
+        self.assertIs(clients['1'].event_queue.queue[1][1],
+                      clients['2'].event_queue.queue[1][1])
+
+    def test_stale_journal_ignored(self):
+        # type: () -> None
+        client = self.make_client('1')
+        event_queue.open_event_queue_journal(self.journal_filename, 'old', truncate=True)
+        event_queue.journal_event_queue_change(dict(op='remove', queue_ids=['1']))
+        event_queue.event_queue_journal.flush()
+        event_queue.write_event_queue_snapshot(self.snapshot_filename, 'new', {'1': client})
+
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertIsNone(event_queue.replay_event_queue_journal(self.journal_filename,
+                                                                 journal_id, clients))
+        self.assertEqual(list(clients.keys()), ['1'])
+
+    def test_partial_record_truncated(self):
+        # type: () -> None
+        client = self.make_client('1')
+        event_queue.write_event_queue_snapshot(self.snapshot_filename, 'a', {'1': client})
+        event_queue.open_event_queue_journal(self.journal_filename, 'a', truncate=True)
+        client.add_event({"type": "unknown", "value": 1})
+        event_queue.event_queue_journal.write('{"op":"push","queue_id":"1"')
+        event_queue.event_queue_journal.close()
+        event_queue.event_queue_journal = None
+
+        # Restart, and append to the journal after the partial record.
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertEqual(event_queue.replay_event_queue_journal(self.journal_filename,
+                                                                journal_id, clients), 1)
+        event_queue.truncate_event_queue_journal(self.journal_filename)
+        event_queue.open_event_queue_journal(self.journal_filename, journal_id, truncate=False)
+        clients['1'].add_event({"type": "unknown", "value": 2})
+        event_queue.event_queue_journal.flush()
+
+        # Nothing we appended is lost on the next restart.
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertEqual(event_queue.replay_event_queue_journal(self.journal_filename,
+                                                                journal_id, clients), 2)
+        self.assertEqual([event['value'] for event in clients['1'].event_queue.contents()],
+                         [1, 2])
+
+    def start_compaction(self, client):
+        # type: (ClientDescriptor) -> None
+        client.add_event({"type": "unknown", "value": 1})
+        event_queue.write_event_queue_snapshot(self.snapshot_filename, 'a', {'1': client})
+        event_queue.open_event_queue_journal(self.journal_filename, 'a', truncate=True)
+        client.add_event({"type": "unknown", "value": 2})
+        event_queue.compact_event_queue_journal()
+        client.add_event({"type": "unknown", "value": 3})
+        event_queue.event_queue_journal.flush()
+
+    def test_compaction(self):
+        # type: () -> None
+        client = self.make_client('1')
+        with override_settings(JSON_PERSISTENT_QUEUE_FILENAME=self.snapshot_filename,
+                               JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME=self.journal_filename), \
+                mock.patch.object(event_queue, 'clients', {'1': client}):
+            self.start_compaction(client)
+            self.assertTrue(event_queue.wait_for_event_queue_snapshot_writer(block=True))
+        self.assertFalse(os.path.exists(self.journal_filename + ".old"))
+
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertEqual(journal_id, event_queue.event_queue_journal_id)
+        self.assertEqual(event_queue.replay_event_queue_journal(self.journal_filename,
+                                                                journal_id, clients), 1)
+        self.assertEqual([event['value'] for event in clients['1'].event_queue.contents()],
+                         [1, 2, 3])
+
+    def test_interrupted_compaction(self):
+        # type: () -> None
+        client = self.make_client('1')
+        # Pretend we crashed before the child process wrote the snapshot.
+        with override_settings(JSON_PERSISTENT_QUEUE_FILENAME=self.snapshot_filename,
+                               JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME=self.journal_filename), \
+                mock.patch.object(event_queue, 'clients', {'1': client}), \
+                mock.patch('os.fork', return_value=12345):
+            self.start_compaction(client)
+        event_queue.event_queue_snapshot_writer_pid = None
+
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertEqual(journal_id, 'a')
+        self.assertIsNone(event_queue.replay_event_queue_journal(self.journal_filename,
+                                                                 journal_id, clients))
+        self.assertEqual(event_queue.replay_rotated_event_queue_journal(self.journal_filename,
+                                                                        journal_id, clients), 2)
+        self.assertEqual([event['value'] for event in clients['1'].event_queue.contents()],
+                         [1, 2, 3])
+
+    def test_old_format(self):
+        # type: () -> None
+        client = self.make_client('1')
+        with open(self.snapshot_filename, 'w') as f:
+            ujson.dump([('1', client.to_dict())], f)
+        clients, journal_id = event_queue.read_event_queue_snapshot(self.snapshot_filename)
+        self.assertIsNone(journal_id)
+        self.assertEqual(list(clients.keys()), ['1'])
+
+@override_settings(TORNADO_SERVERS=['http://127.0.0.1:9993', 'http://127.0.0.1:9994'])
+class TornadoShardingTest(TestCase):
+    def test_shard_lookup(self):
+        # type: () -> None
+        self.assertEqual(get_tornado_shard(4), 0)
+        self.assertEqual(get_tornado_shard(5), 1)
+        self.assertEqual(get_tornado_shard_for_port(9994), 1)
+
+    def test_send_event_partitions_users(self):
+        # type: () -> None
+        with mock.patch('zerver.lib.event_queue.queue_json_publish') as publish:
+            send_event(dict(type='pointer', pointer=1), [4, 5, 6])
+        self.assertEqual([(call[0][0], call[0][1]['users']) for call in publish.call_args_list],
+                         [('notify_tornado', [4, 6]), ('notify_tornado_1', [5])])
+
+    def test_public_stream_messages_go_to_every_shard(self):
+        # type: () -> None
+        with mock.patch('zerver.lib.event_queue.queue_json_publish') as publish:
+            send_event(dict(type='message', stream_name='Denmark', realm_id=1),
+                       [dict(id=4, flags=[])])
+        self.assertEqual([(call[0][0], call[0][1]['users']) for call in publish.call_args_list],
+                         [('notify_tornado', [dict(id=4, flags=[])]), ('notify_tornado_1', [])])
+
+class MessageFanoutTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.allocated_clients = [] # type: List[ClientDescriptor]
+
+    def tearDown(self):
+        # type: () -> None
+        # The event queues are module-level state; don't leave ours
+        # around for later tests.
+        do_gc_event_queues(set(client.event_queue.id for client in self.allocated_clients),
+                           set(client.user_profile_id for client in self.allocated_clients),
+                           set(client.realm_id for client in self.allocated_clients))
+
+    def allocate_client(self, user_profile_id, event_types=None):
+        # type: (int, Optional[List[str]]) -> ClientDescriptor
+        client = allocate_client_descriptor(
+            dict(user_profile_id = user_profile_id,
+                 user_profile_email = 'user%d@zulip.com' % (user_profile_id,),
+                 realm_id = 1,
+                 event_types = event_types,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = [])
+            )
+        self.allocated_clients.append(client)
+        return client
+
+    def test_idle_check_only_for_notifiable_users(self):
+        # type: () -> None
+        mentioned_client = self.allocate_client(90001)
+        other_client = self.allocate_client(90002)
+        presence_client = self.allocate_client(90003, event_types=['presence'])
+        message_dict = dict(id=1, sender_id=90002, type='stream', client='website',
+                            display_recipient='Denmark', subject='fanout')
+        notice = dict(
+            event=dict(type='message', message=1,
+                       message_dict_markdown=message_dict,
+                       message_dict_no_markdown=message_dict,
+                       presences={}),
+            users=[dict(id=90001, flags=['mentioned']),
+                   dict(id=90002, flags=['read']),
+                   dict(id=90003, flags=[])])
+
+        with mock.patch('zerver.lib.event_queue.receiver_is_idle',
+                        return_value=False) as receiver_is_idle:
+            process_notification(notice)
+        receiver_is_idle.assert_called_once_with(90001, {})
+
+        mentioned_events = mentioned_client.event_queue.contents()
+        other_events = other_client.event_queue.contents()
+        self.assertEqual(mentioned_events[0]['flags'], ['mentioned'])
+        self.assertEqual(other_events[0]['flags'], ['read'])
+        # Both queues share the same event body.
+        self.assertIs(mentioned_events[0]['message'], other_events[0]['message'])
+        self.assertIs(mentioned_client.event_queue.queue[0][1],
+                      other_client.event_queue.queue[0][1])
+        self.assertTrue(presence_client.event_queue.empty())
+
+class EventStreamTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.client = allocate_client_descriptor(
+            dict(user_profile_id = 90001,
+                 user_profile_email = 'user90001@zulip.com',
+                 realm_id = 1,
+                 event_types = None,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = [])
+            )
+        self.addCleanup(self.remove_client)
+        self.ioloop = mock.Mock()
+        patcher = mock.patch('tornado.ioloop.IOLoop.instance', return_value=self.ioloop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def remove_client(self):
+        # type: () -> None
+        # Some tests (e.g. test_errors) remove the queue themselves.
+        if self.client.event_queue.id in event_queue.clients:
+            do_gc_event_queues(set([self.client.event_queue.id]),
+                               set([self.client.user_profile_id]), set([self.client.realm_id]))
+
+    def make_connection(self):
+        # type: () -> SocketConnection
+        connection = SocketConnection(mock.Mock())
+        connection.client_id = self.client.event_queue.id
+        connection.did_close = False
+        connection.streaming_events = False
+        return connection
+
+    def run_callbacks(self):
+        # type: () -> None
+        calls = self.ioloop.add_callback.call_args_list
+        self.ioloop.add_callback.reset_mock()
+        for call in calls:
+            call[0][0]()
+
+    def pushed_events(self, connection):
+        # type: (SocketConnection) -> List[List[Dict[str, Any]]]
+        return [call[0][0]['events'] for call in connection.session.send_message.call_args_list]
+
+    def test_stream_events(self):
+        # type: () -> None
+        self.client.add_event(dict(type='unknown', value=0))
+        connection = self.make_connection()
+        result = connection.handle_events_request(dict(last_event_id=-1))
+        self.assertEqual(result['result'], 'success')
+        self.assertIs(self.client.event_stream, connection)
+
+        # The events already in the queue are sent, and then the events
+        # added while the IOLoop runs are batched into one message.
+        self.run_callbacks()
+        self.client.add_event(dict(type='unknown', value=1))
+        self.client.add_event(dict(type='unknown', value=2))
+        self.assertEqual(self.ioloop.add_callback.call_count, 1)
+        self.run_callbacks()
+        self.assertEqual([[event['value'] for event in events]
+                          for events in self.pushed_events(connection)],
+                         [[0], [1, 2]])
+
+        # Acknowledging events prunes them from the queue.
+        connection.handle_events_request(dict(last_event_id=1))
+        self.assertEqual([event['value'] for event in self.client.event_queue.contents()], [2])
+        self.assertFalse(self.client.idle(time.time() + 3600))
+
+    def test_resume_on_new_connection(self):
+        # type: () -> None
+        connection = self.make_connection()
+        connection.handle_events_request(dict(last_event_id=-1))
+        self.client.add_event(dict(type='unknown', value=0))
+        self.client.add_event(dict(type='unknown', value=1))
+        self.run_callbacks()
+
+        # The client only handled the first event before reconnecting.
+        new_connection = self.make_connection()
+        new_connection.handle_events_request(dict(last_event_id=0))
+        self.run_callbacks()
+        self.assertEqual([[event['value'] for event in events]
+                          for events in self.pushed_events(new_connection)],
+                         [[1]])
+
+        # The old connection closing doesn't disconnect the new one.
+        self.client.disconnect_event_stream(connection)
+        self.assertIs(self.client.event_stream, new_connection)
+        self.client.disconnect_event_stream(new_connection)
+        self.assertIsNone(self.client.event_stream)
+        self.assertTrue(self.client.idle(time.time() + 3600))
+
+    def test_errors(self):
+        # type: () -> None
+        connection = self.make_connection()
+        result = connection.handle_events_request(dict())
+        self.assertEqual(result['msg'], "Missing 'last_event_id' argument")
+
+        connection.handle_events_request(dict(last_event_id=-1))
+        self.client.cleanup()
+        connection.session.send_message.assert_called_once_with(
+            {'type': 'events', 'queue_id': connection.client_id, 'result': 'error',
+             'msg': 'Bad event queue id: %s' % (connection.client_id,)})
+        result = connection.handle_events_request(dict(last_event_id=-1))
+        self.assertEqual(result['msg'], 'Bad event queue id: %s' % (connection.client_id,))
+
 class TestEventsRegisterAllPublicStreamsDefaults(TestCase):
     def setUp(self):
         # type: () -> None
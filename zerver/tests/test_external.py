@@ -4,13 +4,19 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from zerver.forms import not_mit_mailing_list
 
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    api_calls_left,
+    block_user,
     clear_user_history,
+    incr_ratelimit,
+    rate_limit_request,
     remove_ratelimit_rule,
+    unblock_user,
 )
 
 from zerver.lib.actions import compute_mit_user_fullname
@@ -26,6 +32,7 @@ import ujson
 from six.moves import urllib
 from six.moves import range
 from six import text_type
+from typing import List
 
 class MITNameTest(TestCase):
     def test_valid_hesiod(self):
@@ -75,6 +82,13 @@ class RateLimitTests(AuthedTestCase):
                                                                    "subject": "Test subject",
                                                                    "email": email,
                                                                    "api-key": api_key})
+    def send_bulk_api_messages(self, email, contents):
+        # type: (text_type, List[text_type]) -> HttpResponse
+        messages = [{"type": "stream", "to": "Verona", "subject": "Test subject",
+                     "content": content} for content in contents]
+        return self.client.post("/api/v1/messages/bulk", {"messages": ujson.dumps(messages)},
+                                **self.api_auth(email))
+
     def test_headers(self):
         # type: () -> None
         email = "hamlet@zulip.com"
@@ -100,6 +114,23 @@ class RateLimitTests(AuthedTestCase):
         newlimit = int(result['X-RateLimit-Remaining'])
         self.assertEqual(limit, newlimit + 1)
 
+    def test_calls_left_past_max_api_calls(self):
+        # type: () -> None
+        user = get_user_profile_by_email("iago@zulip.com")
+        user.rate_limits = "60:3"
+        clear_user_history(user)
+
+        # The calls trimmed from the list stop counting against the user.
+        for i in range(5):
+            incr_ratelimit(user)
+        self.assertEqual(api_calls_left(user)[0], 0)
+
+        clear_user_history(user)
+        incr_ratelimit(user, count=2)
+        self.assertEqual(api_calls_left(user)[0], 1)
+        incr_ratelimit(user, count=2)
+        self.assertEqual(api_calls_left(user)[0], 0)
+
     @slow(1.1, 'has to sleep to work')
     def test_hit_ratelimits(self):
         # type: () -> None
@@ -127,6 +158,55 @@ class RateLimitTests(AuthedTestCase):
 
         self.assert_json_success(result)
 
+    def test_bulk_messages_count_against_ratelimit(self):
+        # type: () -> None
+        email = "othello@zulip.com"
+        user = get_user_profile_by_email(email)
+        clear_user_history(user)
+        api_key = self.get_api_key(email)
+
+        # Each message of a bulk send counts as an API call.
+        result = self.send_bulk_api_messages(email, ["bulk %s" % (i,) for i in range(4)])
+        self.assert_json_success(result)
+        self.assert_json_success(self.send_api_message(email, api_key, "fifth"))
+        result = self.send_api_message(email, api_key, "sixth")
+        self.assertEqual(result.status_code, 429)
+
+        # A bulk send that would exceed the limit sends nothing.
+        clear_user_history(user)
+        last_message_id = self.get_last_message().id
+        result = self.send_bulk_api_messages(email, ["bulk %s" % (i,) for i in range(6)])
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(self.get_last_message().id, last_message_id)
+
+@override_settings(RATE_LIMITING_ALGORITHM='gcra')
+class GCRARateLimitTests(RateLimitTests):
+    # Runs the tests above against the 'gcra' rate limiter.
+    def test_rate_limit_request(self):
+        # type: () -> None
+        user = get_user_profile_by_email("hamlet@zulip.com")
+        clear_user_history(user)
+
+        with mock.patch('time.time', return_value=1000.0):
+            results = [rate_limit_request(user) for i in range(6)]
+        # The 1 second, 5 request rule allows a burst of 5 requests,
+        # after which we have to wait 1/5 of a second for the next one.
+        self.assertEqual([ratelimited for ratelimited, _, _ in results],
+                         [False] * 5 + [True])
+        self.assertAlmostEqual(results[-1][1], 0.2)
+        # The headers describe the longest (60 second, 100 request) rule.
+        self.assertEqual([calls_remaining for _, _, calls_remaining in results[:5]],
+                         [99, 98, 97, 96, 95])
+
+        with mock.patch('time.time', return_value=1000.3):
+            self.assertFalse(rate_limit_request(user)[0])
+
+        block_user(user, 60)
+        ratelimited, secs_to_freedom, _ = rate_limit_request(user)
+        self.assertTrue(ratelimited)
+        self.assertTrue(0 < secs_to_freedom <= 60)
+        unblock_user(user)
+
 class APNSTokenTests(AuthedTestCase):
     def test_add_token(self):
         # type: () -> None
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from django.db.models import Q
+from django.db.models import F, Q
 from django.conf import settings
 from django.test import TestCase
 from zerver.lib import bugdown
@@ -14,6 +14,7 @@ from zerver.lib.test_helpers import (
     message_ids, message_stream_count,
     most_recent_message,
     queries_captured,
+    tornado_redirected_to_list,
 )
 
 from zerver.models import (
@@ -25,8 +26,11 @@ from zerver.models import (
 from zerver.lib.actions import (
     check_message, check_send_message,
     create_stream_if_needed,
-    do_add_subscription, do_create_user,
+    do_add_subscription, do_create_user, do_propagate_topic_rename, do_rerender_messages,
+    do_send_messages,
+    internal_prep_message,
 )
+from zerver.lib.bugdown.render_pool import RenderingPool
 
 from zerver.lib.upload import create_attachment
 
@@ -319,6 +323,34 @@ class StreamMessagesTest(AuthedTestCase):
 
         self.assert_length(queries, 7)
 
+    def test_batched_recipient_queries(self):
+        stream_names = ['Denmark', 'Scotland', 'Verona']
+        for stream_name in stream_names:
+            self.subscribe_to_stream('hamlet@zulip.com', stream_name)
+            self.subscribe_to_stream('othello@zulip.com', stream_name)
+
+        messages = [internal_prep_message('hamlet@zulip.com', 'stream', stream_name,
+                                          'batch', 'batched message')
+                    for stream_name in stream_names]
+        for message in messages:
+            # Force do_send_messages to look up the streams itself.
+            message['stream'] = None
+
+        with queries_captured() as queries:
+            sent_ids = do_send_messages(messages)
+
+        subscription_queries = [query for query in queries
+                                if 'FROM "zerver_subscription"' in query['sql']]
+        stream_queries = [query for query in queries
+                          if 'FROM "zerver_stream" INNER JOIN "zerver_realm"' in query['sql']]
+        self.assert_length(subscription_queries, 1, exact=True)
+        self.assert_length(stream_queries, 1, exact=True)
+
+        othello = get_user_profile_by_email('othello@zulip.com')
+        self.assertEqual(
+            UserMessage.objects.filter(user_profile=othello, message_id__in=sent_ids).count(),
+            len(stream_names))
+
     def test_message_mentions(self):
         user_profile = get_user_profile_by_email("iago@zulip.com")
         self.subscribe_to_stream(user_profile.email, "Denmark")
@@ -449,6 +481,64 @@ class MessageDictTest(AuthedTestCase):
         self.assertEqual(message.rendered_content, expected_content)
         self.assertEqual(message.rendered_content_version, bugdown.version)
 
+    def make_stale_messages(self):
+        sender = get_user_profile_by_email('othello@zulip.com')
+        receiver = get_user_profile_by_email('hamlet@zulip.com')
+        recipient = Recipient.objects.get(type_id=receiver.id, type=Recipient.PERSONAL)
+        sending_client, _ = Client.objects.get_or_create(name="test suite")
+        for content in ['hello **world**', 'goodbye *world*']:
+            Message.objects.create(
+                sender=sender,
+                recipient=recipient,
+                subject='whatever',
+                content=content,
+                rendered_content='<p>stale</p>',
+                rendered_content_version=0,
+                pub_date=datetime.datetime.now(),
+                sending_client=sending_client,
+            )
+        return list(Message.objects.select_related().filter(rendered_content_version=0)
+                    .order_by('id'))
+
+    def test_rerender_messages(self):
+        messages = self.make_stale_messages()
+
+        pool = RenderingPool(2)
+        try:
+            with queries_captured() as queries:
+                rendered = do_rerender_messages(messages, pool)
+        finally:
+            pool.close()
+
+        self.assertEqual(rendered, messages)
+        self.assert_length([query for query in queries
+                            if query['sql'].startswith('UPDATE zerver_message SET rendered_content')], 1)
+        expected = ['<p>hello <strong>world</strong></p>', '<p>goodbye <em>world</em></p>']
+        for message, expected_content in zip(messages, expected):
+            message = Message.objects.get(id=message.id)
+            self.assertEqual(message.rendered_content, expected_content)
+            self.assertEqual(message.rendered_content_version, bugdown.version)
+            self.assertEqual(message.to_dict(apply_markdown=True)['content'], expected_content)
+
+    def test_rerender_skips_edited_messages(self):
+        messages = self.make_stale_messages()
+        # The first message is edited after we fetched it.
+        Message.objects.filter(id=messages[0].id).update(content='edited',
+                                                         rendered_content='<p>edited</p>')
+
+        pool = RenderingPool(2)
+        try:
+            rendered = do_rerender_messages(messages, pool)
+        finally:
+            pool.close()
+
+        self.assertEqual(rendered, messages[1:])
+        message = Message.objects.get(id=messages[0].id)
+        self.assertEqual(message.rendered_content, '<p>edited</p>')
+        self.assertEqual(message.to_dict(apply_markdown=True)['content'], '<p>edited</p>')
+        self.assertEqual(Message.objects.get(id=messages[1].id).rendered_content,
+                         '<p>goodbye <em>world</em></p>')
+
 class MessagePOSTTest(AuthedTestCase):
 
     def test_message_to_self(self):
@@ -718,6 +808,66 @@ class MessagePOSTTest(AuthedTestCase):
         user.realm.domain = domain
         user.realm.save()
 
+class BulkSendMessagesTest(AuthedTestCase):
+    def send_bulk(self, email, messages):
+        return self.client.post("/api/v1/messages/bulk", {"messages": ujson.dumps(messages)},
+                                **self.api_auth(email))
+
+    def test_send_messages(self):
+        """
+        The valid messages of a bulk send are sent, in order, and an
+        invalid message gets an error in place of its id.
+        """
+        result = self.send_bulk("hamlet@zulip.com", [
+            {"type": "stream", "to": "Verona", "subject": "bulk", "content": "first"},
+            {"type": "stream", "to": "nonexistent_stream", "subject": "bulk", "content": "lost"},
+            {"type": "private", "to": ["othello@zulip.com"], "content": "second"},
+            {"type": "stream", "to": "Verona", "subject": "bulk"},
+        ])
+        self.assert_json_success(result)
+        results = ujson.loads(result.content)["results"]
+        self.assertEqual([r["result"] for r in results], ["success", "error", "success", "error"])
+        self.assertEqual(results[1]["msg"], "Stream does not exist")
+        self.assertEqual(results[3]["msg"], 'content key is missing from messages[3]')
+
+        first = Message.objects.get(id=results[0]["id"])
+        self.assertEqual(first.content, "first")
+        self.assertEqual(first.subject, "bulk")
+        second = Message.objects.get(id=results[2]["id"])
+        self.assertEqual(second.content, "second")
+        self.assertEqual(second.recipient.type, Recipient.PERSONAL)
+        self.assertTrue(first.id < second.id)
+        self.assertEqual(self.get_last_message().id, second.id)
+
+    def test_send_messages_in_one_transaction(self):
+        """
+        The messages are saved together, so sending more of them doesn't
+        take more queries per message.
+        """
+        def send(count):
+            with queries_captured() as queries:
+                result = self.send_bulk("hamlet@zulip.com", [
+                    {"type": "stream", "to": "Verona", "subject": "bulk",
+                     "content": "message %s" % (i,)}
+                    for i in range(count)])
+            self.assert_json_success(result)
+            return len(queries)
+
+        send(1) # prime the caches
+        self.assertEqual(send(2), send(10))
+
+    def test_send_messages_invalid(self):
+        result = self.send_bulk("hamlet@zulip.com", [])
+        self.assert_json_error(result, "No messages to send")
+
+        result = self.send_bulk("hamlet@zulip.com", [
+            {"type": "stream", "to": "Verona", "subject": "bulk", "content": "spam"}] * 101)
+        self.assert_json_error(result, "Cannot send more than 100 messages at once")
+
+        result = self.client.post("/api/v1/messages/bulk", {"messages": "not json"},
+                                  **self.api_auth("hamlet@zulip.com"))
+        self.assert_json_error(result, 'argument "messages" is not valid json.')
+
 class EditMessageTest(AuthedTestCase):
     def check_message(self, msg_id, subject=None, content=None):
         msg = Message.objects.get(id=msg_id)
@@ -900,6 +1050,39 @@ class EditMessageTest(AuthedTestCase):
         self.check_message(id5, subject="edited")
         self.check_message(id6, subject="topic3")
 
+    def test_propagate_topic_in_chunks(self):
+        ids = [self.send_message("iago@zulip.com", "Scotland", Recipient.STREAM,
+                                 subject="chunked topic") for i in range(5)]
+        # Old messages used to be left behind.
+        Message.objects.filter(id__in=ids[:2]).update(
+            pub_date=F('pub_date') - datetime.timedelta(days=30))
+        recipient = Message.objects.get(id=ids[2]).recipient
+        Message.objects.filter(id=ids[2]).update(subject="edited")
+
+        event = {'type': 'update_message',
+                 'sender': 'hamlet@zulip.com',
+                 'message_id': ids[2],
+                 'orig_subject': 'chunked topic',
+                 'propagate_mode': 'change_all',
+                 'stream_id': recipient.type_id,
+                 'subject': 'edited',
+                 'subject_links': [],
+                 'edit_timestamp': int(time.time())}
+        events = []
+        with tornado_redirected_to_list(events):
+            count = do_propagate_topic_rename(event, recipient.id, chunk_size=2)
+
+        self.assertEqual(count, 4)
+        self.assertEqual([e['event']['message_ids'] for e in events],
+                         [ids[:2], ids[3:]])
+        for e in events:
+            self.assertEqual(e['event']['subject'], 'edited')
+            self.assertEqual(sorted(user['id'] for user in e['users']),
+                             sorted(UserMessage.objects.filter(message_id=ids[2])
+                                    .values_list('user_profile_id', flat=True)))
+        for id_ in ids[:2] + ids[3:]:
+            self.check_message(id_, subject="edited")
+
 class StarTests(AuthedTestCase):
 
     def change_star(self, messages, add=True):
@@ -23,14 +23,20 @@ from zerver.models import (
 )
 
 from zerver.lib.actions import (
+    bulk_add_subscriptions, bulk_remove_subscriptions,
     create_stream_if_needed, do_add_default_stream, do_add_subscription, do_change_is_admin,
-    do_create_realm, do_remove_default_stream, do_set_realm_create_stream_by_admins_only,
+    do_create_realm, do_deactivate_stream, do_deactivate_user, do_reactivate_user,
+    do_remove_subscription,
+    do_remove_default_stream, do_set_realm_create_stream_by_admins_only,
     gather_subscriptions_helper,
     gather_subscriptions, get_default_streams_for_realm, get_realm, get_stream,
-    get_user_profile_by_email, set_default_streams, get_subscription
+    get_user_profile_by_email, set_default_streams, get_subscription,
+    update_stream_subscriber_counts
 )
 
+from django.db import transaction
 from django.http import HttpResponse
+import mock
 import random
 import ujson
 import six
@@ -815,7 +821,8 @@ class SubscriptionAPITest(AuthedTestCase):
         with tornado_redirected_to_list(events):
             self.helper_check_subs_before_and_after_add(self.streams + add_streams, {},
                 add_streams, self.streams, self.test_email, self.streams + add_streams)
-        self.assert_length(events, 6, True)
+        # One peer_add event covers both streams.
+        self.assert_length(events, 5, True)
 
     def test_successful_subscriptions_notifies_pm(self):
         # type: () -> None
@@ -1024,7 +1031,7 @@ class SubscriptionAPITest(AuthedTestCase):
             )
         self.assert_length(queries, 43)
 
-        self.assert_length(events, 8, exact=True)
+        self.assert_length(events, 7, exact=True)
         for ev in [x for x in events if x['event']['type'] not in ('message', 'stream')]:
             if isinstance(ev['event']['subscriptions'][0], dict):
                 self.assertEqual(ev['event']['op'], 'add')
@@ -1035,8 +1042,10 @@ class SubscriptionAPITest(AuthedTestCase):
             else:
                 # Check "peer_add" events for streams users were
                 # never subscribed to, in order for the neversubscribed
-                # structure to stay up-to-date.
+                # structure to stay up-to-date.  Both users are in
+                # the same event.
                 self.assertEqual(ev['event']['op'], 'peer_add')
+                self.assertEqual(ev['event']['user_emails'], sorted([email1, email2]))
 
         stream = get_stream('multi_user_stream', realm)
         self.assertEqual(stream.num_subscribers(), 2)
@@ -1065,7 +1074,7 @@ class SubscriptionAPITest(AuthedTestCase):
         self.assertEqual(len(add_peer_event['users']), 13)
         self.assertEqual(add_peer_event['event']['type'], 'subscription')
         self.assertEqual(add_peer_event['event']['op'], 'peer_add')
-        self.assertEqual(add_peer_event['event']['user_email'], self.test_email)
+        self.assertEqual(add_peer_event['event']['user_emails'], [self.test_email])
 
         stream = get_stream('multi_user_stream', realm)
         self.assertEqual(stream.num_subscribers(), 3)
@@ -1364,6 +1373,107 @@ class SubscriptionAPITest(AuthedTestCase):
         self.assertFalse(subscription.audible_notifications)
 
 
+class StreamSubscriberCountTest(AuthedTestCase):
+    def stream_events(self, events):
+        # type: (List[Dict[str, Any]]) -> List[str]
+        return [event['event']['op'] for event in events
+                if event['event']['type'] == 'stream']
+
+    def test_subscriber_count(self):
+        # type: () -> None
+        realm = get_realm("zulip.com")
+        stream, _ = create_stream_if_needed(realm, "count_stream")
+        users = [get_user_profile_by_email(email)
+                 for email in ["hamlet@zulip.com", "othello@zulip.com"]]
+        self.assertEqual(stream.num_subscribers(), 0)
+
+        events = [] # type: List[Dict[str, Any]]
+        with tornado_redirected_to_list(events):
+            bulk_add_subscriptions([stream], users)
+        self.assertEqual(stream.num_subscribers(), 2)
+        self.assertEqual(self.stream_events(events), ['occupy'])
+
+        # Deactivated users' subscriptions don't count.
+        do_deactivate_user(users[0])
+        self.assertEqual(stream.num_subscribers(), 1)
+        do_reactivate_user(users[0])
+        self.assertEqual(stream.num_subscribers(), 2)
+
+        events = []
+        with tornado_redirected_to_list(events):
+            do_remove_subscription(users[0], stream)
+        self.assertEqual(stream.num_subscribers(), 1)
+        self.assertEqual(self.stream_events(events), [])
+
+        events = []
+        with tornado_redirected_to_list(events):
+            bulk_remove_subscriptions(users, [stream])
+        self.assertEqual(stream.num_subscribers(), 0)
+        self.assertEqual(self.stream_events(events), ['vacate'])
+
+        events = []
+        with tornado_redirected_to_list(events):
+            do_add_subscription(users[1], stream)
+        self.assertEqual(stream.num_subscribers(), 1)
+        self.assertEqual(self.stream_events(events), ['occupy'])
+
+    def test_repeated_removal(self):
+        # type: () -> None
+        realm = get_realm("zulip.com")
+        stream, _ = create_stream_if_needed(realm, "count_stream")
+        users = [get_user_profile_by_email(email)
+                 for email in ["hamlet@zulip.com", "othello@zulip.com"]]
+        bulk_add_subscriptions([stream], users)
+
+        self.assertTrue(do_remove_subscription(users[0], stream))
+        self.assertFalse(do_remove_subscription(users[0], stream))
+        self.assertEqual(stream.num_subscribers(), 1)
+        bulk_add_subscriptions([stream], users)
+
+        # Another request removes hamlet once we've read the
+        # subscriptions, but before our transaction.
+        real_atomic = transaction.atomic
+        removed = [] # type: List[int]
+        def atomic(*args, **kwargs):
+            # type: (*Any, **Any) -> Any
+            if users[0].id not in removed:
+                removed.append(users[0].id)
+                do_remove_subscription(users[0], stream)
+            return real_atomic(*args, **kwargs)
+
+        events = [] # type: List[Dict[str, Any]]
+        with tornado_redirected_to_list(events), \
+                mock.patch('django.db.transaction.atomic', side_effect=atomic):
+            (removed_pairs, not_subscribed) = bulk_remove_subscriptions(users, [stream])
+        self.assertEqual(removed_pairs, [(users[1], stream)])
+        self.assertEqual(not_subscribed, [(users[0], stream)])
+        self.assertEqual(stream.num_subscribers(), 0)
+        self.assertEqual(self.stream_events(events), ['vacate'])
+        self.assertEqual(update_stream_subscriber_counts([stream.id]), 0)
+
+    def test_deactivated_stream_subscriber_count(self):
+        # type: () -> None
+        realm = get_realm("zulip.com")
+        stream, _ = create_stream_if_needed(realm, "count_stream")
+        users = [get_user_profile_by_email(email)
+                 for email in ["hamlet@zulip.com", "othello@zulip.com"]]
+        bulk_add_subscriptions([stream], users)
+        self.assertEqual(stream.num_subscribers(), 2)
+
+        do_deactivate_stream(stream)
+        self.assertEqual(stream.num_subscribers(), 0)
+        self.assertEqual(update_stream_subscriber_counts([stream.id]), 0)
+
+    def test_repair_subscriber_counts(self):
+        # type: () -> None
+        stream = get_stream("Verona", get_realm("zulip.com"))
+        num_subscribers = stream.num_subscribers()
+        self.assertEqual(update_stream_subscriber_counts(), 0)
+
+        Stream.objects.filter(id=stream.id).update(subscriber_count=1000)
+        self.assertEqual(update_stream_subscriber_counts([stream.id]), 1)
+        self.assertEqual(stream.num_subscribers(), num_subscribers)
+
 class GetPublicStreamsTest(AuthedTestCase):
 
     def test_public_streams(self):
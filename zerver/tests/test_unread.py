@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-AA
 from __future__ import absolute_import
 
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 from zerver.models import (
-    get_user_profile_by_email, Recipient, UserMessage
+    get_recipient, get_stream, get_user_profile_by_email, Recipient, UserMessage
 )
 
+from zerver.lib.actions import update_message_flags_in_ranges
 from zerver.lib.test_helpers import AuthedTestCase, tornado_redirected_to_list
 import ujson
 
@@ -153,6 +154,7 @@ class UnreadCountTests(AuthedTestCase):
         self.login("hamlet@zulip.com")
         user_profile = get_user_profile_by_email("hamlet@zulip.com")
         self.subscribe_to_stream(user_profile.email, "test_stream", user_profile.realm)
+        stream = get_stream("test_stream", user_profile.realm)
 
         message_id = self.send_message("hamlet@zulip.com", "test_stream", Recipient.STREAM, "hello")
         unrelated_message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, "hello")
@@ -169,7 +171,9 @@ class UnreadCountTests(AuthedTestCase):
 
         event = events[0]['event']
         expected = dict(operation='add',
-                        messages=[message_id],
+                        messages=[],
+                        message_range=dict(after=0, until=message_id,
+                                           recipient_id=get_recipient(Recipient.STREAM, stream.id).id),
                         flag='read',
                         type='update_message_flags',
                         all=False)
@@ -190,6 +194,39 @@ class UnreadCountTests(AuthedTestCase):
                 self.assertFalse(msg.flags.read)
 
 
+    def test_mark_all_in_stream_read_in_chunks(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        self.subscribe_to_stream(user_profile.email, "test_stream", user_profile.realm)
+        stream = get_stream("test_stream", user_profile.realm)
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        message_ids = [self.send_message("othello@zulip.com", "test_stream", Recipient.STREAM, "hello")
+                       for i in range(3)]
+        unrelated_message_id = self.send_message("othello@zulip.com", "Denmark", Recipient.STREAM, "hello")
+
+        events = [] # type: List[Dict[str, Any]]
+        progress = [] # type: List[Tuple[int, int]]
+        msgs = UserMessage.objects.filter(user_profile=user_profile, message__recipient=recipient)
+        with tornado_redirected_to_list(events):
+            count = update_message_flags_in_ranges(
+                user_profile, "add", "read", msgs, recipient=recipient, chunk_size=2,
+                progress=lambda count, last_message_id: progress.append((count, last_message_id)))
+
+        self.assertEqual(count, 3)
+        self.assertEqual(progress, [(2, message_ids[1]), (3, message_ids[2])])
+        self.assertEqual([event['event']['message_range'] for event in events],
+                         [dict(after=0, until=message_ids[1], recipient_id=recipient.id),
+                          dict(after=message_ids[1], until=message_ids[2], recipient_id=recipient.id)])
+        for event in events:
+            self.assertEqual(event['event']['messages'], [])
+            self.assertEqual(event['users'], [user_profile.id])
+
+        for message_id in message_ids:
+            self.assertTrue(UserMessage.objects.get(user_profile=user_profile,
+                                                    message_id=message_id).flags.read)
+        self.assertFalse(UserMessage.objects.get(user_profile=user_profile,
+                                                 message_id=unrelated_message_id).flags.read)
+
     def test_mark_all_in_invalid_stream_read(self):
         # type: () -> None
         self.login("hamlet@zulip.com")
@@ -205,6 +242,7 @@ class UnreadCountTests(AuthedTestCase):
         self.login("hamlet@zulip.com")
         user_profile = get_user_profile_by_email("hamlet@zulip.com")
         self.subscribe_to_stream(user_profile.email, "test_stream", user_profile.realm)
+        stream = get_stream("test_stream", user_profile.realm)
 
         message_id = self.send_message("hamlet@zulip.com", "test_stream", Recipient.STREAM, "hello", "test_topic")
         unrelated_message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, "hello", "Denmark2")
@@ -221,7 +259,10 @@ class UnreadCountTests(AuthedTestCase):
 
         event = events[0]['event']
         expected = dict(operation='add',
-                        messages=[message_id],
+                        messages=[],
+                        message_range=dict(after=0, until=message_id,
+                                           recipient_id=get_recipient(Recipient.STREAM, stream.id).id,
+                                           topic='test_topic'),
                         flag='read',
                         type='update_message_flags',
                         all=False)
@@ -9,7 +9,8 @@ from zerver.lib.bugdown import url_filename
 from zerver.lib.test_helpers import AuthedTestCase
 from zerver.lib.test_runner import slow
 from zerver.lib.upload import sanitize_name, S3UploadBackend, \
-    upload_message_image, delete_message_image, LocalUploadBackend
+    upload_message_image, delete_message_image, LocalUploadBackend, \
+    FileTooLargeError, S3_PART_SIZE, UPLOAD_CHUNK_SIZE
 import zerver.lib.upload
 from zerver.models import Attachment, Recipient, get_user_profile_by_email, \
     get_old_unclaimed_attachments, Message, UserProfile
@@ -21,6 +22,7 @@ from six.moves import urllib
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from six.moves import StringIO
+import io
 import os
 import shutil
 import re
@@ -131,6 +133,94 @@ class FileUploadTest(AuthedTestCase):
         self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, body, "test")
         self.assertIn('title="zulip.txt"', self.get_last_message().rendered_content)
 
+    def upload_file(self, contents, name="zulip.txt"):
+        # type: (str, str) -> str
+        self.login("hamlet@zulip.com")
+        fp = StringIO(contents)
+        fp.name = name
+        result = self.client.post("/json/upload_file", {'file': fp})
+        self.assert_json_success(result)
+        return ujson.loads(result.content)["uri"]
+
+    def test_file_download_conditional(self):
+        # type: () -> None
+        uri = self.upload_file("zulip!")
+        response = self.client.get(uri)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        self.assertNotIn('Content-Disposition', response)
+        self.assertIn('immutable', response['Cache-Control'])
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(uri, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH='"other"',
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"zulip!")
+
+    def test_file_download_range(self):
+        # type: () -> None
+        uri = self.upload_file("zulip!")
+        for (byte_range, content_range, data) in [
+                ('bytes=1-3', 'bytes 1-3/6', b"uli"),
+                ('bytes=2-', 'bytes 2-5/6', b"lip!"),
+                ('bytes=-2', 'bytes 4-5/6', b"p!"),
+                ('bytes=4-100', 'bytes 4-5/6', b"p!")]:
+            response = self.client.get(uri, HTTP_RANGE=byte_range)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(response['Content-Length'], str(len(data)))
+            self.assertEqual(b"".join(response.streaming_content), data)
+
+        response = self.client.get(uri, HTTP_RANGE='bytes=6-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */6')
+
+        # Multiple ranges, and ranges for an older version of the file,
+        # get the whole file.
+        for headers in [{'HTTP_RANGE': 'bytes=0-1,3-4'},
+                        {'HTTP_RANGE': 'bytes=1-3', 'HTTP_IF_RANGE': '"other"'}]:
+            response = self.client.get(uri, **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), b"zulip!")
+
+    def test_file_download_unsafe_type(self):
+        # type: () -> None
+        # Uploads that browsers could run scripts from are only ever
+        # downloaded, never displayed.
+        for name in ["zulip.html", "zulip.svg", "zulip"]:
+            uri = self.upload_file("<script>alert(1)</script>", name)
+            response = self.client.get(uri)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/octet-stream')
+            self.assertEqual(response['Content-Disposition'], 'attachment')
+            self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+
+    @override_settings(LOCAL_UPLOADS_ACCEL_REDIRECT=True)
+    def test_file_download_accel_redirect(self):
+        # type: () -> None
+        uri = self.upload_file("zulip!")
+        response = self.client.get(uri)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/internal/uploads/' + uri[len('/user_uploads/'):])
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotIn('Content-Type', response)
+        self.assertEqual(response.content, b"")
+
+        # Only users who can see the file are sent to it.
+        self.client.post('/accounts/logout/')
+        response = self.client.get(uri)
+        self.assertNotIn('X-Accel-Redirect', response)
+
     def test_delete_old_unclaimed_attachments(self):
         # type: () -> None
 
@@ -377,6 +467,32 @@ class LocalStorageTest(AuthedTestCase):
         file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, 'files', path_id)
         self.assertTrue(os.path.isfile(file_path))
 
+    def test_file_upload_local_stream(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        contents = os.urandom(3 * UPLOAD_CHUNK_SIZE + 1)
+        uri = upload_message_image(u'random.bin', None, io.BytesIO(contents), user_profile,
+                                   max_size=len(contents))
+
+        path_id = re.sub('/user_uploads/', '', uri)
+        file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, 'files', path_id)
+        with open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        # Only the renamed file is left in the directory.
+        self.assertEqual(os.listdir(os.path.dirname(file_path)), [os.path.basename(file_path)])
+
+    def test_file_upload_local_too_large(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        contents = os.urandom(3 * UPLOAD_CHUNK_SIZE + 1)
+        with self.assertRaises(FileTooLargeError):
+            upload_message_image(u'random.bin', None, io.BytesIO(contents), user_profile,
+                                 max_size=len(contents) - 1)
+
+        self.assertFalse(Attachment.objects.filter(file_name=u'random.bin').exists())
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(settings.LOCAL_UPLOADS_DIR, 'files')):
+            self.assertEqual(filenames, [])
+
     def test_delete_message_image_local(self):
         # type: () -> None
         self.login("hamlet@zulip.com")
@@ -439,6 +555,35 @@ class S3Test(AuthedTestCase):
         path_id = re.sub('/user_uploads/', '', uri)
         self.assertTrue(delete_message_image(path_id))
 
+    @use_s3_backend
+    def test_file_upload_s3_multipart(self):
+        # type: () -> None
+        conn = S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
+        bucket = conn.create_bucket(settings.S3_AUTH_UPLOADS_BUCKET)
+
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        contents = os.urandom(S3_PART_SIZE + 1)
+        uri = upload_message_image(u'random.bin', u'application/octet-stream',
+                                   io.BytesIO(contents), user_profile)
+
+        path_id = re.sub('/user_uploads/', '', uri)
+        key = bucket.get_key(path_id)
+        self.assertEqual(key.get_contents_as_string(), contents)
+        self.assertEqual(key.get_metadata("user_profile_id"), str(user_profile.id))
+
+    @use_s3_backend
+    def test_file_upload_s3_sniff_content_type(self):
+        # type: () -> None
+        conn = S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
+        bucket = conn.create_bucket(settings.S3_AUTH_UPLOADS_BUCKET)
+
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        with open(os.path.join(TEST_AVATAR_DIR, 'img.png'), 'rb') as fp:
+            uri = upload_message_image(u'image', None, fp, user_profile)
+
+        path_id = re.sub('/user_uploads/', '', uri)
+        self.assertEqual(bucket.get_key(path_id).content_type, 'image/png')
+
     @use_s3_backend
     def test_file_upload_authed(self):
         # type: () -> None
@@ -5,8 +5,9 @@ from __future__ import print_function
 from typing import Any, Callable, Dict, Iterable, List, Tuple, TypeVar
 from mock import patch, MagicMock
 
-from django.http import HttpResponse
+from django.http import HttpRequest, HttpResponse
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from zerver.lib.test_helpers import (
     queries_captured, simulated_empty_cache,
@@ -14,12 +15,13 @@ from zerver.lib.test_helpers import (
     most_recent_usermessage, most_recent_message,
 )
 from zerver.lib.test_runner import slow
+from zerver.lib import cache, queue
 
 from zerver.models import UserProfile, Recipient, \
     Realm, Client, UserActivity, \
     get_user_profile_by_email, split_email_to_domain, get_realm, \
     get_client, get_stream, Message, get_unique_open_realm, \
-    completely_open
+    completely_open, UserPresence, UserActivityInterval, get_user_profile_by_id
 
 from zerver.lib.avatar import get_avatar_url
 from zerver.lib.initial_password import initial_password
@@ -33,7 +35,8 @@ from zerver.lib.alert_words import alert_words_in_realm, user_alert_words, \
     add_user_alert_words, remove_user_alert_words
 from zerver.lib.notifications import handle_missedmessage_emails
 from zerver.lib.session_user import get_session_dict_user
-from zerver.middleware import is_slow_query
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.middleware import is_slow_query, QueueOutboxMiddleware
 
 from zerver.worker import queue_processors
 
@@ -45,6 +48,7 @@ import datetime
 import os
 import re
 import sys
+import threading
 import time
 import ujson
 import random
@@ -336,6 +340,15 @@ class WorkerTest(TestCase):
                 callback = self.consumers[queue_name]
                 callback(data)
 
+        def set_prefetch_count(self, prefetch_count):
+            # type: (int) -> None
+            self.prefetch_count = prefetch_count
+
+        def consume_json_batches(self, queue_name, callback, batch_size, batch_wait):
+            # type: (str, Callable, int, float) -> None
+            events = [data for name, data in self.queue if name == queue_name]
+            for i in range(0, len(events), batch_size):
+                callback(events[i:i + batch_size])
 
     def test_UserActivityWorker(self):
         # type: () -> None
@@ -366,6 +379,94 @@ class WorkerTest(TestCase):
             self.assertTrue(len(activity_records), 1)
             self.assertTrue(activity_records[0].count, 1)
 
+    def test_UserActivityWorker_batch(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserActivity.objects.filter(user_profile=user, client=get_client('ios')).delete()
+        UserActivity.objects.create(user_profile=user, client=get_client('ios'),
+                                    query='get_events_backend', count=5,
+                                    last_visit=timestamp_to_datetime(1000))
+        for i in range(3):
+            for query in ['get_events_backend', 'send_message_backend']:
+                fake_client.queue.append(('user_activity', dict(
+                    user_profile_id=user.id, client='ios', time=2000 + i, query=query)))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            worker.start()
+
+        self.assertEqual(fake_client.prefetch_count, 2 * worker.max_batch_size)
+        activity = UserActivity.objects.get(user_profile=user, client=get_client('ios'),
+                                            query='get_events_backend')
+        self.assertEqual(activity.count, 8)
+        self.assertEqual(activity.last_visit, timestamp_to_datetime(2002))
+        activity = UserActivity.objects.get(user_profile=user, client=get_client('ios'),
+                                            query='send_message_backend')
+        self.assertEqual(activity.count, 3)
+        self.assertEqual(activity.last_visit, timestamp_to_datetime(2002))
+
+    def test_UserActivityIntervalWorker_batch(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserActivityInterval.objects.filter(user_profile=user).delete()
+        UserActivityInterval.objects.create(user_profile=user,
+                                            start=timestamp_to_datetime(10000),
+                                            end=timestamp_to_datetime(10900))
+        # The first two events extend the existing interval; the last
+        # one starts a new interval.
+        for log_time in [10600, 11000, 20000]:
+            fake_client.queue.append(('user_activity_interval',
+                                      dict(user_profile_id=user.id, time=log_time)))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            worker.start()
+
+        intervals = UserActivityInterval.objects.filter(user_profile=user).order_by('start')
+        self.assertEqual([(interval.start, interval.end) for interval in intervals],
+                         [(timestamp_to_datetime(10000), timestamp_to_datetime(11900)),
+                          (timestamp_to_datetime(20000), timestamp_to_datetime(20900))])
+
+    def test_UserPresenceWorker_batch(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        othello = get_user_profile_by_email('othello@zulip.com')
+        UserPresence.objects.filter(user_profile__in=[hamlet, othello]).delete()
+        UserPresence.objects.create(user_profile=hamlet, client=get_client('website'),
+                                    timestamp=timestamp_to_datetime(1000),
+                                    status=UserPresence.IDLE)
+        for user, log_time, status in [(hamlet, 2000, UserPresence.IDLE),
+                                       (hamlet, 2010, UserPresence.ACTIVE),
+                                       (othello, 2000, UserPresence.ACTIVE),
+                                       (othello, 2020, UserPresence.ACTIVE)]:
+            fake_client.queue.append(('user_presence', dict(
+                user_profile_id=user.id, client='website', time=log_time, status=status)))
+
+        events = [] # type: List[Dict[str, Any]]
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserPresenceWorker()
+            worker.setup()
+            with tornado_redirected_to_list(events):
+                worker.start()
+
+        presence = UserPresence.objects.get(user_profile=hamlet, client=get_client('website'))
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+        self.assertEqual(presence.timestamp, timestamp_to_datetime(2010))
+        presence = UserPresence.objects.get(user_profile=othello, client=get_client('website'))
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+        self.assertEqual(presence.timestamp, timestamp_to_datetime(2020))
+        # Hamlet came back online and Othello appeared for the first time.
+        self.assertEqual(sorted(event['event']['email'] for event in events),
+                         ['hamlet@zulip.com', 'othello@zulip.com'])
+
     def test_error_handling(self):
         # type: () -> None
         processed = []
@@ -404,6 +505,44 @@ class WorkerTest(TestCase):
         event = ujson.loads(line.split('\t')[1])
         self.assertEqual(event, 'unexpected behaviour')
 
+    def test_batch_error_handling(self):
+        # type: () -> None
+        processed = [] # type: List[List[str]]
+
+        @queue_processors.assign_queue('unreliable_batch_worker')
+        class UnreliableBatchWorker(queue_processors.BatchQueueProcessingWorker):
+            max_batch_size = 2
+
+            def consume_batch(self, events):
+                # type: (List[str]) -> None
+                if 'unexpected behaviour' in events:
+                    raise Exception('Worker task not performing as expected!')
+                processed.append(events)
+
+            def _log_problem(self):
+                # type: () -> None
+                pass
+
+        fake_client = self.FakeClient()
+        for msg in ['good', 'fine', 'unexpected behaviour', 'bad luck', 'back to normal']:
+            fake_client.queue.append(('unreliable_batch_worker', msg))
+
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'unreliable_batch_worker.errors')
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = UnreliableBatchWorker()
+            worker.setup()
+            worker.start()
+
+        self.assertEqual(processed, [['good', 'fine'], ['back to normal']])
+        # The whole failed batch is saved.
+        events = [ujson.loads(line.strip().split('\t')[1]) for line in open(fn)]
+        self.assertEqual(events, ['unexpected behaviour', 'bad luck'])
+
     def test_worker_noname(self):
         # type: () -> None
         class TestWorker(queue_processors.QueueProcessingWorker):
@@ -428,6 +567,79 @@ class WorkerTest(TestCase):
             worker = TestWorker()
             worker.consume({})
 
+class QueuePublisherTest(TestCase):
+    class FakeClient(object):
+        def __init__(self):
+            # type: () -> None
+            self.batches = [] # type: List[List[Tuple[str, str]]]
+
+        def publish_batch(self, items):
+            # type: (List[Tuple[str, str]]) -> None
+            self.batches.append(list(items))
+
+    def setUp(self):
+        # type: () -> None
+        self.publisher = queue.get_queue_publisher()
+        self.client = self.FakeClient()
+        self.publisher.client = self.client
+
+    def tearDown(self):
+        # type: () -> None
+        self.publisher.client = None
+
+    @override_settings(USING_RABBITMQ=True)
+    def test_publish_without_outbox(self):
+        # type: () -> None
+        queue.queue_json_publish("test", {"n": 1}, lambda event: None)
+        queue.queue_json_publish("test", {"n": 2}, lambda event: None)
+        self.assertEqual(self.client.batches, [[("test", '{"n":1}')], [("test", '{"n":2}')]])
+
+    @override_settings(USING_RABBITMQ=True)
+    def test_outbox(self):
+        # type: () -> None
+        with queue.queue_outbox():
+            queue.queue_json_publish("test", {"n": 1}, lambda event: None)
+            with queue.queue_outbox():
+                queue.queue_json_publish("other", {"n": 2}, lambda event: None)
+            self.assertEqual(self.client.batches, [])
+        self.assertEqual(self.client.batches, [[("test", '{"n":1}'), ("other", '{"n":2}')]])
+
+    @override_settings(USING_RABBITMQ=True)
+    def test_full_outbox(self):
+        # type: () -> None
+        with patch('zerver.lib.queue.QUEUE_OUTBOX_MAX_SIZE', 2):
+            with queue.queue_outbox():
+                for n in range(3):
+                    queue.queue_json_publish("test", n, lambda event: None)
+                self.assertEqual(self.client.batches, [[("test", '0'), ("test", '1')]])
+        self.assertEqual(self.client.batches, [[("test", '0'), ("test", '1')], [("test", '2')]])
+
+    @override_settings(USING_RABBITMQ=True)
+    def test_outbox_left_open(self):
+        # type: () -> None
+        # A request whose middleware never closed its outbox doesn't
+        # leave the next request's events stuck in it.
+        middleware = QueueOutboxMiddleware()
+        middleware.process_request(HttpRequest())
+        queue.queue_json_publish("test", 1, lambda event: None)
+        self.assertEqual(self.client.batches, [])
+
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertEqual(self.client.batches, [[("test", '1')]])
+        queue.queue_json_publish("test", 2, lambda event: None)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(self.client.batches, [[("test", '1')], [("test", '2')]])
+
+    def test_publishers_per_thread(self):
+        # type: () -> None
+        publishers = [] # type: List[queue.QueuePublisher]
+        thread = threading.Thread(target=lambda: publishers.append(queue.get_queue_publisher()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(publishers[0], self.publisher)
+        self.assertIs(queue.get_queue_publisher(), self.publisher)
+
 class ActivityTest(AuthedTestCase):
     def test_activity(self):
         # type: () -> None
@@ -458,6 +670,68 @@ class UserProfileTest(TestCase):
         self.assertEqual(dct[hamlet.id], 'hamlet@zulip.com')
         self.assertEqual(dct[othello.id], 'othello@zulip.com')
 
+class LocalCacheTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        cache.local_caches = {}
+        listener = MagicMock(pid=os.getpid(), listening=True)
+        patcher = patch('zerver.lib.cache.local_cache_listener', listener)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lru(self):
+        # type: () -> None
+        local_cache = cache.LocalCache('test', max_size=2, ttl=60)
+        for key in ['a', 'b', 'c']:
+            local_cache.set(key, (key,), local_cache.generation)
+        self.assertEqual(local_cache.get('a'), None)
+        self.assertEqual(local_cache.get('b'), ('b',))
+        local_cache.set('d', ('d',), local_cache.generation)
+        self.assertEqual(local_cache.get('c'), None)
+        self.assertEqual(local_cache.get('b'), ('b',))
+
+        # Values fetched before an invalidation aren't stored.
+        generation = local_cache.generation
+        local_cache.delete('b')
+        local_cache.set('b', ('stale',), generation)
+        self.assertEqual(local_cache.get('b'), None)
+
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(local_cache.get('d'), None)
+
+    @override_settings(LOCAL_CACHE_KEY_FAMILIES={'user_profile_by_id': {'max_size': 100, 'ttl': 60}})
+    def test_user_profile_by_id(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        with patch('zerver.lib.cache.get_redis_client') as redis_client:
+            cache.update_user_profile_caches([hamlet])
+            self.assertEqual(redis_client().publish.call_count, 1)
+
+            get_user_profile_by_id(hamlet.id)
+            with queries_captured() as queries:
+                user_profile = get_user_profile_by_id(hamlet.id)
+            self.assertEqual(len(queries), 0)
+            self.assertEqual(user_profile.full_name, 'King Hamlet')
+            self.assertEqual(cache.get_local_cache_stats(), {'user_profile_by_id': (1, 1)})
+
+            # Callers get their own copy of the object.
+            user_profile.full_name = 'Prince Hamlet'
+            self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, 'King Hamlet')
+
+            # Saving the user invalidates it in every process's local cache.
+            user_profile.save(update_fields=['full_name'])
+            self.assertEqual(redis_client().publish.call_count, 2)
+            self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, 'Prince Hamlet')
+
+            # So does writing to the remote cache directly.
+            cache.cache_set(cache.user_profile_by_id_cache_key(hamlet.id), hamlet)
+            self.assertEqual(redis_client().publish.call_count, 3)
+            self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, 'King Hamlet')
+            cache.cache_delete_many([cache.user_profile_by_id_cache_key(hamlet.id),
+                                     cache.user_profile_by_email_cache_key(hamlet.email)])
+            self.assertEqual(redis_client().publish.call_count, 4)
+        self.assertEqual(cache.get_local_cache_stats(), {'user_profile_by_id': (2, 3)})
+
 class UserChangesTest(AuthedTestCase):
     def test_update_api_key(self):
         # type: () -> None
@@ -1537,6 +1811,30 @@ class UserPresenceTests(AuthedTestCase):
         for email in json['presences'].keys():
             self.assertEqual(split_email_to_domain(email), 'zulip.com')
 
+    def test_status_dicts_for_users(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        othello = get_user_profile_by_email("othello@zulip.com")
+        self.login("hamlet@zulip.com")
+        self.client.post("/json/users/me/presence", {'status': 'idle'})
+
+        statuses = UserPresence.get_status_dicts_for_users([hamlet.id, othello.id])
+        # Users without any presence rows are left out entirely.
+        self.assertEqual(list(statuses.keys()), [hamlet.id])
+        self.assertEqual(statuses[hamlet.id]['website']['status'], 'idle')
+
+        # A second lookup is served entirely from the cache.
+        with queries_captured() as queries:
+            UserPresence.get_status_dicts_for_users([hamlet.id, othello.id])
+        self.assert_length(queries, 0, exact=True)
+
+        # Updating presence invalidates just that user's entry.
+        self.client.post("/json/users/me/presence", {'status': 'active'})
+        with queries_captured() as queries:
+            statuses = UserPresence.get_status_dicts_for_users([hamlet.id, othello.id])
+        self.assertEqual(statuses[hamlet.id]['website']['status'], 'active')
+        self.assert_length(queries, 2, exact=True)
+
 class AlertWordTests(AuthedTestCase):
     interesting_alert_word_list = ['alert', 'multi-word word', u'☃']
 
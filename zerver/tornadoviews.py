@@ -55,8 +55,9 @@ def get_events_backend(request, user_profile, handler,
                        event_types = REQ(default=None, validator=check_list(check_string)),
                        dont_block = REQ(default=False, validator=check_bool),
                        narrow = REQ(default=[], validator=check_list(None)),
-                       lifespan_secs = REQ(default=0, converter=int)):
-    # type: (HttpRequest, UserProfile, BaseHandler, Optional[Client], Optional[int], Optional[List[text_type]], bool, bool, Optional[text_type], bool, Iterable[Sequence[text_type]], int) -> Union[HttpResponse, _RespondAsynchronously]
+                       lifespan_secs = REQ(default=0, converter=int),
+                       compact_peer_events = REQ(default=False, validator=check_bool)):
+    # type: (HttpRequest, UserProfile, BaseHandler, Optional[Client], Optional[int], Optional[List[text_type]], bool, bool, Optional[text_type], bool, Iterable[Sequence[text_type]], int, bool) -> Union[HttpResponse, _RespondAsynchronously]
     if user_client is None:
         user_client = request.client
 
@@ -84,7 +85,8 @@ def get_events_backend(request, user_profile, handler,
             all_public_streams = all_public_streams,
             queue_timeout = lifespan_secs,
             last_connection_time = time.time(),
-            narrow = narrow)
+            narrow = narrow,
+            compact_peer_events = compact_peer_events)
 
     result = fetch_events(events_query)
     if "extra_log_data" in result:
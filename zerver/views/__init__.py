@@ -863,7 +863,8 @@ def home(request):
             narrow.append(["topic", narrow_topic])
 
     register_ret = do_events_register(user_profile, request.client,
-                                      apply_markdown=True, narrow=narrow)
+                                      apply_markdown=True, narrow=narrow,
+                                      compact_peer_events=True)
     user_has_messages = (register_ret['max_message_id'] != -1)
 
     # Reset our don't-spam-users-with-email counter since the
@@ -1260,14 +1261,15 @@ def events_register_backend(request, user_profile, apply_markdown=True,
                             all_public_streams=None,
                             event_types=REQ(validator=check_list(check_string), default=None),
                             narrow=REQ(validator=check_list(check_list(check_string, length=2)), default=[]),
-                            queue_lifespan_secs=REQ(converter=int, default=0)):
-    # type: (HttpRequest, UserProfile, bool, Optional[bool], Optional[Iterable[str]], Iterable[Sequence[text_type]], int) -> HttpResponse
+                            queue_lifespan_secs=REQ(converter=int, default=0),
+                            compact_peer_events=REQ(validator=check_bool, default=False)):
+    # type: (HttpRequest, UserProfile, bool, Optional[bool], Optional[Iterable[str]], Iterable[Sequence[text_type]], int, bool) -> HttpResponse
     all_public_streams = _default_all_public_streams(user_profile, all_public_streams)
     narrow = _default_narrow(user_profile, narrow)
 
     ret = do_events_register(user_profile, request.client, apply_markdown,
                              event_types, queue_lifespan_secs, all_public_streams,
-                             narrow=narrow)
+                             narrow=narrow, compact_peer_events=compact_peer_events)
     return json_success(ret)
 
 
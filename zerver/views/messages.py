@@ -9,17 +9,17 @@ from django.db import connection
 from django.db.models import Q
 from django.http import HttpRequest, HttpResponse
 from six import text_type
-from typing import AnyStr, Iterable, Optional, Tuple
+from typing import Any, AnyStr, Dict, Iterable, List, Optional, Tuple
 from zerver.lib.str_utils import force_bytes
 
 from zerver.decorator import authenticated_api_view, authenticated_json_post_view, \
     has_request_variables, REQ, JsonableError, \
-    to_non_negative_int
+    to_non_negative_int, rate_limit_user, client_is_exempt_from_rate_limiting
 from django.utils.html import escape as escape_html
 from zerver.lib import bugdown
 from zerver.lib.actions import recipient_for_emails, do_update_message_flags, \
     compute_mit_user_fullname, compute_irc_user_fullname, compute_jabber_user_fullname, \
-    create_mirror_user_if_needed, check_send_message, do_update_message, \
+    create_mirror_user_if_needed, check_send_message, check_send_messages, do_update_message, \
     extract_recipients, truncate_body
 from zerver.lib.cache import generic_bulk_cached_fetch
 from zerver.lib.response import json_success, json_error
@@ -765,6 +765,27 @@ def send_message_backend(request, user_profile,
                              local_id=local_id, sender_queue_id=queue_id)
     return json_success({"id": ret})
 
+# The most messages a single bulk send can contain.
+MAX_BULK_SEND_MESSAGES = 100
+
+@has_request_variables
+def send_messages_backend(request, user_profile,
+                          message_requests = REQ('messages', validator=check_list(check_dict([])))):
+    # type: (HttpRequest, UserProfile, List[Dict[str, Any]]) -> HttpResponse
+    if len(message_requests) == 0:
+        return json_error(_("No messages to send"))
+    if len(message_requests) > MAX_BULK_SEND_MESSAGES:
+        return json_error(_("Cannot send more than %d messages at once") % (MAX_BULK_SEND_MESSAGES,))
+
+    # The request itself was already counted against the user's rate
+    # limit; count each of the other messages in it as a request too.
+    if (settings.RATE_LIMITING and len(message_requests) > 1 and
+            not client_is_exempt_from_rate_limiting(request)):
+        rate_limit_user(request, user_profile, 'all', count=len(message_requests) - 1)
+
+    results = check_send_messages(user_profile, request.client, message_requests)
+    return json_success({"results": results})
+
 @authenticated_json_post_view
 def json_update_message(request, user_profile):
     # type: (HttpRequest, UserProfile) -> HttpResponse
@@ -1,9 +1,13 @@
 from __future__ import absolute_import
 
+from typing import IO, Optional, Tuple
+
 from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, FileResponse, \
-    HttpResponseNotFound
+    HttpResponseNotFound, HttpResponseNotModified
 from django.shortcuts import redirect
+from django.utils.http import http_date
 from django.utils.translation import ugettext as _
+from django.views.static import was_modified_since
 
 from zerver.decorator import authenticated_json_post_view, zulip_login_required
 from zerver.lib.request import has_request_variables, REQ
@@ -14,6 +18,10 @@ from zerver.lib.validator import check_bool
 from zerver.models import UserProfile
 from django.conf import settings
 
+from six.moves import urllib
+import os
+import re
+
 def serve_s3(request, user_profile, realm_id_str, filename, redir):
     # type: (HttpRequest, UserProfile, str, str, bool) -> HttpResponse
     url_path = "%s/%s" % (realm_id_str, filename)
@@ -36,18 +44,187 @@ def serve_s3(request, user_profile, realm_id_str, filename, redir):
     else:
         return HttpResponseForbidden()
 
-# TODO: Rewrite this once we have django-sendfile
+# Every upload's path includes a random component, and is never reused
+# for different contents, so browsers can keep them for as long as they
+# like without revalidating them.
+UPLOAD_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# nginx location (see puppet/zulip/files/nginx/sites-available/zulip-enterprise)
+# that serves LOCAL_UPLOADS_DIR/files to internal redirects only.
+INTERNAL_UPLOADS_LOCATION = '/internal/uploads/'
+
+# The types of uploads we let browsers display inline; the same list as
+# puppet/zulip/files/nginx/zulip-include-frontend/uploads.types, which
+# nginx uses when it serves them.  Anything else (in particular HTML,
+# SVG and other types that can run scripts on our domain) is sent as a
+# download.
+INLINE_UPLOAD_TYPES = {
+    'txt': 'text/plain',
+    'gif': 'image/gif',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'tif': 'image/tiff',
+    'tiff': 'image/tiff',
+    'webp': 'image/webp',
+    '3gpp': 'video/3gpp',
+    '3gp': 'video/3gpp',
+    'mp4': 'video/mp4',
+    'mpeg': 'video/mpeg',
+    'mpg': 'video/mpeg',
+    'mov': 'video/quicktime',
+    'webm': 'video/webm',
+    'flv': 'video/x-flv',
+    'm4v': 'video/x-m4v',
+    'mng': 'video/x-mng',
+    'asx': 'video/x-ms-asf',
+    'asf': 'video/x-ms-asf',
+    'wmv': 'video/x-ms-wmv',
+    'avi': 'video/x-msvideo',
+}
+
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def upload_etag(stat_result):
+    # type: (os.stat_result) -> str
+    # The same format as nginx's ETags, so that a file's ETag doesn't
+    # depend on which of them served it.
+    return '"%x-%x"' % (int(stat_result.st_mtime), stat_result.st_size)
+
+def parse_byte_range(header, size):
+    # type: (Optional[str], int) -> Optional[Tuple[int, int]]
+    """Returns the first and last positions of the bytes requested by a
+    Range header, or None if the whole file should be sent (which
+    includes multiple ranges and headers we don't understand, as RFC
+    7233 allows).  The first position is size or more if the range
+    can't be satisfied."""
+    if header is None:
+        return None
+    match = BYTE_RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    (first, last) = match.groups()
+    if first == '':
+        if last == '':
+            return None
+        # A suffix range, for the last bytes of the file.
+        if int(last) == 0:
+            return (size, size)
+        return (max(size - int(last), 0), size - 1)
+    if last != '' and int(last) < int(first):
+        return None
+    if last == '':
+        return (int(first), size - 1)
+    return (int(first), min(int(last), size - 1))
+
+def upload_content_type(filename):
+    # type: (str) -> Optional[str]
+    """Returns the Content-Type to serve an upload inline with, or None if
+    it should only be downloaded."""
+    extension = os.path.splitext(filename)[1][1:].lower()
+    return INLINE_UPLOAD_TYPES.get(extension)
+
+def etag_matches(header, etag):
+    # type: (str, str) -> bool
+    etags = [tag.strip() for tag in header.split(',')]
+    # Only strong ETags can be used with If-Range, but ours are always
+    # strong, so we can just ignore the weak prefix here.
+    return '*' in etags or etag in [tag[2:] if tag.startswith('W/') else tag
+                                    for tag in etags]
+
+class FileRange(object):
+    """A file-like object for reading the next length bytes of f."""
+    def __init__(self, f, length):
+        # type: (IO[bytes], int) -> None
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        # type: () -> None
+        self.f.close()
+
 def serve_local(request, path_id):
     # type: (HttpRequest, str) -> HttpResponse
-    import os
-    import mimetypes
     local_path = get_local_file_path(path_id)
     if local_path is None:
         return HttpResponseNotFound('<p>File not found</p>')
+
+    if settings.LOCAL_UPLOADS_ACCEL_REDIRECT:
+        # We've checked that the user can see the file; have nginx send
+        # it, which also handles conditional and range requests.  nginx
+        # picks the Content-Type, from its list of types that are safe
+        # to serve from our domain.
+        response = HttpResponse()
+        del response['Content-Type']
+        response['X-Accel-Redirect'] = INTERNAL_UPLOADS_LOCATION + \
+            urllib.parse.quote(path_id.encode('utf-8'))
+        response['Cache-Control'] = UPLOAD_CACHE_CONTROL
+        return response
+
+    stat_result = os.stat(local_path)
+    size = stat_result.st_size
+    etag = upload_etag(stat_result)
+    validators = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat_result.st_mtime),
+        'Cache-Control': UPLOAD_CACHE_CONTROL,
+    }
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                              stat_result.st_mtime, size)
+    if not_modified:
+        response = HttpResponseNotModified()
+        for (header, value) in validators.items():
+            response[header] = value
+        return response
+
+    byte_range = parse_byte_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range is not None and if_range is not None and \
+            not etag_matches(if_range, etag) and if_range != validators['Last-Modified']:
+        # The file has changed since the client fetched the part it has.
+        byte_range = None
+
+    if byte_range is not None and byte_range[0] >= size:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % (size,)
+        return response
+
     filename = os.path.basename(local_path)
-    response = FileResponse(open(local_path, 'rb'), content_type = mimetypes.guess_type(filename))
+    content_type = upload_content_type(filename)
+    f = open(local_path, 'rb')
+    if byte_range is None:
+        response = FileResponse(f)
+        response['Content-Length'] = str(size)
+    else:
+        (first, last) = byte_range
+        f.seek(first)
+        response = FileResponse(FileRange(f, last - first + 1), status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Content-Length'] = str(last - first + 1)
+    if content_type is not None:
+        response['Content-Type'] = content_type
+    else:
+        response['Content-Type'] = 'application/octet-stream'
+        response['Content-Disposition'] = 'attachment'
+    # Browsers mustn't second-guess the type, e.g. render text as HTML.
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['Accept-Ranges'] = 'bytes'
+    for (header, value) in validators.items():
+        response[header] = value
     return response
-    response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
 
 @has_request_variables
 def serve_file_backend(request, user_profile, realm_id_str, filename,
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple
+from six import text_type
 
 from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
@@ -7,15 +8,15 @@ from django.core.handlers.base import BaseHandler
 from zerver.models import get_user_profile_by_email, \
     get_user_profile_by_id, get_prereg_user_by_email, get_client
 from zerver.lib.context_managers import lockfile
-from zerver.lib.queue import SimpleQueueClient, queue_json_publish
+from zerver.lib.queue import SimpleQueueClient, queue_json_publish, queue_outbox
 from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.notifications import handle_missedmessage_emails, enqueue_welcome_emails, \
     clear_followup_emails_queue, send_local_email_template_with_delay
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    do_update_user_activities, do_update_user_activity_intervals, do_update_user_presences, \
     internal_send_message, check_send_message, extract_recipients, \
-    handle_push_notification
-from zerver.lib.digest import handle_digest_email
+    handle_push_notification, do_propagate_topic_rename, do_render_link_previews
+from zerver.lib.digest import handle_digest_email, handle_realm_digest_emails
 from zerver.lib.email_mirror import process_message as mirror_email
 from zerver.decorator import JsonableError
 from zerver.lib.socket import req_redis_key
@@ -58,6 +59,9 @@ def get_active_worker_queues():
 
 class QueueProcessingWorker(object):
     queue_name = None # type: str
+    # How many unacknowledged events RabbitMQ may send us at a time;
+    # None means no limit.
+    prefetch_count = None # type: Optional[int]
 
     def __init__(self):
         self.q = None # type: SimpleQueueClient
@@ -69,20 +73,24 @@ class QueueProcessingWorker(object):
 
     def consume_wrapper(self, data):
         try:
-            self.consume(data)
+            with queue_outbox():
+                self.consume(data)
         except Exception:
             self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = u'%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
+            self._save_failed_events([data])
         reset_queries()
 
+    def _save_failed_events(self, events):
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lines = u''.join(u'%s\t%s\n' % (time.asctime(), ujson.dumps(data)) for data in events)
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                f.write(lines.encode('utf-8'))
+
     def _log_problem(self):
         logging.exception("Problem handling data on queue %s" % (self.queue_name,))
 
@@ -90,12 +98,52 @@ class QueueProcessingWorker(object):
         self.q = SimpleQueueClient()
 
     def start(self):
+        if self.prefetch_count is not None:
+            self.q.set_prefetch_count(self.prefetch_count)
         self.q.register_json_consumer(self.queue_name, self.consume_wrapper)
         self.q.start_consuming()
 
     def stop(self):
         self.q.stop_consuming()
 
+class BatchQueueProcessingWorker(QueueProcessingWorker):
+    """A worker that handles its queue's events in batches: consume_batch
+    is called with up to max_batch_size events at a time, as soon as
+    that many have arrived or max_batch_wait_ms after the first one did.
+    This is for workers whose events are cheaper to write to the
+    database together, e.g. because many of them update the same rows.
+    Unless prefetch_count is set, RabbitMQ may send us up to two
+    batches' worth of events ahead, so the next batch is ready when
+    we finish writing one."""
+    max_batch_size = 500
+    max_batch_wait_ms = 500
+
+    def consume_batch(self, events):
+        raise WorkerDeclarationException("No batch consumer defined!")
+
+    def consume(self, data):
+        self.consume_batch([data])
+
+    def consume_batch_wrapper(self, events):
+        try:
+            with queue_outbox():
+                self.consume_batch(events)
+        except Exception:
+            self._log_problem()
+            self._save_failed_events(events)
+        reset_queries()
+
+    def start(self):
+        if self.prefetch_count is not None:
+            self.q.set_prefetch_count(self.prefetch_count)
+        else:
+            self.q.set_prefetch_count(2 * self.max_batch_size)
+        self.q.consume_json_batches(self.queue_name, self.consume_batch_wrapper,
+                                    self.max_batch_size, self.max_batch_wait_ms / 1000.0)
+
+    def stop(self):
+        self.q.stop_consuming_batches()
+
 if settings.MAILCHIMP_API_KEY:
     from postmonkey import PostMonkey, MailChimpException
 
@@ -149,30 +197,35 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
                                              sender={'email': settings.ZULIP_ADMINISTRATOR, 'name': 'Zulip'})
 
 @assign_queue('user_activity')
-class UserActivityWorker(QueueProcessingWorker):
-    def consume(self, event):
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
+class UserActivityWorker(BatchQueueProcessingWorker):
+    def consume_batch(self, events):
+        # Most of a batch is the same few users hitting the same few
+        # endpoints, so add up the visits for each (user, client, query).
+        activity_counts = {} # type: Dict[Tuple[int, int, text_type], Tuple[int, datetime.datetime]]
+        for event in events:
+            key = (event["user_profile_id"], get_client(event["client"]).id, event["query"])
+            log_time = timestamp_to_datetime(event["time"])
+            count, last_visit = activity_counts.get(key, (0, log_time))
+            activity_counts[key] = (count + 1, max(last_visit, log_time))
+        do_update_user_activities(activity_counts)
 
 @assign_queue('user_activity_interval')
-class UserActivityIntervalWorker(QueueProcessingWorker):
-    def consume(self, event):
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
+class UserActivityIntervalWorker(BatchQueueProcessingWorker):
+    def consume_batch(self, events):
+        activity_times = defaultdict(list) # type: Dict[int, List[datetime.datetime]]
+        for event in events:
+            activity_times[event["user_profile_id"]].append(timestamp_to_datetime(event["time"]))
+        do_update_user_activity_intervals(activity_times)
 
 @assign_queue('user_presence')
-class UserPresenceWorker(QueueProcessingWorker):
-    def consume(self, event):
-        logging.info("Received event: %s" % (event),)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+class UserPresenceWorker(BatchQueueProcessingWorker):
+    def consume_batch(self, events):
+        logging.info("Received %d presence events" % (len(events),))
+        do_update_user_presences([(get_user_profile_by_id(event["user_profile_id"]),
+                                   get_client(event["client"]),
+                                   timestamp_to_datetime(event["time"]),
+                                   event["status"])
+                                  for event in events])
 
 @assign_queue('missedmessage_emails')
 class MissedMessageWorker(QueueProcessingWorker):
@@ -332,7 +385,30 @@ class DigestWorker(QueueProcessingWorker):
     # management command, not here.
     def consume(self, event):
         logging.info("Received digest event: %s" % (event,))
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+        if "user_profile_ids" in event:
+            handle_realm_digest_emails(event["realm_id"], event["user_profile_ids"],
+                                       event["cutoff"])
+        else:
+            # Queued by an older version of enqueue_digest_emails.
+            handle_digest_email(event["user_profile_id"], event["cutoff"])
+
+@assign_queue('topic_renames')
+class TopicRenameWorker(QueueProcessingWorker):
+    def consume(self, event):
+        count = do_propagate_topic_rename(event["event"], event["recipient_id"])
+        logging.info("Moved %d messages to topic %s" % (count, event["event"]["subject"]))
+
+@assign_queue('link_previews')
+class LinkPreviewWorker(BatchQueueProcessingWorker):
+    # The previews for a batch of messages are fetched in parallel, with
+    # a limit on the requests to each domain; see zerver.lib.unfurl.
+    max_batch_size = 50
+    max_batch_wait_ms = 100
+
+    def consume_batch(self, events):
+        updated = do_render_link_previews(events)
+        logging.info("Fetched link previews for %d messages; updated %d" % (
+            len(events), len(updated)))
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Set
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from six import text_type
+
+from zerver.lib.alert_words import AlertWordAutomaton
+
+import random
+import re
+import six
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark matching a message against a realm's alert words.
+
+Builds synthetic alert words for the requested number of users and
+times finding the users alerted by each of a set of messages, both
+with the old approach of one regular expression per alert word and
+with the per-realm AlertWordAutomaton that bugdown now uses.  This
+doesn't touch the database, so it can be run anywhere the Django
+settings load.
+
+Usage: python manage.py benchmark_alert_words --users 2000 --words 10"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, default=2000,
+                            help='Number of users in the realm with alert words.')
+        parser.add_argument('--words', dest='words', type=int, default=10,
+                            help='Number of alert words per user.')
+        parser.add_argument('--messages', dest='messages', type=int, default=20,
+                            help='Number of messages to match.')
+
+    def make_word(self):
+        # type: () -> text_type
+        return u''.join(random.choice(u'abcdefghijklmnopqrstuvwxyz')
+                        for _ in range(random.randint(4, 10)))
+
+    def match_with_regexes(self, realm_words, content):
+        # type: (Dict[int, List[text_type]], text_type) -> Set[int]
+        # The approach bugdown used before AlertWordAutomaton.
+        content = content.lower()
+        allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+        allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+        user_ids = set() # type: Set[int]
+        for user_id, words in six.iteritems(realm_words):
+            for word in words:
+                match_re = re.compile(u'(?:%s)%s(?:%s)' % (allowed_before_punctuation,
+                                                           re.escape(word.lower()),
+                                                           allowed_after_punctuation))
+                if re.search(match_re, content):
+                    user_ids.add(user_id)
+        return user_ids
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        random.seed(0)
+        realm_words = dict((user_id, [self.make_word() for _ in range(options['words'])])
+                           for user_id in range(options['users']))
+        all_words = [word for words in realm_words.values() for word in words]
+        messages = [u' '.join(random.choice(all_words) if random.random() < 0.05
+                              else self.make_word() for _ in range(50))
+                    for _ in range(options['messages'])]
+
+        start = time.time()
+        old_results = [self.match_with_regexes(realm_words, content) for content in messages]
+        old_time = (time.time() - start) / len(messages)
+
+        start = time.time()
+        automaton = AlertWordAutomaton(realm_words)
+        build_time = time.time() - start
+        start = time.time()
+        new_results = [automaton.user_ids_alerted(content) for content in messages]
+        new_time = (time.time() - start) / len(messages)
+
+        assert old_results == new_results
+        print("%d users x %d alert words, %d messages" % (
+            options['users'], options['words'], len(messages)))
+        print("per-word regexes: %9.3f ms/message" % (1000 * old_time,))
+        print("automaton:        %9.3f ms/message  (built once in %.1f ms)" % (
+            1000 * new_time, 1000 * build_time))
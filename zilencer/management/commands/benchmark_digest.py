@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, List
+from six import text_type
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib import digest
+from zerver.lib.actions import update_stream_subscriber_counts
+from zerver.lib.bulk_create import bulk_create_users
+from zerver.models import Realm, Recipient, Stream, Subscription, UserProfile, get_realm
+
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark generating digest emails for a whole realm.
+
+Generates (but doesn't send) the digests for the first --users active
+users of the realm, first all together as the digest_emails queue
+worker does, and then one user at a time for a sample of them.  If the
+realm doesn't have that many users, synthetic users subscribed to all
+of its streams are created first, so only run this against a
+development database.
+
+Usage: python manage.py benchmark_digest --domain zulip.com --users 10000 --days 7"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--domain', dest='domain', type=str, default='zulip.com',
+                            help='The domain of the realm to generate digests for.')
+        parser.add_argument('--users', dest='users', type=int, default=10000,
+                            help='Number of users to generate digests for.')
+        parser.add_argument('--days', dest='days', type=int, default=7,
+                            help='Number of days of traffic to include in the digests.')
+        parser.add_argument('--sample', dest='sample', type=int, default=100,
+                            help='Number of users to generate digests for one at a time.')
+
+    def create_users(self, realm, num_users):
+        # type: (Realm, int) -> None
+        bulk_create_users({realm.domain: realm},
+                          set((u"digest-bench-%d@%s" % (n, realm.domain),
+                               u"Digest Bench %d" % (n,), u"digest-bench-%d" % (n,), True)
+                              for n in range(num_users)))
+        new_user_ids = UserProfile.objects.filter(
+            realm=realm, email__startswith="digest-bench-").exclude(
+            subscription__recipient__type=Recipient.STREAM).values_list('id', flat=True)
+        stream_recipients = Recipient.objects.filter(
+            type=Recipient.STREAM, type_id__in=Stream.objects.filter(realm=realm).values('id'))
+        Subscription.objects.bulk_create(
+            [Subscription(user_profile_id=user_profile_id, recipient=recipient)
+             for user_profile_id in new_user_ids for recipient in stream_recipients])
+        update_stream_subscriber_counts([recipient.type_id for recipient in stream_recipients])
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = get_realm(options['domain'])
+        user_profiles = UserProfile.objects.filter(realm=realm, is_active=True, is_bot=False)
+        if user_profiles.count() < options['users']:
+            self.create_users(realm, options['users'] - user_profiles.count())
+        user_profile_ids = list(user_profiles.order_by('id').values_list(
+                'id', flat=True)[:options['users']]) # type: List[int]
+        cutoff = int(time.time()) - options['days'] * 24 * 60 * 60
+
+        digests = [] # type: List[int]
+        def record_digest(user_profile, html_content, text_content):
+            # type: (UserProfile, text_type, text_type) -> None
+            digests.append(user_profile.id)
+
+        send_digest_email = digest.send_digest_email
+        digest.send_digest_email = record_digest
+        try:
+            start = time.time()
+            digest.handle_realm_digest_emails(realm.id, user_profile_ids, cutoff)
+            elapsed = time.time() - start
+            print("realm batch: %d users, %d digests in %.2fs (%.2f ms/user)" % (
+                len(user_profile_ids), len(digests), elapsed,
+                elapsed * 1000 / len(user_profile_ids)))
+
+            sample = user_profile_ids[:options['sample']]
+            start = time.time()
+            for user_profile_id in sample:
+                digest.handle_digest_email(user_profile_id, cutoff)
+            elapsed = time.time() - start
+            print("one at a time: %d users in %.2fs (%.2f ms/user)" % (
+                len(sample), elapsed, elapsed * 1000 / len(sample)))
+        finally:
+            digest.send_digest_email = send_digest_email
@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict
+
+from argparse import ArgumentParser
+
+from zerver.lib import event_queue
+from zilencer.management.commands import benchmark_process_notification
+
+import gc
+import os
+import resource
+
+def resident_memory():
+    # type: () -> int
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+class Command(benchmark_process_notification.Command):
+    help = """Measure how much memory Tornado's event queues use for messages.
+
+Builds the requested numbers of in-memory event queues (one per
+synthetic user, as benchmark_process_notification does), delivers
+--messages stream messages to all of them, and reports how much the
+process's resident memory grew, both with the event bodies shared by
+all the queues (as process_notification stores them) and with a
+separate event dict in each queue.  Each measurement runs in a forked
+process, so that it can't reuse memory freed by the others; this needs
+Linux's /proc.
+
+Usage: python manage.py benchmark_event_queue_memory --clients 10000 50000 --messages 20"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--clients', dest='clients', type=int, nargs='+',
+                            default=[10000, 50000],
+                            help='Numbers of event queues to benchmark with.')
+        parser.add_argument('--messages', dest='messages', type=int, default=20,
+                            help='Number of messages to deliver to every queue.')
+
+    def deliver_copies(self, notice):
+        # type: (Dict[str, Any]) -> None
+        event = notice['event']
+        for user_data in notice['users']:
+            for client in event_queue.get_client_descriptors_for_user(user_data['id']):
+                client.add_event(dict(type='message', message=event['message_dict_markdown'],
+                                      flags=user_data['flags']))
+
+    def measure(self, deliver, num_clients, num_messages):
+        # type: (Callable[[Dict[str, Any]], None], int, int) -> int
+        (read_fd, write_fd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                self.setup_clients(num_clients, 0)
+                notices = [self.make_notice(message_id, num_clients)
+                           for message_id in range(num_messages)]
+                gc.collect()
+                before = resident_memory()
+                for notice in notices:
+                    deliver(notice)
+                gc.collect()
+                os.write(write_fd, str(resident_memory() - before).encode('ascii'))
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        result = os.read(read_fd, 64)
+        os.close(read_fd)
+        return int(result)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        num_messages = options['messages']
+        for num_clients in options['clients']:
+            shared = self.measure(event_queue.process_notification, num_clients, num_messages)
+            copied = self.measure(self.deliver_copies, num_clients, num_messages)
+            num_events = num_clients * num_messages
+            print("%7d clients: shared bodies %7.1f MB (%5.0f bytes/event), "
+                  "copied events %7.1f MB (%5.0f bytes/event)" % (
+                      num_clients,
+                      shared / 1024.0 / 1024, float(shared) / num_events,
+                      copied / 1024.0 / 1024, float(copied) / num_events))
@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib import event_queue
+from zerver.lib.event_queue import ClientDescriptor, EventQueue, InternedEvent, \
+    read_event_queue_snapshot, replay_event_queue_journal, \
+    write_event_queue_snapshot
+
+import os
+import shutil
+import tempfile
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark saving and restoring Tornado's event queues.
+
+For each requested number of synthetic event queues, writes a snapshot
+and a journal of pushes to a temporary directory, and reports the
+snapshot size and how long it takes to write the snapshot and to
+restore the queues from the snapshot plus journal, as Tornado does on
+restart.  As in Tornado, each event is sent to all the queues, which
+share its body.
+
+Usage: python manage.py benchmark_event_queue_persistence --queues 10000 50000 100000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--queues', dest='queues', type=int, nargs='+',
+                            default=[10000, 50000, 100000],
+                            help='Numbers of event queues to benchmark with.')
+        parser.add_argument('--events', dest='events', type=int, default=5,
+                            help='Number of events in each queue in the snapshot.')
+        parser.add_argument('--journal-events', dest='journal_events', type=int, default=2,
+                            help='Number of events per queue pushed after the snapshot.')
+
+    def make_event(self, n):
+        # type: (int) -> Dict[str, Any]
+        return dict(type='message',
+                    message=dict(id=n, sender_id=1, type='stream', client='website',
+                                 display_recipient='benchmark', subject='benchmark',
+                                 content='benchmark message %d' % (n,)))
+
+    def make_clients(self, num_queues, num_events):
+        # type: (int, int) -> Dict[str, ClientDescriptor]
+        clients = {} # type: Dict[str, ClientDescriptor]
+        events = [InternedEvent(self.make_event(event_num)) for event_num in range(num_events)]
+        for n in range(num_queues):
+            queue = EventQueue('benchmark:%d' % (n,))
+            for event in events:
+                queue.push(event, dict(flags=[]))
+            clients[queue.id] = ClientDescriptor(n, 'user%d@example.com' % (n,), 1, queue,
+                                                 None, 'website')
+        return clients
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        tmp_dir = tempfile.mkdtemp()
+        snapshot_filename = os.path.join(tmp_dir, 'event_queues.json')
+        journal_filename = os.path.join(tmp_dir, 'event_queues.journal')
+        try:
+            for num_queues in options['queues']:
+                clients = self.make_clients(num_queues, options['events'])
+
+                start = time.time()
+                write_event_queue_snapshot(snapshot_filename, 'benchmark', clients)
+                dump_time = time.time() - start
+
+                event_queue.open_event_queue_journal(journal_filename, 'benchmark', truncate=True)
+                try:
+                    for event_num in range(options['journal_events']):
+                        event = InternedEvent(self.make_event(options['events'] + event_num))
+                        for client in clients.values():
+                            client.add_event(event, dict(flags=[]))
+                finally:
+                    event_queue.event_queue_journal.close()
+                    event_queue.event_queue_journal = None
+                    event_queue.event_queue_journal_id = None
+
+                start = time.time()
+                loaded_clients, journal_id = read_event_queue_snapshot(snapshot_filename)
+                load_time = time.time() - start
+                num_records = replay_event_queue_journal(journal_filename, journal_id, loaded_clients)
+                replay_time = time.time() - start - load_time
+
+                print("%7d queues: snapshot %7.1f MB written in %6.2fs, loaded in %6.2fs; "
+                      "journal %7.1f MB (%d entries) replayed in %6.2fs" % (
+                          num_queues, os.path.getsize(snapshot_filename) / 1024.0 / 1024,
+                          dump_time, load_time,
+                          os.path.getsize(journal_filename) / 1024.0 / 1024,
+                          num_records, replay_time))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib import event_queue
+
+import time
+
+class Command(BaseCommand):
+    help = """Micro-benchmark Tornado's message fan-out with synthetic event queues.
+
+Builds the requested number of in-memory event queues (one per
+synthetic user, none of them connected to a handler), then times
+event_queue.process_notification delivering a stream message to all
+of those users.  This doesn't touch the database or the running
+Tornado server, so it can be run anywhere the Django settings load.
+
+Usage: python manage.py benchmark_process_notification --clients 1000 10000 50000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--clients', dest='clients', type=int, nargs='+',
+                            default=[1000, 10000, 50000],
+                            help='Numbers of event queues to benchmark with.')
+        parser.add_argument('--iterations', dest='iterations', type=int, default=10,
+                            help='Number of messages to deliver for each size.')
+        parser.add_argument('--all-public-streams', dest='all_public_streams', type=int,
+                            default=0,
+                            help='How many of the queues should have all_public_streams set.')
+
+    def setup_clients(self, num_clients, num_all_public_streams):
+        # type: (int, int) -> None
+        event_queue.clients = {}
+        event_queue.user_clients = {}
+        event_queue.realm_clients_all_streams = {}
+        for user_profile_id in range(1, num_clients + 1):
+            event_queue.allocate_client_descriptor(
+                dict(user_profile_id=user_profile_id,
+                     user_profile_email='user%d@example.com' % (user_profile_id,),
+                     realm_id=1,
+                     event_types=None,
+                     client_type_name='website',
+                     apply_markdown=True,
+                     all_public_streams=user_profile_id <= num_all_public_streams,
+                     queue_timeout=600,
+                     last_connection_time=time.time(),
+                     narrow=[]))
+
+    def make_notice(self, message_id, num_clients):
+        # type: (int, int) -> Dict[str, Any]
+        message_dict = dict(id=message_id,
+                            sender_id=1,
+                            type='stream',
+                            client='website',
+                            display_recipient='benchmark',
+                            subject='benchmark',
+                            content='benchmark message %d' % (message_id,))
+        event = dict(type='message',
+                     message=message_id,
+                     message_dict_markdown=message_dict,
+                     message_dict_no_markdown=message_dict,
+                     presences={},
+                     realm_id=1,
+                     stream_name='benchmark')
+        users = [{'id': user_profile_id, 'flags': [], 'always_push_notify': False}
+                 for user_profile_id in range(1, num_clients + 1)] # type: List[Dict[str, Any]]
+        return dict(event=event, users=users)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        saved_state = (event_queue.clients, event_queue.user_clients,
+                       event_queue.realm_clients_all_streams)
+        try:
+            for num_clients in options['clients']:
+                self.setup_clients(num_clients, options['all_public_streams'])
+                notices = [self.make_notice(message_id, num_clients)
+                           for message_id in range(options['iterations'])]
+
+                start = time.time()
+                for notice in notices:
+                    event_queue.process_notification(notice)
+                elapsed = time.time() - start
+
+                per_message = elapsed / options['iterations']
+                print("%7d clients: %8.2f ms/message  %6.2f us/client" % (
+                    num_clients, 1000 * per_message, 1000000 * per_message / num_clients))
+        finally:
+            (event_queue.clients, event_queue.user_clients,
+             event_queue.realm_clients_all_streams) = saved_state
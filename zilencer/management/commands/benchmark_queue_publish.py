@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib import queue
+
+import threading
+import time
+import ujson
+
+BENCHMARK_QUEUE = 'benchmark_queue_publish'
+
+class StubChannel(object):
+    """Mimics the parts of pika's BlockingChannel that zerver.lib.queue
+    uses.  Methods that wait for a reply from the broker sleep for the
+    round trip time, and publishing sleeps for the time it takes to
+    write a message to the socket."""
+    round_trip_time = 0.0
+    write_time = 0.0
+
+    def __init__(self):
+        # type: () -> None
+        self.confirming = False
+
+    def queue_declare(self, queue, durable=False):
+        # type: (str, bool) -> None
+        time.sleep(self.round_trip_time)
+
+    def queue_delete(self, queue):
+        # type: (str) -> None
+        time.sleep(self.round_trip_time)
+
+    def confirm_delivery(self):
+        # type: () -> None
+        time.sleep(self.round_trip_time)
+        self.confirming = True
+
+    def tx_select(self):
+        # type: () -> None
+        time.sleep(self.round_trip_time)
+
+    def tx_commit(self):
+        # type: () -> None
+        time.sleep(self.round_trip_time)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        # type: (str, str, str, Any) -> bool
+        time.sleep(self.write_time)
+        if self.confirming:
+            time.sleep(self.round_trip_time)
+        return True
+
+class StubConnection(object):
+    def __init__(self, parameters):
+        # type: (Any) -> None
+        self.is_open = True
+
+    def channel(self):
+        # type: () -> StubChannel
+        return StubChannel()
+
+    def close(self):
+        # type: () -> None
+        self.is_open = False
+
+class Command(BaseCommand):
+    help = """Benchmark publishing events to RabbitMQ.
+
+Publishes the same events from several threads in three ways: one
+client shared behind a lock without confirmations (how we used to
+publish), the same with publisher confirms for every message, and a
+QueuePublisher per thread that publishes outboxes of --batch-size
+events in a transaction each.  With --stub, pika's BlockingConnection
+is replaced by an in-process stub with a simulated round trip time;
+otherwise this publishes to (and then deletes) a queue on the local
+RabbitMQ server.
+
+Usage: python manage.py benchmark_queue_publish --stub --events 20000 --threads 4 --batch-size 10"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--events', dest='events', type=int, default=20000,
+                            help='Total number of events to publish.')
+        parser.add_argument('--threads', dest='threads', type=int, default=4,
+                            help='Number of threads publishing events.')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=10,
+                            help='Number of events per outbox, like the events of a request.')
+        parser.add_argument('--stub', dest='stub', action='store_true', default=False,
+                            help='Publish to an in-process stub instead of RabbitMQ.')
+        parser.add_argument('--round-trip-ms', dest='round_trip_ms', type=float, default=0.2,
+                            help='Simulated round trip time to the broker with --stub.')
+        parser.add_argument('--write-us', dest='write_us', type=float, default=20,
+                            help='Simulated time to write a message with --stub.')
+
+    def run_threads(self, num_threads, target):
+        # type: (int, Callable[[int], None]) -> float
+        threads = [threading.Thread(target=target, args=(n,)) for n in range(num_threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def benchmark_shared_client(self, events_per_thread, num_threads, confirm):
+        # type: (int, int, bool) -> float
+        client = queue.SimpleQueueClient()
+        if confirm:
+            client.channel.confirm_delivery()
+        lock = threading.RLock()
+        event = dict(type='benchmark', data='x' * 200)
+
+        def publish(thread_num):
+            # type: (int) -> None
+            for i in range(events_per_thread):
+                with lock:
+                    client.json_publish(BENCHMARK_QUEUE, event)
+        try:
+            return self.run_threads(num_threads, publish)
+        finally:
+            client.close()
+
+    def benchmark_publishers(self, events_per_thread, num_threads, batch_size):
+        # type: (int, int, int) -> float
+        publishers = [] # type: List[queue.QueuePublisher]
+        body = ujson.dumps(dict(type='benchmark', data='x' * 200))
+
+        def publish(thread_num):
+            # type: (int) -> None
+            publisher = queue.QueuePublisher()
+            publishers.append(publisher)
+            for i in range(0, events_per_thread, batch_size):
+                publisher.open_outbox()
+                for j in range(min(batch_size, events_per_thread - i)):
+                    publisher.publish(BENCHMARK_QUEUE, body)
+                publisher.close_outbox()
+        try:
+            return self.run_threads(num_threads, publish)
+        finally:
+            for publisher in publishers:
+                if publisher.client is not None:
+                    publisher.client.close()
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        num_threads = options['threads']
+        events_per_thread = options['events'] // num_threads
+        num_events = events_per_thread * num_threads
+
+        real_connection = queue.pika.BlockingConnection
+        if options['stub']:
+            StubChannel.round_trip_time = options['round_trip_ms'] / 1000.0
+            StubChannel.write_time = options['write_us'] / 1000000.0
+            queue.pika.BlockingConnection = StubConnection
+        try:
+            results = [
+                ("shared, unconfirmed",
+                 self.benchmark_shared_client(events_per_thread, num_threads, False)),
+                ("shared, confirmed",
+                 self.benchmark_shared_client(events_per_thread, num_threads, True)),
+                ("per-thread batches",
+                 self.benchmark_publishers(events_per_thread, num_threads,
+                                           options['batch_size'])),
+            ]
+            for name, elapsed in results:
+                print("%-20s %8.0f events/s" % (name, num_events / elapsed))
+        finally:
+            client = queue.SimpleQueueClient()
+            client.channel.queue_delete(queue=BENCHMARK_QUEUE)
+            client.close()
+            queue.pika.BlockingConnection = real_connection
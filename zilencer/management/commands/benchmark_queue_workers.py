@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.models import UserPresence, UserProfile, get_realm
+from zerver.worker import queue_processors
+
+import random
+import time
+
+CLIENTS = ['website', 'ZulipAndroid', 'ZulipiOS']
+QUERIES = ['get_events_backend', 'update_active_status_backend', 'send_message_backend',
+           'update_pointer_backend', 'get_old_messages_backend']
+
+class Command(BaseCommand):
+    help = """Benchmark the user activity and presence queue workers.
+
+Generates the events that clients produce while --users users of the
+realm poll for events and report their presence, and feeds them to the
+user_activity, user_activity_interval and user_presence workers, first
+one event at a time (as the workers consumed them before they handled
+batches) and then in batches of the worker's max_batch_size.  This
+measures the workers' database writes, not RabbitMQ; the events update
+the users' real activity and presence rows, so only run this against a
+development database.
+
+Usage: python manage.py benchmark_queue_workers --domain zulip.com --users 100 --events 10000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--domain', dest='domain', type=str, default='zulip.com',
+                            help='The domain of the realm whose users generate events.')
+        parser.add_argument('--users', dest='users', type=int, default=100,
+                            help='Number of users generating events.')
+        parser.add_argument('--events', dest='events', type=int, default=10000,
+                            help='Number of events to send each worker.')
+
+    def make_events(self, queue_name, user_profile_ids, num_events, start_time):
+        # type: (str, List[int], int, float) -> List[Dict[str, Any]]
+        events = [] # type: List[Dict[str, Any]]
+        for i in range(num_events):
+            event = dict(user_profile_id=random.choice(user_profile_ids),
+                         time=start_time + i * 0.01) # type: Dict[str, Any]
+            if queue_name in ('user_activity', 'user_presence'):
+                event['client'] = random.choice(CLIENTS)
+            if queue_name == 'user_activity':
+                event['query'] = random.choice(QUERIES)
+            if queue_name == 'user_presence':
+                event['status'] = random.choice([UserPresence.ACTIVE, UserPresence.IDLE])
+            events.append(event)
+        return events
+
+    def time_calls(self, args, function):
+        # type: (List[Any], Callable[[Any], None]) -> float
+        start = time.time()
+        for arg in args:
+            function(arg)
+        return time.time() - start
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = get_realm(options['domain'])
+        user_profile_ids = list(UserProfile.objects.filter(
+            realm=realm, is_active=True).order_by('id').values_list(
+            'id', flat=True)[:options['users']])
+
+        for queue_name in ['user_activity', 'user_activity_interval', 'user_presence']:
+            worker = queue_processors.get_worker(queue_name)
+            num_events = options['events']
+            # The events of the second run come after those of the first,
+            # as they would if the worker had been running all along.
+            start_time = time.time()
+            events = self.make_events(queue_name, user_profile_ids, num_events, start_time)
+            one_at_a_time = self.time_calls(events, worker.consume_wrapper)
+
+            batch_size = worker.max_batch_size
+            events = self.make_events(queue_name, user_profile_ids, num_events,
+                                      start_time + num_events * 0.01)
+            batches = [events[i:i + batch_size] for i in range(0, num_events, batch_size)]
+            batched = self.time_calls(batches, worker.consume_batch_wrapper)
+            print("%-25s %8.0f events/s one at a time  %8.0f events/s in batches of %d" % (
+                queue_name, num_events / one_at_a_time, num_events / batched, batch_size))
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, List
+
+from argparse import ArgumentParser
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from zerver.lib import rate_limiter
+from zerver.models import UserProfile
+
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark the rate limiter algorithms against the local Redis server.
+
+Runs the same stream of rate-limited requests from a set of synthetic
+users through each RATE_LIMITING_ALGORITHM and reports the requests
+per second and the memory Redis uses for the rate limiter's keys.
+This only touches the synthetic users' keys, but only run it against
+a development Redis server.
+
+Usage: python manage.py benchmark_rate_limiter --users 1000 --requests 20000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, default=1000,
+                            help='Number of synthetic users making requests.')
+        parser.add_argument('--requests', dest='requests', type=int, default=20000,
+                            help='Total number of requests to make.')
+
+    def used_memory(self):
+        # type: () -> int
+        return int(rate_limiter.client.info('memory')['used_memory'])
+
+    def run_algorithm(self, algorithm, users, num_requests):
+        # type: (str, List[UserProfile], int) -> None
+        for user in users:
+            rate_limiter.clear_user_history(user)
+        settings.RATE_LIMITING_ALGORITHM = algorithm
+        memory_before = self.used_memory()
+
+        start = time.time()
+        limited = 0
+        for i in range(num_requests):
+            ratelimited, _, _ = rate_limiter.rate_limit_request(users[i % len(users)])
+            limited += ratelimited
+        elapsed = time.time() - start
+
+        print("%-15s %8.0f requests/s  %7.1f bytes/user  (%d limited)" % (
+            algorithm, num_requests / elapsed,
+            (self.used_memory() - memory_before) / float(len(users)), limited))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        # Synthetic users are never saved; the rate limiter only needs ids.
+        users = [UserProfile(id=10000000 + i, rate_limits="") for i in range(options['users'])]
+        saved_algorithm = settings.RATE_LIMITING_ALGORITHM
+        try:
+            for algorithm in ['sliding_window', 'gcra']:
+                self.run_algorithm(algorithm, users, options['requests'])
+        finally:
+            settings.RATE_LIMITING_ALGORITHM = saved_algorithm
+            for user in users:
+                rate_limiter.clear_user_history(user)
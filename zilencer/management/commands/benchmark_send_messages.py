@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Optional
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib.actions import do_send_messages, internal_prep_message
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import get_user_profile_by_email
+
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark do_send_messages on a batch of stream messages.
+
+Sends the same set of stream messages twice: once as a single batch
+passed to do_send_messages, and once with one do_send_messages call
+per message, and reports the number of database queries and the wall
+time for each.  Only run this against a development database.
+
+Usage: python manage.py benchmark_send_messages --count 1000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--count', dest='count', type=int, default=1000,
+                            help='Number of messages to send in each mode.')
+        parser.add_argument('--sender', dest='sender', type=str,
+                            default='hamlet@zulip.com',
+                            help='Email of the user sending the messages.')
+        parser.add_argument('--stream', dest='stream', type=str, default='Verona',
+                            help='Stream to send the messages to.')
+
+    def prep_messages(self, options):
+        # type: (Dict[str, Any]) -> List[Optional[Dict[str, Any]]]
+        sender = get_user_profile_by_email(options['sender'])
+        return [internal_prep_message(sender.email, 'stream', options['stream'],
+                                      'benchmark', 'benchmark message %d' % (i,))
+                for i in range(options['count'])]
+
+    def run_mode(self, name, options, batched):
+        # type: (str, Dict[str, Any], bool) -> None
+        messages = self.prep_messages(options)
+        start = time.time()
+        with queries_captured() as queries:
+            if batched:
+                do_send_messages(messages)
+            else:
+                for message in messages:
+                    do_send_messages([message])
+        elapsed = time.time() - start
+        print("%-12s %6d messages  %7d queries  %8.3fs  (%.2f ms/message)" % (
+            name, len(messages), len(queries), elapsed, 1000 * elapsed / len(messages)))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        self.run_mode('batched', options, batched=True)
+        self.run_mode('one-by-one', options, batched=False)
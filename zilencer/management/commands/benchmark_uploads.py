@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from zerver.lib.upload import delete_message_image, upload_message_image
+from zerver.models import Attachment, UserProfile, get_user_profile_by_email
+from zilencer.management.commands.benchmark_event_queue_memory import resident_memory
+
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+class Command(BaseCommand):
+    help = """Measure the peak memory use of concurrent file uploads.
+
+Uploads --concurrency copies of a --size MB file at once, from
+separate threads, to the configured upload backend (local storage or
+S3), and reports how much the process's peak resident memory grew and
+how long the uploads took.  It does this twice, each time in a forked
+process: once passing the upload backend the open file, as
+upload_message_image_from_request does, and once passing it the file's
+contents read into memory first.  The uploaded files are deleted
+afterwards.  Only run this against a development server; the
+measurement needs Linux's /proc.
+
+Usage: python manage.py benchmark_uploads --size 25 --concurrency 8"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--size', dest='size', type=int, default=25,
+                            help='Size of each uploaded file, in MB.')
+        parser.add_argument('--concurrency', dest='concurrency', type=int, default=8,
+                            help='Number of files to upload at once.')
+        parser.add_argument('--user', dest='user', type=str, default='hamlet@zulip.com',
+                            help='Email of the user uploading the files.')
+
+    def upload(self, path, user_profile, in_memory, uris):
+        # type: (str, UserProfile, bool, List[str]) -> None
+        try:
+            with open(path, 'rb') as f:
+                file_data = f.read() if in_memory else f
+                uris.append(upload_message_image(u'benchmark.bin', u'application/octet-stream',
+                                                 file_data, user_profile))
+        finally:
+            connection.close()
+
+    def measure(self, path, options, in_memory):
+        # type: (str, Dict[str, Any], bool) -> None
+        pid = os.fork()
+        if pid == 0:
+            try:
+                user_profile = get_user_profile_by_email(options['user'])
+                uris = [] # type: List[str]
+                threads = [threading.Thread(target=self.upload,
+                                            args=(path, user_profile, in_memory, uris))
+                           for i in range(options['concurrency'])]
+
+                before = resident_memory()
+                start = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.time() - start
+                # ru_maxrss is in kilobytes on Linux.
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+                print("%-9s %3d x %4d MB uploads: peak RSS grew %7.1f MB, %7.2fs" % (
+                    'in-memory' if in_memory else 'streamed', options['concurrency'],
+                    options['size'], (peak - before) / 1024.0 / 1024, elapsed))
+
+                for uri in uris:
+                    path_id = uri[len('/user_uploads/'):]
+                    delete_message_image(path_id)
+                    Attachment.objects.filter(path_id=path_id).delete()
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        (fd, path) = tempfile.mkstemp(prefix='benchmark-upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for i in range(options['size']):
+                    f.write(os.urandom(1024 * 1024))
+            # Each forked process opens its own database connections.
+            for conn in connections.all():
+                conn.close()
+            self.measure(path, options, in_memory=False)
+            self.measure(path, options, in_memory=True)
+        finally:
+            os.remove(path)
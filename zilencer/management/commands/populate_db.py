@@ -12,7 +12,7 @@ from zerver.models import Message, UserProfile, Stream, Recipient, Client, \
     split_email_to_domain, email_to_username
 from zerver.lib.actions import do_send_message, set_default_streams, \
     do_activate_user, do_deactivate_user, do_change_password, do_change_is_admin,\
-    do_change_bot_type
+    do_change_bot_type, update_stream_subscriber_counts
 from zerver.lib.parallel import run_parallel
 from django.db.models import Count
 from django.conf import settings
@@ -258,6 +258,9 @@ class Command(BaseCommand):
                     ]
                 create_users(realms, internal_zulip_users_nosubs, bot_type=UserProfile.DEFAULT_BOT)
 
+            # We created the subscriptions directly, so count them.
+            update_stream_subscriber_counts()
+
             # Mark all messages as read
             UserMessage.objects.all().update(flags=UserMessage.flags.read)
 
@@ -687,6 +690,7 @@ def restore_saved_messages():
     for (sub_tuple, active) in subscriptions_to_change:
         current_subs_obj[sub_tuple].active = active
         current_subs_obj[sub_tuple].save(update_fields=["active"])
+    update_stream_subscriber_counts()
 
     subs = {} # type: Dict[Tuple[int, int], Subscription]
     for sub in Subscription.objects.all():
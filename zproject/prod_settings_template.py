@@ -120,6 +120,14 @@ ERROR_REPORTING = True
 # a link to an image is referenced in a message.
 INLINE_IMAGE_PREVIEW = True
 
+# By default, each Django process renders markdown in a background
+# thread, giving up after 5 seconds.  To instead render in a pool of
+# worker processes (per Django process), each of which gives up on a
+# message after BUGDOWN_RENDERING_CPU_LIMIT seconds of CPU time, set
+# this to the number of workers.
+#BUGDOWN_RENDERING_PROCESSES = 2
+#BUGDOWN_RENDERING_CPU_LIMIT = 5
+
 # By default, files uploaded by users and user avatars are stored
 # directly on the Zulip server.  If file storage in Amazon S3 is
 # desired, you can configure that as follows:
@@ -131,11 +139,16 @@ INLINE_IMAGE_PREVIEW = True
 # Then restart Zulip (scripts/restart-zulip).
 #
 # (2) Edit /etc/nginx/sites-available/zulip-enterprise to comment out
-# the nginx configuration for /user_uploads and /user_avatars (see
+# the nginx configuration for /user_avatars (see
 # https://github.com/zulip/zulip/issues/291 for discussion of a better
 # solution that won't be automatically reverted by the Zulip upgrade
 # script), and then restart nginx.
 LOCAL_UPLOADS_DIR = "/home/zulip/var/uploads"
+# Once Django has checked that a user may see a file uploaded to
+# LOCAL_UPLOADS_DIR, nginx sends it (via the /internal/uploads location
+# in the nginx configuration), rather than a Django process.  Only set
+# this to False if you serve Zulip without that nginx configuration.
+#LOCAL_UPLOADS_ACCEL_REDIRECT = True
 #S3_AUTH_UPLOADS_BUCKET = ""
 #S3_AVATAR_BUCKET = ""
 
@@ -327,6 +340,19 @@ CAMO_URI = '/external_content/'
 # Format HOST:PORT
 # MEMCACHED_LOCATION = 127.0.0.1:11211
 
+# Frequently read objects can also be cached in each server process,
+# in front of memcached.  List the families of cache keys to cache
+# locally (the part of the key before the first ':'), each with the
+# maximum number of entries to keep and how many seconds to keep
+# them for.  Processes use Redis to tell each other about changes.
+# LOCAL_CACHE_KEY_FAMILIES = {
+#     'user_profile_by_id': {'max_size': 10000, 'ttl': 60},
+#     'user_profile_by_email': {'max_size': 10000, 'ttl': 60},
+#     'stream_by_realm_and_name': {'max_size': 10000, 'ttl': 60},
+#     'get_client': {'max_size': 1000, 'ttl': 3600},
+#     'get_recipient': {'max_size': 10000, 'ttl': 3600},
+# }
+
 # Redis configuration
 #
 # By default, Zulip connects to redis running locally on the machine,
@@ -338,3 +364,8 @@ CAMO_URI = '/external_content/'
 
 # Controls whether Zulip will rate-limit user requests.
 # RATE_LIMITING = True
+# The default rate limiter keeps a list and a sorted set of recent
+# request times per user in Redis.  The 'gcra' rate limiter instead
+# checks and records each request with a single Redis script call,
+# storing one timestamp per rule per user.
+# RATE_LIMITING_ALGORITHM = 'gcra'
@@ -111,6 +111,7 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'S3_BUCKET': '',
                     'S3_AVATAR_BUCKET': '',
                     'LOCAL_UPLOADS_DIR': None,
+                    'LOCAL_UPLOADS_ACCEL_REDIRECT': not DEVELOPMENT,
                     'MAX_FILE_UPLOAD_SIZE': 25,
                     'ERROR_REPORTING': True,
                     'STAGING_ERROR_NOTIFICATIONS': False,
@@ -121,7 +122,9 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'RABBITMQ_HOST': 'localhost',
                     'RABBITMQ_USERNAME': 'zulip',
                     'MEMCACHED_LOCATION': '127.0.0.1:11211',
+                    'LOCAL_CACHE_KEY_FAMILIES': {},
                     'RATE_LIMITING': True,
+                    'RATE_LIMITING_ALGORITHM': 'sliding_window',
                     'REDIS_HOST': '127.0.0.1',
                     'REDIS_PORT': 6379,
                     # The following bots only exist in non-VOYAGER installs
@@ -138,6 +141,8 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'ADMINS': '',
                     'SHARE_THE_LOVE': False,
                     'INLINE_IMAGE_PREVIEW': True,
+                    'BUGDOWN_RENDERING_PROCESSES': 0,
+                    'BUGDOWN_RENDERING_CPU_LIMIT': 5,
                     'CAMO_URI': '',
                     'ENABLE_FEEDBACK': PRODUCTION,
                     'FEEDBACK_EMAIL': None,
@@ -281,7 +286,10 @@ TEMPLATES = [
 ]
 
 MIDDLEWARE_CLASSES = (
-    # Our logging middleware should be the first middleware item.
+    # This publishes the queue events from the other middleware, so
+    # it should come first.
+    'zerver.middleware.QueueOutboxMiddleware',
+    # Our logging middleware should be the first middleware item after that.
     'zerver.middleware.TagRequests',
     'zerver.middleware.LogRequests',
     'zerver.middleware.JsonErrorHandler',
@@ -327,6 +335,14 @@ ZILENCER_ENABLED = 'zilencer' in INSTALLED_APPS
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
 
+# To spread event queues over several Tornado processes, list the base
+# URLs of all of them here (the first one should be TORNADO_SERVER).
+# Each user's event queues then live on the process picked by
+# TORNADO_SHARD_ROUTER, a function of the user id and the number of
+# processes.  See docs/architecture-overview.md for the nginx side.
+TORNADO_SERVERS = []
+TORNADO_SHARD_ROUTER = 'zerver.lib.event_queue.shard_by_user_id'
+
 ########################################################################
 # DATABASE CONFIGURATION
 ########################################################################
@@ -796,6 +812,7 @@ ZULIP_PATHS = [
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.pickle"),
     ("JSON_PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.json"),
+    ("JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME", "/home/zulip/tornado/event_queues.journal"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email-mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),
     ("LDAP_SYNC_LOG_PATH", "/var/log/zulip/sync_ldap_user_data.log"),
@@ -815,8 +832,8 @@ for (var, path) in ZULIP_PATHS:
     if DEVELOPMENT:
         # if DEVELOPMENT, store these files in the Zulip checkout
         path = os.path.join(DEVELOPMENT_LOG_DIRECTORY, os.path.basename(path))
-        # only `JSON_PERSISTENT_QUEUE_FILENAME` will be stored in `var`
-        if var == 'JSON_PERSISTENT_QUEUE_FILENAME':
+        # only the persistent event queue files will be stored in `var`
+        if var in ('JSON_PERSISTENT_QUEUE_FILENAME', 'JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME'):
             path = os.path.join(os.path.join(DEPLOY_ROOT, 'var'), os.path.basename(path))
     vars()[var] = path
 
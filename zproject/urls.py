@@ -157,6 +157,8 @@ v1_api_and_json_patterns = [
         {'GET': 'zerver.views.messages.get_old_messages_backend',
          'PATCH': 'zerver.views.messages.update_message_backend',
          'POST': 'zerver.views.messages.send_message_backend'}),
+    url(r'^messages/bulk$', 'zerver.lib.rest.rest_dispatch',
+        {'POST': 'zerver.views.messages.send_messages_backend'}),
     url(r'^messages/render$', 'zerver.lib.rest.rest_dispatch',
         {'GET': 'zerver.views.messages.render_message_backend'}),
     url(r'^messages/flags$', 'zerver.lib.rest.rest_dispatch',